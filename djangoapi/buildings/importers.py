@@ -0,0 +1,8 @@
+from core.myLib.geoBulkImporter import GeoBulkImporter
+from .models import Buildings
+
+class BuildingsBulkImporter(GeoBulkImporter):
+    model = Buildings
+    properties = ['description'] #fields read from the properties of the features
+    check_st_relation = True #if true it will chck the relation of the geometry with the other geometries
+    matrix9IM = 'T********' #matrix 9IM for the relation of the geometries: 'T********' = interiors intersects
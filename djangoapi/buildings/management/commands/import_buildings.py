@@ -0,0 +1,44 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.myLib.geojsonStream import GeojsonStreamReader
+from buildings.importers import BuildingsBulkImporter
+
+class Command(BaseCommand):
+    """
+    Imports buildings from a GeoJSON FeatureCollection, or a newline-delimited
+    GeoJSON file, with the BuildingsBulkImporter. The file is read as a stream.
+
+    Usage:
+        python manage.py import_buildings buildings.geojson --report report.ndjson
+        cat buildings.ndjson | python manage.py import_buildings -
+    """
+    help = 'Imports buildings in bulk from GeoJSON or newline-delimited GeoJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="GeoJSON file. '-' to read from stdin")
+        parser.add_argument('--report', default=None,
+                            help='File for the report, one JSON line per feature. Only the summary is shown if not given')
+
+    def handle(self, *args, **options):
+        importer=BuildingsBulkImporter()
+        if options['path']=='-':
+            stream=sys.stdin.buffer
+        else:
+            stream=open(options['path'], 'rb')
+        try:
+            importer.run(GeojsonStreamReader(stream))
+        except ValueError as e:
+            raise CommandError(f'Wrong GeoJSON: {e}')
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                f.writelines(importer.iter_report_ndjson())
+        else:
+            importer.drop_staging_table()
+        self.stdout.write(self.style.SUCCESS(
+            f'Buildings accepted: {importer.accepted}. Rejected: {importer.rejected}'))
@@ -5,8 +5,14 @@ from djangoapi.settings import EPSG_FOR_GEOMETRIES
 class Buildings(models.Model):
     id = models.AutoField(primary_key=True)
     description = models.CharField(max_length=100, blank=True, null=True)
-    area = models.FloatField(blank=True, null=True)
     geom = gis_models.PolygonField(srid=int(EPSG_FOR_GEOMETRIES), blank=True, null=True)
+    #Computed by the database from the stored geometry, with a trigger (core/myLib/derivedGeometry.py).
+    #The values set by Django are overwritten. After a save, use refresh_derived_fields(instance)
+    area = models.FloatField(blank=True, null=True, db_index=True)
+    perimeter = models.FloatField(blank=True, null=True, db_index=True)
+    bbox = gis_models.PolygonField(srid=int(EPSG_FOR_GEOMETRIES), blank=True, null=True)#spatial index
+    centroid = gis_models.PointField(srid=int(EPSG_FOR_GEOMETRIES), blank=True, null=True)#spatial index
+    derived_geometry_fields = ['area', 'perimeter', 'bbox', 'centroid']
 #    def __str__(self):
 #        return str(self.id)
 
@@ -1,3 +1,4 @@
+import logging
 
 from django.db import connection
 
@@ -6,6 +7,8 @@ from rest_framework import serializers
 from core.myLib.geoModelSerializer import GeoModelSerializer
 from .models import Buildings, Owners
 
+logger=logging.getLogger(__name__)
+
 class BuildingsSerializer(GeoModelSerializer):
     check_geometry_is_valid = True #if true ºit will check if the geometry is valid: not self-intersecting and closed
     check_st_relation = True #if true it will chck the relation of the geometry with the other geometries
@@ -18,16 +21,17 @@ class BuildingsSerializer(GeoModelSerializer):
 
     class Meta:
         model = Buildings
-        fields = GeoModelSerializer.Meta.fields + ['description', 'area'] # The serializer 
+        fields = GeoModelSerializer.Meta.fields + ['description', 'area', 'perimeter'] # The serializer 
                     #assumes that the model has the geometry field \textit{geom}. 
                     # add here the rest of the fields of the model that you want to serialize
                     # and that are not in the GeoModelSerializer
+        read_only_fields = ['area', 'perimeter'] #computed by the database from the geometry
 
     def validate_geom(self, value):
         """Validates if a geometry is valid.
             Do not do anythin special. Simple is an example of how to override the father method
         """
-        print('validate_geom, child')
+        logger.debug('validate_geom, child')
         return super().validate_geom(value)
         
 class OwnersSerializer(serializers.ModelSerializer):
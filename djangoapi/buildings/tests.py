@@ -1,3 +1,526 @@
-from django.test import TestCase
+import json
+import math
+import struct
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client, TestCase, TransactionTestCase
+from django.contrib.gis.geos import GEOSGeometry
+
+from core.myLib.asyncDb import close_async_pool
+from core.myLib.asyncGeometryTools import AsyncGeometryValidation
+from core.myLib.geoModelSerializer import GeoModelSerializer2
+from core.myLib.layerCache import layer_cache
+from core.myLib.geometryTools import GeometryValidation
+from core.myLib.derivedGeometry import backfill_derived_geometry, install_derived_geometry_trigger
+from core.myLib.objectCache import object_cache
+from core.myLib.layerVersion import get_layer_version, install_layer_version_triggers
+from core.myLib.spatialFilters import annotate_geom_encodings
+from core.myLib.vectorTileView import MVT_CONTENT_TYPE
+
+from .models import Buildings
+from .serializers import BuildingsSerializer
+
+class BuildingsSerializerValidationTest(TestCase):
+    def setUp(self):
+        self.building=Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=Buildings.geom.field.srid))
+
+    def test_validate_geom_is_one_query(self):
+        serializer=BuildingsSerializer(data={'geom': 'POLYGON((20 20, 30 20, 30 30, 20 30, 20 20))', 'description': 'b'})
+        with self.assertNumQueries(1):
+            self.assertTrue(serializer.is_valid())
+
+    def test_validate_geom_rejects_intersections(self):
+        serializer=BuildingsSerializer(data={'geom': 'POLYGON((5 5, 15 5, 15 15, 5 15, 5 5))'})
+        with self.assertNumQueries(1):
+            self.assertFalse(serializer.is_valid())
+        self.assertIn('geom', serializer.errors)
+
+    def test_update_does_not_check_itself(self):
+        serializer=BuildingsSerializer(self.building, data={'geom': 'POLYGON((0 0, 11 0, 11 11, 0 11, 0 0))'})
+        self.assertTrue(serializer.is_valid())
+
+
+class BuildingsLayerCacheTest(TestCase):
+    def setUp(self):
+        layer_cache.clear()
+        self.building=Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=Buildings.geom.field.srid))
+
+    def tearDown(self):
+        layer_cache.clear()
+
+    def test_bbox_list_is_cached_and_invalidated(self):
+        url='/buildings/buildings/?bbox=0,0,100,100'
+        self.assertEqual(len(self.client.get(url, HTTP_ACCEPT='application/json').json()), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.client.get(url, HTTP_ACCEPT='application/json').json()), 1)
+        #a building out of the bbox does not invalidate it
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/buildings/buildings/', {'geom': 'POLYGON((500 500, 510 500, 510 510, 500 510, 500 500))'})
+        with self.assertNumQueries(0):
+            self.client.get(url, HTTP_ACCEPT='application/json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/buildings/buildings/', {'geom': 'POLYGON((50 50, 60 50, 60 60, 50 60, 50 50))'})
+        self.assertEqual(len(self.client.get(url, HTTP_ACCEPT='application/json').json()), 2)
+
+
+class Buildings2Serializer(GeoModelSerializer2):
+    class Meta:
+        model = Buildings
+        fields = GeoModelSerializer2.Meta.fields + ['description', 'area']
+
+class BuildingsSerializerEncodingsTest(TestCase):
+    """The serialization of a list must not query or parse the geometries per object"""
+    def setUp(self):
+        layer_cache.clear()
+        srid=Buildings.geom.field.srid
+        Buildings.objects.bulk_create([
+            Buildings(geom=GEOSGeometry(f'POLYGON(({i*20} 0, {i*20+10} 0, {i*20+10} 10, {i*20} 10, {i*20} 0))', srid=srid))
+            for i in range(50)])
+
+    def test_list_is_one_query(self):
+        with self.assertNumQueries(1):
+            response=self.client.get('/buildings/buildings/', HTTP_ACCEPT='application/json')
+        data=response.json()
+        self.assertEqual(len(data), 50)
+        self.assertTrue(data[0]['geom_wkt'].startswith('POLYGON'))
+        self.assertIn('"Polygon"', data[0]['geom_geojson'])
+
+    def test_serializers_use_the_annotations(self):
+        queryset=annotate_geom_encodings(Buildings.objects.order_by('id'))
+        for serializer_class in (BuildingsSerializer, Buildings2Serializer):
+            with self.assertNumQueries(1):
+                data=serializer_class(queryset.all(), many=True).data
+            self.assertEqual(len(data), 50)
+
+    def test_plain_instance_fallback(self):
+        building=Buildings.objects.order_by('id').first()
+        for serializer_class in (BuildingsSerializer, Buildings2Serializer):
+            with self.assertNumQueries(0):
+                data=serializer_class(building).data
+            self.assertEqual(GEOSGeometry(data['geom_wkt'], srid=building.geom.srid), building.geom)
+
+
+class BuildingsBinaryFormatsTest(TestCase):
+    def setUp(self):
+        layer_cache.clear()
+        self.building=Buildings.objects.create(description='b1',
+            geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=Buildings.geom.field.srid))
+
+    def read_records(self, content: bytes)->list:
+        records=[]
+        i=0
+        while i < len(content):
+            n=struct.unpack_from('<I', content, i)[0]
+            props=json.loads(content[i+4:i+4+n])
+            i += 4 + n
+            n=struct.unpack_from('<I', content, i)[0]
+            records.append((props, content[i+4:i+4+n]))
+            i += 4 + n
+        return records
+
+    def test_wkb_by_format_parameter(self):
+        response=self.client.get('/buildings/buildings/?format=wkb')
+        self.assertEqual(response['Content-Type'], 'application/vnd.metatierrascol.wkb-records')
+        records=self.read_records(b''.join(response.streaming_content))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0][0]['id'], self.building.id)
+        self.assertEqual(records[0][0]['description'], 'b1')
+        self.assertTrue(GEOSGeometry(records[0][1]).equals_exact(self.building.geom))
+
+    def test_ewkb_by_accept_header(self):
+        response=self.client.get(f'/buildings/buildings/{self.building.id}/', HTTP_ACCEPT='application/vnd.metatierrascol.ewkb-records')
+        self.assertEqual(response['Content-Type'], 'application/vnd.metatierrascol.ewkb-records')
+        records=self.read_records(b''.join(response.streaming_content))
+        self.assertEqual(GEOSGeometry(records[0][1]), self.building.geom)
+
+    def test_json_is_the_default(self):
+        response=self.client.get('/buildings/buildings/', HTTP_ACCEPT='application/json, application/vnd.metatierrascol.twkb-records;q=0.5')
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+
+class BuildingsLayerVersionTest(TransactionTestCase):
+    """The version is incremented when the writes commit"""
+    def setUp(self):
+        layer_cache.clear()
+        install_layer_version_triggers([Buildings._meta.db_table])
+        self.building=Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=Buildings.geom.field.srid))
+
+    def test_write_bumps_the_version(self):
+        version, _=get_layer_version(Buildings)
+        Buildings.objects.filter(id=self.building.id).update(description='changed')
+        self.assertEqual(get_layer_version(Buildings)[0], version + 1)
+        #one version per transaction, whatever the number of rows and statements
+        with transaction.atomic():
+            Buildings.objects.create(geom=GEOSGeometry('POLYGON((20 0, 30 0, 30 10, 20 10, 20 0))', srid=Buildings.geom.field.srid))
+            Buildings.objects.all().update(description='again')
+            #not before the commit
+            self.assertEqual(get_layer_version(Buildings)[0], version + 1)
+        self.assertEqual(get_layer_version(Buildings)[0], version + 2)
+        Buildings.objects.all().delete()
+        self.assertEqual(get_layer_version(Buildings)[0], version + 3)
+
+    def test_if_none_match_returns_304(self):
+        for url in ('/buildings/buildings/', f'/buildings/buildings/{self.building.id}/'):
+            response=self.client.get(url, HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, 200)
+            etag=response['ETag']
+            #only the version is queried
+            with self.assertNumQueries(1):
+                response=self.client.get(url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            #other representation, other ETag
+            response=self.client.get(url, HTTP_ACCEPT='application/vnd.metatierrascol.twkb-records', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+
+    def test_django_view_if_none_match_returns_304(self):
+        self.client.force_login(User.objects.create_user('etag_user', password='etag_password'))
+        for url in ('/buildings/buildings_view/selectall/', f'/buildings/buildings_view/selectone/{self.building.id}/'):
+            response=self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            response=self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_write_changes_the_etag(self):
+        url='/buildings/buildings/'
+        etag=self.client.get(url, HTTP_ACCEPT='application/json')['ETag']
+        self.client.post(url, {'geom': 'POLYGON((50 50, 60 50, 60 60, 50 60, 50 50))'})
+        response=self.client.get(url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.json()), 2)
+
+    def test_cache_entries_of_an_old_version_are_not_served(self):
+        #a write of other process, whose invalidation this process has not seen: the update
+        #does not invalidate the cache, but it increments the version
+        for url in ('/buildings/buildings/?bbox=0,0,100,100', '/buildings/buildings_view/selectall/?bbox=0,0,100,100'):
+            self.client.force_login(User.objects.get_or_create(username='cache_user')[0])
+            Buildings.objects.update(description='before')
+            etag=self.client.get(url, HTTP_ACCEPT='application/json')['ETag']
+            self.assertEqual(self.client.get(url, HTTP_ACCEPT='application/json')['ETag'], etag)#cached
+            Buildings.objects.update(description='after')
+            response=self.client.get(url, HTTP_ACCEPT='application/json')
+            self.assertNotEqual(response['ETag'], etag)
+            self.assertIn(b'after', response.content)
+            self.assertNotIn(b'before', response.content)
+
+    def test_cached_bbox_list_has_etag(self):
+        url='/buildings/buildings/?bbox=0,0,100,100'
+        etag=self.client.get(url, HTTP_ACCEPT='application/json')['ETag']
+        #served from the layer cache
+        self.assertEqual(self.client.get(url, HTTP_ACCEPT='application/json')['ETag'], etag)
+        response=self.client.get(url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class BuildingsTileViewTest(TestCase):
+    def setUp(self):
+        layer_cache.clear()
+        install_layer_version_triggers([Buildings._meta.db_table])
+        #a square of 0.01 degrees around (1.5, 1.5)
+        geom=GEOSGeometry('POLYGON((1.495 1.495, 1.505 1.495, 1.505 1.505, 1.495 1.505, 1.495 1.495))', srid=4326)
+        geom.transform(Buildings.geom.field.srid)
+        self.building=Buildings.objects.create(description='tile', geom=geom)
+        self.user=User.objects.create_user('tile_user', password='tile_password')
+
+    def get_tile_url(self, z: int, lon: float=1.5, lat: float=1.5)->str:
+        n=2**z
+        x=int((lon + 180)/360*n)
+        y=int((1 - math.asinh(math.tan(math.radians(lat)))/math.pi)/2*n)
+        return f'/buildings/tiles/{z}/{x}/{y}.mvt'
+
+    def test_only_for_logged_in_users(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(self.get_tile_url(14)).status_code, 200)
+        #the tile is in the layer cache now: it is not served to the anonymous users either
+        self.client.logout()
+        self.assertEqual(self.client.get(self.get_tile_url(14)).status_code, 302)
+
+    def test_tile_has_the_features_of_its_extent(self):
+        self.client.force_login(self.user)
+        for z in (0, 8, 14):
+            response=self.client.get(self.get_tile_url(z))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], MVT_CONTENT_TYPE)
+            self.assertIn(b'buildings', response.content)
+            self.assertIn(b'tile', response.content)
+        #other tile, far away
+        response=self.client.get(self.get_tile_url(14, lon=-60, lat=-30))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+
+    def test_invalid_tile(self):
+        self.client.force_login(self.user)
+        for url in ('/buildings/tiles/1/2/0.mvt', '/buildings/tiles/25/0/0.mvt'):
+            self.assertEqual(self.client.get(url).status_code, 400)
+
+    def test_etag(self):
+        self.client.force_login(self.user)
+        response=self.client.get(self.get_tile_url(14))
+        response=self.client.get(self.get_tile_url(14), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class BuildingsObjectCacheTest(TestCase):
+    def setUp(self):
+        object_cache.clear()
+        self.building=Buildings.objects.create(description='b1',
+            geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=Buildings.geom.field.srid))
+        self.url=f'/buildings/buildings/{self.building.id}/'
+
+    def tearDown(self):
+        object_cache.clear()
+
+    def test_retrieve_is_cached_and_invalidated_on_save(self):
+        self.assertEqual(self.client.get(self.url, HTTP_ACCEPT='application/json').json()['description'], 'b1')
+        #only the version of the layer is queried
+        with self.assertNumQueries(1):
+            response=self.client.get(self.url, HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.json()['description'], 'b1')
+        self.building.description='b2'
+        self.building.save()
+        self.assertEqual(self.client.get(self.url, HTTP_ACCEPT='application/json').json()['description'], 'b2')
+
+    def test_raw_update_and_delete_invalidate(self):
+        self.client.get(self.url, HTTP_ACCEPT='application/json')
+        Buildings.objects.filter(id=self.building.id).update(description='raw')
+        object_cache.invalidate_on_commit(Buildings, self.building.id)
+        self.assertEqual(self.client.get(self.url, HTTP_ACCEPT='application/json').json()['description'], 'raw')
+        self.building.delete()
+        self.assertEqual(self.client.get(self.url, HTTP_ACCEPT='application/json').status_code, 404)
+
+
+class BuildingsDerivedGeometryTest(TestCase):
+    def setUp(self):
+        install_derived_geometry_trigger(Buildings)
+        self.srid=Buildings.geom.field.srid
+
+    def test_trigger_computes_the_derived_fields(self):
+        b=Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 5, 0 5, 0 0))', srid=self.srid), area=1)
+        b.refresh_from_db()
+        self.assertAlmostEqual(b.area, 50)
+        self.assertAlmostEqual(b.perimeter, 30)
+        self.assertEqual(b.bbox.extent, (0, 0, 10, 5))
+        self.assertEqual(b.centroid.coords, (5, 2.5))
+        #the raw updates also change them
+        Buildings.objects.filter(id=b.id).update(geom=GEOSGeometry('POLYGON((0 0, 2 0, 2 2, 0 2, 0 0))', srid=self.srid))
+        b.refresh_from_db()
+        self.assertAlmostEqual(b.area, 4)
+        self.assertEqual(Buildings.objects.filter(area__lt=5).count(), 1)
+
+    def test_trigger_only_runs_on_the_updates_of_the_geometry(self):
+        b=Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=self.srid))
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE buildings_buildings DISABLE TRIGGER derived_geometry")
+            cursor.execute("UPDATE buildings_buildings SET area = -1 WHERE id = %s", [b.id])
+            cursor.execute("ALTER TABLE buildings_buildings ENABLE TRIGGER derived_geometry")
+        #the area is not computed again
+        Buildings.objects.filter(id=b.id).update(description='changed')
+        self.assertEqual(Buildings.objects.get(id=b.id).area, -1)
+        #the writes of the derived fields are replaced by the computed values
+        Buildings.objects.filter(id=b.id).update(area=5)
+        self.assertAlmostEqual(Buildings.objects.get(id=b.id).area, 100)
+
+    def test_create_returns_the_area_of_the_database(self):
+        response=self.client.post('/buildings/buildings/', {'geom': 'POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', 'area': 7})
+        self.assertEqual(response.status_code, 201)
+        self.assertAlmostEqual(response.json()['area'], 100)
+        self.assertAlmostEqual(response.json()['perimeter'], 40)
+        response=self.client.get('/buildings/buildings/?area__lt=50', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json(), [])
+
+    def test_backfill(self):
+        b=Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=self.srid))
+        #as a row written before the trigger
+        with connection.cursor() as cursor:
+            cursor.execute("ALTER TABLE buildings_buildings DISABLE TRIGGER derived_geometry")
+            cursor.execute("UPDATE buildings_buildings SET area = NULL WHERE id = %s", [b.id])
+            cursor.execute("ALTER TABLE buildings_buildings ENABLE TRIGGER derived_geometry")
+        self.assertEqual(sum(backfill_derived_geometry(Buildings, batch_size=1, only_missing=True)), 1)
+        b.refresh_from_db()
+        self.assertAlmostEqual(b.area, 100)
+
+
+class BuildingsSpatialLocksTest(TransactionTestCase):
+    """
+    Concurrent creates through the API. The validation is slowed down, so without
+    locks all the writes would pass the relation check before any of them commits
+    """
+    delay = 0.5
+
+    def post_concurrently(self, geoms: list, url: str='/buildings/buildings/', slow_method=(GeometryValidation, 'validate'),
+                          user=None)->list:
+        """Posts the geoms at the same time. slow_method (class, name) sleeps delay after it runs"""
+        cls, name=slow_method
+        original=getattr(cls, name)
+        def slow(*args, **kwargs):
+            result=original(*args, **kwargs)
+            time.sleep(self.delay)#between the check and the write, or the write and the commit
+            return result
+        barrier=threading.Barrier(len(geoms))
+        status_codes=[None]*len(geoms)
+        def post(i):
+            try:
+                client=Client()
+                if user is not None:
+                    client.force_login(user)
+                barrier.wait()
+                status_codes[i]=client.post(url, {'geom': geoms[i]}).status_code
+            finally:
+                connection.close()
+        with mock.patch.object(cls, name, slow):
+            threads=[threading.Thread(target=post, args=(i,)) for i in range(len(geoms))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        return status_codes
+
+    def test_overlapping_writes_are_serialized(self):
+        geoms=[f'POLYGON(({i} 0, {i+10} 0, {i+10} 10, {i} 10, {i} 0))' for i in range(4)]
+        status_codes=self.post_concurrently(geoms)
+        self.assertEqual(sorted(status_codes), [201, 400, 400, 400])
+        self.assertEqual(Buildings.objects.count(), 1)
+
+    def test_far_away_writes_run_in_parallel(self):
+        #each one in other cell of the lock grid
+        geoms=[f'POLYGON(({i*10000} 0, {i*10000+10} 0, {i*10000+10} 10, {i*10000} 10, {i*10000} 0))' for i in range(4)]
+        start=time.perf_counter()
+        status_codes=self.post_concurrently(geoms)
+        elapsed=time.perf_counter() - start
+        self.assertEqual(status_codes, [201]*4)
+        self.assertEqual(Buildings.objects.count(), 4)
+        self.assertLess(elapsed, 2*self.delay)
+
+    def test_far_away_view_inserts_run_in_parallel(self):
+        """
+        The delay is after the save: the writes hold their row locks and their pending version
+        of the layer (core.myLib.layerVersion) during it, and must not wait for each other
+        """
+        user=User.objects.create_user('locks_user', password='locks_password')
+        geoms=[f'POLYGON(({i*10000} 0, {i*10000+10} 0, {i*10000+10} 10, {i*10000} 10, {i*10000} 0))' for i in range(4)]
+        start=time.perf_counter()
+        status_codes=self.post_concurrently(geoms, '/buildings/buildings_view/insert/', (Buildings, 'save'), user)
+        elapsed=time.perf_counter() - start
+        self.assertEqual(status_codes, [201]*4)
+        self.assertEqual(Buildings.objects.count(), 4)
+        self.assertLess(elapsed, 2*self.delay)
+
+
+class BuildingsAsyncViewTest(TransactionTestCase):
+    """The async pool has its own connections, so the data must be committed"""
+    square = 'POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))'
+
+    def setUp(self):
+        self.user=User.objects.create_user('async', password='async')
+
+    async def test_avalidate_is_the_same_as_validate(self):
+        try:
+            b=await Buildings.objects.acreate(geom=GEOSGeometry(self.square, srid=Buildings._meta.get_field('geom').srid))
+            candidate='POLYGON((5 5, 15 5, 15 15, 5 15, 5 5))'
+            v=await AsyncGeometryValidation().avalidate(candidate, 'buildings_buildings', with_wkt=True)
+            self.assertTrue(v.is_valid)
+            self.assertEqual(v.related_ids, [b.id])
+            expected=await sync_to_async(GeometryValidation().validate)(candidate, 'buildings_buildings', with_wkt=True)
+            self.assertEqual((v.wkt, v.related_ids), (expected.wkt, expected.related_ids))
+        finally:
+            await close_async_pool()
+
+    async def test_insert_select_update_delete(self):
+        await self.async_client.aforce_login(self.user)
+        try:
+            response=await self.async_client.post('/buildings/buildings_async/insert/', {'geom': self.square, 'description': 'a'})
+            self.assertEqual(response.status_code, 201)
+            d=response.json()['data'][0]
+            self.assertEqual(d['area'], 100)
+            response=await self.async_client.post('/buildings/buildings_async/insert/', {'geom': 'POLYGON((5 5, 15 5, 15 15, 5 15, 5 5))'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(await Buildings.objects.acount(), 1)
+
+            response=await self.async_client.get(f"/buildings/buildings_async/selectone/{d['id']}/")
+            self.assertEqual(response.json()['data'][0]['description'], 'a')
+            response=await self.async_client.get('/buildings/buildings_async/selectall/?bbox=-1,-1,1,1')
+            self.assertEqual([b['id'] for b in response.json()['data']], [d['id']])
+
+            #the update does not check the building against itself
+            response=await self.async_client.post(f"/buildings/buildings_async/update/{d['id']}/",
+                                                  {'geom': 'POLYGON((0 0, 20 0, 20 10, 0 10, 0 0))', 'description': 'b'})
+            self.assertEqual(response.status_code, 200)
+            b=await Buildings.objects.aget(id=d['id'])
+            self.assertEqual((b.description, b.area), ('b', 200))
+
+            response=await self.async_client.post(f"/buildings/buildings_async/delete/{d['id']}/")
+            self.assertTrue(response.json()['ok'])
+            self.assertEqual(await Buildings.objects.acount(), 0)
+        finally:
+            await close_async_pool()
+
+
+class BuildingsBulkImportTest(TestCase):
+    url = '/buildings/buildings_view/bulkimport/'
+
+    def setUp(self):
+        install_derived_geometry_trigger(Buildings)
+        self.client.force_login(User.objects.create_user('bulk', password='bulk'))
+        self.existing=Buildings.objects.create(geom=GEOSGeometry('POLYGON((100 0, 110 0, 110 10, 100 10, 100 0))',
+                                                                  srid=Buildings.geom.field.srid))
+
+    def feature(self, wkt: str=None, description: str='d')->dict:
+        geometry=json.loads(GEOSGeometry(wkt).json) if wkt else None
+        return {'type': 'Feature', 'geometry': geometry, 'properties': {'description': description}}
+
+    def post(self, body: str):
+        return self.client.post(self.url, data=body, content_type='application/geo+json')
+
+    def test_reject_reasons_and_report(self):
+        features=[
+            self.feature('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))'),#A
+            self.feature('POLYGON((5 0, 15 0, 15 10, 5 10, 5 0))'),#B, rejected by A
+            self.feature('POLYGON((12 0, 20 0, 20 10, 12 10, 12 0))'),#C, only related with B, that is not imported
+            self.feature(None),
+            self.feature('POINT(50 50)'),
+            self.feature('POLYGON((50 0, 60 0, 60 10, 50 10, 50 0))', description='x'*101),
+            self.feature('POLYGON((200 0, 210 10, 210 0, 200 10, 200 0))'),#bowtie
+            self.feature('POLYGON((105 5, 115 5, 115 15, 105 15, 105 5))'),
+        ]
+        response=self.post(json.dumps({'type': 'FeatureCollection', 'features': features}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines=[json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        report, summary=lines[:-1], lines[-1]
+        self.assertEqual([line['index'] for line in report], list(range(8)))
+        self.assertEqual([line['ok'] for line in report], [True, False, True, False, False, False, False, False])
+        self.assertIn('previous features of the import', report[1]['message'])
+        self.assertTrue(report[1]['message'].endswith('{0}'))
+        self.assertEqual(report[3]['message'], 'Wrong feature: The geometry is mandatory')
+        self.assertEqual(report[4]['message'], 'Wrong feature: The geometry must be a POLYGON, not a Point')
+        self.assertIn('at most 100 characters', report[5]['message'])
+        self.assertIn('not valid after the st_SnapToGrid', report[6]['message'])
+        self.assertIn('ids of the table buildings_buildings', report[7]['message'])
+        self.assertTrue(report[7]['message'].endswith(f'{{{self.existing.id}}}'))
+        self.assertEqual((summary['accepted'], summary['rejected']), (2, 6))
+        self.assertEqual(set(Buildings.objects.exclude(id=self.existing.id).values_list('id', flat=True)),
+                         {report[0]['id'], report[2]['id']})
+        #the area is computed by the database
+        self.assertEqual(Buildings.objects.get(id=report[0]['id']).area, 100)
+
+    def test_chain_of_import_relations(self):
+        #each one overlaps the previous one: the odd ones are rejected by the even ones
+        features=[self.feature(f'POLYGON(({8*i} 0, {8*i + 10} 0, {8*i + 10} 10, {8*i} 10, {8*i} 0))') for i in range(5)]
+        response=self.post('\n'.join(json.dumps(f) for f in features))
+        report=[json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()][:-1]
+        self.assertEqual([line['ok'] for line in report], [True, False, True, False, True])
+        self.assertTrue(report[3]['message'].endswith('{2}'))
+
+    def test_malformed_geojson(self):
+        for body in ('[1, 2]', '{"type": "FeatureCollection", "features": [{"type": "Feature"} {"type": "Feature"}]}',
+                     '{"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [1,'):
+            response=self.post(body)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Wrong GeoJSON', response.json()['message'])
+        self.assertEqual(Buildings.objects.count(), 1)
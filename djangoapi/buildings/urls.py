@@ -12,4 +12,7 @@ urlpatterns = [
     path('', include(router.urls)),
     path('buildings_view/<str:action>/', views.BuildigsView.as_view(), name='buildings_views'),  # POST requests
     path('buildings_view/<str:action>/<int:id>/', views.BuildigsView.as_view(), name='buildings_views'),  # POST requests
+    path('buildings_async/<str:action>/', views.BuildingsAsyncView.as_view(), name='buildings_async'),
+    path('buildings_async/<str:action>/<int:id>/', views.BuildingsAsyncView.as_view(), name='buildings_async'),
+    path('tiles/<int:z>/<int:x>/<int:y>.mvt', views.BuildingsTileView.as_view(), name='buildings_tiles'),  # GET requests
 ]
\ No newline at end of file
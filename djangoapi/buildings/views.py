@@ -1,27 +1,57 @@
 # Create your views here.
+import logging
+
 #Django imports
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views import View
 from django.contrib.auth import logout
 from django.shortcuts import redirect
 from django.forms.models import model_to_dict
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import transaction
 
 #Geoss
-from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import GEOSGeometry, GEOSException
 from django.contrib.gis.db.models.functions import SnapToGrid
 
 
 #rest_framework imports
 from rest_framework import viewsets
 from rest_framework import permissions
+from rest_framework.exceptions import ValidationError
 
 #My imports
-from core.myLib.geometryTools import WkbConversor, GeometryChecks
+from core.myLib.geometryTools import WkbConversor, GeometryChecks, GeometryValidation
 from .models import Buildings, Owners
 from .serializers import BuildingsSerializer, OwnersSerializer
 from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION, MAX_NUMBER_OF_RETRIEVED_ROWS
 from core.myLib.baseDjangoView import BaseDjangoView
+from core.myLib.asyncBaseDjangoView import AsyncBaseDjangoView
+from core.myLib.asyncDb import acquire_connections, execute_fetchone, fetchall, fetchone
+from core.myLib.asyncGeometryTools import AsyncGeometryValidation
+from core.myLib.geoBinaryFormats import GeoBinaryViewSetMixin, binary_response
+from core.myLib.geometryEncoders import geom_to_wkt, get_output_precision
+from core.myLib.geojsonStream import GeojsonStreamReader
+from core.myLib.geoStreaming import geojson_streaming_response
+from core.myLib.keysetPagination import KeysetPagination
+from core.myLib.derivedGeometry import refresh_derived_fields
+from core.myLib.layerVersion import LayerVersionViewSetMixin
+from core.myLib.requestMetrics import timed_phase
+from core.myLib.structuredLogging import debug_enabled
+from core.myLib.layerCache import layer_cache, get_layer, LayerCacheViewSetMixin
+from core.myLib.objectCache import object_cache, ObjectCacheViewSetMixin
+from core.myLib.spatialLocks import lock_geometry_cells, alock_geometry_cells, AtomicWriteViewSetMixin
+from core.myLib.spatialFilters import (apply_spatial_filters, annotate_geom_encodings, output_geom, parse_bbox,
+                                      get_simplify_tolerance)
+from core.myLib.vectorTileView import VectorTileView
+from .importers import BuildingsBulkImporter
+
+#The bbox and the centroid are geometries: they are not sent in the JSON of the BuildigsView
+DERIVED_GEOMETRIES = ['bbox', 'centroid']
+#Columns of the BuildingsAsyncView responses. The parameter is the precision of the WKT
+BUILDINGS_ASYNC_COLUMNS = "id, description, area, perimeter, ST_AsText({geom}, %s)"
+
+logger=logging.getLogger(__name__)
 
 def custom_logout_view(request):
     logout(request)
@@ -46,13 +76,31 @@ class BuildigsView(LoginRequiredMixin, BaseDjangoView):
         GET /buildings_view/selectone/<id>/
     To get all the records, the URL must be like:
         GET /buildings_view/selectall/
+    To get all the records, without limit, streamed as GeoJSON or newline-delimited GeoJSON:
+        GET /buildings_view/selectall/?stream=geojson
+        GET /buildings_view/selectall/?stream=ndjson
+    To get the records by pages (keyset pagination), ordered by id or spatially:
+        GET /buildings_view/selectall/?page_size=100&order=spatial
+        GET /buildings_view/selectall/?cursor=<next_cursor of the previous page>
+    To get the records of a bbox, simplified for the zoom of the map (or a tolerance):
+        GET /buildings_view/selectall/?bbox=minx,miny,maxx,maxy&zoom=14
+    To get all the records in a binary format (wkb, ewkb, twkb or flatgeobuf):
+        GET /buildings_view/selectall/?format=twkb
+        GET /buildings_view/selectall/ -H 'Accept: application/flatgeobuf'
     To insert a record, the URL must be like:
         POST /buildings_view/insert/ --> The data must be sent in the body of the request.
     To update a record, the URL must be like:
         POST /buildings_view/update/<id>/ --> The data must be sent in the body of the request.
     To delete a record, the URL must be like:
         POST /buildings_view/delete/<id>/
+    To import buildings in bulk, the URL must be like:
+        POST /buildings_view/bulkimport/ --> The body is a GeoJSON FeatureCollection,
+            or newline-delimited GeoJSON features
+
+    The selectall responses with bbox are cached. All the writes invalidate the
+    cached responses that touch the old or the new geometry.
     """
+    layer_model = Buildings
     
     def post(self, request, *args, **kwargs):
         """
@@ -61,33 +109,67 @@ class BuildigsView(LoginRequiredMixin, BaseDjangoView):
         if not it will call the post method of the BaseDjangoView class.
         """
         action = kwargs.get('action')
-        print(f"action child: {action}")
+        logger.debug('action child: %s', action)
 
         if action == 'insert2':
             return self.insert2(request)
+        elif action == 'bulkimport':
+            return self.bulkimport(request)
         else:            
             return super().post(request, *args, **kwargs)
 
     #GET OPERATIONS
     def selectone(self, id):
+        #the serialized building is kept in the object cache
+        d=object_cache.get_or_set(Buildings, id, f'selectone|{self.output_precision}', lambda: self.get_building_dict(id))
+        if d is None:
+            return JsonResponse({'ok':False, "message": f"The building id {id} does not exist", "data":[]}, status=200)
+        with timed_phase('serialize'):
+            return JsonResponse({'ok':True, 'message': 'Building Retriewed', 'data': [d]}, status=200)
+
+    def get_building_dict(self, id):
         l=list(Buildings.objects.filter(id=id))
         if len(l)==0:
-            return JsonResponse({'ok':False, "message": f"The building id {id} does not exist", "data":[]}, status=200)
+            return None
         b=l[0]
-        d=model_to_dict(b)
-        d['geom']=b.geom.wkt
-        return JsonResponse({'ok':True, 'message': 'Building Retriewed', 'data': [d]}, status=200)
+        with timed_phase('serialize'):
+            d=model_to_dict(b, exclude=DERIVED_GEOMETRIES)
+            d['geom']=geom_to_wkt(b.geom, self.output_precision)
+        return d
 
     def selectall(self):
-        l=Buildings.objects.all()[:MAX_NUMBER_OF_RETRIEVED_ROWS]
-        data=[]
-        for b in l:
-            d=model_to_dict(b)
-            d['geom']=b.geom.wkt
-            data.append(d)
-        return JsonResponse({'ok':True, 'message': 'Data retrieved', 'data': data}, status=200)
+        try:
+            queryset=self.get_spatial_queryset(Buildings.objects.all())
+            binary_format=self.get_binary_format()
+            if binary_format:
+                return binary_response(queryset, ['description', 'area'], binary_format, precision=self.output_precision)
+            stream_format=self.get_stream_format()
+            if stream_format:
+                return geojson_streaming_response(queryset.order_by('id'), ['description', 'area'], stream_format,
+                                                  precision=self.output_precision)
+            page=self.get_keyset_page(queryset)
+        except ValueError as e:
+            return JsonResponse({'ok':False, 'message': str(e), 'data':[]}, status=400)
+        if page is None:
+            l=queryset[:MAX_NUMBER_OF_RETRIEVED_ROWS]
+            next_cursor=None
+        else:
+            l, next_cursor=page
+        #the rows are read when the loop starts: the query is counted as db time
+        l=list(l)
+        with timed_phase('serialize'):
+            data=[]
+            for b in l:
+                d=model_to_dict(b, exclude=DERIVED_GEOMETRIES)
+                d['geom']=geom_to_wkt(output_geom(b), self.output_precision)
+                data.append(d)
+            return JsonResponse({'ok':True, 'message': 'Data retrieved', 'data': data, 'next_cursor': next_cursor}, status=200)
 
     #POST OPERATIONS
+    #The checks and the write are done in one transaction, with the advisory locks of the
+    #grid cells of the geometry (core.myLib.spatialLocks), so two concurrent writes of
+    #overlapping buildings can not both pass the checks. The far away ones are not serialized
+    @transaction.atomic
     def insert(self, request):
         """
         Inserts the polygon. Latter snap it to the grid. This must be done
@@ -99,9 +181,7 @@ class BuildigsView(LoginRequiredMixin, BaseDjangoView):
             - If any check fails, remove the row.
             - The only inconvenient is the id counter sums one more
         """
-        print(f"Insert building")
-        print(f"Request: {request.POST}")
-        print(f"Request body: {request.body}")
+        logger.debug('Insert building')
         #Check if the geometry is present
         originalWkt=request.POST.get('geom', None)
         if originalWkt is None:
@@ -109,50 +189,52 @@ class BuildigsView(LoginRequiredMixin, BaseDjangoView):
         
         #Creates the geometry
         g=GEOSGeometry(request.POST.get('geom',''), srid=EPSG_FOR_GEOMETRIES)
-        #print the representation of the object
-        print(f"Original geometry: {g}")
+        #the representation of the object is only built if the message is written
+        logger.debug('Original geometry: %s', g)
+        lock_geometry_cells(get_layer(Buildings), g)
 
         description = request.POST.get('description','') 
-        b=Buildings(description=description, area=g.area, geom=g)
+        b=Buildings(description=description, geom=g)#the area is computed by the database
         b.save()
-        print(f"Geometry inserted id: {b.id}")
+        logger.debug('Geometry inserted id: %s', b.id)
 
         #Update the geometry to an snaped one yo the grid
         Buildings.objects.filter(id=b.id).update(geom=SnapToGrid('geom', ST_SNAP_PRECISION))
+        object_cache.invalidate_on_commit(Buildings, b.id)#the update does not send post_save
 
         #Now we get a new object with the new geometry to perform the checks
         b=Buildings.objects.get(id=b.id)
-        print('Snapped geometry',b.geom.wkt)
+        logger.debug('Snapped geometry %s', b.geom)
         #bGeos=GEOSGeometry(b.geom.wkt, srid=25830)
         #valid=bGeos.valid
         #b.geom is a GEOSGeometry object, so we can use it directly
         valid=b.geom.valid
-        print(f'Valid: {valid}')
+        logger.debug('Valid: %s', valid)
+        layer_cache.invalidate_on_commit(get_layer(Buildings), b.geom)
         if not valid:
-            print(f"Deleting invalid geometry {b.id}")
+            logger.debug('Deleting invalid geometry %s', b.id)
             b.delete()
             return JsonResponse({'ok':False, 'message': 'The geometry is not valid after the st_SnapToGrid', 'data':[]}, status=200)   
 
         #create a filter to get all the geometries which interiors intersects,
         #but excluding the one just created
         filt=Buildings.objects.filter(geom__relate=(g.wkt,'T********')).exclude(id=b.id)
-        print(f"Query:{filt.query}")
-        exist=filt.exists()
-        print(f"Exists {exist}") 
-        n=filt.count() 
-        print(f"Count: {n}")
-        print(f"Values: {list(filt)}")
+        logger.debug('Query: %s', filt.query)
+        #one query: the count says if there are any
+        n=filt.count()
+        logger.debug('Count: %s', n)
         
-        if exist:
-            print(f"Deleting de building id {b.id}, as it intersects with others")
+        if n > 0:
+            logger.debug('Deleting de building id %s, as it intersects with others', b.id)
             b.delete()
             return JsonResponse({'ok':False, 'message': f'The building intersects with {n} building/s'}, status=200)
         
         #create a building object, from the model Buildings
-        d=model_to_dict(b)
-        d['geom']=b.geom.wkt
+        d=model_to_dict(b, exclude=DERIVED_GEOMETRIES)
+        d['geom']=geom_to_wkt(b.geom)
         return JsonResponse({'ok':True, 'message': 'Data inserted', 'data': [d]}, status=201)
 
+    @transaction.atomic
     def update(self, request, id):
         """
         On update you shoud also check the new geometry: snap it, check if it is valid,
@@ -173,37 +255,37 @@ class BuildigsView(LoginRequiredMixin, BaseDjangoView):
         originalWkt=request.POST.get('geom', None)
         
         if originalWkt is not None:
-            conversor=WkbConversor()
-            wkb=conversor.set_wkt_from_text(originalWkt)
-            newWkt=conversor.get_as_wkt()
-            geojson=conversor.get_as_geojson()
-            gc=GeometryChecks(wkb)
-            isValid=gc.is_geometry_valid()
-            interesectionIds=gc.check_st_relate('buildings_buildings','T********', id_to_avoid=id)
-            thereAre = gc.are_there_related_ids()
-
-            print(f"Snaped wkt: {newWkt}")
-            print(f"Snaped geojson: {geojson}")
-            print(f"Snaped is valid: {isValid}")
-            print(f"Snaped intersection ids: {interesectionIds}")
-            print(f"There are intersection ids: {thereAre}")
-            print(gc.get_relate_message())
-
-            if not(isValid):
-                return JsonResponse({'ok':False, 'message': 'The geometry is not valid after the st_SnapToGrid', 'data':[]}, status=200)   
-            if gc.are_there_related_ids():
-                return JsonResponse({'ok':False, 'message': gc.get_relate_message(), 'data':gc.related_ids}, status=200)   
-            b.geom=wkb
+            try:
+                with timed_phase('geos'):
+                    new_geom=GEOSGeometry(originalWkt, srid=EPSG_FOR_GEOMETRIES)
+                lock_geometry_cells(get_layer(Buildings), b.geom, new_geom)
+            except (GEOSException, ValueError) as e:
+                return JsonResponse({'ok':False, 'message': f'Wrong geometry: {e}', 'data':[]}, status=400)
+            #snap, validity, relation and encodings in one query
+            v=GeometryValidation().validate(originalWkt, 'buildings_buildings','T********',
+                                            id_to_avoid=id, with_wkt=True)
+
+            if debug_enabled(logger):
+                logger.debug('Snaped wkt: %s, valid: %s, intersection ids: %s. %s', v.wkt, v.is_valid,
+                             v.related_ids, v.get_relate_message())
+
+            if not(v.is_valid):
+                return JsonResponse({'ok':False, 'message': f'The geometry is not valid after the st_SnapToGrid. {v.valid_reason}', 'data':[]}, status=200)   
+            if v.are_there_related_ids():
+                return JsonResponse({'ok':False, 'message': v.get_relate_message(), 'data':v.related_ids}, status=200)   
+            old_geom=b.geom
+            b.geom=v.wkb
             b.description=request.POST.get('description', '')
-            polyGeos=GEOSGeometry(wkb)
-            b.area=polyGeos.area
             b.save()
-            d=model_to_dict(b)
-            d['geom']=conversor.get_as_wkt()#snaped version
+            refresh_derived_fields(b)#area, perimeter, bbox and centroid of the snaped geometry
+            layer_cache.invalidate_on_commit(get_layer(Buildings), old_geom, b.geom)
         else:
             return JsonResponse({'ok':False, 'message': 'Update. The geometry is mandartory', 'data':[]}, status=200)
         
-        return JsonResponse({'ok':True, 'message': "Building updated", 'data':[d]}, status=200)   
+        with timed_phase('serialize'):
+            d=model_to_dict(b, exclude=DERIVED_GEOMETRIES)
+            d['geom']=v.wkt#snaped version
+            return JsonResponse({'ok':True, 'message': "Building updated", 'data':[d]}, status=200)   
 
     def delete(self, id):
         l=list(Buildings.objects.filter(id=id))
@@ -211,8 +293,10 @@ class BuildigsView(LoginRequiredMixin, BaseDjangoView):
             return JsonResponse({'ok':False, "message": f"The building id {id} does not exist", "data":[]}, status=200)
         b=l[0]
         b.delete()  
+        layer_cache.invalidate_on_commit(get_layer(Buildings), b.geom)
         return JsonResponse({'ok':True, "message": f"The building id {id} has been deleted", "data":[]}, status=200)
 
+    @transaction.atomic
     def insert2(self, request):
         """
         This method do the same that the insert methid, 
@@ -226,25 +310,28 @@ class BuildigsView(LoginRequiredMixin, BaseDjangoView):
         originalWkt=request.POST.get('geom', None)
         
         if originalWkt is not None:
-            conversor=WkbConversor()
-            wkb=conversor.set_wkt_from_text(originalWkt)
-            gc=GeometryChecks(wkb)
-            isValid=gc.is_geometry_valid()
-            gc.check_st_relate('buildings_buildings','T********')
-            print(gc.get_relate_message())
-
-            if not(isValid):
-                return JsonResponse({'ok':False, 'message': 'The geometry is not valid after the st_SnapToGrid', 'data':[]}, status=400)   
-            if gc.are_there_related_ids():
-                return JsonResponse({'ok':False, 'message': gc.get_relate_message(), 'data':gc.related_ids}, status=400)   
+            try:
+                lock_geometry_cells(get_layer(Buildings), GEOSGeometry(originalWkt, srid=EPSG_FOR_GEOMETRIES))
+            except (GEOSException, ValueError) as e:
+                return JsonResponse({'ok':False, 'message': f'Wrong geometry: {e}', 'data':[]}, status=400)
+            #snap, validity, relation and wkt in one query
+            v=GeometryValidation().validate(originalWkt, 'buildings_buildings','T********', with_wkt=True)
+            if debug_enabled(logger):
+                logger.debug(v.get_relate_message())
+
+            if not(v.is_valid):
+                return JsonResponse({'ok':False, 'message': f'The geometry is not valid after the st_SnapToGrid. {v.valid_reason}', 'data':[]}, status=400)   
+            if v.are_there_related_ids():
+                return JsonResponse({'ok':False, 'message': v.get_relate_message(), 'data':v.related_ids}, status=400)   
             
             b=Buildings()
-            b.geom=wkb
+            b.geom=v.wkb
             b.description=request.POST.get('description', '')
-            b.area=b.geom.area
             b.save()
-            d=model_to_dict(b)
-            d['geom']=b.geom.wkt
+            refresh_derived_fields(b)
+            layer_cache.invalidate_on_commit(get_layer(Buildings), b.geom)
+            d=model_to_dict(b, exclude=DERIVED_GEOMETRIES)
+            d['geom']=v.wkt
         else:
             return JsonResponse({'ok':False, 'message': 'The geometry mandartory', 'data':[]}, status=200)
 
@@ -252,7 +339,164 @@ class BuildigsView(LoginRequiredMixin, BaseDjangoView):
 
 
 
-class BuildingsModelViewSet(viewsets.ModelViewSet):
+    def bulkimport(self, request):
+        """
+        Imports the features of the body with the BuildingsBulkImporter.
+        The body is read as a stream, so it can be of hundreds of MB.
+        The features are COPYed to a staging table, and checked
+        with set-based SQL. Only the features that pass the checks are inserted.
+        The response is newline-delimited JSON, with one line per feature:
+            {"index": 0, "ok": true, "id": 25}
+            {"index": 1, "ok": false, "message": "The geometry is not valid ..."}
+        and a last line with the summary.
+        """
+        importer=BuildingsBulkImporter()
+        try:
+            importer.run(GeojsonStreamReader(request))#invalidates the layer cache
+        except ValueError as e:
+            return JsonResponse({'ok':False, 'message': f'Wrong GeoJSON: {e}', 'data':[]}, status=400)
+        return StreamingHttpResponse(importer.iter_report_ndjson(), content_type='application/x-ndjson')
+
+
+class BuildingsAsyncView(AsyncBaseDjangoView):
+    """
+    The actions of the BuildigsView as coroutines, for the ASGI server. While a request
+    waits for the database, the worker serves the other ones.
+        GET /buildings_async/selectone/<id>/
+        GET /buildings_async/selectall/?bbox=minx,miny,maxx,maxy&zoom=14
+        POST /buildings_async/insert/
+        POST /buildings_async/update/<id>/
+        POST /buildings_async/delete/<id>/
+    The queries use the async pool (core.myLib.asyncDb). On insert and update, the
+    validity of the snapped geometry and its relation with the other buildings are
+    checked at the same time (AsyncGeometryValidation). The relation is checked in the
+    transaction of the write, after taking the spatial locks, as in the BuildigsView.
+    The streams, the binary formats and the pages are served by the BuildigsView.
+    """
+    login_required = True
+    layer_model = Buildings
+
+    def row_to_dict(self, row)->dict:
+        return {'id': row[0], 'description': row[1], 'area': row[2], 'perimeter': row[3], 'geom': row[4]}
+
+    #GET OPERATIONS
+    async def selectone(self, id):
+        #the same payload, and cache entry, of the BuildigsView
+        d=await object_cache.aget_or_set(Buildings, id, f'selectone|{self.output_precision}',
+                                         lambda: self.get_building_dict(id))
+        if d is None:
+            return JsonResponse({'ok':False, "message": f"The building id {id} does not exist", "data":[]}, status=200)
+        return JsonResponse({'ok':True, 'message': 'Building Retriewed', 'data': [d]}, status=200)
+
+    async def get_building_dict(self, id):
+        columns=BUILDINGS_ASYNC_COLUMNS.format(geom='geom')
+        row=await fetchone(f"SELECT {columns} FROM buildings_buildings WHERE id = %s", [self.output_precision, id])
+        return None if row is None else self.row_to_dict(row)
+
+    async def selectall(self):
+        params=self.request.GET
+        if (self.get_stream_format() or self.get_binary_format() or params.get('cursor')
+                or params.get('page_size')):
+            return JsonResponse({'ok':False, 'message': 'The streams, binary formats and pages are served by /buildings/buildings_view/selectall/',
+                                 'data':[]}, status=400)
+        geom="geom"
+        values=[]
+        where=""
+        try:
+            tolerance=get_simplify_tolerance(params, EPSG_FOR_GEOMETRIES)
+            if tolerance is not None:
+                geom="ST_SimplifyPreserveTopology(geom, %s)"
+                values.append(tolerance)
+            values.append(self.output_precision)
+            if params.get('bbox'):
+                bbox=parse_bbox(params.get('bbox'), EPSG_FOR_GEOMETRIES, params.get('bbox_srid'))
+                where="WHERE geom && ST_GeomFromEWKT(%s)"
+                values.append(bbox.ewkt)
+        except ValueError as e:
+            return JsonResponse({'ok':False, 'message': str(e), 'data':[]}, status=400)
+        columns=BUILDINGS_ASYNC_COLUMNS.format(geom=geom)
+        rows=await fetchall(f"SELECT {columns} FROM buildings_buildings {where} ORDER BY id LIMIT %s",
+                            values + [MAX_NUMBER_OF_RETRIEVED_ROWS])
+        data=[self.row_to_dict(row) for row in rows]
+        return JsonResponse({'ok':True, 'message': 'Data retrieved', 'data': data, 'next_cursor': None}, status=200)
+
+    #POST OPERATIONS
+    async def insert(self, request):
+        return await self.write(request)
+
+    async def update(self, request, id):
+        return await self.write(request, id)
+
+    async def write(self, request, id=None):
+        """
+        Inserts the building, or updates the building id. In one transaction:
+            - takes the spatial locks of the old and the new geometries
+            - snaps the geometry, and checks its validity and its relation with the
+              other buildings, at the same time, in two connections
+            - writes the snapped geometry. The database computes the derived fields
+        """
+        geom_text=request.POST.get('geom', None)
+        if geom_text is None:
+            return JsonResponse({'ok':False, 'message': 'The geometry is mandartory', 'data':[]}, status=400)
+        try:
+            geom=GEOSGeometry(geom_text, srid=EPSG_FOR_GEOMETRIES)
+        except (GEOSException, ValueError) as e:
+            return JsonResponse({'ok':False, 'message': f'Wrong geometry: {e}', 'data':[]}, status=400)
+        description=request.POST.get('description', '')
+        layer=get_layer(Buildings)
+        old_geom=None
+        v=AsyncGeometryValidation()
+        async with acquire_connections(2) as (conn, other):
+            async with conn.transaction():
+                if id is not None:
+                    row=await execute_fetchone(conn, "SELECT geom FROM buildings_buildings WHERE id = %s", [id])
+                    if row is None:
+                        return JsonResponse({'ok':False, "message": f"The building id {id} does not exist", "data":[]}, status=200)
+                    old_geom=GEOSGeometry(row[0]) if row[0] else None
+                await alock_geometry_cells(conn, layer, old_geom, geom)
+                #the relation runs in conn, so it sees the buildings of the transaction
+                await v.avalidate(geom_text, layer, 'T********', id_to_avoid=id, with_wkt=True,
+                                  connections=[other, conn])
+                if not v.is_valid:
+                    return JsonResponse({'ok':False, 'message': f'The geometry is not valid after the st_SnapToGrid. {v.valid_reason}', 'data':[]}, status=400)
+                if v.are_there_related_ids():
+                    return JsonResponse({'ok':False, 'message': v.get_relate_message(), 'data':v.related_ids}, status=400)
+                returning="RETURNING id, description, area, perimeter"
+                if id is None:
+                    row=await execute_fetchone(conn, f"INSERT INTO buildings_buildings (description, geom) VALUES (%s, %s) {returning}",
+                                               [description, v.wkb])
+                else:
+                    row=await execute_fetchone(conn, f"UPDATE buildings_buildings SET description = %s, geom = %s WHERE id = %s {returning}",
+                                               [description, v.wkb, id])
+        #committed
+        layer_cache.invalidate_geometries(layer, old_geom, GEOSGeometry(v.wkb))
+        object_cache.invalidate(Buildings, row[0])
+        d=self.row_to_dict(row[:4] + (v.wkt,))
+        if id is None:
+            return JsonResponse({'ok':True, 'message': 'Building Inserted', 'data': [d]}, status=201)
+        return JsonResponse({'ok':True, 'message': 'Building updated', 'data': [d]}, status=200)
+
+    async def delete(self, id):
+        row=await fetchone("DELETE FROM buildings_buildings WHERE id = %s RETURNING geom", [id])
+        if row is None:
+            return JsonResponse({'ok':False, "message": f"The building id {id} does not exist", "data":[]}, status=200)
+        layer_cache.invalidate_geometries(get_layer(Buildings), GEOSGeometry(row[0]) if row[0] else None)
+        object_cache.invalidate(Buildings, id)
+        return JsonResponse({'ok':True, "message": f"The building id {id} has been deleted", "data":[]}, status=200)
+
+
+class BuildingsTileView(LoginRequiredMixin, VectorTileView):
+    """
+    Buildings as Mapbox Vector Tiles, only for the logged in users, as the BuildigsView:
+        GET /buildings/tiles/<z>/<x>/<y>.mvt
+    """
+    model = Buildings
+    layer_name = 'buildings'
+    tile_attributes = ['description', 'area'] #the id is always added
+
+
+class BuildingsModelViewSet(LayerVersionViewSetMixin, LayerCacheViewSetMixin, GeoBinaryViewSetMixin,
+                            ObjectCacheViewSetMixin, AtomicWriteViewSetMixin, viewsets.ModelViewSet):
     """
     DJANGO REST FRAMEWORK VIEWSET.
 
@@ -273,14 +517,63 @@ class BuildingsModelViewSet(viewsets.ModelViewSet):
                 only the fields that are present in the request.
         -destroy() -> DELETE operation over /buildings/buildings/<id>/. 
                 It will delete the record with the id.
+    The list and the retrieve can be returned in WKB, EWKB, TWKB or FlatGeobuf,
+    with the header Accept or the parameter format (GeoBinaryViewSetMixin):
+        GET /buildings/buildings/?format=twkb&bbox=minx,miny,maxx,maxy
+    The list and the retrieve have the ETag of the version of the layer, and answer
+    304 Not Modified to If-None-Match while the table is not written (LayerVersionViewSetMixin).
+    The retrieve payloads are kept in the object cache (ObjectCacheViewSetMixin).
+    The create and update are atomic, with the spatial locks taken by the serializer
+    validation (AtomicWriteViewSetMixin).
     """
     queryset = Buildings.objects.all()
+    binary_properties = ['description', 'area', 'perimeter']
+    filterset_fields = {'area': ['lt', 'lte', 'gt', 'gte'], 'perimeter': ['lt', 'lte', 'gt', 'gte']}#indexed columns
+    pagination_class = KeysetPagination#Only if the request has the parameters cursor or page_size
     serializer_class = BuildingsSerializer#The serializer that will be used to serialize 
                             #the data. and check the data that is sent in the request.
     permission_classes = [permissions.AllowAny]#Any can use it.
                                 # Use https://rsinger86.github.io/drf-access-policy/
                                 # to more advanced permissions management
 
+    def get_queryset(self):
+        """
+        On list, filters by the parameter bbox, and simplifies the geometries
+        according to the parameters zoom or tolerance:
+            GET /buildings/buildings/?bbox=minx,miny,maxx,maxy&zoom=14
+        On list and retrieve, the encodings of the geometries are annotated, so
+        the serialization does not query or parse geometries per object. They have
+        the decimal digits of the snap, or the ones of the parameter precision.
+        """
+        queryset=super().get_queryset()
+        if self.action=='list':
+            try:
+                queryset=apply_spatial_filters(queryset, self.request.query_params)
+            except ValueError as e:
+                raise ValidationError({'detail': str(e)})
+        if self.action in ('list', 'retrieve'):
+            #the GeoJSON and the WKT are computed in the same SELECT
+            try:
+                precision=get_output_precision(self.request.query_params)
+            except ValueError as e:
+                raise ValidationError({'detail': str(e)})
+            queryset=annotate_geom_encodings(queryset, precision=precision)
+        return queryset
+
+    #The writes invalidate the cached tiles and lists that touch the old or the new geometry
+    def perform_create(self, serializer):
+        instance=refresh_derived_fields(serializer.save())
+        layer_cache.invalidate_on_commit(get_layer(Buildings), instance.geom)
+
+    def perform_update(self, serializer):
+        old_geom=serializer.instance.geom
+        instance=refresh_derived_fields(serializer.save())
+        layer_cache.invalidate_on_commit(get_layer(Buildings), old_geom, instance.geom)
+
+    def perform_destroy(self, instance):
+        layer_cache.invalidate_on_commit(get_layer(Buildings), instance.geom)
+        instance.delete()
+
 
 class OwnersModelViewSet(viewsets.ModelViewSet):
     """
@@ -305,6 +598,7 @@ class OwnersModelViewSet(viewsets.ModelViewSet):
                 It will delete the record with the id.
     """
     queryset = Owners.objects.all()
+    pagination_class = KeysetPagination#Only if the request has the parameters cursor or page_size
     serializer_class = OwnersSerializer#The serializer that will be used to serialize 
                             #the data. and check the data that is sent in the request.
     permission_classes = [permissions.AllowAny]#Any can use it.
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from core.myLib.derivedGeometry import install_derived_geometry_triggers_on_migrate
+        from core.myLib.layerVersion import get_geometry_models, install_layer_version_triggers_on_migrate
+        from core.myLib.objectCache import register_object_cache_signals
+        #after all the migrations, so the tables of the other apps exist
+        post_migrate.connect(install_layer_version_triggers_on_migrate, sender=self)
+        post_migrate.connect(install_derived_geometry_triggers_on_migrate, sender=self)
+        register_object_cache_signals(get_geometry_models())
@@ -0,0 +1,49 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from core.myLib.derivedGeometry import backfill_derived_geometry, get_derived_models, install_derived_geometry_trigger
+
+class Command(BaseCommand):
+    """
+    Installs the triggers that maintain the fields derived from the geometry
+    (area, perimeter, bbox, centroid: see core.myLib.derivedGeometry), and computes
+    them for the existing rows, in batches of ids.
+
+    The triggers are installed after each migrate (post_migrate). Run this command
+    once after adding derived fields to a model with rows, or after restoring a dump.
+
+    Usage:
+        python manage.py backfill_derived_geometry
+        python manage.py backfill_derived_geometry --model buildings.Buildings --batch-size 10000
+        python manage.py backfill_derived_geometry --only-missing
+    """
+    help = 'Installs the triggers of the derived geometry fields and computes them for the existing rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=None, help='app_label.Model. All the models with derived fields by default')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows updated by each UPDATE')
+        parser.add_argument('--only-missing', action='store_true', help='Only the rows with any derived field NULL')
+
+    def handle(self, *args, **options):
+        if options['model']:
+            try:
+                models=[apps.get_model(options['model'])]
+            except (LookupError, ValueError) as e:
+                raise CommandError(str(e))
+            if not getattr(models[0], 'derived_geometry_fields', None):
+                raise CommandError(f"The model {options['model']} has no derived_geometry_fields")
+        else:
+            models=get_derived_models()
+        if options['batch_size'] < 1:
+            raise CommandError('The batch size must be greater than 0')
+
+        for model in models:
+            table_name=model._meta.db_table
+            if not install_derived_geometry_trigger(model):
+                self.stdout.write(self.style.WARNING(f'{table_name}: the table does not exist. Run the migrations'))
+                continue
+            self.stdout.write(f'{table_name}: trigger installed')
+            total=0
+            for updated in backfill_derived_geometry(model, options['batch_size'], options['only_missing']):
+                total += updated
+            self.stdout.write(self.style.SUCCESS(f'{table_name}: {total} rows updated'))
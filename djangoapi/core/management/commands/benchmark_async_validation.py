@@ -0,0 +1,195 @@
+import asyncio
+import queue
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+
+from buildings.models import Buildings
+from core.myLib.asyncDb import close_async_pool, get_async_pool
+from core.myLib.benchmarkTools import summarize, write_json
+from core.myLib.layerCache import ANY_EXTENT, get_layer, layer_cache
+from core.myLib.objectCache import object_cache
+from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION
+
+BENCHMARK_DESCRIPTION = 'benchmark_async'
+BENCHMARK_USERNAME = 'benchmark_async'
+#URL of the view of each stack
+STACKS = {'sync': '/buildings/buildings_view/', 'async': '/buildings/buildings_async/'}
+
+class Command(BaseCommand):
+    """
+    Compares the request path of the sync deployment, the BuildigsView in the WSGI server
+    with gthread workers, with the one of the async deployment, the BuildingsAsyncView
+    in the ASGI server. The requests go through all the middlewares of the MIDDLEWARE setting:
+        - sync: the test Client (the WSGI handler). --threads requests in flight, each one
+          in its thread, with its own connection, as the threads of a gthread worker
+        - async: the AsyncClient (the ASGI handler, with the async path of the middlewares).
+          --concurrency requests in flight in one event loop, as a uvicorn worker
+    For each stack and operation it reports the latency percentiles, the requests per second
+    and the errors. The inserts and the updates snap the geometry and check its validity
+    and its relation with the other buildings (GeometryValidation, AsyncGeometryValidation).
+
+    The squares are inserted in a grid of --cell-size units from --origin, that must be empty,
+    each stack in its own cells. They are removed at the end.
+
+    Usage:
+        python manage.py benchmark_async_validation --samples 200 --threads 4 --concurrency 20 --output async.json
+    """
+    help = 'Benchmarks the sync views in the WSGI stack against the async views in the ASGI stack'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=100, help='Requests per operation and stack')
+        parser.add_argument('--threads', type=int, default=4, help='Requests in flight in the sync stack')
+        parser.add_argument('--concurrency', type=int, default=10, help='Requests in flight in the async stack')
+        parser.add_argument('--origin', default='0,0', help='Lower left corner of the grid: x,y')
+        parser.add_argument('--cell-size', type=float, default=None,
+                            help='Size of the cells of the grid. By default 100 times the ST_SNAP_PRECISION')
+        parser.add_argument('--output', default=None, help='JSON file for the results. Stdout by default')
+
+    def handle(self, *args, **options):
+        try:
+            self.origin=tuple(float(v) for v in options['origin'].split(','))
+        except ValueError:
+            raise CommandError('The origin must be x,y')
+        if len(self.origin) != 2:
+            raise CommandError('The origin must be x,y')
+        self.samples=options['samples']
+        self.cell_size=options['cell_size'] or 100*ST_SNAP_PRECISION
+        self.columns=max(1, int((len(STACKS)*self.samples)**0.5) + 1)
+        self.next_cell=0
+        if self.grid_has_rows():
+            raise CommandError(f'There are buildings in the grid from {self.origin}. Use other --origin')
+
+        results={'settings': {'samples': self.samples, 'threads': options['threads'],
+                              'concurrency': options['concurrency']}}
+        allowed_hosts=override_settings(ALLOWED_HOSTS=['testserver'])#the host of the test client
+        allowed_hosts.enable()
+        self.user, _=User.objects.get_or_create(username=BENCHMARK_USERNAME)
+        try:
+            results['sync']=self.run_stack(STACKS['sync'], lambda requests: self.run_sync(requests, options['threads']))
+            results['async']=asyncio.run(self.run_async_stack(STACKS['async'], options['concurrency']))
+        finally:
+            allowed_hosts.disable()
+            User.objects.filter(username=BENCHMARK_USERNAME).delete()
+            self.delete_benchmark_rows()
+        write_json(results, options['output'], self.stdout)
+
+    def grid_has_rows(self)->bool:
+        x, y=self.origin
+        grid=GEOSGeometry(self.square_wkt(x, y, self.columns*self.cell_size), srid=EPSG_FOR_GEOMETRIES)
+        return Buildings.objects.filter(geom__intersects=grid).exists()
+
+    def delete_benchmark_rows(self):
+        """With SQL: the ORM would load the rows, to send the post_delete signals"""
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM buildings_buildings WHERE description = %s", [BENCHMARK_DESCRIPTION])
+        object_cache.invalidate_layer(Buildings)
+        layer_cache.invalidate(get_layer(Buildings), [ANY_EXTENT])
+
+    def square_wkt(self, x: float, y: float, size: float)->str:
+        return f'POLYGON(({x} {y}, {x+size} {y}, {x+size} {y+size}, {x} {y+size}, {x} {y}))'
+
+    def new_cell(self)->tuple:
+        i=self.next_cell
+        self.next_cell += 1
+        return (self.origin[0] + (i % self.columns)*self.cell_size, self.origin[1] + (i // self.columns)*self.cell_size)
+
+    def get_requests(self, url: str, operation: str, cells: list, ids: list=None)->list:
+        """(method, path, data) of the requests of the operation"""
+        size=0.5*self.cell_size
+        if operation == 'insert':
+            return [('post', f'{url}insert/', {'geom': self.square_wkt(x, y, size), 'description': BENCHMARK_DESCRIPTION})
+                    for x, y in cells]
+        if operation == 'selectone':
+            return [('get', f'{url}selectone/{id}/', {}) for id in ids]
+        return [('post', f'{url}update/{id}/', {'geom': self.square_wkt(x + 0.1*self.cell_size, y, size),
+                                                'description': BENCHMARK_DESCRIPTION})
+                for id, (x, y) in zip(ids, cells)]
+
+    def run_stack(self, url: str, run)->dict:
+        """Inserts samples squares, selects them and updates them moved a bit inside their cells"""
+        cells=[self.new_cell() for _ in range(self.samples)]
+        results={}
+        results['insert'], responses=self.summarize(*run(self.get_requests(url, 'insert', cells)))
+        ids=[r.json()['data'][0]['id'] for r in responses if r.status_code == 201]
+        for operation in ('selectone', 'update'):
+            results[operation], _=self.summarize(*run(self.get_requests(url, operation, cells, ids)))
+        return results
+
+    async def run_async_stack(self, url: str, concurrency: int)->dict:
+        #two connections per write, as the views
+        await get_async_pool(max_size=max(2, concurrency*2))
+        client=AsyncClient()
+        await client.aforce_login(self.user)
+        results={}
+        try:
+            cells=[self.new_cell() for _ in range(self.samples)]
+            results['insert'], responses=self.summarize(*await self.run_async(client, self.get_requests(url, 'insert', cells), concurrency))
+            ids=[r.json()['data'][0]['id'] for r in responses if r.status_code == 201]
+            for operation in ('selectone', 'update'):
+                results[operation], _=self.summarize(*await self.run_async(client, self.get_requests(url, operation, cells, ids), concurrency))
+        finally:
+            await close_async_pool()
+        return results
+
+    def run_sync(self, requests: list, threads: int)->tuple:
+        """Returns the list of (duration, response) in the order of requests, and the total time"""
+        pending=queue.SimpleQueue()
+        for i, request in enumerate(requests):
+            pending.put((i, request))
+        results=[None]*len(requests)
+        clients=[]
+        for _ in range(threads):
+            client=Client()
+            client.force_login(self.user)
+            clients.append(client)
+
+        def work(client):
+            try:
+                while True:
+                    try:
+                        i, (method, path, data)=pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    t=time.perf_counter()
+                    response=getattr(client, method)(path, data)
+                    results[i]=(time.perf_counter() - t, response)
+            finally:
+                connections.close_all()#the connections of the thread
+
+        workers=[threading.Thread(target=work, args=(client,)) for client in clients]
+        t0=time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results, time.perf_counter() - t0
+
+    async def run_async(self, client, requests: list, concurrency: int)->tuple:
+        """As run_sync, with concurrency requests in flight in the event loop"""
+        semaphore=asyncio.Semaphore(concurrency)
+
+        async def call(method, path, data):
+            async with semaphore:
+                t=time.perf_counter()
+                response=await getattr(client, method)(path, data)
+                return time.perf_counter() - t, response
+
+        t0=time.perf_counter()
+        results=await asyncio.gather(*(call(*request) for request in requests))
+        return results, time.perf_counter() - t0
+
+    def summarize(self, results: list, seconds: float)->tuple:
+        """The summary of the durations, with the requests per second and the errors, and the responses"""
+        results=[r for r in results if r is not None]
+        responses=[response for _, response in results]
+        summary=summarize([duration for duration, _ in results])
+        summary['requests_per_second']=round(len(results)/seconds, 1) if seconds else None
+        summary['errors']=sum(1 for r in responses if r.status_code >= 400 or not r.json().get('ok'))
+        return summary, responses
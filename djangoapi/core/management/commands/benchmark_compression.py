@@ -0,0 +1,110 @@
+import json
+
+from django.apps import apps
+from django.contrib.gis.db.models import GeometryField
+from django.core.management.base import BaseCommand, CommandError
+
+from core.myLib.benchmarkTools import summarize, time_calls, write_json
+from core.myLib.compression import available_encodings, compress, compress_stream, decompress, get_compressor
+from core.myLib.geoBinaryFormats import iter_records
+from core.myLib.geoStreaming import iter_feature_collection, iter_features
+from core.myLib.geometryEncoders import AsText
+
+DEFAULT_ENCODINGS = 'gzip:1,gzip:6,gzip:9,br:1,br:4,br:11'
+
+class Command(BaseCommand):
+    """
+    Measures the size and the CPU time of the compression of the responses of a
+    geometry layer, with gzip and brotli at several levels.
+
+    The payloads are built from the rows of the layer, as the endpoints send them:
+        - geojson: the streamed GeoJSON FeatureCollection (selectall?stream=geojson)
+        - wkt_json: the JSON list with the WKT geometries (selectall)
+        - twkb: the TWKB records (selectall?format=twkb)
+    Each payload is compressed all at once ('whole'), and chunk by chunk with a
+    flush per chunk ('streamed'), as the CompressionMiddleware does with the streaming responses.
+
+    Usage:
+        python manage.py benchmark_compression --model buildings.Buildings --limit 10000 --output compression.json
+        python manage.py benchmark_compression --encodings gzip:1,gzip:6,br:4
+    """
+    help = 'Benchmarks the compression of the geometry responses: size against CPU time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default='buildings.Buildings', help='app_label.Model of the layer')
+        parser.add_argument('--limit', type=int, default=10000, help='Number of rows of the payloads')
+        parser.add_argument('--encodings', default=DEFAULT_ENCODINGS,
+                            help='Comma separated encoding:level. The brotli ones are skipped if brotli is not installed')
+        parser.add_argument('--repeat', type=int, default=3, help='Times each compression is done')
+        parser.add_argument('--output', default=None, help='JSON file for the results. Stdout by default')
+
+    def handle(self, *args, **options):
+        try:
+            model=apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        geom_fields=[f.name for f in model._meta.concrete_fields if isinstance(f, GeometryField)]
+        if not geom_fields:
+            raise CommandError(f"The model {options['model']} has no geometry field")
+        properties=[f.name for f in model._meta.concrete_fields
+                    if not isinstance(f, GeometryField) and not f.primary_key]
+        queryset=model.objects.order_by('id')[:options['limit']]
+        if not queryset.exists():
+            raise CommandError(f"The table of {options['model']} has no rows")
+        payloads=self.get_payloads(queryset, properties, geom_fields[0])
+
+        results={'model': options['model'], 'rows': queryset.count(), 'available_encodings': available_encodings(),
+                 'payloads': {}}
+        encodings=self.parse_encodings(options['encodings'])
+        for name, chunks in payloads.items():
+            data=b''.join(chunks)
+            payload={'raw_bytes': len(data), 'chunks': len(chunks), 'encodings': {}}
+            for encoding, level in encodings:
+                payload['encodings'][f'{encoding}:{level}']=self.benchmark(data, chunks, encoding, level, options['repeat'])
+            results['payloads'][name]=payload
+        write_json(results, options['output'], self.stdout)
+
+    def parse_encodings(self, value: str)->list:
+        encodings=[]
+        for item in value.split(','):
+            try:
+                encoding, level=item.split(':')
+                level=int(level)
+            except ValueError:
+                raise CommandError(f"Invalid encoding {item}. It must be encoding:level")
+            if encoding not in ('gzip', 'br'):
+                raise CommandError(f"Unknown encoding {encoding}")
+            if encoding in available_encodings():
+                encodings.append((encoding, level))
+        return encodings
+
+    def get_payloads(self, queryset, properties: list, geom_field: str)->dict:
+        geojson=[c.encode() for c in iter_feature_collection(iter_features(queryset, properties, geom_field))]
+        rows=queryset.annotate(geom_wkt=AsText(geom_field)).values('id', *properties, 'geom_wkt')
+        wkt_json=[json.dumps({'ok': True, 'message': 'Data retrieved',
+                              'data': [self.row_to_dict(r) for r in rows]}, default=str).encode()]
+        twkb=list(iter_records(queryset, properties, 'twkb', geom_field))
+        return {'geojson': geojson, 'wkt_json': wkt_json, 'twkb': twkb}
+
+    def row_to_dict(self, row: dict)->dict:
+        d={k: v for k, v in row.items() if k != 'geom_wkt'}
+        d['geom']=row['geom_wkt']
+        return d
+
+    def benchmark(self, data: bytes, chunks: list, encoding: str, level: int, repeat: int)->dict:
+        whole=compress(data, encoding, level)
+        streamed=b''.join(compress_stream(chunks, get_compressor(encoding, level)))
+        compress_samples=time_calls(compress, repeat, data, encoding, level)
+        streamed_samples=time_calls(lambda: b''.join(compress_stream(chunks, get_compressor(encoding, level))), repeat)
+        decompress_samples=time_calls(decompress, repeat, whole, encoding)
+        mean_seconds=sum(compress_samples)/len(compress_samples)
+        return {
+            'whole_bytes': len(whole),
+            'whole_ratio': round(len(whole)/len(data), 4),
+            'streamed_bytes': len(streamed),
+            'streamed_ratio': round(len(streamed)/len(data), 4),
+            'compress_mb_per_s': round(len(data)/mean_seconds/1e6, 2) if mean_seconds else None,
+            'compress': summarize(compress_samples),
+            'compress_streamed': summarize(streamed_samples),
+            'decompress': summarize(decompress_samples),
+        }
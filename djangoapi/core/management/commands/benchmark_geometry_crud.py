@@ -0,0 +1,243 @@
+import json
+import math
+import random
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+
+from buildings.models import Buildings
+from core.myLib.benchmarkTools import compare_to_baseline, peak_memory, summarize, time_calls_with_queries, write_json
+from core.myLib.geometryTools import GeometryChecks
+from core.myLib.layerCache import ANY_EXTENT, get_layer, layer_cache
+from core.myLib.objectCache import object_cache
+from djangoapi.settings import DB_POOL, EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION, WKB_CONVERSOR_ENGINE
+
+BENCHMARK_DESCRIPTION = 'benchmark'
+BENCHMARK_USERNAME = 'benchmark_geometry_crud'
+OPERATIONS = ('view_insert', 'view_insert2', 'view_update', 'view_selectall', 'view_selectall_bbox',
+              'api_list_bbox', 'api_list_page', 'api_create', 'relate_check')
+
+class Command(BaseCommand):
+    """
+    Benchmarks the CRUD of the buildings at several table sizes, through the
+    same URLs the clients use (BuildigsView and BuildingsModelViewSet), and the
+    relation checks of GeometryChecks.
+
+    The table is filled with a grid of squares, one per cell of --cell-size units, with
+    the description 'benchmark'. The inserted geometries go to the free part of the
+    cells, so they pass the checks; the relation checks use squares that overlap the grid.
+    For each table size and operation it records:
+        - the latency percentiles (core.myLib.benchmarkTools.summarize)
+        - the queries per request (mean and max)
+        - the peak of Python memory of a request, measured in a separate pass
+          with tracemalloc, so it does not slow down the timed one
+        - the errors: responses with status >= 400 or ok false
+
+    Run it against a local PostGIS container: the benchmark rows are removed at the
+    end, unless --keep, but the table must not have other rows, unless --allow-existing.
+    The layer and object caches are disabled, unless --with-cache.
+    With --baseline, the p95 of each operation is compared with the one of a previous
+    output, and the command fails if any is more than --max-regression percent slower.
+
+    Usage:
+        python manage.py benchmark_geometry_crud --sizes 10000,100000,1000000 --samples 50 --output crud.json
+        python manage.py benchmark_geometry_crud --sizes 10000 --baseline crud.json --max-regression 20
+    """
+    help = 'Benchmarks the geometry CRUD endpoints at several table sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000', help='Comma separated numbers of rows')
+        parser.add_argument('--samples', type=int, default=50, help='Requests per operation and size')
+        parser.add_argument('--memory-samples', type=int, default=5, help='Requests of the tracemalloc pass')
+        parser.add_argument('--operations', default=','.join(OPERATIONS), help='Comma separated operations')
+        parser.add_argument('--cell-size', type=float, default=None,
+                            help='Size of the cells of the grid. By default 100 times the ST_SNAP_PRECISION')
+        parser.add_argument('--bbox-cells', type=int, default=10, help='Width, in cells, of the bbox of the selects')
+        parser.add_argument('--with-cache', action='store_true', help='Keep the layer and object caches enabled')
+        parser.add_argument('--allow-existing', action='store_true', help='Run even if the table has other rows')
+        parser.add_argument('--keep', action='store_true', help='Do not remove the benchmark rows at the end')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--baseline', default=None, help='JSON output of a previous run to compare with')
+        parser.add_argument('--max-regression', type=float, default=20.0, help='Percent of p95 increase allowed')
+        parser.add_argument('--output', default=None, help='JSON file for the results. Stdout by default')
+
+    def handle(self, *args, **options):
+        try:
+            sizes=sorted(int(s) for s in options['sizes'].split(','))
+        except ValueError:
+            raise CommandError(f"Invalid sizes {options['sizes']}")
+        operations=[o for o in options['operations'].split(',') if o]
+        unknown=set(operations) - set(OPERATIONS)
+        if unknown:
+            raise CommandError(f"Unknown operations {sorted(unknown)}. The options are {list(OPERATIONS)}")
+        others=Buildings.objects.exclude(description=BENCHMARK_DESCRIPTION).count()
+        if others and not options['allow_existing']:
+            raise CommandError(f'The table has {others} rows that are not of the benchmark. Use --allow-existing')
+        baseline=None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline=json.load(f)
+
+        self.random=random.Random(options['seed'])
+        self.cell_size=options['cell_size'] or 100*ST_SNAP_PRECISION
+        self.square_size=self.cell_size/2
+        self.bbox_cells=options['bbox_cells']
+        #the grid is square, with room for the largest size
+        self.columns=math.ceil(math.sqrt(sizes[-1]))
+        self.samples=options['samples']
+        self.memory_samples=options['memory_samples']
+        self.used_cells=set()
+        self.filled=0
+        if self.delete_benchmark_rows():
+            self.stderr.write('The benchmark rows of a previous run have been removed')
+
+        caches=(layer_cache.backend, object_cache.backend)
+        if not options['with_cache']:
+            layer_cache.backend=object_cache.backend=None
+        allowed_hosts=override_settings(ALLOWED_HOSTS=['testserver'])#the host of the test client
+        allowed_hosts.enable()
+        user, _=User.objects.get_or_create(username=BENCHMARK_USERNAME)
+        self.client=Client()
+        self.client.force_login(user)
+        results={'settings': {'wkb_conversor_engine': WKB_CONVERSOR_ENGINE, 'db_pool': DB_POOL,
+                              'cache': options['with_cache'], 'epsg': EPSG_FOR_GEOMETRIES,
+                              'cell_size': self.cell_size, 'samples': self.samples,
+                              'postgis': self.get_postgis_version()},
+                 'sizes': {}}
+        try:
+            for size in sizes:
+                rows=self.fill(size)
+                self.stderr.write(f'Size {size}: {rows} rows in the table')
+                results['sizes'][str(size)]={'rows': rows, 'operations': {op: self.run_operation(op) for op in operations}}
+        finally:
+            allowed_hosts.disable()
+            layer_cache.backend, object_cache.backend=caches
+            User.objects.filter(username=BENCHMARK_USERNAME).delete()
+            if not options['keep']:
+                self.delete_benchmark_rows()
+
+        regressions=None
+        if baseline is not None:
+            regressions=compare_to_baseline(results['sizes'], baseline.get('sizes', {}), 'p95_ms', options['max_regression'])
+            results['regressions']=regressions
+        write_json(results, options['output'], self.stdout)
+        if regressions:
+            raise CommandError(f'{len(regressions)} operations are more than {options["max_regression"]}% slower than the baseline')
+
+    def get_postgis_version(self)->str:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT postgis_lib_version()")
+            return cursor.fetchone()[0]
+
+    def delete_benchmark_rows(self)->int:
+        """With SQL: the ORM would load the rows, to send the post_delete signals"""
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM buildings_buildings WHERE description = %s", [BENCHMARK_DESCRIPTION])
+            deleted=cursor.rowcount
+        object_cache.invalidate_layer(Buildings)
+        layer_cache.invalidate(get_layer(Buildings), [ANY_EXTENT])
+        return deleted
+
+    def fill(self, size: int)->int:
+        """Adds the squares of the grid up to size squares. Returns the number of rows of the table"""
+        if self.filled < size:
+            with connection.cursor() as cursor:
+                cursor.execute("""INSERT INTO buildings_buildings (description, geom)
+                                  SELECT %s, ST_MakeEnvelope(x, y, x + %s, y + %s, %s)
+                                  FROM (SELECT (i %% %s)*%s AS x, (i / %s)*%s AS y
+                                        FROM generate_series(%s, %s) AS i) AS cells""",
+                               [BENCHMARK_DESCRIPTION, self.square_size, self.square_size, EPSG_FOR_GEOMETRIES,
+                                self.columns, self.cell_size, self.columns, self.cell_size, self.filled, size - 1])
+                cursor.execute("ANALYZE buildings_buildings")
+            self.filled=size
+        return Buildings.objects.count()
+
+    def random_cell(self)->tuple:
+        """A cell of the grid that has a square and has not been used by other write"""
+        if len(self.used_cells) >= self.filled:
+            raise CommandError('All the cells of the grid have been used. Use less --samples')
+        while True:
+            i=self.random.randrange(self.filled)
+            if i not in self.used_cells:
+                self.used_cells.add(i)
+                return (i % self.columns)*self.cell_size, (i // self.columns)*self.cell_size
+
+    def square_wkt(self, x: float, y: float, size: float)->str:
+        return f'POLYGON(({x} {y}, {x+size} {y}, {x+size} {y+size}, {x} {y+size}, {x} {y}))'
+
+    def free_square(self)->str:
+        """A square in the free part of a cell: it does not touch the square of the grid"""
+        x, y=self.random_cell()
+        return self.square_wkt(x + 0.6*self.cell_size, y + 0.6*self.cell_size, 0.3*self.cell_size)
+
+    def overlapping_square(self)->str:
+        x, y=self.random_cell()
+        return self.square_wkt(x + 0.25*self.cell_size, y + 0.25*self.cell_size, self.square_size)
+
+    def random_bbox(self)->str:
+        width=self.bbox_cells*self.cell_size
+        side=self.columns*self.cell_size
+        x=self.random.uniform(0, max(side - width, 0))
+        y=self.random.uniform(0, max(side*self.filled/self.columns**2 - width, 0))
+        return f'{x},{y},{x + width},{y + width}'
+
+    def get_update_calls(self, n: int)->list:
+        """Updates of the benchmark squares, moved a bit inside their cells"""
+        ids=[]
+        while len(ids) < n:
+            x, y=self.random_cell()
+            b=Buildings.objects.filter(description=BENCHMARK_DESCRIPTION, geom__intersects=self.square_wkt(
+                x + 0.1*self.cell_size, y + 0.1*self.cell_size, 0.1*self.cell_size)).first()
+            if b is None:
+                continue
+            ids.append((b.id, self.square_wkt(x + 0.05*self.cell_size, y + 0.05*self.cell_size, self.square_size)))
+        return [partial(self.client.post, f'/buildings/buildings_view/update/{id}/',
+                        {'geom': wkt, 'description': BENCHMARK_DESCRIPTION}) for id, wkt in ids]
+
+    def get_calls(self, operation: str, n: int)->list:
+        post=self.client.post
+        get=self.client.get
+        data=lambda: {'geom': self.free_square(), 'description': BENCHMARK_DESCRIPTION}
+        if operation=='view_insert':
+            return [partial(post, '/buildings/buildings_view/insert/', data()) for _ in range(n)]
+        if operation=='view_insert2':
+            return [partial(post, '/buildings/buildings_view/insert2/', data()) for _ in range(n)]
+        if operation=='view_update':
+            return self.get_update_calls(n)
+        if operation=='view_selectall':
+            return [partial(get, '/buildings/buildings_view/selectall/') for _ in range(n)]
+        if operation=='view_selectall_bbox':
+            return [partial(get, '/buildings/buildings_view/selectall/', {'bbox': self.random_bbox()}) for _ in range(n)]
+        if operation=='api_list_bbox':
+            return [partial(get, '/buildings/buildings/', {'bbox': self.random_bbox()}) for _ in range(n)]
+        if operation=='api_list_page':
+            return [partial(get, '/buildings/buildings/', {'page_size': 100}) for _ in range(n)]
+        if operation=='api_create':
+            return [partial(post, '/buildings/buildings/', data()) for _ in range(n)]
+        #relate_check
+        checks=[GeometryChecks(self.overlapping_square()) for _ in range(n)]
+        return [partial(gc.check_st_relate, 'buildings_buildings', 'T********') for gc in checks]
+
+    def is_error(self, result)->bool:
+        status_code=getattr(result, 'status_code', None)
+        if status_code is None:
+            return False
+        if status_code >= 400:
+            return True
+        if result.get('Content-Type', '').startswith('application/json'):
+            content=json.loads(result.content)
+            return isinstance(content, dict) and content.get('ok') is False
+        return False
+
+    def run_operation(self, operation: str)->dict:
+        samples, queries, responses=time_calls_with_queries(self.get_calls(operation, self.samples), connection)
+        summary=summarize(samples)
+        summary['queries_mean']=round(sum(queries)/len(queries), 2) if queries else None
+        summary['queries_max']=max(queries) if queries else None
+        summary['errors']=sum(1 for r in responses if self.is_error(r))
+        summary['peak_memory_kb']=round(peak_memory(self.get_calls(operation, self.memory_samples))/1024, 1)
+        return summary
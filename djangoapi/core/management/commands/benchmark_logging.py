@@ -0,0 +1,199 @@
+import logging
+import os
+import time
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+
+from buildings.models import Buildings
+from core.myLib.benchmarkTools import summarize, time_calls_with_queries, write_json
+from core.myLib.layerCache import ANY_EXTENT, get_layer, layer_cache
+from core.myLib.objectCache import object_cache
+from core.myLib.structuredLogging import (BackgroundStreamHandler, DebugSamplingFilter, RequestIdFilter,
+                                          request_logging_context)
+from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION
+
+BENCHMARK_DESCRIPTION = 'benchmark_logging'
+BENCHMARK_USERNAME = 'benchmark_logging'
+#Loggers of the project whose level is changed
+PROJECT_LOGGERS = ('core', 'buildings', 'flowers')
+#Number of print calls of an insert of BuildigsView before the logging, not counting the query
+OLD_INSERT_PRINTS = 15
+#Message of the micro benchmark, with the arguments of a typical one
+MESSAGE = ('Snapped geometry %s', 'POLYGON((751834.4123 4303759.8698, 751844.4123 4303759.8698, '
+           '751844.4123 4303769.8698, 751834.4123 4303759.8698))')
+
+class Command(BaseCommand):
+    """
+    Benchmarks the cost of the logging (core.myLib.structuredLogging) in the requests of
+    BuildigsView, and compares it with the print() calls it has replaced.
+
+    The inserts and updates of BuildigsView, the requests with more messages, are run with
+    the loggers of the project at:
+        - info: the production level. The debug messages are not formatted
+        - debug_sampled: DEBUG, with the debug messages of --sample-rate of the requests
+        - debug: DEBUG, all the debug messages written
+    For each one it records the latency percentiles and the queries per request. The messages
+    are written to os.devnull by a BackgroundStreamHandler, as in production to stdout.
+
+    The micro benchmark measures the cost of one message: a print() to an unbuffered file
+    (PYTHONUNBUFFERED=1, as the Docker image), and a logger.debug disabled, not sampled
+    and written. per_old_insert_us is the cost of the OLD_INSERT_PRINTS messages of an insert.
+    The insert also did two queries more, only to print their results, that are not done now.
+
+    The squares are inserted in a grid of --cell-size units from --origin, that must be empty.
+    They are removed at the end.
+
+    Usage:
+        python manage.py benchmark_logging --samples 200 --output logging.json
+        python manage.py benchmark_logging --origin 100000,100000 --sample-rate 0.05
+    """
+    help = 'Benchmarks the logging of the geometry views against print()'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', type=int, default=100, help='Requests per operation and mode')
+        parser.add_argument('--micro-samples', type=int, default=100000, help='Messages of the micro benchmark')
+        parser.add_argument('--sample-rate', type=float, default=0.01, help='Sample rate of the mode debug_sampled')
+        parser.add_argument('--origin', default='0,0', help='Lower left corner of the grid: x,y')
+        parser.add_argument('--cell-size', type=float, default=None,
+                            help='Size of the cells of the grid. By default 100 times the ST_SNAP_PRECISION')
+        parser.add_argument('--output', default=None, help='JSON file for the results. Stdout by default')
+
+    def handle(self, *args, **options):
+        try:
+            self.origin=tuple(float(v) for v in options['origin'].split(','))
+        except ValueError:
+            raise CommandError('The origin must be x,y')
+        if len(self.origin) != 2 or not 0 <= options['sample_rate'] <= 1:
+            raise CommandError('The origin must be x,y and the sample rate in [0, 1]')
+        self.samples=options['samples']
+        self.cell_size=options['cell_size'] or 100*ST_SNAP_PRECISION
+        #each mode inserts samples squares in its own cells
+        self.columns=max(1, int((3*self.samples)**0.5) + 1)
+        self.next_cell=0
+        if self.grid_has_rows():
+            raise CommandError(f'There are buildings in the grid from {self.origin}. Use other --origin')
+
+        modes={'info': (logging.INFO, 1.0), 'debug_sampled': (logging.DEBUG, options['sample_rate']),
+               'debug': (logging.DEBUG, 1.0)}
+        results={'settings': {'samples': self.samples, 'sample_rate': options['sample_rate'],
+                              'old_insert_prints': OLD_INSERT_PRINTS},
+                 'micro': self.run_micro(options['micro_samples']), 'modes': {}}
+        levels={name: logging.getLogger(name).level for name in PROJECT_LOGGERS}
+        root=logging.getLogger()
+        handlers=root.handlers[:]
+        devnull=open(os.devnull, 'w')
+        allowed_hosts=override_settings(ALLOWED_HOSTS=['testserver'])#the host of the test client
+        allowed_hosts.enable()
+        user, _=User.objects.get_or_create(username=BENCHMARK_USERNAME)
+        try:
+            root.handlers=[self.get_handler(devnull)]
+            for mode, (level, sample_rate) in modes.items():
+                for name in PROJECT_LOGGERS:
+                    logging.getLogger(name).setLevel(level)
+                #the middlewares of the client are created with the settings of its first request
+                with override_settings(LOG_DEBUG_SAMPLE_RATE=sample_rate):
+                    client=Client()
+                    client.force_login(user)
+                    results['modes'][mode]=self.run_mode(client)
+        finally:
+            for handler in root.handlers:
+                handler.close()
+            root.handlers=handlers
+            for name, level in levels.items():
+                logging.getLogger(name).setLevel(level)
+            devnull.close()
+            allowed_hosts.disable()
+            User.objects.filter(username=BENCHMARK_USERNAME).delete()
+            self.delete_benchmark_rows()
+        write_json(results, options['output'], self.stdout)
+
+    def get_handler(self, stream)->logging.Handler:
+        handler=BackgroundStreamHandler(stream)
+        handler.addFilter(DebugSamplingFilter())
+        handler.addFilter(RequestIdFilter())
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+        return handler
+
+    def grid_has_rows(self)->bool:
+        x, y=self.origin
+        grid=GEOSGeometry(self.square_wkt(x, y, self.columns*self.cell_size), srid=EPSG_FOR_GEOMETRIES)
+        return Buildings.objects.filter(geom__intersects=grid).exists()
+
+    def delete_benchmark_rows(self):
+        """With SQL: the ORM would load the rows, to send the post_delete signals"""
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM buildings_buildings WHERE description = %s", [BENCHMARK_DESCRIPTION])
+        object_cache.invalidate_layer(Buildings)
+        layer_cache.invalidate(get_layer(Buildings), [ANY_EXTENT])
+
+    def square_wkt(self, x: float, y: float, size: float)->str:
+        return f'POLYGON(({x} {y}, {x+size} {y}, {x+size} {y+size}, {x} {y+size}, {x} {y}))'
+
+    def new_cell(self)->tuple:
+        i=self.next_cell
+        self.next_cell += 1
+        return (self.origin[0] + (i % self.columns)*self.cell_size, self.origin[1] + (i // self.columns)*self.cell_size)
+
+    def run_mode(self, client)->dict:
+        """Inserts samples squares, and updates them moved a bit inside their cells"""
+        cells=[self.new_cell() for _ in range(self.samples)]
+        size=0.5*self.cell_size
+        inserts=[partial(client.post, '/buildings/buildings_view/insert/',
+                         {'geom': self.square_wkt(x, y, size), 'description': BENCHMARK_DESCRIPTION})
+                 for x, y in cells]
+        results={}
+        results['view_insert'], responses=self.run_calls(inserts)
+        ids=[r.json()['data'][0]['id'] for r in responses]
+        updates=[partial(client.post, f'/buildings/buildings_view/update/{id}/',
+                         {'geom': self.square_wkt(x + 0.1*self.cell_size, y, size), 'description': BENCHMARK_DESCRIPTION})
+                 for id, (x, y) in zip(ids, cells)]
+        results['view_update'], _=self.run_calls(updates)
+        return results
+
+    def run_calls(self, calls: list)->tuple:
+        """Returns the summary of the calls and their responses. Fails if any request has failed"""
+        samples, queries, responses=time_calls_with_queries(calls, connection)
+        errors=[r for r in responses if r.status_code >= 400 or not r.json().get('ok')]
+        if errors:
+            raise CommandError(f'{len(errors)} requests have failed: {errors[0].content[:200]}')
+        summary=summarize(samples)
+        summary['queries_mean']=round(sum(queries)/len(queries), 2) if queries else None
+        return summary, responses
+
+    def run_micro(self, n: int)->dict:
+        """Cost of one message, in microseconds"""
+        logger=logging.getLogger('core.benchmark_logging')
+        logger.propagate=False
+        results={}
+        with open(os.devnull, 'w', buffering=1) as unbuffered:
+            results['print_unbuffered']=self.time_message(n, lambda: print(MESSAGE[0] % MESSAGE[1], file=unbuffered, flush=True))
+        logger.setLevel(logging.INFO)
+        results['debug_disabled']=self.time_message(n, lambda: logger.debug(*MESSAGE))
+        devnull=open(os.devnull, 'w')
+        handler=self.get_handler(devnull)
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            with request_logging_context('micro', debug_sample_rate=0):
+                results['debug_not_sampled']=self.time_message(n, lambda: logger.debug(*MESSAGE))
+            with request_logging_context('micro'):
+                results['debug_written']=self.time_message(n, lambda: logger.debug(*MESSAGE))
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+            devnull.close()
+        for r in results.values():
+            r['per_old_insert_us']=round(r['per_message_us']*OLD_INSERT_PRINTS, 2)
+        return results
+
+    def time_message(self, n: int, call)->dict:
+        t0=time.perf_counter()
+        for _ in range(n):
+            call()
+        return {'per_message_us': round((time.perf_counter() - t0)*1e6/n, 3)}
@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core.myLib.benchmarkTools import summarize, time_calls, write_json
+from core.myLib.geometryTools import GeometryChecks, matrix_implies_intersection
+
+class Command(BaseCommand):
+    """
+    Compares GeometryChecks.check_st_relate with and without the bounding box
+    prefilter &&, over the geometries of a table.
+
+    The candidate geometries are taken from the table itself, moved a bit, so
+    they have the same size and density of the real ones.
+
+    Usage:
+        python manage.py benchmark_st_relate --table buildings_buildings --samples 50 --output relate.json
+    """
+    help = 'Benchmarks check_st_relate with and without the && prefilter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table', default='buildings_buildings')
+        parser.add_argument('--matrix', default='T********')
+        parser.add_argument('--samples', type=int, default=50, help='Number of candidate geometries')
+        parser.add_argument('--repeat', type=int, default=3, help='Times each candidate is checked')
+        parser.add_argument('--offset', type=float, default=1.0, help='Translation applied to the candidates')
+        parser.add_argument('--output', default=None, help='JSON file for the results. Stdout by default')
+
+    def handle(self, *args, **options):
+        table_name=options['table']
+        candidates=self.get_candidates(table_name, options['samples'], options['offset'])
+        if not candidates:
+            raise CommandError(f'The table {table_name} has no geometries')
+
+        results={'table': table_name, 'matrix': options['matrix'],
+                 'rows': self.count_rows(table_name), 'candidates': len(candidates)}
+        for use_bbox_prefilter in (False, True):
+            samples=[]
+            for wkb in candidates:
+                gc=GeometryChecks(wkb)
+                samples += time_calls(gc.check_st_relate, options['repeat'], table_name,
+                                      options['matrix'], use_bbox_prefilter=use_bbox_prefilter)
+            key='with_prefilter' if use_bbox_prefilter else 'without_prefilter'
+            results[key]=summarize(samples)
+            results[key]['plan']=self.get_plan(table_name, options['matrix'], candidates[0], use_bbox_prefilter)
+
+        write_json(results, options['output'], self.stdout)
+
+    def get_candidates(self, table_name: str, samples: int, offset: float)->list:
+        with connection.cursor() as cursor:
+            cursor.execute(f"""SELECT ST_Translate(geom, %s, %s) FROM {table_name}
+                               WHERE geom IS NOT NULL ORDER BY random() LIMIT %s""",
+                           [offset, offset, samples])
+            return [row[0] for row in cursor.fetchall()]
+
+    def count_rows(self, table_name: str)->int:
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {table_name}")
+            return cursor.fetchone()[0]
+
+    def get_plan(self, table_name: str, matrix9IM: str, wkb: str, use_bbox_prefilter: bool)->str:
+        """The plan of the query of check_st_relate: without && if the matrix does not imply intersection"""
+        use_bbox_prefilter=use_bbox_prefilter and matrix_implies_intersection(matrix9IM)
+        prefilter="geom && %s and " if use_bbox_prefilter else ""
+        values=[wkb, wkb, matrix9IM] if use_bbox_prefilter else [wkb, matrix9IM]
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN SELECT id FROM {table_name} WHERE {prefilter}ST_relate(geom,%s,%s)", values)
+            return '\n'.join(row[0] for row in cursor.fetchall())
@@ -0,0 +1,109 @@
+from django.apps import apps
+from django.contrib.gis.db.models import GeometryField
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core.myLib.keysetPagination import SPATIAL_SORT_SQL
+
+class Command(BaseCommand):
+    """
+    Creates, if they do not exist, the GiST indexes over all the geometry columns
+    of the models, and verifies them.
+
+    The geometry checks (GeometryChecks, GeometryValidation) prefilter the relations
+    with the operator &&, which only is fast if the geometry column has a GiST index.
+
+    Usage:
+        python manage.py ensure_spatial_indexes          -> creates the missing indexes
+        python manage.py ensure_spatial_indexes --check  -> only verifies. Fails if any is missing
+    """
+    help = 'Creates and verifies the GiST indexes of all the geometry columns'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only checks the indexes. Exits with error if any is missing')
+        parser.add_argument('--spatial-sort', action='store_true',
+                            help='Also creates the indexes of the spatial order of the keyset pagination')
+
+    def handle(self, *args, **options):
+        missing=[]
+        for table_name, column in self.get_geometry_columns():
+            if not self.table_exists(table_name):
+                self.stdout.write(self.style.WARNING(f'{table_name}: the table does not exist. Run the migrations'))
+                continue
+            index_name=self.get_gist_index(table_name, column)
+            if index_name:
+                self.stdout.write(f'{table_name}.{column}: GiST index {index_name}')
+                continue
+            if options['check']:
+                missing.append(f'{table_name}.{column}')
+                self.stdout.write(self.style.ERROR(f'{table_name}.{column}: without GiST index'))
+                continue
+            self.create_gist_index(table_name, column)
+            index_name=self.get_gist_index(table_name, column)
+            if not index_name:
+                raise CommandError(f'The GiST index on {table_name}.{column} could not be created')
+            self.stdout.write(self.style.SUCCESS(f'{table_name}.{column}: GiST index {index_name} created'))
+
+        if options['spatial_sort'] and not options['check']:
+            for table_name, column in self.get_geometry_columns():
+                if self.table_exists(table_name):
+                    self.create_spatial_sort_index(table_name, column)
+
+        if missing:
+            raise CommandError(f'Geometry columns without GiST index: {missing}')
+
+    def get_geometry_columns(self)->list:
+        """Returns a list of tuples (table_name, column) with all the geometry columns of the models"""
+        columns=[]
+        for model in apps.get_models():
+            if not model._meta.managed or model._meta.proxy:
+                continue
+            for field in model._meta.concrete_fields:
+                if isinstance(field, GeometryField):
+                    columns.append((model._meta.db_table, field.column))
+        return columns
+
+    def table_exists(self, table_name: str)->bool:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [table_name])
+            return cursor.fetchone()[0]
+
+    def get_gist_index(self, table_name: str, column: str)->str:
+        """Returns the name of a valid GiST index whose first column is column, or None"""
+        q="""SELECT i.relname
+             FROM pg_index x
+             JOIN pg_class i ON i.oid = x.indexrelid
+             JOIN pg_am am ON am.oid = i.relam
+             JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = x.indkey[0]
+             WHERE x.indrelid = to_regclass(%s) AND a.attname = %s
+               AND am.amname = 'gist' AND x.indisvalid
+          """
+        with connection.cursor() as cursor:
+            cursor.execute(q, [table_name, column])
+            row=cursor.fetchone()
+            return row[0] if row else None
+
+    def create_gist_index(self, table_name: str, column: str):
+        """Creates the index without blocking the writes, and updates the statistics"""
+        qn=connection.ops.quote_name
+        index_name=f'{table_name}_{column}_gist'[:63]
+        with connection.cursor() as cursor:
+            #a previous CONCURRENTLY creation can fail and leave an invalid index
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {qn(index_name)}")
+            cursor.execute(f"CREATE INDEX CONCURRENTLY {qn(index_name)} ON {qn(table_name)} USING GIST ({qn(column)})")
+            cursor.execute(f"ANALYZE {qn(table_name)}")
+
+    def create_spatial_sort_index(self, table_name: str, column: str):
+        """
+        Creates the btree index over (geohash of the centroid, id), used by the keyset pagination.
+        The index of the previous sort key, without the COALESCE, is not used by the queries: it is dropped
+        """
+        qn=connection.ops.quote_name
+        old_index_name=f'{table_name}_{column}_sort'[:63]
+        index_name=f'{table_name}_{column}_sortkey'[:63]
+        sort_sql=SPATIAL_SORT_SQL.format(geom=qn(column))
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {qn(old_index_name)}")
+            cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {qn(index_name)} ON {qn(table_name)} (({sort_sql}), id)")
+        self.stdout.write(f'{table_name}.{column}: spatial sort index {index_name}')
@@ -0,0 +1,153 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from buildings.models import Buildings, Owners
+from core.myLib.copyTools import copy_from_iterator, copy_text_row
+from core.myLib.layerCache import ANY_EXTENT, get_layer, layer_cache
+from core.myLib.objectCache import object_cache
+from core.myLib.spatialFilters import is_geographic
+from core.myLib.spatialLocks import lock_layer
+from core.myLib.syntheticData import (np, check_numpy, check_polygon_shape, JitteredGrid, building_polygons,
+                                      random_points)
+from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION
+from flowers.models import Flower
+
+SYNTHETIC_DESCRIPTION = 'synthetic'
+SYNTHETIC_DNI_PREFIX = 'SYN'
+DNI_LETTERS = 'TRWAGMYFPDXBNJZSQVHLCKE'
+FIRST_NAMES = ['Ana', 'Luis', 'Marta', 'Jorge', 'Lucia', 'Pablo', 'Elena', 'Carlos', 'Sara', 'Diego']
+SURNAMES = ['Garcia', 'Lopez', 'Martinez', 'Sanchez', 'Perez', 'Gomez', 'Ruiz', 'Diaz', 'Moreno', 'Alvarez']
+
+class Command(BaseCommand):
+    """
+    Generates synthetic buildings, flowers and owners for the load tests, and loads
+    them with COPY. The geometries are in EPSG_FOR_GEOMETRIES, snapped to the ST_SNAP_PRECISION.
+
+    The buildings are star polygons of --vertices vertices, one per cell of a jittered
+    grid of --cell-size units (core.myLib.syntheticData), so they are valid and do not overlap.
+    --density is the fraction of the cells with a building. With --clusters, the cells are
+    chosen with a mixture of gaussians of --cluster-spread cells, and --clustering (0-1) is
+    the weight of the clusters against the uniform background. The flowers are points
+    in the same grid, with the same clusters.
+
+    The same --seed generates the same dataset. The rows have the description 'synthetic'
+    and the owners a dni starting with SYN; --replace removes the ones of a previous run.
+    The grid starts in --origin: place it where there are not real buildings.
+
+    Usage:
+        python manage.py generate_synthetic_dataset --buildings 1000000 --flowers 100000 --owners 100000 --seed 1
+        python manage.py generate_synthetic_dataset --buildings 100000 --clusters 20 --clustering 0.9 --vertices 4,32
+    """
+    help = 'Generates and COPYs synthetic buildings, flowers and owners'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buildings', type=int, default=100000)
+        parser.add_argument('--flowers', type=int, default=0)
+        parser.add_argument('--owners', type=int, default=0)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--density', type=float, default=0.8, help='Fraction of the cells with a building (0-1]')
+        parser.add_argument('--clusters', type=int, default=0, help='Number of clusters. 0: uniform')
+        parser.add_argument('--clustering', type=float, default=0.8, help='Weight of the clusters (0-1)')
+        parser.add_argument('--cluster-spread', type=float, default=50, help='Sigma of the clusters, in cells')
+        parser.add_argument('--vertices', default='4,12', help='Min and max vertices of the polygons: min,max')
+        parser.add_argument('--cell-size', type=float, default=None,
+                            help='Size of the cells in the units of EPSG_FOR_GEOMETRIES. By default 25 m or 0.0003 degrees')
+        parser.add_argument('--origin', default='0,0', help='Lower left corner of the grid: x,y')
+        parser.add_argument('--batch-size', type=int, default=100000, help='Features generated and COPYed at once')
+        parser.add_argument('--replace', action='store_true', help='Remove the synthetic rows of a previous run')
+
+    def handle(self, *args, **options):
+        try:
+            check_numpy()
+        except ImportError as e:
+            raise CommandError(str(e))
+        try:
+            min_vertices, max_vertices=[int(v) for v in options['vertices'].split(',')]
+            origin=tuple(float(v) for v in options['origin'].split(','))
+        except ValueError:
+            raise CommandError('The vertices must be min,max and the origin x,y')
+        if min_vertices < 3 or max_vertices < min_vertices:
+            raise CommandError('The polygons need at least 3 vertices, and max must not be lower than min')
+        if not 0 < options['density'] <= 1 or not 0 <= options['clustering'] <= 1 or len(origin) != 2:
+            raise CommandError('The density must be in (0, 1], the clustering in [0, 1] and the origin x,y')
+        cell_size=options['cell_size'] or max(0.0003 if is_geographic(EPSG_FOR_GEOMETRIES) else 25, 200*ST_SNAP_PRECISION)
+        try:
+            check_polygon_shape(cell_size, max_vertices)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.batch_size=options['batch_size']
+        rng=np.random.default_rng(options['seed'])
+        grid=JitteredGrid(max(1, round(options['buildings']/options['density'])), cell_size, origin)
+        start=time.perf_counter()
+        weights=grid.get_weights(rng, options['clusters'], options['clustering'], options['cluster_spread'])
+        cells=grid.choose_cells(rng, options['buildings'], weights)
+
+        with transaction.atomic():
+            if options['replace']:
+                self.delete_synthetic_rows()
+            elif Buildings.objects.filter(description=SYNTHETIC_DESCRIPTION).exists():
+                raise CommandError('There are synthetic buildings of a previous run. Use --replace')
+            #as the bulk import: the writes of the API wait until the load commits
+            lock_layer(get_layer(Buildings))
+            self.copy_buildings(rng, grid, cells, min_vertices, max_vertices)
+            self.copy_flowers(rng, grid, options['flowers'], weights)
+            self.copy_owners(rng, options['owners'])
+            self.invalidate_caches_on_commit()
+        with connection.cursor() as cursor:
+            for model in (Buildings, Flower, Owners):
+                cursor.execute(f"ANALYZE {connection.ops.quote_name(model._meta.db_table)}")
+
+        self.stdout.write(f"{options['buildings']} buildings, {options['flowers']} flowers and {options['owners']} owners "
+                          f"in {time.perf_counter() - start:.1f} s. Grid of {grid.columns}x{grid.rows} cells of {cell_size} "
+                          f"units from {origin}")
+
+    def delete_synthetic_rows(self):
+        """With SQL: the ORM would load the rows, to send the post_delete signals"""
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM buildings_buildings WHERE description = %s", [SYNTHETIC_DESCRIPTION])
+            cursor.execute(f"DELETE FROM {Flower._meta.db_table} WHERE description = %s", [SYNTHETIC_DESCRIPTION])
+            cursor.execute(f"DELETE FROM {Owners._meta.db_table} WHERE dni LIKE %s", [SYNTHETIC_DNI_PREFIX + '%'])
+
+    def copy(self, table_name: str, columns: list, batches, rows_per_chunk: int=1000):
+        """COPYs the batches, lists of rows, to the table. The rows are sent in chunks of rows_per_chunk"""
+        with connection.cursor() as cursor:
+            for rows in batches:
+                chunks=(''.join(copy_text_row(row) for row in rows[k:k + rows_per_chunk])
+                        for k in range(0, len(rows), rows_per_chunk))
+                copy_from_iterator(cursor, f"COPY {table_name} ({', '.join(columns)}) FROM STDIN", chunks)
+
+    def copy_buildings(self, rng, grid: JitteredGrid, cells, min_vertices: int, max_vertices: int):
+        """The area, perimeter, bbox and centroid are computed by the trigger of the table"""
+        def batches():
+            for k in range(0, len(cells), self.batch_size):
+                wkbs=building_polygons(rng, grid, cells[k:k + self.batch_size], min_vertices, max_vertices)
+                yield [(SYNTHETIC_DESCRIPTION, wkb) for wkb in wkbs]
+        self.copy(Buildings._meta.db_table, ['description', 'geom'], batches())
+
+    def copy_flowers(self, rng, grid: JitteredGrid, n: int, weights):
+        def batches():
+            for k in range(0, n, self.batch_size):
+                m=min(self.batch_size, n - k)
+                wkbs=random_points(rng, grid, m, weights)
+                heath=np.round(rng.uniform(0, 1, m), 3)
+                age_days=rng.integers(0, 365, m)
+                yield [(SYNTHETIC_DESCRIPTION, h, a, wkb) for wkb, h, a in zip(wkbs, heath.tolist(), age_days.tolist())]
+        self.copy(Flower._meta.db_table, ['description', 'heath', 'age_days', 'geom'], batches())
+
+    def copy_owners(self, rng, n: int):
+        def batches():
+            for k in range(0, n, self.batch_size):
+                numbers=range(k, min(n, k + self.batch_size))
+                first_names=rng.choice(FIRST_NAMES, len(numbers))
+                surnames=rng.choice(SURNAMES, len(numbers))
+                yield [(f'{first} {surname}', f'{SYNTHETIC_DNI_PREFIX}{i:08d}{DNI_LETTERS[i % 23]}')
+                       for i, first, surname in zip(numbers, first_names, surnames)]
+        self.copy(Owners._meta.db_table, ['name', 'dni'], batches())
+
+    def invalidate_caches_on_commit(self):
+        for model in (Buildings, Flower):
+            object_cache.invalidate_layer_on_commit(model)
+            transaction.on_commit(lambda layer=get_layer(model): layer_cache.invalidate(layer, [ANY_EXTENT]))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.myLib.layerVersion import get_geometry_tables, install_layer_version_triggers
+
+class Command(BaseCommand):
+    """
+    Installs the triggers that increment the version of the geometry tables
+    in core_layerversion. The versions are the ETags of the conditional GET of the
+    selects, the DRF list and retrieve, and the vector tiles.
+
+    The triggers are installed after each migrate (post_migrate). This command is
+    for the databases restored from a dump, or the tables created outside the migrations.
+
+    Usage:
+        python manage.py install_layer_version_triggers
+        python manage.py install_layer_version_triggers --table buildings_buildings
+    """
+    help = 'Installs the triggers of the versions of the geometry tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--table', action='append', default=None,
+                            help='Table to install. All the geometry tables by default. Can be repeated')
+
+    def handle(self, *args, **options):
+        tables=options['table'] or get_geometry_tables()
+        installed=install_layer_version_triggers(tables)
+        if not installed and tables:
+            raise CommandError('No trigger was installed. Run the migrations first')
+        for table_name in tables:
+            if table_name in installed:
+                self.stdout.write(self.style.SUCCESS(f'{table_name}: trigger installed'))
+            else:
+                self.stdout.write(self.style.WARNING(f'{table_name}: the table does not exist'))
@@ -0,0 +1,281 @@
+import contextlib
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.utils.cache import patch_vary_headers
+
+from djangoapi.settings import COMPRESSION_MIN_SIZE, REQUEST_METRICS_SERVER_TIMING
+from core.myLib.asyncDb import observe_queries
+from core.myLib.compression import acompress_stream, compress, compress_stream, get_compressor, negotiate_encoding
+from core.myLib.requestMetrics import get_labels, measure_request, request_metrics
+from core.myLib.slowQueries import slow_query_recorder
+from core.myLib.structuredLogging import get_request_id, request_logging_context
+
+#Content types that are already compressed
+INCOMPRESSIBLE_CONTENT_TYPES = ('image/', 'video/', 'audio/', 'application/zip', 'application/gzip',
+                                'application/x-gzip', 'application/x-brotli')
+
+class CompressionMiddleware:
+    """
+    Compresses the responses with gzip, or brotli if the package brotli is installed,
+    according to the header Accept-Encoding of the request.
+
+    The streaming responses (selectall?stream=..., the binary formats, the bulk import reports)
+    are compressed chunk by chunk while they are sent: they are not buffered.
+    Only the first chunks, up to COMPRESSION_MIN_SIZE bytes, are read before deciding.
+    The async streaming responses are compressed in the same way when the middleware
+    runs in the ASGI server; in the WSGI server they are sent as they are.
+
+    The responses smaller than COMPRESSION_MIN_SIZE are not compressed. The levels are
+    COMPRESSION_GZIP_LEVEL and COMPRESSION_BROTLI_QUALITY. As the Django GZipMiddleware,
+    the strong ETags are made weak, as the compressed content is not the same.
+
+    Add it to the MIDDLEWARE setting before the middlewares that can change the content:
+        'core.middleware.CompressionMiddleware',
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response, min_size: int=COMPRESSION_MIN_SIZE):
+        self.get_response=get_response
+        self.min_size=min_size
+        self.async_mode=iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        response=self.get_response(request)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        response=await self.get_response(request)
+        if response.streaming and response.is_async:
+            return await self.aprocess_streaming_response(request, response)
+        return self.process_response(request, response)
+
+    def is_compressible(self, response)->bool:
+        if response.has_header('Content-Encoding') or response.status_code in (204, 304):
+            return False
+        if 'no-transform' in response.get('Cache-Control', ''):
+            return False
+        content_type=response.get('Content-Type', '').lower()
+        return not content_type.startswith(INCOMPRESSIBLE_CONTENT_TYPES)
+
+    def get_encoding(self, request, response)->str:
+        """The encoding of the response, or None if it is not compressed"""
+        if not self.is_compressible(response):
+            return None
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+
+    def process_response(self, request, response):
+        encoding=self.get_encoding(request, response)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:#only the async path can read its head
+                return response
+            head, rest=self.read_head(response.streaming_content)
+            if rest is None and len(head) < self.min_size:
+                response.streaming_content=[head]
+                return response
+            chunks=[head] if rest is None else self.chain(head, rest)
+            response.streaming_content=compress_stream(chunks, get_compressor(encoding))
+            del response['Content-Length']
+        else:
+            if len(response.content) < self.min_size:
+                return response
+            compressed=compress(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content=compressed
+            response['Content-Length']=str(len(response.content))
+        return self.set_encoding(response, encoding)
+
+    async def aprocess_streaming_response(self, request, response):
+        """As process_response, for the async streaming responses"""
+        encoding=self.get_encoding(request, response)
+        if encoding is None:
+            return response
+        head, rest=await self.aread_head(response.streaming_content)
+        response.streaming_content=self.achain(head, rest)
+        if rest is None and len(head) < self.min_size:
+            return response
+        response.streaming_content=acompress_stream(response.streaming_content, get_compressor(encoding))
+        del response['Content-Length']
+        return self.set_encoding(response, encoding)
+
+    def set_encoding(self, response, encoding: str):
+        etag=response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag']='W/' + etag
+        response['Content-Encoding']=encoding
+        return response
+
+    def read_head(self, streaming_content):
+        """
+        Reads the first chunks, up to min_size bytes. Returns (head, iterator of the rest),
+        or (head, None) if the stream has ended
+        """
+        iterator=iter(streaming_content)
+        head=[]
+        size=0
+        while size < self.min_size:
+            chunk=next(iterator, None)
+            if chunk is None:
+                return b''.join(head), None
+            head.append(chunk)
+            size += len(chunk)
+        return b''.join(head), iterator
+
+    async def aread_head(self, streaming_content):
+        """As read_head, for an async iterator"""
+        iterator=streaming_content.__aiter__()
+        head=[]
+        size=0
+        while size < self.min_size:
+            try:
+                chunk=await iterator.__anext__()
+            except StopAsyncIteration:
+                return b''.join(head), None
+            head.append(chunk)
+            size += len(chunk)
+        return b''.join(head), iterator
+
+    def chain(self, head: bytes, rest):
+        yield head
+        yield from rest
+
+    async def achain(self, head: bytes, rest):
+        yield head
+        if rest is not None:
+            async for chunk in rest:
+                yield chunk
+
+class RequestMetricsMiddleware:
+    """
+    Measures the SQL queries, the slowest one, the GEOS and serialization phases and the
+    python time of each request (core.myLib.requestMetrics). Adds them to the Server-Timing
+    header of the response if REQUEST_METRICS_SERVER_TIMING, and to the Prometheus
+    metrics of /metrics/, by URL name and action of the BaseDjangoView.
+
+    Its cost is one perf_counter per query and one lock per request, so it can be left
+    in production. Add it the first of the MIDDLEWARE setting, so the queries of the
+    other middlewares (sessions, authentication) are counted:
+        'core.middleware.RequestMetricsMiddleware',
+
+    In the ASGI server the queries measured are the ones of the async pool
+    (core.myLib.asyncDb.observe_queries): the Django connections of the event loop
+    are not the ones used by the sync code of the request.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response, server_timing: bool=REQUEST_METRICS_SERVER_TIMING):
+        self.get_response=get_response
+        self.server_timing=server_timing
+        self.async_mode=iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with measure_request(connections.all()) as timings:
+            response=self.get_response(request)
+        return self.add_timings(request, response, timings)
+
+    async def __acall__(self, request):
+        with measure_request(()) as timings, observe_queries(timings.observe):
+            response=await self.get_response(request)
+        return self.add_timings(request, response, timings)
+
+    def add_timings(self, request, response, timings):
+        total=time.perf_counter() - timings.start
+        request_metrics.add(get_labels(request, response.status_code), timings, total)
+        if self.server_timing:
+            response['Server-Timing']=timings.get_server_timing(total)
+            #the browsers only show it to the origins that can see the response (CORS)
+            allowed_origin=response.get('Access-Control-Allow-Origin')
+            if allowed_origin:
+                response['Timing-Allow-Origin']=allowed_origin
+        return response
+
+class RequestIdMiddleware:
+    """
+    Gives an id to each request: the header X-Request-ID of the request, if it is valid,
+    or a new one. It is in all the log messages of the request (core.myLib.structuredLogging),
+    and in the header X-Request-ID of the response. Chooses if the debug messages of the
+    request are written, with the probability LOG_DEBUG_SAMPLE_RATE.
+
+    Add it the first of the MIDDLEWARE setting:
+        'core.middleware.RequestIdMiddleware',
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response, debug_sample_rate: float=None):
+        self.get_response=get_response
+        #from django.conf, so the tests and the benchmarks can change it with override_settings
+        self.debug_sample_rate=settings.LOG_DEBUG_SAMPLE_RATE if debug_sample_rate is None else debug_sample_rate
+        self.async_mode=iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        request_id=get_request_id(request.META.get('HTTP_X_REQUEST_ID'))
+        with request_logging_context(request_id, self.debug_sample_rate):
+            response=self.get_response(request)
+        response['X-Request-ID']=request_id
+        return response
+
+    async def __acall__(self, request):
+        request_id=get_request_id(request.META.get('HTTP_X_REQUEST_ID'))
+        with request_logging_context(request_id, self.debug_sample_rate):
+            response=await self.get_response(request)
+        response['X-Request-ID']=request_id
+        return response
+
+class SlowQueryMiddleware:
+    """
+    Captures the slow queries of the requests, and all the ones of the sampled requests,
+    with their plans (core.myLib.slowQueries). If SLOW_QUERY_THRESHOLD_MS and
+    SLOW_QUERY_SAMPLE_RATE are 0, it does nothing. Add it after the RequestIdMiddleware,
+    so the captures have the request id, and before the RequestMetricsMiddleware, so the
+    time of the EXPLAIN is not counted as time of the queries of the request:
+        'core.middleware.SlowQueryMiddleware',
+    In the ASGI server the queries captured are the ones of the async pool, without plan.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response, recorder=slow_query_recorder):
+        self.get_response=get_response
+        self.recorder=recorder
+        self.async_mode=iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.recorder.enabled:
+            return self.get_response(request)
+        wrapper=self.recorder.get_wrapper(request.path, self.recorder.is_sampled())
+        with contextlib.ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(wrapper))
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        if not self.recorder.enabled:
+            return await self.get_response(request)
+        with observe_queries(self.recorder.get_observer(request.path, self.recorder.is_sampled())):
+            return await self.get_response(request)
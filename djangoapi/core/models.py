@@ -2,3 +2,16 @@ from django.db import models
 from django.contrib.gis.db import models as gis_models
 # Create your models here.
 
+class LayerVersion(models.Model):
+    """
+    Version of each geometry table, for the ETags of the conditional GET.
+    It is written by the triggers of core_bump_layer_version (core.myLib.layerVersion),
+    not by Django: each transaction with an INSERT, UPDATE or DELETE of the table, when it
+    commits, and each TRUNCATE, increments it.
+    """
+    table_name = models.CharField(max_length=100, primary_key=True)
+    version = models.BigIntegerField(default=0)
+    modified = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.table_name}: {self.version}'
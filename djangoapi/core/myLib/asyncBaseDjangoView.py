@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.contrib.auth.views import redirect_to_login
+from django.http import JsonResponse
+
+from .baseDjangoView import BaseDjangoView
+from .geometryEncoders import get_output_precision
+from .layerVersion import aconditional_layer_response
+
+class AsyncBaseDjangoView(BaseDjangoView):
+    """
+    DJANGO ASYNC CLASS BASED VIEW
+
+    The BaseDjangoView with async handlers, for the ASGI server (uvicorn). While a request
+    waits for the database, the worker serves other requests, so a worker can have many
+    requests in flight instead of one. In production only these views are sent to the
+    ASGI server (the service djangoapi_async of docker-compose.prod.yml): the sync views stay
+    in the WSGI one, as the ASGI handler of Django reads their streaming responses whole
+    before sending them.
+
+    The children implement the actions as coroutines, with the async pool of
+    core.myLib.asyncDb, and AsyncGeometryValidation, which runs the validity and
+    the relation checks at the same time:
+        async def selectone(self, id)
+        async def selectall(self)
+        async def insert(self, request)
+        async def update(self, request, id)
+        async def delete(self, id)
+    The URLs are the same as in the BaseDjangoView. The helpers get_stream_format, get_binary_format,
+    and self.output_precision are the same. The ORM must not be used in the actions:
+    it is sync. Use the async pool, or wrap the ORM calls with asgiref.sync.sync_to_async.
+
+    If login_required is True, the requests of anonymous users are redirected to the LOGIN_URL,
+    as with the LoginRequiredMixin, which can not be used here as it reads the user synchronously.
+    If layer_model is set, the selects have the ETag of the version of the layer, as in the BaseDjangoView.
+    """
+    login_required = False
+
+    async def dispatch(self, request, *args, **kwargs):
+        if self.login_required:
+            user=await request.auser()
+            if not user.is_authenticated:
+                return redirect_to_login(request.get_full_path(), settings.LOGIN_URL)
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def get(self, request, *args, **kwargs):
+        """Handles the 'select' method with a GET request."""
+        action=kwargs.get('action')
+        try:
+            self.output_precision=get_output_precision(request.GET)
+        except ValueError as e:
+            return JsonResponse({'ok':False, 'message': str(e), 'data':[]}, status=400)
+        if action == 'selectone':
+            id = kwargs.get('id')
+            return await self.conditional_response(lambda: self.selectone(id))
+        elif action == 'selectall':
+            return await self.conditional_response(self.selectall)
+        else:
+            return JsonResponse({"message": "Invalid operation option"}, status=400)
+
+    async def post(self, request, *args, **kwargs):
+        """Handles insert, update, and delete depending on the URL parameter."""
+        action = kwargs.get('action')
+        if action == 'insert':
+            return await self.insert(request)
+        elif action == 'update':
+            return await self.update(request, kwargs.get('id'))
+        elif action == 'delete':
+            return await self.delete(kwargs.get('id'))
+        else:
+            return JsonResponse({"message": "Invalid operation option"}, status=400)
+
+    async def conditional_response(self, get_response):
+        """As BaseDjangoView.conditional_response. get_response is a coroutine function"""
+        if self.layer_model is None:
+            return await get_response()
+        return await aconditional_layer_response(self.request, self.layer_model, get_response)
+
+    #GET OPERATIONS
+    async def selectone(self, id):
+        return JsonResponse({'ok':True, 'message': 'Method selectone called: GET', 'data': []}, status=200)
+
+    async def selectall(self):
+        return JsonResponse({'ok':True, 'message': 'Method selectall called: GET', 'data': []}, status=200)
+
+    #POST OPERATIONS
+    async def insert(self, request):
+        return JsonResponse({'ok':True, 'message': 'Method insert called: POST', 'data': []}, status=200)
+
+    async def update(self, request, id):
+        return JsonResponse({'ok':True, 'message': 'Method update called: POST', 'data': []}, status=200)
+
+    async def delete(self, id):
+        return JsonResponse({'ok':True, 'message': 'Method delete called: POST', 'data': []}, status=200)
@@ -0,0 +1,129 @@
+import asyncio
+import contextlib
+import contextvars
+import time
+import weakref
+
+from django.db import connections
+
+from djangoapi.settings import ASYNC_DB_POOL_MIN_SIZE, ASYNC_DB_POOL_MAX_SIZE
+
+try:
+    from psycopg import AsyncClientCursor
+    from psycopg.conninfo import make_conninfo
+    from psycopg_pool import AsyncConnectionPool
+except ImportError: #psycopg_pool is needed only by the async views: pip install psycopg psycopg-pool
+    AsyncConnectionPool = None
+
+#One pool per event loop: the connections of a pool can not be used from other loop.
+#With uvicorn there is one loop per worker
+_pools=weakref.WeakKeyDictionary()
+_acquire_locks=weakref.WeakKeyDictionary()
+#Functions observer(sql, params, duration) called after each query (observe_queries)
+_observers=contextvars.ContextVar('async_query_observers', default=())
+
+def get_conninfo(alias: str='default')->str:
+    """
+    The connection string of the Django database. It is read when the pool is created,
+    so the tests use the test database
+    """
+    settings_dict=connections[alias].settings_dict
+    params={'dbname': settings_dict['NAME'], 'user': settings_dict['USER'], 'password': settings_dict['PASSWORD'],
+            'host': settings_dict['HOST'], 'port': settings_dict['PORT']}
+    params.update({k: v for k, v in settings_dict.get('OPTIONS', {}).items() if k in ('options', 'sslmode')})
+    return make_conninfo(**{k: v for k, v in params.items() if v not in (None, '')})
+
+async def get_async_pool(min_size: int=ASYNC_DB_POOL_MIN_SIZE, max_size: int=ASYNC_DB_POOL_MAX_SIZE):
+    """Returns the psycopg AsyncConnectionPool of the running event loop, opening it the first time"""
+    if AsyncConnectionPool is None:
+        raise ImportError("The async views need the packages psycopg and psycopg-pool")
+    loop=asyncio.get_running_loop()
+    pool=_pools.get(loop)
+    if pool is not None:
+        return pool
+    #client side binding, as the Django cursors, so the SQL of the sync code can be reused as it is
+    pool=AsyncConnectionPool(get_conninfo(), min_size=min_size, max_size=max_size, open=False,
+                             kwargs={'cursor_factory': AsyncClientCursor})
+    await pool.open()
+    #other request of the loop can have opened one meanwhile
+    if loop in _pools:
+        await pool.close()
+        return _pools[loop]
+    _pools[loop]=pool
+    return pool
+
+async def close_async_pool():
+    """Closes the pool of the running event loop"""
+    pool=_pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
+async def fetchone(sql: str, params: list=None):
+    """Runs the query in a connection of the pool, and returns the first row"""
+    pool=await get_async_pool()
+    async with pool.connection() as conn:
+        return await execute_fetchone(conn, sql, params)
+
+async def fetchall(sql: str, params: list=None)->list:
+    pool=await get_async_pool()
+    async with pool.connection() as conn:
+        cursor=await execute(conn, sql, params)
+        return await cursor.fetchall()
+
+@contextlib.asynccontextmanager
+async def acquire_connections(n: int):
+    """
+    Yields a list of n connections of the pool. The requests that need several connections
+    at the same time get them one request after other: if they were taken in parallel,
+    all the requests could keep one connection and wait forever for the second one.
+    At the end, the transactions are committed, or rolled back on exception
+    """
+    pool=await get_async_pool()
+    lock=_acquire_locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+    async with contextlib.AsyncExitStack() as stack:
+        async with lock:
+            conns=[await stack.enter_async_context(pool.connection()) for _ in range(n)]
+        yield conns
+
+@contextlib.contextmanager
+def observe_queries(observer):
+    """
+    As connection.execute_wrapper, for the queries of the pool, that the Django wrappers do not see:
+    observer(sql, params, duration) is called after each query run inside, also by the tasks created
+    inside (asyncio.gather), as they copy the context. Used by the async path of the middlewares
+    """
+    token=_observers.set(_observers.get() + (observer,))
+    try:
+        yield
+    finally:
+        _observers.reset(token)
+
+async def execute(conn, sql: str, params: list=None):
+    """conn.execute, with the observers of observe_queries. Returns the cursor"""
+    observers=_observers.get()
+    if not observers:
+        return await conn.execute(sql, params)
+    start=time.perf_counter()
+    try:
+        return await conn.execute(sql, params)
+    finally:
+        duration=time.perf_counter() - start
+        for observer in observers:
+            observer(sql, params, duration)
+
+async def execute_fetchone(conn, sql: str, params: list=None):
+    cursor=await execute(conn, sql, params)
+    return await cursor.fetchone()
+
+async def gather_queries(*queries, connections: list=None)->list:
+    """
+    Runs the queries, tuples (sql, params), at the same time, each one in its
+    own connection: the ones of the list connections (from acquire_connections), or new
+    ones of the pool. Returns the list of their first rows. The time is the
+    one of the slowest query, not the sum of all of them
+    """
+    if connections is not None:
+        return await asyncio.gather(*(execute_fetchone(conn, sql, params)
+                                      for conn, (sql, params) in zip(connections, queries)))
+    async with acquire_connections(len(queries)) as conns:
+        return await gather_queries(*queries, connections=conns)
@@ -0,0 +1,38 @@
+from .asyncDb import gather_queries
+from .geometryTools import GeometryValidation
+
+class AsyncGeometryValidation(GeometryValidation):
+    """
+    GeometryValidation for the async views. The independent queries run at the same
+    time, each one in a connection of the async pool (core.myLib.asyncDb):
+        - the snap, the validity and the encodings (wkt, geojson).
+        - the relation with the geometries of the table. It is the slow one, with big layers.
+    So the time of the validation is the one of the slowest query, and the event loop
+    serves other requests meanwhile.
+
+    Usage:
+        v=await AsyncGeometryValidation().avalidate(geom_text, 'buildings_buildings', 'T********', with_wkt=True)
+        if not v.is_valid:
+            ... v.valid_reason
+        if v.are_there_related_ids():
+            ... v.get_relate_message()
+    """
+    async def avalidate(self, geom_text: str, table_name: str=None, matrix9IM: str='T********',
+                        id_to_avoid: int=None, with_wkt: bool=False, with_geojson: bool=False,
+                        precision: int=None, connections: list=None):
+        """
+        As GeometryValidation.validate. Returns self.
+        connections are the two connections (core.myLib.asyncDb.acquire_connections) for the queries
+        of the validity and of the relation. For example, the relation can be checked in the
+        connection with the transaction of the write. By default, they are taken from the pool
+        """
+        queries=[(self.get_query(geom_text, None, None, matrix9IM),
+                  self.get_values(geom_text, None, matrix9IM, None, with_wkt, with_geojson, precision))]
+        if table_name is not None:
+            #the relation is only computed if the geometry is valid: see get_query
+            queries.append((self.get_query(geom_text, table_name, id_to_avoid, matrix9IM),
+                            self.get_values(geom_text, table_name, matrix9IM, id_to_avoid, False, False, precision)))
+        rows=await gather_queries(*queries, connections=connections)
+        row=rows[0]
+        ids=rows[1][3] if table_name is not None else None
+        return self.set_result((row[0], row[1], row[2], ids, row[4], row[5]), table_name, matrix9IM)
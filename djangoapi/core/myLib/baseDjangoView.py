@@ -1,7 +1,18 @@
+import logging
 
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.views import View  
 
+from .geoBinaryFormats import negotiate_binary_format
+from .geometryEncoders import get_output_precision
+from .geoStreaming import STREAM_FORMATS
+from .keysetPagination import keyset_page, get_page_size
+from .layerCache import layer_cache, get_layer, get_versioned_key
+from .layerVersion import conditional_layer_response
+from .spatialFilters import apply_spatial_filters, parse_bbox
+
+logger=logging.getLogger(__name__)
+
 class BaseDjangoView(View):
     """
     DJANGO CLASS BASED VIEW
@@ -54,16 +65,66 @@ class BaseDjangoView(View):
         To call them, the URL must be like:
             GET /buildings_view/newgetmethod/
             POST /buildings_view/newpostmethod/       
+
+        The selectall can be streamed, without the MAX_NUMBER_OF_RETRIEVED_ROWS limit,
+        with the parameter stream. The children get it with self.get_stream_format(), 
+        and return core.myLib.geoStreaming.geojson_streaming_response:
+            GET /buildings_view/selectall/?stream=geojson --> GeoJSON FeatureCollection
+            GET /buildings_view/selectall/?stream=ndjson --> newline-delimited GeoJSON
+
+        The selectall can be paginated with keyset pagination, with the parameters cursor,
+        page_size and order ('id' or 'spatial'). The children get the page with 
+        self.get_keyset_page(queryset), and return the next_cursor in the response:
+            GET /buildings_view/selectall/?page_size=100
+            GET /buildings_view/selectall/?page_size=100&order=spatial
+            GET /buildings_view/selectall/?cursor=<next_cursor>
+
+        The selectall can be filtered by bbox, and simplified according to the zoom of the
+        map (or a tolerance). The children get the queryset with self.get_spatial_queryset(queryset),
+        and the geometry to return with core.myLib.spatialFilters.output_geom(obj):
+            GET /buildings_view/selectall/?bbox=minx,miny,maxx,maxy&zoom=14
+            GET /buildings_view/selectall/?bbox=minx,miny,maxx,maxy&bbox_srid=4326&tolerance=2
+        The selectall can be returned in a binary format: WKB, EWKB, TWKB or FlatGeobuf, requested 
+        with the header Accept or with the parameter format. The children get it with
+        self.get_binary_format(), and return core.myLib.geoBinaryFormats.binary_response:
+            GET /buildings_view/selectall/?format=twkb
+            GET /buildings_view/selectall/ -H 'Accept: application/flatgeobuf'
+
+        The output geometries have the decimal digits of the ST_SNAP_PRECISION, or the ones
+        of the parameter precision. The children use self.output_precision with the encoders of
+        core.myLib.geometryEncoders: geom_to_wkt(geom, self.output_precision)
+            GET /buildings_view/selectall/?precision=2
+
+        If the child sets layer_model, the selectall responses with bbox are kept in the
+        layer cache (core.myLib.layerCache). The writes must invalidate them with
+        layer_cache.invalidate_on_commit(get_layer(model), old_geom, new_geom).
+
+        If the child sets layer_model, the selectone and selectall responses have the ETag and
+        Last-Modified of the version of the layer (core.myLib.layerVersion). The requests with
+        If-None-Match or If-Modified-Since get a 304 Not Modified, without querying the geometries,
+        if the layer has not been written since:
+            GET /buildings_view/selectall/ -H 'If-None-Match: "buildings_buildings-12-3a4b5c6d"'
+
+        The children can keep the selectone payloads in the object cache (core.myLib.objectCache):
+            d=object_cache.get_or_set(Buildings, id, f'selectone|{self.output_precision}', lambda: build(id))
+        The post_save and post_delete of the geometry models invalidate them. The raw SQL
+        writes must call object_cache.invalidate_on_commit(model, id).
     """
+    layer_model = None #model of the geometries. If set, the bbox responses are cached and the responses have ETag
+
     def get(self, request, *args, **kwargs):
         """Handles the 'select' method with a GET request."""
 
         action=kwargs.get('action')
+        try:
+            self.output_precision=get_output_precision(request.GET)
+        except ValueError as e:
+            return JsonResponse({'ok':False, 'message': str(e), 'data':[]}, status=400)
         if action == 'selectone':
             id = kwargs.get('id')
-            return self.selectone(id)
+            return self.conditional_response(lambda: self.selectone(id))
         elif action == 'selectall':
-            return self.selectall()
+            return self.conditional_response(self.get_cached_selectall)
         else:            
             return JsonResponse({"message": "Invalid operation option"}, status=400)
 
@@ -71,7 +132,7 @@ class BaseDjangoView(View):
         """Handles insert, update, and delete depending on the URL parameter."""
         
         action = kwargs.get('action')
-        print(f"action father: {action}")
+        logger.debug('action father: %s', action)
         if action == 'insert':
             return self.insert(request)
         elif action == 'update':
@@ -83,6 +144,76 @@ class BaseDjangoView(View):
         else:
             JsonResponse({"message": "Invalid operation option"}, status=400)
     
+    def conditional_response(self, get_response):
+        """
+        Returns get_response() with the ETag of the version of the layer_model, or 304
+        if the request already has it. Without layer_model, only returns get_response()
+        """
+        if self.layer_model is None:
+            return get_response()
+        return conditional_layer_response(self.request, self.layer_model, get_response)
+
+    def get_cached_selectall(self):
+        """
+        Returns the selectall response from the layer cache, if the request has a bbox
+        and it is not streamed. If it is not cached, calls selectall and caches the response,
+        with the extent of the bbox. The key has the version of the layer of the conditional_response.
+        """
+        if (self.layer_model is None or not self.request.GET.get('bbox') or self.get_stream_format()
+                or self.get_binary_format()):
+            return self.selectall()
+        layer=get_layer(self.layer_model)
+        key=get_versioned_key(self.layer_model, self.request.get_full_path())
+        cached=layer_cache.get(layer, key)
+        if cached is not None:
+            return HttpResponse(cached[0], content_type=cached[1])
+        generation=layer_cache.get_generation(layer)
+        response=self.selectall()
+        if response.status_code==200 and not response.streaming:
+            #the selectall has already validated the bbox
+            srid=self.layer_model._meta.get_field('geom').srid
+            bbox=parse_bbox(self.request.GET.get('bbox'), srid, self.request.GET.get('bbox_srid'))
+            layer_cache.set(layer, key, response.content, response['Content-Type'], bbox.extent, generation)
+        return response
+
+    def get_stream_format(self)->str:
+        """
+        Returns the value of the parameter stream of the request: 'geojson' or 'ndjson'.
+        None if the response must not be streamed
+        """
+        stream_format=self.request.GET.get('stream')
+        if stream_format in STREAM_FORMATS:
+            return stream_format
+        return None
+
+    def get_binary_format(self)->str:
+        """
+        Returns the binary format requested with the parameter format or the header Accept:
+        'wkb', 'ewkb', 'twkb' or 'flatgeobuf'. None for the default JSON response
+        """
+        return negotiate_binary_format(self.request)
+
+    def get_keyset_page(self, queryset):
+        """
+        Returns a tuple (list of objects, next_cursor) with the page of the queryset
+        requested with the parameters cursor, page_size and order.
+        Returns None if the request is not paginated.
+        Raises ValueError if the parameters are not valid.
+        """
+        cursor=self.request.GET.get('cursor')
+        page_size=self.request.GET.get('page_size')
+        if cursor is None and page_size is None:
+            return None
+        return keyset_page(queryset, cursor, get_page_size(page_size), self.request.GET.get('order', 'id'))
+
+    def get_spatial_queryset(self, queryset):
+        """
+        Returns the queryset filtered by the parameter bbox, and with the geometries
+        simplified according to the parameters zoom or tolerance.
+        Raises ValueError if the parameters are not valid.
+        """
+        return apply_spatial_filters(queryset, self.request.GET)
+
     #GET OPERATIONS
     def selectone(self, id):
         return JsonResponse({'ok':True, 'message': 'Method selectone called: GET', 'data': []}, status=200)
@@ -0,0 +1,104 @@
+import json
+import math
+import time
+import tracemalloc
+
+from django.test.utils import CaptureQueriesContext
+
+def percentile(sorted_values: list, p: float)->float:
+    """Returns the percentile p (0-100) of a sorted list, with linear interpolation"""
+    if not sorted_values:
+        return None
+    k=(len(sorted_values)-1)*p/100
+    f=math.floor(k)
+    c=math.ceil(k)
+    if f==c:
+        return sorted_values[int(k)]
+    return sorted_values[f]*(c-k) + sorted_values[c]*(k-f)
+
+def summarize(samples_seconds: list)->dict:
+    """
+    Receives a list of durations in seconds and returns a dictionary with
+    the number of samples and the min, mean, p50, p95, p99 and max in milliseconds
+    """
+    values=sorted(s*1000 for s in samples_seconds)
+    if not values:
+        return {'n': 0}
+    return {
+        'n': len(values),
+        'min_ms': round(values[0], 3),
+        'mean_ms': round(sum(values)/len(values), 3),
+        'p50_ms': round(percentile(values, 50), 3),
+        'p95_ms': round(percentile(values, 95), 3),
+        'p99_ms': round(percentile(values, 99), 3),
+        'max_ms': round(values[-1], 3),
+    }
+
+def time_calls(func, repeat: int, *args, **kwargs)->list:
+    """Calls func repeat times and returns the list of durations in seconds"""
+    samples=[]
+    for _ in range(repeat):
+        t0=time.perf_counter()
+        func(*args, **kwargs)
+        samples.append(time.perf_counter()-t0)
+    return samples
+
+def write_json(results: dict, output: str=None, stdout=None):
+    """Writes the results in JSON to the file output, or to stdout if output is None"""
+    text=json.dumps(results, indent=2, default=str)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+    elif stdout is not None:
+        stdout.write(text)
+
+def time_calls_with_queries(calls: list, connection)->tuple:
+    """
+    Calls each function of the list calls, and returns the list of durations in seconds,
+    the list of numbers of queries of each call, and the list of results
+    """
+    samples=[]
+    queries=[]
+    results=[]
+    for call in calls:
+        with CaptureQueriesContext(connection) as context:
+            t0=time.perf_counter()
+            results.append(call())
+            samples.append(time.perf_counter()-t0)
+        queries.append(len(context.captured_queries))
+    return samples, queries, results
+
+def peak_memory(calls: list)->int:
+    """The maximum of the peaks of memory allocated by Python, in bytes, during each call of the list calls"""
+    tracemalloc.start()
+    peak=0
+    try:
+        for call in calls:
+            tracemalloc.reset_peak()
+            current=tracemalloc.get_traced_memory()[0]
+            call()
+            peak=max(peak, tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def compare_to_baseline(results: dict, baseline: dict, metric: str='p95_ms', max_regression: float=20.0,
+                        path: str='')->list:
+    """
+    Compares the metric of all the summaries of results with the ones of the same path in baseline.
+    Returns the list of the regressions: the summaries whose metric is more than
+    max_regression percent greater than the one of the baseline
+    """
+    regressions=[]
+    if not isinstance(results, dict) or not isinstance(baseline, dict):
+        return regressions
+    if metric in results and metric in baseline:
+        new, old=results[metric], baseline[metric]
+        if new is not None and old and (new - old)*100/old > max_regression:
+            regressions.append({'path': path, 'metric': metric, 'baseline': old, 'value': new,
+                                'change_percent': round((new - old)*100/old, 1)})
+        return regressions
+    for key, value in results.items():
+        if key in baseline:
+            regressions += compare_to_baseline(value, baseline[key], metric, max_regression, f'{path}/{key}')
+    return regressions
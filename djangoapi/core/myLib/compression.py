@@ -0,0 +1,137 @@
+import zlib
+
+try:
+    import brotli
+except ImportError: #brotli is optional: pip install brotli
+    brotli = None
+
+from djangoapi.settings import COMPRESSION_GZIP_LEVEL, COMPRESSION_BROTLI_QUALITY
+
+def available_encodings()->list:
+    """The content encodings that can be used, by preference"""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+class GzipStreamCompressor:
+    """
+    Incremental gzip. Each compress(chunk) returns the compressed bytes of the chunk,
+    flushed (Z_SYNC_FLUSH), so the client can decompress what has been sent so far.
+    finish() returns the end of the stream.
+    """
+    encoding = 'gzip'
+
+    def __init__(self, level: int=COMPRESSION_GZIP_LEVEL):
+        #wbits 16 + 15: gzip header and trailer
+        self.compressor=zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes)->bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self)->bytes:
+        return self.compressor.flush()
+
+class BrotliStreamCompressor:
+    """Incremental brotli, as GzipStreamCompressor"""
+    encoding = 'br'
+
+    def __init__(self, quality: int=COMPRESSION_BROTLI_QUALITY):
+        self.compressor=brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes)->bytes:
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self)->bytes:
+        return self.compressor.finish()
+
+def get_compressor(encoding: str, level: int=None):
+    """Returns a new stream compressor of the encoding: 'gzip' or 'br'"""
+    if encoding=='br':
+        if brotli is None:
+            raise ValueError("The brotli encoding needs the package brotli")
+        return BrotliStreamCompressor() if level is None else BrotliStreamCompressor(level)
+    if encoding=='gzip':
+        return GzipStreamCompressor() if level is None else GzipStreamCompressor(level)
+    raise ValueError(f"Unknown encoding {encoding}. The options are {available_encodings()}")
+
+def compress(data: bytes, encoding: str, level: int=None)->bytes:
+    """Compresses all the data at once"""
+    if encoding=='br':
+        if brotli is None:
+            raise ValueError("The brotli encoding needs the package brotli")
+        return brotli.compress(data, quality=COMPRESSION_BROTLI_QUALITY if level is None else level)
+    if encoding=='gzip':
+        compressor=zlib.compressobj(COMPRESSION_GZIP_LEVEL if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    raise ValueError(f"Unknown encoding {encoding}. The options are {available_encodings()}")
+
+def decompress(data: bytes, encoding: str)->bytes:
+    if encoding=='br':
+        return brotli.decompress(data)
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def compress_stream(chunks, compressor, min_block: int=16384):
+    """
+    Yields the compressed chunks. The small chunks are joined in blocks of at least
+    min_block bytes before compressing them, as each flush adds some bytes and
+    makes the compression worse. So only min_block bytes are buffered
+    """
+    pending=[]
+    size=0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk=chunk.encode()
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= min_block:
+            data=compressor.compress(b''.join(pending))
+            pending=[]
+            size=0
+            if data:
+                yield data
+    if pending:
+        yield compressor.compress(b''.join(pending))
+    yield compressor.finish()
+
+async def acompress_stream(chunks, compressor, min_block: int=16384):
+    """As compress_stream, for the async iterators of the streaming responses of the async views"""
+    pending=[]
+    size=0
+    async for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk=chunk.encode()
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= min_block:
+            data=compressor.compress(b''.join(pending))
+            pending=[]
+            size=0
+            if data:
+                yield data
+    if pending:
+        yield compressor.compress(b''.join(pending))
+    yield compressor.finish()
+
+def negotiate_encoding(accept_encoding: str)->str:
+    """
+    Returns the content encoding to use for the header Accept-Encoding: 'br', 'gzip',
+    or None if none is accepted. With equal qualities, brotli is preferred if it is available
+    """
+    qualities={}
+    for part in accept_encoding.split(','):
+        items=[item.strip() for item in part.split(';')]
+        if not items[0]:
+            continue
+        q=1.0
+        for item in items[1:]:
+            if item.startswith('q='):
+                try:
+                    q=float(item[2:])
+                except ValueError:
+                    q=0
+        qualities[items[0].lower()]=q
+    best=None
+    best_q=0
+    for encoding in available_encodings():
+        q=qualities.get(encoding, qualities.get('*', 0))
+        if q > best_q:
+            best, best_q=encoding, q
+    return best
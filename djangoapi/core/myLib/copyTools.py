@@ -0,0 +1,50 @@
+
+def copy_text_value(value)->str:
+    """Escapes a value for the text format of the PostgreSQL COPY. None is NULL"""
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+def copy_text_row(values)->str:
+    """Returns a line of the text format of the PostgreSQL COPY, with the values"""
+    return '\t'.join(copy_text_value(v) for v in values) + '\n'
+
+class IterStream:
+    """
+    File-like object over an iterator of strings, to feed cursor.copy_expert
+    without building the whole file in memory. copy_expert calls read(size)
+    until it returns an empty string.
+
+    Usage:
+        rows=(copy_text_row(r) for r in generate_rows())
+        cursor.copy_expert("COPY table (a, b) FROM STDIN", IterStream(rows))
+    """
+    def __init__(self, iterator):
+        self.iterator=iter(iterator)
+        self.buffer=''
+
+    def read(self, size: int=-1)->str:
+        while size < 0 or len(self.buffer) < size:
+            chunk=next(self.iterator, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            data, self.buffer=self.buffer, ''
+        else:
+            data, self.buffer=self.buffer[:size], self.buffer[size:]
+        return data
+
+def copy_from_iterator(cursor, sql: str, chunks):
+    """
+    Runs the COPY ... FROM STDIN sql with the data of the iterator of strings,
+    without building the whole file in memory. With psycopg2 (copy_expert)
+    and with psycopg 3 (copy), whatever the driver Django uses
+    """
+    if hasattr(cursor, 'copy_expert'):
+        cursor.copy_expert(sql, IterStream(chunks))
+        return
+    with cursor.copy(sql) as copy:
+        for chunk in chunks:
+            copy.write(chunk)
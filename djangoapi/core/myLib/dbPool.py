@@ -0,0 +1,28 @@
+from django.db import connections
+
+def get_pool_metrics(alias: str='default')->dict:
+    """
+    The size and the waits of the connection pool of this process (settings DB_POOL).
+    The waits are the ones of the requests that found no free connection:
+    requests_waiting now, and requests_wait_ms in total since the pool was opened.
+    Returns {'enabled': False} if the database has no pool
+    """
+    pool=getattr(connections[alias], 'pool', None)
+    if pool is None:
+        return {'enabled': False}
+    stats=pool.get_stats()
+    requests=stats.get('requests_num', 0)
+    return {
+        'enabled': True,
+        'min_size': stats.get('pool_min'),
+        'max_size': stats.get('pool_max'),
+        'size': stats.get('pool_size'),
+        'available': stats.get('pool_available'),
+        'requests': requests,
+        'requests_waiting': stats.get('requests_waiting', 0),
+        'requests_queued': stats.get('requests_queued', 0),
+        'requests_wait_ms': stats.get('requests_wait_ms', 0),
+        'mean_wait_ms': round(stats.get('requests_wait_ms', 0)/requests, 3) if requests else 0,
+        'requests_errors': stats.get('requests_errors', 0),
+        'connections_lost': stats.get('connections_lost', 0),
+    }
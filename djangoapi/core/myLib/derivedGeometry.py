@@ -0,0 +1,97 @@
+from django.apps import apps
+from django.db import connection
+
+#SQL of the columns that the database derives from the geometry.
+#The bbox is built with ST_MakeEnvelope, as ST_Envelope returns points or lines
+#for the degenerated geometries, that do not fit in a polygon column
+DERIVED_GEOMETRY_EXPRESSIONS = {
+    'area': 'ST_Area({geom})',
+    'perimeter': 'ST_Perimeter({geom})',
+    'bbox': 'ST_MakeEnvelope(ST_XMin({geom}), ST_YMin({geom}), ST_XMax({geom}), ST_YMax({geom}), ST_SRID({geom}))',
+    'centroid': 'ST_Centroid({geom})',
+}
+DERIVED_GEOMETRY_TRIGGER = 'derived_geometry'
+
+def get_derived_models()->list:
+    """
+    The models with the attribute derived_geometry_fields: the fields that
+    the database computes from the geometry. For example:
+        class Buildings(models.Model):
+            derived_geometry_fields = ['area', 'perimeter', 'bbox', 'centroid']
+    """
+    return [model for model in apps.get_models()
+            if getattr(model, 'derived_geometry_fields', None) and model._meta.managed]
+
+def get_derived_assignments(model, geom: str='geom', prefix: str='')->list:
+    """The SQL 'column = expression' of the derived fields of the model"""
+    qn=connection.ops.quote_name
+    geom=prefix + qn(model._meta.get_field(geom).column)
+    assignments=[]
+    for name in model.derived_geometry_fields:
+        if name not in DERIVED_GEOMETRY_EXPRESSIONS:
+            raise ValueError(f"Unknown derived geometry field {name}. The options are {list(DERIVED_GEOMETRY_EXPRESSIONS)}")
+        column=qn(model._meta.get_field(name).column)
+        assignments.append((prefix + column, DERIVED_GEOMETRY_EXPRESSIONS[name].format(geom=geom)))
+    return assignments
+
+def install_derived_geometry_trigger(model, geom: str='geom')->bool:
+    """
+    Creates the BEFORE INSERT OR UPDATE OF <geometry and derived columns> trigger that
+    computes the derived fields of the model from the stored geometry, so they are always
+    the ones of the snapped geometry, whatever the write path: ORM, raw SQL or COPY.
+    The updates that do not set those columns, as the ones of the description, do not
+    run it. Returns False if the table does not exist
+    """
+    qn=connection.ops.quote_name
+    table_name=model._meta.db_table
+    function_name=f'{table_name}_{DERIVED_GEOMETRY_TRIGGER}'
+    body=''.join(f'    {column} := {expression};\n'
+                 for column, expression in get_derived_assignments(model, geom, prefix='NEW.'))
+    #the derived columns too, so a write of them is replaced by the computed values
+    columns=', '.join(qn(model._meta.get_field(name).column) for name in [geom] + list(model.derived_geometry_fields))
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [table_name])
+        if not cursor.fetchone()[0]:
+            return False
+        cursor.execute(f"""CREATE OR REPLACE FUNCTION {qn(function_name)}() RETURNS trigger AS $$
+BEGIN
+{body}    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql""")
+        cursor.execute(f"""CREATE OR REPLACE TRIGGER {DERIVED_GEOMETRY_TRIGGER}
+                           BEFORE INSERT OR UPDATE OF {columns} ON {qn(table_name)}
+                           FOR EACH ROW EXECUTE FUNCTION {qn(function_name)}()""")
+    return True
+
+def install_derived_geometry_triggers_on_migrate(sender, **kwargs):
+    """post_migrate receiver"""
+    for model in get_derived_models():
+        install_derived_geometry_trigger(model)
+
+def backfill_derived_geometry(model, batch_size: int=5000, only_missing: bool=False, geom: str='geom'):
+    """
+    Computes the derived fields of the existing rows, in batches of ids, so each
+    UPDATE locks only batch_size rows. Yields the number of updated rows of each batch
+    """
+    qn=connection.ops.quote_name
+    table_name=qn(model._meta.db_table)
+    pk=qn(model._meta.pk.column)
+    assignments=get_derived_assignments(model, geom)
+    sets=', '.join(f'{column} = {expression}' for column, expression in assignments)
+    where=''
+    if only_missing:
+        where=' AND (' + ' OR '.join(f'{column} IS NULL' for column, _ in assignments) + ')'
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT min({pk}), max({pk}) FROM {table_name}")
+        first, last=cursor.fetchone()
+        if first is None:
+            return
+        for start in range(first, last + 1, batch_size):
+            cursor.execute(f"UPDATE {table_name} SET {sets} WHERE {pk} >= %s AND {pk} < %s{where}",
+                           [start, start + batch_size])
+            yield cursor.rowcount
+
+def refresh_derived_fields(instance):
+    """Reads the derived fields computed by the database after a save"""
+    instance.refresh_from_db(fields=instance.derived_geometry_fields)
+    return instance
@@ -0,0 +1,214 @@
+"""
+Binary responses of the geometry layers: GeoBinaryViewSetMixin, BaseDjangoView.get_binary_format.
+
+'flatgeobuf' is a standard FlatGeobuf file (application/flatgeobuf). 'wkb', 'ewkb' and 'twkb'
+are a sequence of records, one per row, that is not a standard format, so they have
+media types of this project, and not the ones of a single WKB geometry:
+    application/vnd.metatierrascol.wkb-records
+    application/vnd.metatierrascol.ewkb-records
+    application/vnd.metatierrascol.twkb-records
+Each record is:
+    uint32 little endian: length of the properties
+    properties: UTF-8 JSON object, with the id and the properties
+    uint32 little endian: length of the geometry. 0 if the geometry is null
+    geometry: one WKB, EWKB or TWKB geometry, as ST_AsBinary, ST_AsEWKB and ST_AsTWKB
+The records end with the response. The header X-Srid has the srid of the geometries.
+To read them:
+    i=0
+    while i < len(content):
+        n=struct.unpack_from('<I', content, i)[0]
+        properties=json.loads(content[i+4:i+4+n])
+        i += 4 + n
+        n=struct.unpack_from('<I', content, i)[0]
+        geometry=GEOSGeometry(content[i+4:i+4+n]) if n else None
+        i += 4 + n
+"""
+
+import json
+import struct
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.gis.db.models.functions import AsWKB, GeoFunc
+from django.db import connection
+from django.db.models import BinaryField
+from django.http import HttpResponse, StreamingHttpResponse
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from .geometryTools import snap_decimal_digits
+from .spatialFilters import output_geom_field
+
+#Binary formats of the geometries. The keys are the values of the parameter format.
+#The records of wkb, ewkb and twkb are not a standard format: vendor media types
+BINARY_FORMATS = {
+    'wkb': 'application/vnd.metatierrascol.wkb-records',
+    'ewkb': 'application/vnd.metatierrascol.ewkb-records',
+    'twkb': 'application/vnd.metatierrascol.twkb-records',
+    'flatgeobuf': 'application/flatgeobuf',
+}
+#Media types that prefer the default JSON response
+JSON_MEDIA_TYPES = ('application/json', 'application/geo+json', 'text/html', 'application/*', 'text/*', '*/*')
+
+class AsEWKB(GeoFunc):
+    """ST_AsEWKB(geom): WKB with the SRID"""
+    function = 'ST_AsEWKB'
+    output_field = BinaryField()
+    arity = 1
+
+class AsTWKB(GeoFunc):
+    """ST_AsTWKB(geom, precision): tiny WKB, with the coordinates as deltas of precision decimal digits"""
+    function = 'ST_AsTWKB'
+    output_field = BinaryField()
+
+    def __init__(self, expression, precision: int, **extra):
+        super().__init__(expression, self._handle_param(precision, 'precision', int), **extra)
+
+def parse_accept(accept: str)->list:
+    """Returns the media types of an Accept header, sorted by quality. Equal qualities keep the order"""
+    media_types=[]
+    for i, part in enumerate(accept.split(',')):
+        items=[item.strip() for item in part.split(';')]
+        if not items[0]:
+            continue
+        q=1.0
+        for item in items[1:]:
+            if item.startswith('q='):
+                try:
+                    q=float(item[2:])
+                except ValueError:
+                    q=0
+        if q > 0:
+            media_types.append((-q, i, items[0].lower()))
+    return [m for _, _, m in sorted(media_types)]
+
+def negotiate_binary_format(request)->str:
+    """
+    Returns the binary format requested with the parameter format, or with the header
+    Accept: 'wkb', 'ewkb', 'twkb' or 'flatgeobuf'. Returns None for the default JSON response.
+    The Accept header only selects a binary format if it is preferred to JSON
+    """
+    binary_format=request.GET.get('format')
+    if binary_format in BINARY_FORMATS:
+        return binary_format
+    media_to_format={v: k for k, v in BINARY_FORMATS.items()}
+    for media_type in parse_accept(request.META.get('HTTP_ACCEPT', '')):
+        if media_type in media_to_format:
+            return media_to_format[media_type]
+        if media_type in JSON_MEDIA_TYPES:
+            return None
+    return None
+
+def get_geom_expression(binary_format: str, geom_field: str, precision: int=None):
+    if binary_format=='wkb':
+        return AsWKB(geom_field)
+    if binary_format=='ewkb':
+        return AsEWKB(geom_field)
+    return AsTWKB(geom_field, snap_decimal_digits() if precision is None else precision)
+
+def iter_records(queryset, properties: list, binary_format: str='wkb', geom_field: str='geom',
+                 precision: int=None, chunk_size: int=2000, batch: int=200):
+    """
+    Yields the rows of the queryset as length-prefixed binary records (see the module docstring):
+        uint32 little endian: length of the properties
+        properties: UTF-8 JSON object, with the id and the properties
+        uint32 little endian: length of the geometry. 0 if the geometry is null
+        geometry: WKB, EWKB or TWKB, encoded by PostGIS
+    The rows are read with a server side cursor, so the memory does not depend on the number of rows.
+    TWKB uses precision decimal digits, the ones of the ST_SNAP_PRECISION by default, so there is no loss.
+    """
+    geom_field=output_geom_field(queryset, geom_field)
+    rows=(queryset.annotate(geom_binary=get_geom_expression(binary_format, geom_field, precision))
+          .values_list('id', *properties, 'geom_binary')
+          .iterator(chunk_size=chunk_size))
+    pending=[]
+    for row in rows:
+        props=json.dumps(dict(zip(['id'] + properties, row[:-1])), cls=DjangoJSONEncoder).encode()
+        geometry=bytes(row[-1]) if row[-1] is not None else b''
+        pending.append(struct.pack('<I', len(props)) + props + struct.pack('<I', len(geometry)) + geometry)
+        if len(pending) >= batch:
+            yield b''.join(pending)
+            pending=[]
+    if pending:
+        yield b''.join(pending)
+
+def get_flatgeobuf(queryset, properties: list, geom_field: str='geom')->bytes:
+    """
+    Returns the rows of the queryset as a FlatGeobuf file, with a spatial index,
+    built by PostGIS with ST_AsFlatGeobuf. The file is built in the database as one value:
+    filter big layers by bbox
+    """
+    geom_field=output_geom_field(queryset, geom_field)
+    sql, params=queryset.values('id', *properties, geom_field).query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT ST_AsFlatGeobuf(q, true, %s) FROM ({sql}) q", [geom_field, *params])
+        row=cursor.fetchone()
+    return bytes(row[0]) if row and row[0] is not None else b''
+
+def binary_response(queryset, properties: list, binary_format: str, geom_field: str='geom', precision: int=None):
+    """
+    Returns the rows of the queryset in the binary format: a StreamingHttpResponse of
+    records for 'wkb', 'ewkb' and 'twkb' (see iter_records), or an HttpResponse with
+    the FlatGeobuf file. The header X-Srid has the srid of the geometries
+    """
+    srid=queryset.model._meta.get_field(geom_field).srid
+    if binary_format=='flatgeobuf':
+        response=HttpResponse(get_flatgeobuf(queryset, properties, geom_field), content_type=BINARY_FORMATS[binary_format])
+    else:
+        response=StreamingHttpResponse(iter_records(queryset.order_by('id'), properties, binary_format, geom_field, precision),
+                                       content_type=BINARY_FORMATS[binary_format])
+    response['X-Srid']=str(srid)
+    return response
+
+class GeoBinaryRenderer(BaseRenderer):
+    """
+    DJANGO REST FRAMEWORK RENDERER. Only for the content negotiation: the views
+    with GeoBinaryViewSetMixin return the binary response from the queryset, and the
+    other responses (errors, other actions) are rendered in JSON
+    """
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return JSONRenderer().render(data, accepted_media_type, renderer_context)
+
+BINARY_RENDERERS = [type(f'{name.capitalize()}Renderer', (GeoBinaryRenderer,),
+                         {'media_type': media_type, 'format': name, 'binary_format': name})
+                    for name, media_type in BINARY_FORMATS.items()]
+
+class GeoBinaryViewSetMixin:
+    """
+    Mixin for the ModelViewSets of geometry models. The list and the retrieve
+    are returned in a binary format if it is requested with the Accept header
+    or with the parameter format (see BINARY_FORMATS):
+        GET /buildings/buildings/?format=twkb
+        GET /buildings/buildings/ -H 'Accept: application/flatgeobuf'
+    The JSON is the default. Set binary_properties with the fields to send with the geometries.
+    """
+    binary_properties = []
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + BINARY_RENDERERS
+
+    def get_binary_format(self)->str:
+        renderer=getattr(self.request, 'accepted_renderer', None)
+        return getattr(renderer, 'binary_format', None)
+
+    def list(self, request, *args, **kwargs):
+        binary_format=self.get_binary_format()
+        if binary_format is None:
+            return super().list(request, *args, **kwargs)
+        return binary_response(self.filter_queryset(self.get_queryset()), self.binary_properties, binary_format)
+
+    def retrieve(self, request, *args, **kwargs):
+        binary_format=self.get_binary_format()
+        if binary_format is None:
+            return super().retrieve(request, *args, **kwargs)
+        instance=self.get_object()
+        return binary_response(self.get_queryset().filter(pk=instance.pk), self.binary_properties, binary_format)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        #the other responses, as the errors, are sent in JSON
+        if self.get_binary_format() is not None and isinstance(response, Response):
+            request.accepted_renderer=JSONRenderer()
+            request.accepted_media_type=JSONRenderer.media_type
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -0,0 +1,253 @@
+import json
+import uuid
+
+from django.core.exceptions import ValidationError
+from django.contrib.gis.gdal import GDALException
+from django.contrib.gis.geos import GEOSGeometry, GEOSException
+from django.db import connection, transaction
+
+from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION
+from .copyTools import copy_from_iterator, copy_text_row
+from .geometryTools import wkb_to_hex, matrix_implies_intersection
+from .layerCache import layer_cache, get_layer
+from .objectCache import object_cache
+from .spatialLocks import lock_layer
+
+class GeoBulkImporter:
+    """
+    Imports a stream of GeoJSON features into the table of a model, in bulk.
+    The table is expected to have the fields:
+        -id: the primary key of the table
+        -geom: the geometry field
+
+    The steps are:
+        1. The features are read one by one, and COPYed into a temporary staging table.
+            Here only the properties are validated (field.clean) and the geometry
+            is parsed and its type checked.
+        2. The snap, the validity check, and the relation check with the geometries
+            of the table and with the other imported features, are done with set-based
+            SQL over the staging table. When two imported features have the relation,
+            the first one wins: the features are decided in the order of the stream, and
+            a feature is only rejected by the previous ones that have been accepted.
+        3. Only the features that pass all checks are inserted. On commit, the cached
+            tiles and responses of the layer that touch the extent of the inserted features
+            are invalidated.
+        4. The report, with one line per feature, is read from the staging table with
+            a server side cursor.
+    The memory used does not depend on the number of features, only on the number of
+    imported features related with previous ones.
+
+    To use it, inherit and set the class attributes. For example:
+        class BuildingsBulkImporter(GeoBulkImporter):
+            model = Buildings
+            properties = ['description']
+
+        importer=BuildingsBulkImporter().run(GeojsonStreamReader(request))
+        for line in importer.iter_report():
+            ...
+    """
+    model = None
+    properties = [] #fields of the model read from the properties of the features
+    check_st_relation = True #if true it will chck the relation of the geometry with the other geometries
+    matrix9IM = 'T********' #matrix 9IM for the relation of the geometries: 'T********' = interiors intersects
+    sql_columns = {} #columns of the model computed with a SQL expression over the snaped geom. For example
+            #{'area': 'ST_Area(geom)'}, if the model has not the area maintained by a trigger (core.myLib.derivedGeometry)
+
+    def __init__(self, epsg_for_geometries: int=EPSG_FOR_GEOMETRIES,
+                 st_snap_precision: float=ST_SNAP_PRECISION):
+        self.epsg_for_geometries=int(epsg_for_geometries)
+        self.st_snap_precision=st_snap_precision
+        self.staging_table=f"bulk_import_{uuid.uuid4().hex[:16]}"
+        self.accepted=0
+        self.rejected=0
+
+    def get_table_name(self)->str:
+        return self.model._meta.db_table
+
+    def get_property_fields(self)->list:
+        return [self.model._meta.get_field(name) for name in self.properties]
+
+    def run(self, features):
+        """
+        Imports the features, an iterable of GeoJSON features as dictionaries.
+        All is done in one transaction. Returns self
+        """
+        with transaction.atomic():
+            #waits for the edits of the layer, and the new ones wait for the import
+            lock_layer(self.get_table_name())
+            self.create_staging_table()
+            self.copy_features(features)
+            self.check_features()
+            self.insert_features()
+        return self
+
+    def create_staging_table(self):
+        qn=connection.ops.quote_name
+        columns=''.join(f"{qn(f.column)} {f.db_type(connection)}, " for f in self.get_property_fields())
+        with connection.cursor() as cursor:
+            cursor.execute(f"""CREATE TEMP TABLE {self.staging_table} (
+                                    ord bigint,
+                                    reject_reason text,
+                                    {columns}
+                                    geom_raw geometry,
+                                    geom geometry,
+                                    new_id bigint
+                                )""")
+
+    def feature_to_copy_row(self, ord: int, feature: dict)->str:
+        """
+        Returns the COPY line of the feature. If the properties or the geometry
+        are wrong, the line has the reject_reason
+        """
+        fields=self.get_property_fields()
+        geom_field=self.model._meta.get_field('geom')
+        try:
+            properties=feature.get('properties') or {}
+            values=[field.clean(properties.get(field.name), None) for field in fields]
+            geometry=feature.get('geometry')
+            if not geometry:
+                raise ValueError('The geometry is mandatory')
+            g=GEOSGeometry(json.dumps(geometry))
+            if g.geom_type.upper() != geom_field.geom_type.upper():
+                raise ValueError(f'The geometry must be a {geom_field.geom_type}, not a {g.geom_type}')
+            g.srid=self.epsg_for_geometries
+            return copy_text_row([ord, None] + values + [wkb_to_hex(g.ewkb)])
+        except ValidationError as e:
+            reason='; '.join(e.messages)
+        except (ValueError, TypeError, AttributeError, GEOSException, GDALException) as e:
+            reason=f'Wrong feature: {e}'
+        return copy_text_row([ord, reason] + [None]*len(fields) + [None])
+
+    def copy_features(self, features):
+        qn=connection.ops.quote_name
+        columns=''.join(f"{qn(f.column)}, " for f in self.get_property_fields())
+        rows=(self.feature_to_copy_row(ord, feature) for ord, feature in enumerate(features))
+        with connection.cursor() as cursor:
+            copy_from_iterator(cursor, f"COPY {self.staging_table} (ord, reject_reason, {columns}geom_raw) FROM STDIN", rows)
+            cursor.execute(f"ALTER TABLE {self.staging_table} ADD PRIMARY KEY (ord)")
+
+    def check_features(self):
+        """Snap, validity and relation checks, set-based"""
+        table_name=self.get_table_name()
+        s=self.staging_table
+        prefilter_t="t.geom && s.geom AND" if matrix_implies_intersection(self.matrix9IM) else ""
+        with connection.cursor() as cursor:
+            cursor.execute(f"""UPDATE {s} SET geom = ST_SNAPTOGRID(geom_raw, %s)
+                               WHERE reject_reason IS NULL""", [self.st_snap_precision])
+            #the invalid geometries must be rejected always, as ST_Relate can fail with them
+            cursor.execute(f"""UPDATE {s} SET reject_reason = 'The geometry is empty after the st_SnapToGrid'
+                               WHERE reject_reason IS NULL AND ST_IsEmpty(geom)""")
+            cursor.execute(f"""UPDATE {s} SET reject_reason = 'The geometry is not valid after the st_SnapToGrid. ' || ST_IsValidReason(geom)
+                               WHERE reject_reason IS NULL AND NOT ST_IsValid(geom)""")
+            if not self.check_st_relation:
+                return
+            cursor.execute(f"CREATE INDEX ON {s} USING GIST (geom)")
+            cursor.execute(f"ANALYZE {s}")
+            cursor.execute(f"""UPDATE {s} SET reject_reason = format(
+                                    'The following ids of the table {table_name} have the requested relation (ST_relate, matrix: %%s) with the geometry: %%s',
+                                    %s, r.ids)
+                               FROM (SELECT s.ord, array_agg(t.id ORDER BY t.id) AS ids
+                                     FROM {s} s JOIN {table_name} t
+                                        ON {prefilter_t} ST_relate(t.geom, s.geom, %s)
+                                     WHERE s.reject_reason IS NULL
+                                     GROUP BY s.ord) r
+                               WHERE {s}.ord = r.ord""", [self.matrix9IM, self.matrix9IM])
+        self.check_import_relations()
+
+    def check_import_relations(self):
+        """
+        Rejects the features related with previous accepted features of the import.
+        The pairs are found with one set-based query, and decided in Python in the
+        order of the stream: in a chain A-B-C, B is rejected by A, and C is accepted,
+        as B is not imported
+        """
+        s=self.staging_table
+        prefilter="s1.geom && s.geom AND" if matrix_implies_intersection(self.matrix9IM) else ""
+        rejected={}
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(f"""SELECT s.ord, array_agg(s1.ord ORDER BY s1.ord)
+                               FROM {s} s JOIN {s} s1
+                                  ON s1.ord < s.ord AND {prefilter} ST_relate(s1.geom, s.geom, %s)
+                               WHERE s.reject_reason IS NULL AND s1.reject_reason IS NULL
+                               GROUP BY s.ord ORDER BY s.ord""", [self.matrix9IM])
+            while True:
+                rows=cursor.fetchmany(2000)
+                if not rows:
+                    break
+                for ord, previous in rows:
+                    #the previous ones are already decided
+                    accepted=[p for p in previous if p not in rejected]
+                    if accepted:
+                        rejected[ord]=accepted
+        if not rejected:
+            return
+        reasons=[f"The following previous features of the import have the requested relation "
+                 f"(ST_relate, matrix: {self.matrix9IM}) with the geometry: {{{','.join(map(str, ords))}}}"
+                 for ords in rejected.values()]
+        with connection.cursor() as cursor:
+            cursor.execute(f"""UPDATE {s} SET reject_reason = r.reason
+                               FROM unnest(%s::bigint[], %s::text[]) AS r(ord, reason)
+                               WHERE {s}.ord = r.ord""", [list(rejected), reasons])
+
+    def insert_features(self):
+        qn=connection.ops.quote_name
+        table_name=self.get_table_name()
+        pk=self.model._meta.pk.column
+        s=self.staging_table
+        columns=[qn(f.column) for f in self.get_property_fields()]
+        expressions=list(columns)
+        for column, expression in self.sql_columns.items():
+            columns.append(qn(column))
+            expressions.append(expression)
+        columns=''.join(f"{c}, " for c in columns)
+        expressions=''.join(f"{e}, " for e in expressions)
+        with connection.cursor() as cursor:
+            cursor.execute(f"""UPDATE {s} SET new_id = nextval(pg_get_serial_sequence(%s, %s))
+                               WHERE reject_reason IS NULL""", [table_name, pk])
+            cursor.execute(f"""INSERT INTO {qn(table_name)} ({qn(pk)}, {columns}geom)
+                               SELECT new_id, {expressions}geom FROM {s}
+                               WHERE reject_reason IS NULL ORDER BY ord""")
+            self.accepted=cursor.rowcount
+            cursor.execute(f"SELECT count(*) FROM {s}")
+            self.rejected=cursor.fetchone()[0] - self.accepted
+            cursor.execute(f"""SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+                               FROM (SELECT ST_Extent(geom) AS e FROM {s} WHERE reject_reason IS NULL) x""")
+            extent=cursor.fetchone()
+        if extent[0] is not None:
+            layer=get_layer(self.model)
+            transaction.on_commit(lambda: layer_cache.invalidate(layer, [extent]))
+            #the INSERT ... SELECT does not send post_save. The whole layer, instead of thousands of ids
+            object_cache.invalidate_layer_on_commit(self.model)
+
+    def drop_staging_table(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.staging_table}")
+
+    def iter_report(self, chunk_size: int=2000):
+        """
+        Yields a dictionary per feature, in the order of the stream:
+            {'index': 0, 'ok': True, 'id': 25}
+            {'index': 1, 'ok': False, 'message': 'The geometry is not valid ...'}
+        The staging table is removed at the end.
+        """
+        try:
+            with connection.chunked_cursor() as cursor:
+                cursor.execute(f"SELECT ord, new_id, reject_reason FROM {self.staging_table} ORDER BY ord")
+                while True:
+                    rows=cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for ord, new_id, reject_reason in rows:
+                        if reject_reason is None:
+                            yield {'index': ord, 'ok': True, 'id': new_id}
+                        else:
+                            yield {'index': ord, 'ok': False, 'message': reject_reason}
+        finally:
+            self.drop_staging_table()
+
+    def iter_report_ndjson(self):
+        """The report as newline-delimited JSON. The last line is the summary"""
+        for line in self.iter_report():
+            yield json.dumps(line) + '\n'
+        yield json.dumps({'ok': True, 'message': 'Import finished',
+                          'accepted': self.accepted, 'rejected': self.rejected}) + '\n'
@@ -1,10 +1,29 @@
+import logging
 
-from django.db import connection
+from django.contrib.gis.geos import GEOSGeometry, GEOSException
+from django.db import connection, transaction
 
 from rest_framework import serializers
 
 from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION
-from .geometryTools import WkbConversor, GeometryChecks
+from .geometryEncoders import get_output_precision
+from .spatialFilters import geom_encoding
+from .spatialLocks import lock_geometry_cells
+from .geometryTools import WkbConversor, GeometryChecks, GeometryValidation, matrix_implies_intersection
+
+logger=logging.getLogger(__name__)
+
+def lock_cells(serializer, geom):
+    """
+    Inside the transaction of the write (AtomicWriteViewSetMixin), takes the advisory locks
+    of the grid cells of the new and the old geometry, before the relation check. So the
+    overlapping writes wait until this one commits, and see it in their check.
+    Outside a transaction the locks would be released at once, so nothing is done
+    """
+    if transaction.get_autocommit():
+        return
+    old_geom=serializer.instance.geom if serializer.instance is not None else None
+    lock_geometry_cells(serializer.get_table_name(), geom, old_geom)
 
 class GeoModelSerializer(serializers.ModelSerializer):
     """
@@ -15,6 +34,8 @@ class GeoModelSerializer(serializers.ModelSerializer):
         -geom: the geometry field
     The serializer will return the geometry in WKT and GEOJSON format,
         in the fields 'geom_geojson' and 'geom_wkt'.
+    To get the encodings from the SELECT, annotate the queryset of the view:
+        queryset=annotate_geom_encodings(queryset) #core.myLib.spatialFilters
     """
     check_geometry_is_valid = True #if true it will check if the geometry is valid: not self-intersecting and closed
     check_st_relation = True #if true it will chck the relation of the geometry with the other geometries
@@ -29,42 +50,52 @@ class GeoModelSerializer(serializers.ModelSerializer):
     def validate_geom(self, value):
         """Validates if a geometry in geojson/wkt is valid.
         If pass all checks, return the wkb value, wich is the 
-        value stored in the database
+        value stored in the database.
+        The snap, the validity check and the relation check are done
+        in only one query, with GeometryValidation
         """
-        print('validate_geom')
-        c=WkbConversor()
-        wkb=c.set_wkt_from_text(value)
-        gc=GeometryChecks(wkb)
+        logger.debug('validate_geom')
+        table_name=self.get_table_name() if self.check_st_relation else None
+        if self.check_st_relation:
+            try:
+                lock_cells(self, GEOSGeometry(value, srid=EPSG_FOR_GEOMETRIES))
+            except (GEOSException, ValueError) as e:
+                raise serializers.ValidationError(f'Invalid geometry. {e}')
+        #we have to know if we are editing (UPDATE) or inserting (CREATE).
+        #On UPDATE the current geometry is removed from the checks
+        id_to_avoid=self.instance.id if self.instance else None
+        v=GeometryValidation()
+        v.validate(value, table_name, self.matrix9IM, id_to_avoid)
         if self.check_geometry_is_valid:
-            if not gc.is_geometry_valid():
-                raise serializers.ValidationError('Invalid geometry. May be self-intersecting or not closed.')
+            if not v.is_valid:
+                raise serializers.ValidationError(f'Invalid geometry. May be self-intersecting or not closed. {v.valid_reason}')
         if self.check_st_relation:
-            #we have to know if we are editing (UPDATE) or inserting (CREATE)
-            if self.instance:
-                print("It is an UPDATE. You must remove the current geometry from the checks")
-                gc.check_st_relate(self.get_table_name(),self.matrix9IM, self.instance.id)
-                if gc.are_there_related_ids():
-                    raise serializers.ValidationError(gc.get_relate_message())
-            else:
-                print("It is a CREATE.")
-                gc.check_st_relate(self.get_table_name(),self.matrix9IM)        
-                if gc.are_there_related_ids():
-                    raise serializers.ValidationError(gc.get_relate_message())        
-        return wkb
+            if v.are_there_related_ids():
+                raise serializers.ValidationError(v.get_relate_message())
+        return v.wkb
     
     def get_geom_geojson(self, obj):
-        """Obtiene la geometría en formato WKT a partir de WKB usando PostGIS."""
-        print('get_geom_asgeojson ')
-        return obj.geom.geojson
+        """
+        The geometry in GeoJSON. Computed by PostGIS in the SELECT if the queryset
+        has core.myLib.spatialFilters.annotate_geom_encodings, or by GEOS if not
+        """
+        return geom_encoding(obj, 'geojson', self.get_output_precision())
     
     def get_geom_wkt(self, obj):
-        """Obtiene la geometría en formato WKT a partir de WKB usando PostGIS."""
-        print('get_geom_wkt')
-        return obj.geom.wkt
+        """The geometry in WKT. From the annotation, or by GEOS"""
+        return geom_encoding(obj, 'wkt', self.get_output_precision())
         
     def get_table_name(self):
         return self.Meta.model._meta.db_table
 
+    def get_output_precision(self)->int:
+        """The decimal digits of the output geometries: the parameter precision of the request, or the ones of the snap"""
+        request=self.context.get('request')
+        try:
+            return get_output_precision(request.query_params if request is not None else {})
+        except ValueError:
+            return get_output_precision({})
+
 class GeoModelSerializer2(serializers.ModelSerializer):
     """
     This class is a serializer for models that have a geometry field.
@@ -74,6 +105,8 @@ class GeoModelSerializer2(serializers.ModelSerializer):
         -geom: the geometry field
     The serializer will return the geometry in WKT and GEOJSON format,
         in the fields 'geom_geojson' and 'geom_wkt'.
+    To get the encodings from the SELECT, annotate the queryset of the view:
+        queryset=annotate_geom_encodings(queryset) #core.myLib.spatialFilters
     """
     check_geometry_is_valid = True #if true it will check if the geometry is valid: not self-intersecting and closed
     check_st_relation = True #if true it will chck the relation of the geometry with the other geometries
@@ -100,7 +133,7 @@ class GeoModelSerializer2(serializers.ModelSerializer):
     
     def validate_geom(self, value):
         """Validates if a geometry in geojson is valid."""
-        print('validate_geom')
+        logger.debug('validate_geom')
         geom_binary = self.convert_to_wkb(value)
 
         if self.check_geometry_is_valid:
@@ -109,6 +142,7 @@ class GeoModelSerializer2(serializers.ModelSerializer):
 
         """Validates if a geometry of the layer has the relation 'T********' (interiors intersects)."""
         if self.check_st_relation:
+            lock_cells(self, geom_binary)
             r = self.check_st_relate(geom_binary)
             if len(r) > 0:
                 table_name = self.get_table_name()
@@ -116,28 +150,29 @@ class GeoModelSerializer2(serializers.ModelSerializer):
         return value
         
     def get_geom_geojson(self, obj):
-        """Obtiene la geometría en formato WKT a partir de WKB usando PostGIS."""
-        print('get_geom_asgeojson 4')
-        return self.get_geometry_as_geojson(obj.id)
+        """
+        The geometry in GeoJSON. Computed by PostGIS in the SELECT if the queryset
+        has core.myLib.spatialFilters.annotate_geom_encodings, or by GEOS if not
+        """
+        return geom_encoding(obj, 'geojson', self.get_output_precision())
     
     def get_geom_wkt(self, obj):
-        """Obtiene la geometría en formato WKT a partir de WKB usando PostGIS."""
-        print('get_geom_wkt')
-        return self.get_geometry_as_wkt(obj.id)
+        """The geometry in WKT. From the annotation, or by GEOS"""
+        return geom_encoding(obj, 'wkt', self.get_output_precision())
 
     def get_geometry_as_geojson(self, model_id):
-        """Returns the geometry as geojson from PostGIS."""
+        """Returns the geometry as geojson from PostGIS. One query: do not use it per object"""
         table_name = self.get_table_name()
-        print('get_geometry_as_geojson', table_name)
+        logger.debug('get_geometry_as_geojson %s', table_name)
         with connection.cursor() as cursor:
             cursor.execute(f"SELECT ST_AsGeojson(geom) FROM {table_name} WHERE id = %s", [model_id])
             row = cursor.fetchone()
             return row[0] if row else None  # Devuelve la geometría en formato geojson o None
 
     def get_geometry_as_wkt(self, model_id):
-        """Returns the geometry as geojson from PostGIS."""
+        """Returns the geometry as wkt from PostGIS. One query: do not use it per object"""
         table_name = self.get_table_name()
-        print('get_geometry_as_wkt', table_name)
+        logger.debug('get_geometry_as_wkt %s', table_name)
         with connection.cursor() as cursor:
             cursor.execute(f"SELECT ST_AsText(geom) FROM {table_name} WHERE id = %s", [model_id])
             row = cursor.fetchone()
@@ -146,7 +181,7 @@ class GeoModelSerializer2(serializers.ModelSerializer):
     def convert_geojson_to_wkb(self, geojson_value):
         with connection.cursor() as cursor:
             #Ejecuta la función PostGIS ST_GeomFromText para convertir WKT a WKB
-            print('convert_geojson_to_wkb')
+            logger.debug('convert_geojson_to_wkb')
             q="""SELECT 
                     ST_SNAPTOGRID(
                         st_setsrid(
@@ -163,7 +198,7 @@ class GeoModelSerializer2(serializers.ModelSerializer):
     def convert_wkt_to_wkb(self, wkt_value):
         with connection.cursor() as cursor:
             #Ejecuta la función PostGIS ST_GeomFromText para convertir WKT a WKB
-            print('convert_wkt_to_wkb')
+            logger.debug('convert_wkt_to_wkb')
             q="""SELECT 
                     ST_SNAPTOGRID(
                         st_setsrid(
@@ -179,7 +214,7 @@ class GeoModelSerializer2(serializers.ModelSerializer):
 
     def is_geometry_valid(self, geom_binary):
         """Checks if a geometry in geojson is valid."""
-        print('is_geometry_valid')
+        logger.debug('is_geometry_valid')
         with connection.cursor() as cursor:
             q="""SELECT ST_IsValid(%s)"""
             cursor.execute(q, [geom_binary])
@@ -190,6 +225,14 @@ class GeoModelSerializer2(serializers.ModelSerializer):
     def get_table_name(self):
         return self.Meta.model._meta.db_table
 
+    def get_output_precision(self)->int:
+        """The decimal digits of the output geometries: the parameter precision of the request, or the ones of the snap"""
+        request=self.context.get('request')
+        try:
+            return get_output_precision(request.query_params if request is not None else {})
+        except ValueError:
+            return get_output_precision({})
+
     def check_st_relate(self, geom_binary: str, layerName: str= None, matrix9IM: str = None):
         """Checks whether or not exists a geometry wih the relation of the geom with all the geometries in the layer
             layername using the matrix 9IM. The geom is in geojson format.
@@ -200,11 +243,16 @@ class GeoModelSerializer2(serializers.ModelSerializer):
         if matrix9IM is None:
             matrix9IM = self.matrix9IM
         
-        print('check_st_relate')
+        logger.debug('check_st_relate %s', matrix9IM)
 
         with connection.cursor() as cursor:
-            q=f"""SELECT id FROM {layerName} WHERE ST_relate(geom,%s,%s)"""
-            cursor.execute(q, [geom_binary, matrix9IM])
+            if matrix_implies_intersection(matrix9IM):
+                #the && uses the spatial index
+                q=f"""SELECT id FROM {layerName} WHERE geom && %s and ST_relate(geom,%s,%s)"""
+                cursor.execute(q, [geom_binary, geom_binary, matrix9IM])
+            else:
+                q=f"""SELECT id FROM {layerName} WHERE ST_relate(geom,%s,%s)"""
+                cursor.execute(q, [geom_binary, matrix9IM])
             row = cursor.fetchall()
             return row  # Devuelve los ids de las geometrías que cumplen la relación
 
@@ -0,0 +1,74 @@
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.gis.db.models.functions import AsGeoJSON
+from django.http import StreamingHttpResponse
+
+from .geometryEncoders import OUTPUT_DECIMAL_DIGITS
+from .spatialFilters import output_geom_field
+
+STREAM_FORMATS = {
+    'geojson': 'application/geo+json',
+    'ndjson': 'application/x-ndjson',
+}
+
+def iter_features(queryset, properties: list, geom_field: str='geom', chunk_size: int=2000,
+                  precision: int=OUTPUT_DECIMAL_DIGITS):
+    """
+    Yields the rows of the queryset as GeoJSON features, in text.
+    The geometry is encoded by PostGIS (ST_AsGeoJSON, with at most precision decimal digits), and the rows are read
+    with a server side cursor, chunk_size rows at a time, so the memory does not
+    depend on the number of rows.
+    """
+    #the simplified geometry if the queryset has been simplified by apply_spatial_filters
+    geom_field=output_geom_field(queryset, geom_field)
+    rows=(queryset.annotate(geom_geojson_stream=AsGeoJSON(geom_field, precision=precision))
+          .values_list('id', *properties, 'geom_geojson_stream')
+          .iterator(chunk_size=chunk_size))
+    for row in rows:
+        props=json.dumps(dict(zip(properties, row[1:-1])), cls=DjangoJSONEncoder)
+        geometry=row[-1] if row[-1] is not None else 'null'
+        yield f'{{"type": "Feature", "id": {json.dumps(row[0])}, "geometry": {geometry}, "properties": {props}}}'
+
+def iter_feature_collection(features, batch: int=200):
+    """Wraps the features in a FeatureCollection. The features are written in batches"""
+    yield '{"type": "FeatureCollection", "features": ['
+    pending=[]
+    first=True
+    for feature in features:
+        pending.append(feature)
+        if len(pending) >= batch:
+            yield ('' if first else ',') + ','.join(pending)
+            first=False
+            pending=[]
+    if pending:
+        yield ('' if first else ',') + ','.join(pending)
+    yield ']}'
+
+def iter_ndjson(features, batch: int=200):
+    """One feature per line. The features are written in batches"""
+    pending=[]
+    for feature in features:
+        pending.append(feature)
+        if len(pending) >= batch:
+            yield '\n'.join(pending) + '\n'
+            pending=[]
+    if pending:
+        yield '\n'.join(pending) + '\n'
+
+def geojson_streaming_response(queryset, properties: list, stream_format: str='geojson',
+                               geom_field: str='geom', chunk_size: int=2000,
+                               precision: int=OUTPUT_DECIMAL_DIGITS)->StreamingHttpResponse:
+    """
+    Returns a StreamingHttpResponse with all the rows of the queryset, without
+    the MAX_NUMBER_OF_RETRIEVED_ROWS limit. stream_format is:
+        - 'geojson': a FeatureCollection.
+        - 'ndjson': newline-delimited GeoJSON, one feature per line.
+    properties is the list of the fields of the model to include in the properties of the features.
+    """
+    features=iter_features(queryset, properties, geom_field, chunk_size, precision)
+    if stream_format=='ndjson':
+        content=iter_ndjson(features)
+    else:
+        content=iter_feature_collection(features)
+    return StreamingHttpResponse(content, content_type=STREAM_FORMATS[stream_format])
@@ -0,0 +1,121 @@
+import codecs
+import json
+
+#Characters between the values. \x1e is the record separator of the GeoJSON text sequences (RFC 8142)
+WHITESPACE = ' \t\r\n\x1e'
+
+class GeojsonStreamReader:
+    """
+    Reads GeoJSON features from a stream, without loading the whole stream in memory.
+    Only one feature at a time is decoded.
+
+    The stream can contain:
+        - a FeatureCollection: the features of the 'features' array are returned one by one.
+        - newline-delimited GeoJSON, or GeoJSON text sequences: one Feature per line.
+        - Feature objects, or bare geometries, one after other.
+    The stream is any object with a read(size) method, returning bytes or str:
+    a file, or a Django request.
+
+    Usage:
+        for feature in GeojsonStreamReader(request):
+            feature['geometry'], feature['properties']
+    """
+    def __init__(self, stream, chunk_size: int=64*1024):
+        self.stream=stream
+        self.chunk_size=chunk_size
+        self.decoder=codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder=json.JSONDecoder()
+        self.buffer=''
+        self.pos=0
+        self.eof=False
+
+    def __iter__(self):
+        while self.peek():
+            if self.peek() != '{':
+                raise ValueError(f"Unexpected character {self.peek()!r}. A GeoJSON object was expected")
+            yield from self.read_top_object()
+
+    def fill(self)->bool:
+        """Reads another chunk of the stream. Returns false at the end of the stream"""
+        if self.eof:
+            return False
+        chunk=self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof=True
+            self.buffer=self.buffer[self.pos:] + self.decoder.decode(b'', final=True)
+            self.pos=0
+            return False
+        if isinstance(chunk, bytes):
+            chunk=self.decoder.decode(chunk)
+        #the already decoded part of the buffer is discarded
+        self.buffer=self.buffer[self.pos:] + chunk
+        self.pos=0
+        return True
+
+    def peek(self)->str:
+        """Skips the whitespaces and returns the next character, or '' at the end"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos] if self.pos < len(self.buffer) else ''
+
+    def expect(self, characters: str)->str:
+        c=self.peek()
+        if c=='' or c not in characters:
+            raise ValueError(f"Invalid GeoJSON. Expected one of {characters!r}, found {c!r}")
+        self.pos += 1
+        return c
+
+    def read_value(self):
+        """Decodes the next JSON value, reading more chunks while it is incomplete"""
+        self.peek()
+        while True:
+            try:
+                value, end=self.json_decoder.raw_decode(self.buffer, self.pos)
+                #a number at the end of the buffer may be truncated
+                if end < len(self.buffer) or self.eof or not isinstance(value, (int, float)):
+                    self.pos=end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def read_top_object(self):
+        """
+        Reads an object of the first level. If it has a 'features' array, its
+        features are yielded while they are read. If not, it is a feature or a geometry,
+        and it is yielded as a feature.
+        """
+        self.expect('{')
+        obj={}
+        is_collection=False
+        if self.peek()=='}':
+            self.pos += 1
+        else:
+            while True:
+                key=self.read_value()
+                self.expect(':')
+                if key=='features' and self.peek()=='[':
+                    is_collection=True
+                    yield from self.read_features_array()
+                else:
+                    obj[key]=self.read_value()
+                if self.expect(',}')=='}':
+                    break
+        if not is_collection and obj:
+            if obj.get('type')=='Feature':
+                yield obj
+            else:
+                yield {'type': 'Feature', 'geometry': obj, 'properties': {}}
+
+    def read_features_array(self):
+        self.expect('[')
+        if self.peek()==']':
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self.expect(',]')==']':
+                return
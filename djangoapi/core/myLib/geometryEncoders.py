@@ -0,0 +1,63 @@
+import json
+
+from django.contrib.gis.db.models.functions import GeoFunc
+from django.contrib.gis.geos import GEOSGeometry, WKTWriter
+from django.db.models import TextField
+
+from .geometryTools import snap_decimal_digits
+
+#The geometries are snapped to ST_SNAP_PRECISION on write, so more decimal digits
+#than the ones of the grid only add noise and bytes to the responses
+OUTPUT_DECIMAL_DIGITS = snap_decimal_digits()
+MAX_DECIMAL_DIGITS = 15
+
+class AsText(GeoFunc):
+    """ST_AsText(geom, maxdecimaldigits): WKT with at most maxdecimaldigits decimal digits"""
+    function = 'ST_AsText'
+    output_field = TextField()
+
+    def __init__(self, expression, precision: int=OUTPUT_DECIMAL_DIGITS, **extra):
+        super().__init__(expression, self._handle_param(precision, 'precision', int), **extra)
+
+def get_output_precision(params, default: int=OUTPUT_DECIMAL_DIGITS)->int:
+    """
+    Returns the number of decimal digits of the output geometries: the parameter precision,
+    or the digits of the ST_SNAP_PRECISION. Raises ValueError if the parameter is not valid
+    """
+    value=params.get('precision')
+    if value in (None, ''):
+        return default
+    try:
+        precision=int(value)
+    except (TypeError, ValueError):
+        precision=-1
+    if precision < 0 or precision > MAX_DECIMAL_DIGITS:
+        raise ValueError(f"Invalid precision {value}. It must be an integer between 0 and {MAX_DECIMAL_DIGITS}")
+    return precision
+
+def geom_to_wkt(geom: GEOSGeometry, precision: int=OUTPUT_DECIMAL_DIGITS)->str:
+    """The WKT of the geometry, with at most precision decimal digits, as ST_AsText(geom, precision)"""
+    if geom is None:
+        return None
+    writer=WKTWriter(dim=3 if geom.hasz else 2, trim=True, precision=precision)
+    return writer.write(geom).decode()
+
+def round_coordinates(coordinates, precision: int):
+    """Rounds the nested coordinates of a GeoJSON geometry. The integer values are written without decimals"""
+    if isinstance(coordinates, (int, float)):
+        value=round(coordinates, precision)
+        return int(value) if value == int(value) else value
+    return [round_coordinates(c, precision) for c in coordinates]
+
+def round_geojson_geometry(geometry: dict, precision: int)->dict:
+    if 'geometries' in geometry:
+        geometry['geometries']=[round_geojson_geometry(g, precision) for g in geometry['geometries']]
+    else:
+        geometry['coordinates']=round_coordinates(geometry['coordinates'], precision)
+    return geometry
+
+def geom_to_geojson(geom: GEOSGeometry, precision: int=OUTPUT_DECIMAL_DIGITS)->str:
+    """The GeoJSON of the geometry, with at most precision decimal digits, as ST_AsGeoJSON(geom, precision)"""
+    if geom is None:
+        return None
+    return json.dumps(round_geojson_geometry(json.loads(geom.json), precision))
@@ -1,37 +1,185 @@
+import logging
+import math
+
 from django.db import connection
-from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION
+from django.contrib.gis.geos import GEOSGeometry, Point, LineString, LinearRing, Polygon
+from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION, WKB_CONVERSOR_ENGINE
+from .preparedStatements import execute_prepared
+
+WKB_CONVERSOR_ENGINES = ('postgis', 'geos')
+#PostgreSQL types of the parameters of the fixed queries, to prepare them (core.myLib.preparedStatements)
+TEXT_TO_WKB_TYPES = ['text', 'integer', 'float8']
+
+logger=logging.getLogger(__name__)
+
+def _snap_coord(coord: tuple, size: float)->tuple:
+    """Rounds x and y as ST_SnapToGrid(geom, size) does: rint(v/size)*size. Z is not snapped"""
+    return (round(coord[0]/size)*size, round(coord[1]/size)*size) + tuple(coord[2:])
+
+def _snap_coords(coords, size: float)->list:
+    """Snaps a sequence of coordinates and removes the consecutive repeated points"""
+    snapped=[]
+    for c in coords:
+        c=_snap_coord(c, size)
+        if snapped and snapped[-1]==c:
+            continue
+        snapped.append(c)
+    return snapped
+
+def snap_geos_to_grid(geom: GEOSGeometry, size: float)->GEOSGeometry:
+    """
+    Snaps a GEOS geometry to a grid of the given size, reproducing the
+    PostGIS ST_SnapToGrid rules, so the WKB is identical to the one returned by PostGIS:
+        - x and y are rounded to the grid. Z is kept.
+        - consecutive repeated points are removed.
+        - linestrings with less than 2 points and rings with less than 4 points collapse.
+          If the shell of a polygon collapses, the polygon is empty.
+        - empty components of the collections are removed.
+    """
+    srid=geom.srid
+    if isinstance(geom, Point):
+        snapped=geom.clone() if geom.empty else Point(_snap_coord(geom.coords, size))
+    elif isinstance(geom, LinearRing):
+        coords=_snap_coords(geom.coords, size)
+        snapped=LinearRing(coords) if len(coords) >= 4 else LinearRing()
+    elif isinstance(geom, LineString):
+        coords=_snap_coords(geom.coords, size)
+        snapped=LineString(coords) if len(coords) >= 2 else LineString()
+    elif isinstance(geom, Polygon):
+        rings=[]
+        for ring in geom:
+            coords=_snap_coords(ring.coords, size)
+            if len(coords) < 4:
+                if not rings:
+                    #the shell has collapsed
+                    break
+                continue
+            rings.append(coords)
+        snapped=Polygon(*rings) if rings else Polygon()
+    else:
+        #collections: MultiPoint, MultiLineString, MultiPolygon, GeometryCollection
+        parts=[snap_geos_to_grid(g, size) for g in geom]
+        parts=[g for g in parts if not g.empty]
+        snapped=type(geom)(*parts)
+    snapped.srid=srid
+    return snapped
+
+#ST_ functions that are only true when the geometries interact, so their
+#bounding boxes must overlap: the operator && can be added to use the spatial index
+INTERACTING_ST_CONDITIONS = ('st_intersects', 'st_contains', 'st_containsproperly', 'st_within',
+                             'st_covers', 'st_coveredby', 'st_overlaps', 'st_touches',
+                             'st_crosses', 'st_equals')
+
+def matrix_implies_intersection(matrix9IM: str)->bool:
+    """
+    Returns true if the DE-9IM pattern can only be matched by geometries that intersect.
+    This happens when any of the cells interior-interior, interior-boundary,
+    boundary-interior or boundary-boundary must be not empty (T, 0, 1 or 2).
+    In this case the bounding boxes of the geometries overlap, and the ST_Relate
+    can be prefiltered with the operator &&, which uses the GiST index.
+    """
+    if len(matrix9IM) != 9:
+        return False
+    return any(matrix9IM[i].upper() in 'T012' for i in (0, 1, 3, 4))
+
+def st_condition_implies_intersection(st_condition: str)->bool:
+    """Returns true if the ST_ function is only true for geometries that intersect"""
+    return st_condition.lower() in INTERACTING_ST_CONDITIONS
+
+def wkb_to_hex(wkb)->str:
+    """Returns the EWKB in the same format psycopg returns the PostGIS geometries: hex uppercase string"""
+    if isinstance(wkb, str):
+        return wkb
+    return bytes(wkb).hex().upper()
+
+def snap_decimal_digits(size: float=ST_SNAP_PRECISION, max_digits: int=15)->int:
+    """
+    Returns the number of decimal digits needed to write, without loss, the coordinates
+    snapped to a grid of the size: 0.0001 -> 4, 0.25 -> 2, 10 -> 0
+    """
+    for digits in range(max_digits + 1):
+        v=size*10**digits
+        if math.isclose(v, round(v), rel_tol=1e-9):
+            return digits
+    return max_digits
 
 class WkbConversor:
+    """
+    Converts a geometry in wkt or geojson to wkb, setting the SRID and
+    snapping the vertices to the grid.
+
+    The work can be done by two engines:
+        - 'postgis': each operation is a query to the database.
+        - 'geos': the operations are done in process with GEOS, without touching the
+            database. The wkb is identical to the one returned by PostGIS.
+    The default engine is the setting WKB_CONVERSOR_ENGINE. It also can be selected for
+    each call with the engine parameter of the methods set_wkt_from_text, get_as_wkt
+    and get_as_geojson.
+    """
     def __init__(self,epsg_for_geometries: str=EPSG_FOR_GEOMETRIES,
                  st_snap_precision: float=ST_SNAP_PRECISION,
-                 snap_to_grid: bool = True):   
+                 snap_to_grid: bool = True,
+                 engine: str = WKB_CONVERSOR_ENGINE):   
 
         self.epsg_for_geometries=epsg_for_geometries
         self.st_snap_precision=st_snap_precision
         self.snap_to_grid=snap_to_grid
+        self.engine=self.__check_engine(engine if engine is not None else WKB_CONVERSOR_ENGINE)
 
         self.__wkb=None
+        self.__geos=None
+
+    def __check_engine(self, engine: str=None)->str:
+        if engine is None:
+            return self.engine
+        if engine not in WKB_CONVERSOR_ENGINES:
+            raise ValueError(f"Unknown engine {engine}. The options are {WKB_CONVERSOR_ENGINES}")
+        return engine
 
-    def set_wkt_from_text(self, geom_text:str)-> str:
+    def set_wkt_from_text(self, geom_text:str, engine: str=None)-> str:
         """
         Receives a string, with a geojson, or wkt geometry,
         and return it in wkt. 
         If the self.st_snap_precision is true the vertices are rounded
         """
+        if self.__check_engine(engine)=='geos':
+            return self.__set_wkb_with_geos(geom_text)
         if 'coordinates' in geom_text:
-            print('geojson')
+            logger.debug('set_wkt_from_text: geojson')
             return self.__set_wkb_from_geojson(geom_text)
         else:
-            print('wkt')
+            logger.debug('set_wkt_from_text: wkt')
             return self.__set_wkb_from_wkt(geom_text)
 
     def set_wkb_from_wkb(self,wkb):
         self.__wkb=wkb
+        self.__geos=None
+
+    def __set_wkb_with_geos(self, geom_text:str)->str:
+        """
+        Does the same that __set_wkb_from_geojson and __set_wkb_from_wkt,
+        with GEOS. GEOSGeometry reads both, wkt and geojson
+        """
+        g=GEOSGeometry(geom_text)
+        g.srid=int(self.epsg_for_geometries)
+        if self.snap_to_grid:
+            g=snap_geos_to_grid(g, self.st_snap_precision)
+        self.__geos=g
+        self.__wkb=wkb_to_hex(g.ewkb)
+        return self.get_as_wkb()
+
+    def get_as_geos(self)->GEOSGeometry:
+        """
+        Returns the snaped geometry as a GEOSGeometry, decoding the wkb only once
+        """
+        if self.__geos is None and self.__wkb is not None:
+            self.__geos=GEOSGeometry(self.__wkb)
+        return self.__geos
 
     def __set_wkb_from_geojson(self, geojson:str)->str:
         cursor = connection.cursor()
         #Ejecuta la función PostGIS ST_GeomFromText para convertir WKT a WKB
-        print('set_wkb_from_geojson')
+        logger.debug('set_wkb_from_geojson')
         if self.snap_to_grid:
             q="""SELECT 
                     ST_SNAPTOGRID(
@@ -50,15 +198,16 @@ class WkbConversor:
                     ),
                     %s
             """           
-        cursor.execute(q, [geojson, self.epsg_for_geometries, self.st_snap_precision])
+        execute_prepared(cursor, q, [geojson, self.epsg_for_geometries, self.st_snap_precision], TEXT_TO_WKB_TYPES)
         row = cursor.fetchone()
         self.__wkb=row[0]
+        self.__geos=None
         return self.get_as_wkb()  # Esto será el WKB
 
     def __set_wkb_from_wkt(self, wkt:str):
         cursor = connection.cursor()
         #Ejecuta la función PostGIS ST_GeomFromText para convertir WKT a WKB
-        print('set_wkb_from_wkt')
+        logger.debug('set_wkb_from_wkt')
         if self.snap_to_grid:
             q="""SELECT 
                     ST_SNAPTOGRID(
@@ -77,15 +226,16 @@ class WkbConversor:
                     ),
                     %s
             """               
-        cursor.execute(q, [wkt, self.epsg_for_geometries, self.st_snap_precision])
+        execute_prepared(cursor, q, [wkt, self.epsg_for_geometries, self.st_snap_precision], TEXT_TO_WKB_TYPES)
         row = cursor.fetchone()
         self.__wkb=row[0]
+        self.__geos=None
         return self.get_as_wkb() 
          
     def set_wkb_from_table(self, table_name:str, id_to_select:int, geom_field_name:str='geom')->str:
         cursor = connection.cursor()
         #Ejecuta la función PostGIS ST_GeomFromText para convertir WKT a WKB
-        print('set_wkb_from_table')
+        logger.debug('set_wkb_from_table %s %s', table_name, id_to_select)
         if self.snap_to_grid:
             q=f"""SELECT ST_SNAPTOGRID({geom_field_name})
                   FROM {table_name} WHERE id = %s
@@ -94,12 +244,13 @@ class WkbConversor:
             q=f"""SELECT {geom_field_name}
                   FROM {table_name} WHERE id = %s
                 """             
-        cursor.execute(q, [id_to_select])
+        execute_prepared(cursor, q, [id_to_select], ['integer'])
         l = cursor.fetchall()
         if len(l)==0:
             raise Exception(f"No reccord with the id {id_to_select} in the table {table_name}")
         
         self.__wkb=l[0][0]
+        self.__geos=None
         return self.get_as_wkb()
 
     def get_as_wkb(self):
@@ -108,23 +259,29 @@ class WkbConversor:
         """
         return self.__wkb
 
-    def get_as_geojson(self):
+    def get_as_geojson(self, engine: str=None):
         """
         Returns the snaped geometry in geojson
         """
+        if self.__check_engine(engine)=='geos':
+            g=self.get_as_geos()
+            return g.json if g is not None else None
         query="SELECT ST_AsGeojson(%s)"
         cursor=connection.cursor()
-        cursor.execute(query,[self.get_as_wkb()])
+        execute_prepared(cursor, query, [self.get_as_wkb()], ['geometry'])
         row = cursor.fetchone()
         return row[0] if row else None  #Devuelve la geometría en formato geojson o None
     
-    def get_as_wkt(self):
+    def get_as_wkt(self, engine: str=None):
         """
         Returns the snaped geometry in wkt
         """
+        if self.__check_engine(engine)=='geos':
+            g=self.get_as_geos()
+            return g.wkt if g is not None else None
         query="SELECT ST_AsText(%s)"
         cursor=connection.cursor()
-        cursor.execute(query, [self.get_as_wkb()])
+        execute_prepared(cursor, query, [self.get_as_wkb()], ['geometry'])
         row = cursor.fetchone()
         return row[0] if row else None  #Devuelve la geometría en formato geojson o None
 
@@ -142,52 +299,130 @@ class GeometryChecks:
 
     def is_geometry_valid(self):
         """Checks if a geometry in geojson is valid."""
-        print('is_geometry_valid')
+        logger.debug('is_geometry_valid')
         cursor=connection.cursor()
         q="""SELECT ST_IsValid(%s)"""
-        cursor.execute(q, [self.wkb])
+        execute_prepared(cursor, q, [self.wkb], ['geometry'])
         row = cursor.fetchone()
         #row is true or false
         return row[0]
             
-    def check_st_relate(self, table_name: str, matrix9IM: str, id_to_avoid:int=None)->list:
+    def check_st_relate(self, table_name: str, matrix9IM: str, id_to_avoid:int=None,
+                        use_bbox_prefilter: bool=True)->list:
         """Checks whether or not exists a geometry wih the relation of the geom with all the geometries in the layer
             layername using the matrix 9IM. The geom is in geojson format.
+            ST_Relate with a matrix can not use the spatial index. If the matrix implies
+            that the geometries intersect, and use_bbox_prefilter is true, the
+            bounding box operator && is added, so the GiST index is used.
         """
         
         cursor=connection.cursor()
+        values=[self.wkb, matrix9IM]
+        types=['geometry', 'text']
+        prefilter=""
+        if use_bbox_prefilter and matrix_implies_intersection(matrix9IM):
+            prefilter="geom && %s and "
+            values=[self.wkb] + values
+            types=['geometry'] + types
         if id_to_avoid is None:
-            q=f"""SELECT id FROM {table_name} WHERE ST_relate(geom,%s,%s)"""
-            values=[self.wkb, matrix9IM]
+            q=f"""SELECT id FROM {table_name} WHERE {prefilter}ST_relate(geom,%s,%s)"""
         else:
-            q=f"""SELECT id FROM {table_name} WHERE ST_relate(geom,%s,%s) and id != %s"""
-            values=[self.wkb, matrix9IM, id_to_avoid]
-        cursor.execute(q, values)
+            q=f"""SELECT id FROM {table_name} WHERE {prefilter}ST_relate(geom,%s,%s) and id != %s"""
+            values.append(id_to_avoid)
+            types.append('integer')
+        execute_prepared(cursor, q, values, types)
         self.related_ids=cursor.fetchall()
         self.requested_relation= f'ST_relate, matrix: {matrix9IM}'
         self.table_name=table_name
         return self.related_ids  # Devuelve los ids de las geometrías que cumplen la relación
 
-    def check_st_condition(self, table_name: str, st_condition: str, id_to_avoid:int=None)->list:   
+    def check_st_condition(self, table_name: str, st_condition: str, id_to_avoid:int=None,
+                           use_bbox_prefilter: bool=True)->list:   
         """Checks whether or not exists a geometry wih the condition 
            st_condition: st_intersects, st_contains, st_within, ... 
            of the current geom with all the geometries in the layer
             layername.
+            If the condition implies that the geometries intersect, and use_bbox_prefilter
+            is true, the bounding box operator && is added, so the GiST index is used.
         """
         cursor=connection.cursor()
+        values=[self.wkb]
+        types=['geometry']
+        prefilter=""
+        if use_bbox_prefilter and st_condition_implies_intersection(st_condition):
+            prefilter="geom && %s and "
+            values=[self.wkb] + values
+            types=['geometry'] + types
         if id_to_avoid is None:
-            q=f"""SELECT id FROM {table_name} WHERE {st_condition}(geom,%s)"""
-            values=[self.wkb]
+            q=f"""SELECT id FROM {table_name} WHERE {prefilter}{st_condition}(geom,%s)"""
         else:
-            q=f"""SELECT id FROM {table_name} WHERE {st_condition}(geom,%s) and id != %s"""
-            values=[self.wkb, id_to_avoid]
+            q=f"""SELECT id FROM {table_name} WHERE {prefilter}{st_condition}(geom,%s) and id != %s"""
+            values.append(id_to_avoid)
+            types.append('integer')
 
-        cursor.execute(q, values)
+        execute_prepared(cursor, q, values, types)
         self.related_ids=cursor.fetchall()
         self.requested_relation= st_condition
         self.table_name=table_name
         return self.related_ids
 
+    @staticmethod
+    def check_batch(wkbs: list, table_name: str, matrix9IM: str='T********',
+                    ids_to_avoid: list=None, use_bbox_prefilter: bool=True)->list:
+        """
+        Checks a list of geometries in only one query, with unnest. For each one
+        returns a dictionary with:
+            - index: the position of the geometry in wkbs
+            - is_valid and valid_reason: the ST_IsValid and ST_IsValidReason of the geometry
+            - related_ids: the ids of the table_name geometries with the relation matrix9IM
+            - conflicting_candidates: the indexes of the other geometries of wkbs with the
+                relation matrix9IM
+        The relations are only checked for the valid geometries.
+        wkbs can be a list of wkb (hex strings or bytes) or GEOSGeometry objects.
+        ids_to_avoid, if given, is a list with the same length that wkbs, with the id
+            of the row that each geometry replaces (UPDATE), or None (INSERT).
+        """
+        if len(wkbs)==0:
+            return []
+        if ids_to_avoid is None:
+            ids_to_avoid=[None]*len(wkbs)
+        if len(ids_to_avoid) != len(wkbs):
+            raise Exception("wkbs and ids_to_avoid must have the same length")
+        wkbs=[wkb_to_hex(g.ewkb if isinstance(g, GEOSGeometry) else g) for g in wkbs]
+
+        prefilter_t=prefilter_o=""
+        if use_bbox_prefilter and matrix_implies_intersection(matrix9IM):
+            prefilter_t="t.geom && c.geom AND"
+            prefilter_o="o.geom && c.geom AND"
+        q=f"""WITH candidates AS (
+                    SELECT c.ord, c.geom, c.id_to_avoid, ST_IsValid(c.geom) AS is_valid
+                    FROM unnest(%s::geometry[], %s::integer[]) WITH ORDINALITY AS c(geom, id_to_avoid, ord)
+                )
+                SELECT c.ord - 1,
+                       c.is_valid,
+                       CASE WHEN c.is_valid THEN NULL ELSE ST_IsValidReason(c.geom) END,
+                       CASE WHEN c.is_valid THEN
+                            ARRAY(SELECT t.id FROM {table_name} t
+                                  WHERE {prefilter_t} ST_relate(t.geom, c.geom, %s)
+                                    AND t.id IS DISTINCT FROM c.id_to_avoid
+                                  ORDER BY t.id)
+                       ELSE ARRAY[]::integer[] END,
+                       CASE WHEN c.is_valid THEN
+                            ARRAY(SELECT o.ord - 1 FROM candidates o
+                                  WHERE o.ord != c.ord AND o.is_valid
+                                    AND {prefilter_o} ST_relate(o.geom, c.geom, %s)
+                                  ORDER BY o.ord)
+                       ELSE ARRAY[]::bigint[] END
+                FROM candidates c
+                ORDER BY c.ord
+            """
+        with connection.cursor() as cursor:
+            cursor.execute(q, [wkbs, ids_to_avoid, matrix9IM, matrix9IM])
+            rows=cursor.fetchall()
+        return [{'index': index, 'is_valid': is_valid, 'valid_reason': valid_reason,
+                 'related_ids': related_ids, 'conflicting_candidates': conflicting_candidates}
+                for index, is_valid, valid_reason, related_ids, conflicting_candidates in rows]
+
     def are_there_related_ids(self)->bool:
         """
         First must call check_st_relate, or raise exception
@@ -206,3 +441,144 @@ class GeometryChecks:
             return f"The following ids of the table {self.table_name} have the requested  relation ({self.requested_relation}), with the given geometry: {self.related_ids}"
         else:        
             return "There are not geometries with the requested relation"
+
+class GeometryValidation:
+    """
+    Does in one query, and one round trip to the database, the work that
+    WkbConversor and GeometryChecks do in several ones:
+        - parses the wkt or geojson, sets the SRID and snaps the geometry to the grid.
+        - checks if the snaped geometry is valid, and the reason if not.
+        - gets the ids of the geometries of the table with the relation matrix9IM
+            with the snaped geometry. Only if the geometry is valid.
+        - optionally, encodes the snaped geometry in wkt and geojson.
+
+    Usage:
+        v=GeometryValidation()
+        v.validate(geom_text, 'buildings_buildings', 'T********', id_to_avoid=id, with_wkt=True)
+        if not v.is_valid:
+            ... v.valid_reason
+        if v.are_there_related_ids():
+            ... v.get_relate_message()
+        b.geom=v.wkb
+    """
+    def __init__(self,epsg_for_geometries: str=EPSG_FOR_GEOMETRIES,
+                 st_snap_precision: float=ST_SNAP_PRECISION,
+                 snap_to_grid: bool = True):
+        self.epsg_for_geometries=epsg_for_geometries
+        self.st_snap_precision=st_snap_precision
+        self.snap_to_grid=snap_to_grid
+
+        self.wkb=None
+        self.is_valid=None
+        self.valid_reason=None
+        self.related_ids=None
+        self.requested_relation=None
+        self.table_name=None
+        self.wkt=None
+        self.geojson=None
+
+    def get_query(self, geom_text: str, table_name: str=None, id_to_avoid: int=None,
+                  matrix9IM: str='T********')->str:
+        """
+        Returns the CTE query. The parameters, in order, are:
+            geom_text, epsg, [st_snap_precision], [matrix9IM, [id_to_avoid]], with_wkt, precision,
+            with_geojson, precision
+        """
+        parser='ST_GeomFromGeoJSON' if 'coordinates' in geom_text else 'ST_GeomFromText'
+        if self.snap_to_grid:
+            candidate=f"ST_SNAPTOGRID(ST_SetSRID({parser}(%s), %s), %s)"
+        else:
+            candidate=f"ST_SetSRID({parser}(%s), %s)"
+
+        if table_name is None:
+            relation="NULL::integer[]"
+        else:
+            avoid="" if id_to_avoid is None else "AND t.id != %s"
+            #the && uses the spatial index, as GeometryChecks.check_st_relate
+            prefilter="t.geom && c.geom AND" if matrix_implies_intersection(matrix9IM) else ""
+            relation=f"""CASE WHEN ST_IsValid(c.geom) THEN
+                            ARRAY(SELECT t.id FROM {table_name} t
+                                  WHERE {prefilter} ST_relate(t.geom, c.geom, %s) {avoid}
+                                  ORDER BY t.id)
+                         ELSE ARRAY[]::integer[] END"""
+
+        return f"""WITH candidate AS (
+                        SELECT {candidate} AS geom
+                    )
+                    SELECT c.geom,
+                           ST_IsValid(c.geom),
+                           ST_IsValidReason(c.geom),
+                           {relation},
+                           CASE WHEN %s THEN ST_AsText(c.geom, %s) END,
+                           CASE WHEN %s THEN ST_AsGeojson(c.geom, %s) END
+                    FROM candidate c
+                """
+
+    def validate(self, geom_text: str, table_name: str=None, matrix9IM: str='T********',
+                 id_to_avoid: int=None, with_wkt: bool=False, with_geojson: bool=False,
+                 precision: int=None):
+        """
+        Receives a string, with a geojson, or wkt geometry, and does all the checks.
+        If table_name is None the relation is not checked.
+        The wkt and the geojson have at most precision decimal digits: by default, the ones of the snap.
+        Returns self, with the attributes wkb, is_valid, valid_reason, related_ids, wkt and geojson
+        """
+        q=self.get_query(geom_text, table_name, id_to_avoid, matrix9IM)
+        values=self.get_values(geom_text, table_name, matrix9IM, id_to_avoid, with_wkt, with_geojson, precision)
+
+        types=self.get_types(table_name, id_to_avoid)
+
+        with connection.cursor() as cursor:
+            execute_prepared(cursor, q, values, types)
+            row=cursor.fetchone()
+        return self.set_result(row, table_name, matrix9IM)
+
+    def get_values(self, geom_text: str, table_name: str=None, matrix9IM: str='T********',
+                   id_to_avoid: int=None, with_wkt: bool=False, with_geojson: bool=False,
+                   precision: int=None)->list:
+        """The parameters of the query of get_query"""
+        values=[geom_text, self.epsg_for_geometries]
+        if self.snap_to_grid:
+            values.append(self.st_snap_precision)
+        if table_name is not None:
+            values.append(matrix9IM)
+            if id_to_avoid is not None:
+                values.append(id_to_avoid)
+        if precision is None:
+            precision=snap_decimal_digits(self.st_snap_precision) if self.snap_to_grid else 15
+        return values + [with_wkt, precision, with_geojson, precision]
+
+    def get_types(self, table_name: str=None, id_to_avoid: int=None)->list:
+        """The PostgreSQL types of the parameters of get_values, to prepare the query"""
+        types=['text', 'integer']
+        if self.snap_to_grid:
+            types.append('float8')
+        if table_name is not None:
+            types.append('text')
+            if id_to_avoid is not None:
+                types.append('integer')
+        return types + ['boolean', 'integer', 'boolean', 'integer']
+
+    def set_result(self, row: tuple, table_name: str, matrix9IM: str):
+        """Sets the attributes from the row of the query. Returns self"""
+        self.wkb, self.is_valid, self.valid_reason, ids, self.wkt, self.geojson = row
+        #the same format that GeometryChecks.related_ids: a list of tuples
+        self.related_ids=None if ids is None else [(i,) for i in ids]
+        self.requested_relation=f'ST_relate, matrix: {matrix9IM}'
+        self.table_name=table_name
+        return self
+
+    def are_there_related_ids(self)->bool:
+        """
+        First must call validate with a table_name, or raise exception
+        If there hare related ids returns true
+        """
+        if self.related_ids is None:
+            raise Exception("You first have to call the validate method with a table_name")
+        return len(self.related_ids) > 0
+
+    def get_relate_message(self)->str:
+        if self.are_there_related_ids():
+            return f"The following ids of the table {self.table_name} have the requested  relation ({self.requested_relation}), with the given geometry: {self.related_ids}"
+        else:        
+            return "There are not geometries with the requested relation"
@@ -0,0 +1,158 @@
+import base64
+import json
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection
+from django.db.models import BooleanField, CharField
+from django.db.models.expressions import RawSQL
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+from djangoapi.settings import MAX_NUMBER_OF_RETRIEVED_ROWS
+
+KEYSET_ORDERS = ('id', 'spatial')
+DEFAULT_PAGE_SIZE = 100
+
+#Spatial sort key: the geohash of the centroid. Near features have near keys.
+#The null and empty geometries have the key '', and go first: a NULL key would not be
+#greater than any cursor, and the rows after it would be skipped.
+#To make the pages of the spatial order cost the same that the first one, create the index
+#over the same expression (python manage.py ensure_spatial_indexes --spatial-sort):
+#   CREATE INDEX ON <table> ((COALESCE(CASE WHEN NOT ST_IsEmpty(geom) THEN ...), id)
+SPATIAL_SORT_SQL = "COALESCE(CASE WHEN NOT ST_IsEmpty({geom}) THEN ST_GeoHash(ST_Transform(ST_Centroid({geom}), 4326)) END, '')"
+
+def encode_cursor(values: dict)->str:
+    """Returns the opaque cursor of the values"""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str)->dict:
+    """Returns the values of an opaque cursor. Raises ValueError if the cursor is not valid"""
+    try:
+        values=json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if not isinstance(values, dict) or values.get('o') not in KEYSET_ORDERS or not isinstance(values.get('id'), int):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if values['o']=='spatial' and not isinstance(values.get('k'), str):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return values
+
+def get_spatial_sort_sql(queryset, geom_field: str='geom')->str:
+    qn=connection.ops.quote_name
+    try:
+        column=queryset.model._meta.get_field(geom_field).column
+    except FieldDoesNotExist:
+        raise ValueError(f"The spatial order needs the geometry field {geom_field}")
+    return SPATIAL_SORT_SQL.format(geom=f"{qn(queryset.model._meta.db_table)}.{qn(column)}")
+
+def keyset_page(queryset, cursor: str=None, page_size: int=DEFAULT_PAGE_SIZE, order: str='id',
+                geom_field: str='geom'):
+    """
+    Returns a page of the queryset, with keyset pagination: the next page starts
+    after the last key of the previous one, with an indexed WHERE, not with an OFFSET.
+    So the page 10000 costs the same that the page 1.
+
+    order is:
+        - 'id': the rows are ordered by id.
+        - 'spatial': the rows are ordered by the geohash of the centroid, and the id.
+    If the cursor is given, the order is the one of the cursor.
+
+    Returns a tuple (list of objects, next_cursor). The next_cursor is None on the last page.
+    Raises ValueError if the cursor or the order are not valid
+    """
+    if cursor:
+        values=decode_cursor(cursor)
+        order=values['o']
+    else:
+        values=None
+    if order not in KEYSET_ORDERS:
+        raise ValueError(f"Invalid order {order}. The options are {KEYSET_ORDERS}")
+
+    if order=='spatial':
+        sort_sql=get_spatial_sort_sql(queryset, geom_field)
+        queryset=queryset.annotate(keyset_sort_key=RawSQL(sort_sql, [], output_field=CharField()))
+        if values is not None:
+            #the row comparison uses the index over (sort key, id)
+            queryset=queryset.filter(RawSQL(f"({sort_sql}, {connection.ops.quote_name(queryset.model._meta.db_table)}.id) > (%s, %s)",
+                                            [values['k'], values['id']], output_field=BooleanField()))
+        queryset=queryset.order_by('keyset_sort_key', 'id')
+    else:
+        if values is not None:
+            queryset=queryset.filter(id__gt=values['id'])
+        queryset=queryset.order_by('id')
+
+    rows=list(queryset[:page_size + 1])
+    next_cursor=None
+    if len(rows) > page_size:
+        rows=rows[:page_size]
+        last=rows[-1]
+        next_values={'o': order, 'id': last.id}
+        if order=='spatial':
+            next_values['k']=last.keyset_sort_key
+        next_cursor=encode_cursor(next_values)
+    return rows, next_cursor
+
+def get_page_size(value, default: int=DEFAULT_PAGE_SIZE)->int:
+    """Returns the page size of the parameter, between 1 and MAX_NUMBER_OF_RETRIEVED_ROWS"""
+    if value in (None, ''):
+        return default
+    return max(1, min(int(value), MAX_NUMBER_OF_RETRIEVED_ROWS))
+
+class KeysetPagination(BasePagination):
+    """
+    DJANGO REST FRAMEWORK PAGINATION, with keyset_page.
+
+    The pagination is only applied if the request has the parameters cursor or page_size,
+    so the lists without them return all the records, as before:
+        GET /buildings/buildings/?page_size=100 -> first page, ordered by id
+        GET /buildings/buildings/?page_size=100&order=spatial -> first page, ordered by the geohash of the centroid
+        GET /buildings/buildings/?cursor=<next_cursor> -> next page
+    The response is:
+        {"next": <url of the next page>, "next_cursor": <cursor>, "results": [...]}
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    order_query_param = 'order'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        cursor=request.query_params.get(self.cursor_query_param)
+        page_size=request.query_params.get(self.page_size_query_param)
+        if cursor is None and page_size is None:
+            return None
+        self.request=request
+        order=request.query_params.get(self.order_query_param, 'id')
+        try:
+            page_size=get_page_size(page_size)
+            rows, self.next_cursor=keyset_page(queryset, cursor, page_size, order)
+        except ValueError as e:
+            raise ValidationError({'detail': str(e)})
+        self.page_size=page_size
+        return rows
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url=self.request.build_absolute_uri()
+        url=remove_query_param(url, self.order_query_param)
+        url=replace_query_param(url, self.page_size_query_param, self.page_size)
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'next_cursor': self.next_cursor,
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'next_cursor': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
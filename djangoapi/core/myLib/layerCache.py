@@ -0,0 +1,469 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.contrib.gis.gdal import GDALException
+from django.contrib.gis.geos import Polygon, GEOSException
+from django.db import transaction
+from django.http import HttpResponse
+
+from djangoapi.settings import (LAYER_CACHE_BACKEND, LAYER_CACHE_DIR, LAYER_CACHE_MAX_BYTES,
+                                LAYER_CACHE_MAX_ENTRIES, LAYER_CACHE_TTL)
+from .layerVersion import get_current_layer_version
+from .spatialFilters import parse_bbox
+
+#Half of the width of the web mercator world, in meters
+WEB_MERCATOR_HALF_WIDTH = 20037508.342789244
+#Segments of each side of the envelope of a tile, before it is transformed to the srid of the layer:
+#a rectangle in web mercator is not a rectangle in other projections, and the bbox of its 4
+#transformed corners would miss parts of the tile. The same for the query of the tile
+#(core.myLib.vectorTileView) and its extent in the cache (tile_extent)
+ENVELOPE_SEGMENTS = 16
+#Extent of the entries that can not be located: they are removed on every invalidation of the layer
+ANY_EXTENT = (-math.inf, -math.inf, math.inf, math.inf)
+
+def get_layer(model)->str:
+    """The name of the cache layer of a model: its table"""
+    return model._meta.db_table
+
+def extents_intersect(a: tuple, b: tuple)->bool:
+    """True if the extents (minx, miny, maxx, maxy) intersect"""
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def tile_extent(z: int, x: int, y: int, srid: int, buffer_ratio: float=0, points_per_side: int=ENVELOPE_SEGMENTS)->tuple:
+    """
+    Returns the extent of the web mercator tile z/x/y in the srid. The tile is
+    expanded buffer_ratio times its width, as the geometries of the buffer also are in the tile.
+    The sides are densified before the transformation, as they can be curves in the srid.
+    If the tile can not be transformed to the srid, returns ANY_EXTENT
+    """
+    width=2*WEB_MERCATOR_HALF_WIDTH/2**z
+    margin=width*buffer_ratio
+    minx=-WEB_MERCATOR_HALF_WIDTH + x*width - margin
+    maxx=-WEB_MERCATOR_HALF_WIDTH + (x+1)*width + margin
+    maxy=WEB_MERCATOR_HALF_WIDTH - y*width + margin
+    miny=WEB_MERCATOR_HALF_WIDTH - (y+1)*width - margin
+    if int(srid)==3857:
+        return (minx, miny, maxx, maxy)
+    n=points_per_side
+    dx=(maxx - minx)/n
+    dy=(maxy - miny)/n
+    ring=([(minx + i*dx, miny) for i in range(n)] + [(maxx, miny + i*dy) for i in range(n)]
+          + [(maxx - i*dx, maxy) for i in range(n)] + [(minx, maxy - i*dy) for i in range(n)])
+    ring.append(ring[0])
+    try:
+        bbox=Polygon(ring, srid=3857)
+        bbox.transform(int(srid))
+        extent=bbox.extent
+    except (GDALException, GEOSException):
+        return ANY_EXTENT
+    if not all(math.isfinite(v) for v in extent):
+        return ANY_EXTENT
+    return extent
+
+def get_expires(ttl: float)->float:
+    """The expiration time of an entry stored now. None if ttl is 0: it does not expire"""
+    return time.time() + ttl if ttl else None
+
+def has_expired(expires: float)->bool:
+    return expires is not None and expires <= time.time()
+
+class MemoryLRUBackend:
+    """
+    Keeps the entries in the memory of the process, and removes the least
+    recently used ones when there are more than max_entries, or they use more than max_bytes,
+    and the ones older than ttl seconds.
+    Each process (gunicorn worker) has its own cache, and the invalidations only
+    affect the cache of the process that does the write: the other ones serve the old
+    responses until the ttl. Use it only with one worker, or use the FileLRUBackend.
+    """
+    def __init__(self, max_bytes: int=LAYER_CACHE_MAX_BYTES, max_entries: int=LAYER_CACHE_MAX_ENTRIES,
+                 ttl: float=LAYER_CACHE_TTL):
+        self.max_bytes=max_bytes
+        self.max_entries=max_entries
+        self.ttl=ttl
+        self.entries=OrderedDict() #key: (layer, entry_key). value: (content, content_type, extent, expires)
+        self.size=0
+        self.lock=threading.Lock()
+
+    def get(self, layer: str, key: str):
+        """Returns a tuple (content, content_type), or None"""
+        with self.lock:
+            entry=self.entries.get((layer, key))
+            if entry is None:
+                return None
+            if has_expired(entry[3]):
+                self.size -= len(self.entries.pop((layer, key))[0])
+                return None
+            self.entries.move_to_end((layer, key))
+            return entry[0], entry[1]
+
+    def set(self, layer: str, key: str, content: bytes, content_type: str, extent: tuple)->int:
+        """Stores the entry and returns the number of evicted entries"""
+        if len(content) > self.max_bytes:
+            return 0
+        with self.lock:
+            old=self.entries.pop((layer, key), None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[(layer, key)]=(content, content_type, tuple(extent), get_expires(self.ttl))
+            self.size += len(content)
+            evicted=0
+            while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+                _, (old_content, _, _, _)=self.entries.popitem(last=False)
+                self.size -= len(old_content)
+                evicted += 1
+            return evicted
+
+    def invalidate(self, layer: str, extents: list)->int:
+        """Removes the entries of the layer whose extent intersects any of the extents"""
+        with self.lock:
+            keys=[k for k, (_, _, extent, _) in self.entries.items()
+                  if k[0]==layer and any(extents_intersect(extent, e) for e in extents)]
+            for k in keys:
+                self.size -= len(self.entries.pop(k)[0])
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size=0
+
+    def get_stats(self)->dict:
+        return {'entries': len(self.entries), 'bytes': self.size,
+                'max_entries': self.max_entries, 'max_bytes': self.max_bytes, 'ttl': self.ttl}
+
+class FileLRUBackend:
+    """
+    Keeps the entries in files, in a directory shared by all the processes (gunicorn workers),
+    so the invalidations of one worker are seen by all of them.
+    Each entry is two files: <dir>/<layer>/<hash>.bin with the content, and <hash>.json
+    with the content type, the extent and the expiration time, ttl seconds after it is stored.
+    The modification time of the .bin file is the last use, and the least recently used
+    entries are removed when there are more than max_entries, or they use more than max_bytes.
+
+    So the stores do not list the directory, each process keeps an index of the entries,
+    by last use, with their sizes. It is rebuilt from the directory each rescan_interval
+    seconds, to add the entries of the other processes, that until then are not counted:
+    with several workers the limits are approximate.
+
+    The process also keeps the extents of the entries it has stored or read, so the
+    invalidations only list the names of the files of the layer, and only read the .json
+    of the entries stored by other processes since then. The extent of a key never changes.
+    """
+    def __init__(self, directory: str=LAYER_CACHE_DIR, max_bytes: int=LAYER_CACHE_MAX_BYTES,
+                 max_entries: int=LAYER_CACHE_MAX_ENTRIES, ttl: float=LAYER_CACHE_TTL,
+                 rescan_interval: float=60):
+        self.directory=str(directory)
+        self.max_bytes=max_bytes
+        self.max_entries=max_entries
+        self.ttl=ttl
+        self.rescan_interval=rescan_interval
+        self.lock=threading.Lock()
+        self.index=OrderedDict() #key: content_path. value: (size, meta_path)
+        self.extents={} #key: content_path. value: extent
+        self.size=0
+        self.scanned=None #time.monotonic() of the last scan
+
+    def get_paths(self, layer: str, key: str)->tuple:
+        name=hashlib.sha1(key.encode()).hexdigest()
+        layer_dir=os.path.join(self.directory, layer)
+        return os.path.join(layer_dir, name + '.bin'), os.path.join(layer_dir, name + '.json')
+
+    def get(self, layer: str, key: str):
+        content_path, meta_path=self.get_paths(layer, key)
+        try:
+            with open(meta_path) as f:
+                meta=json.load(f)
+            if has_expired(meta.get('expires')):
+                self.remove(content_path, meta_path)
+                return None
+            with open(content_path, 'rb') as f:
+                content=f.read()
+            os.utime(content_path)
+        except (OSError, ValueError):
+            return None
+        self.add_to_index(content_path, meta_path, len(content), meta['extent'])
+        return content, meta['content_type']
+
+    def set(self, layer: str, key: str, content: bytes, content_type: str, extent: tuple)->int:
+        if len(content) > self.max_bytes:
+            return 0
+        content_path, meta_path=self.get_paths(layer, key)
+        os.makedirs(os.path.dirname(content_path), exist_ok=True)
+        #written to temporary files and renamed, so other processes never read half files
+        suffix=f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(meta_path + suffix, 'w') as f:
+            json.dump({'key': key, 'content_type': content_type, 'extent': list(extent),
+                       'expires': get_expires(self.ttl)}, f)
+        with open(content_path + suffix, 'wb') as f:
+            f.write(content)
+        os.replace(meta_path + suffix, meta_path)
+        os.replace(content_path + suffix, content_path)
+        self.add_to_index(content_path, meta_path, len(content), extent)
+        return self.evict()
+
+    def iter_entries(self, layer: str=None):
+        """Yields (layer, content_path, meta_path, stat of the content)"""
+        if not os.path.isdir(self.directory):
+            return
+        layers=[layer] if layer else os.listdir(self.directory)
+        for layer_name in layers:
+            layer_dir=os.path.join(self.directory, layer_name)
+            if not os.path.isdir(layer_dir):
+                continue
+            for entry in os.scandir(layer_dir):
+                if entry.name.endswith('.bin'):
+                    try:
+                        yield layer_name, entry.path, entry.path[:-4] + '.json', entry.stat()
+                    except OSError:
+                        continue
+
+    def iter_layer_entries(self, layer: str):
+        """Yields (content_path, meta_path) of the entries of the layer, without reading their stats"""
+        layer_dir=os.path.join(self.directory, layer)
+        if not os.path.isdir(layer_dir):
+            return
+        for entry in os.scandir(layer_dir):
+            if entry.name.endswith('.bin'):
+                yield entry.path, entry.path[:-4] + '.json'
+
+    def add_to_index(self, content_path: str, meta_path: str, size: int, extent):
+        """Adds the entry to the index, as the most recently used"""
+        with self.lock:
+            old=self.index.pop(content_path, None)
+            if old is not None:
+                self.size -= old[0]
+            self.index[content_path]=(size, meta_path)
+            self.size += size
+            self.extents[content_path]=tuple(extent)
+
+    def get_extent(self, content_path: str, meta_path: str):
+        """The extent of the entry: the one known by the process, or the one of its .json. None if it can not be read"""
+        with self.lock:
+            extent=self.extents.get(content_path)
+        if extent is not None:
+            return extent
+        try:
+            with open(meta_path) as f:
+                extent=tuple(json.load(f)['extent'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        with self.lock:
+            self.extents[content_path]=extent
+        return extent
+
+    def remove(self, content_path: str, meta_path: str):
+        with self.lock:
+            old=self.index.pop(content_path, None)
+            if old is not None:
+                self.size -= old[0]
+            self.extents.pop(content_path, None)
+        for path in (content_path, meta_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def scan(self):
+        """Rebuilds the index from the files. Call it with the lock"""
+        entries=sorted(self.iter_entries(), key=lambda e: e[3].st_mtime)
+        self.index=OrderedDict((content_path, (stat.st_size, meta_path)) for _, content_path, meta_path, stat in entries)
+        self.size=sum(size for size, _ in self.index.values())
+        #without the entries removed by other processes
+        self.extents={path: extent for path, extent in self.extents.items() if path in self.index}
+        self.scanned=time.monotonic()
+
+    def evict(self)->int:
+        """Removes the least recently used entries of the index while it is over the limits"""
+        removed=[]
+        with self.lock:
+            if self.scanned is None or time.monotonic() - self.scanned >= self.rescan_interval:
+                self.scan()
+            while self.index and (self.size > self.max_bytes or len(self.index) > self.max_entries):
+                content_path, (size, meta_path)=self.index.popitem(last=False)
+                self.size -= size
+                removed.append((content_path, meta_path))
+        for content_path, meta_path in removed:
+            self.remove(content_path, meta_path)
+        return len(removed)
+
+    def invalidate(self, layer: str, extents: list)->int:
+        removed=0
+        for content_path, meta_path in list(self.iter_layer_entries(layer)):
+            extent=self.get_extent(content_path, meta_path)
+            if extent is None or any(extents_intersect(extent, e) for e in extents):
+                self.remove(content_path, meta_path)
+                removed += 1
+        return removed
+
+    def clear(self):
+        for _, content_path, meta_path, _ in list(self.iter_entries()):
+            self.remove(content_path, meta_path)
+        with self.lock:
+            self.index.clear()
+            self.extents.clear()
+            self.size=0
+
+    def get_stats(self)->dict:
+        entries=list(self.iter_entries())
+        return {'entries': len(entries), 'bytes': sum(e[3].st_size for e in entries),
+                'max_entries': self.max_entries, 'max_bytes': self.max_bytes, 'ttl': self.ttl,
+                'directory': self.directory}
+
+class LayerCache:
+    """
+    Cache of the responses of the geometry layers: vector tiles and bbox queries.
+    Each entry has the extent, in the srid of the layer, of the geometries it has.
+    When a geometry of the layer is written, the entries whose extent intersects
+    the extent of the old or the new geometry are removed: invalidate_geometries.
+
+    A response computed while the layer was being invalidated is not stored:
+    the generation of the layer is read before computing it, and passed to set.
+    The generations are of the process, so with the FileLRUBackend a worker can still
+    store a response computed while other worker was writing the same area: it is
+    served until it expires, LAYER_CACHE_TTL seconds later.
+
+    Usage:
+        cached=layer_cache.get('buildings_buildings', key)
+        if cached is None:
+            generation=layer_cache.get_generation('buildings_buildings')
+            ... compute content
+            layer_cache.set('buildings_buildings', key, content, content_type, extent, generation)
+
+        layer_cache.invalidate_on_commit('buildings_buildings', old_geom, new_geom)
+    """
+    def __init__(self, backend=None):
+        self.backend=backend
+        self.lock=threading.Lock()
+        self.generations={}
+        self.metrics={'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0, 'invalidations': 0, 'invalidated_entries': 0}
+
+    @property
+    def enabled(self)->bool:
+        return self.backend is not None
+
+    def count(self, metric: str, n: int=1):
+        with self.lock:
+            self.metrics[metric] += n
+
+    def get(self, layer: str, key: str):
+        """Returns a tuple (content, content_type), or None"""
+        if not self.enabled:
+            return None
+        cached=self.backend.get(layer, key)
+        self.count('hits' if cached is not None else 'misses')
+        return cached
+
+    def get_generation(self, layer: str)->int:
+        """Number of invalidations of the layer in this process"""
+        with self.lock:
+            return self.generations.get(layer, 0)
+
+    def set(self, layer: str, key: str, content: bytes, content_type: str, extent: tuple, generation: int=None):
+        """
+        Stores the content. If generation is given, and the layer has been
+        invalidated after it was read, the content is not stored, as it can be stale
+        """
+        if not self.enabled:
+            return
+        if generation is not None and generation != self.get_generation(layer):
+            return
+        evicted=self.backend.set(layer, key, content, content_type, extent)
+        self.count('sets')
+        self.count('evictions', evicted)
+
+    def invalidate(self, layer: str, extents: list):
+        """Removes the entries of the layer that intersect any of the extents (minx, miny, maxx, maxy)"""
+        extents=[tuple(e) for e in extents if e]
+        if not self.enabled or not extents:
+            return
+        with self.lock:
+            self.generations[layer]=self.generations.get(layer, 0) + 1
+        removed=self.backend.invalidate(layer, extents)
+        self.count('invalidations')
+        self.count('invalidated_entries', removed)
+
+    def invalidate_geometries(self, layer: str, *geoms):
+        """Removes the entries that intersect any of the geometries. The None or empty geometries are ignored"""
+        self.invalidate(layer, [g.extent for g in geoms if g is not None and not g.empty])
+
+    def invalidate_on_commit(self, layer: str, *geoms):
+        """
+        Like invalidate_geometries, but when the current transaction commits.
+        Before, the other requests do not see the changes, so their responses are right.
+        Outside a transaction it invalidates immediately
+        """
+        extents=[g.extent for g in geoms if g is not None and not g.empty]
+        if extents:
+            transaction.on_commit(lambda: self.invalidate(layer, extents))
+
+    def clear(self):
+        if self.enabled:
+            self.backend.clear()
+
+    def get_metrics(self)->dict:
+        with self.lock:
+            metrics=dict(self.metrics)
+        requests=metrics['hits'] + metrics['misses']
+        metrics['hit_ratio']=round(metrics['hits']/requests, 4) if requests else None
+        metrics['backend']=type(self.backend).__name__ if self.enabled else None
+        if self.enabled:
+            metrics.update(self.backend.get_stats())
+        metrics['timestamp']=time.time()
+        return metrics
+
+def get_versioned_key(model, key: str)->str:
+    """
+    The key with the version of the layer read by the conditional response
+    (core.myLib.layerVersion), if there is one. The invalidations of get_generation are
+    only seen by this process: with the version in the key, a content computed by
+    a process before the write of other one is not served after that write
+    """
+    version=get_current_layer_version(model)
+    return key if version is None else f'{key}|v{version}'
+
+class LayerCacheViewSetMixin:
+    """
+    Mixin for the ModelViewSets of geometry models. The lists with bbox are kept
+    in the layer cache, with the extent of the bbox. The key has the Accept header,
+    as the content depends on the renderer (JSON or browsable API), and the version
+    of the layer (LayerVersionViewSetMixin must be before it).
+    The binary formats are not cached. The writes must invalidate the layer.
+    """
+    def list(self, request, *args, **kwargs):
+        binary_format=getattr(self, 'get_binary_format', lambda: None)()
+        if not request.query_params.get('bbox') or binary_format or not layer_cache.enabled:
+            return super().list(request, *args, **kwargs)
+        model=self.queryset.model
+        layer=get_layer(model)
+        key=get_versioned_key(model, f"{request.get_full_path()}|{request.META.get('HTTP_ACCEPT', '')}")
+        cached=layer_cache.get(layer, key)
+        if cached is not None:
+            return HttpResponse(cached[0], content_type=cached[1])
+        generation=layer_cache.get_generation(layer)
+        response=super().list(request, *args, **kwargs)#the bbox has been validated in get_queryset
+        srid=model._meta.get_field('geom').srid
+        extent=parse_bbox(request.query_params.get('bbox'), srid, request.query_params.get('bbox_srid')).extent
+        def cache_rendered(r):
+            #the content is only available once the response is rendered
+            if r.status_code==200:
+                layer_cache.set(layer, key, r.content, r['Content-Type'], extent, generation)
+        response.add_post_render_callback(cache_rendered)
+        return response
+
+def get_layer_cache_backend(backend: str=LAYER_CACHE_BACKEND):
+    if backend=='memory':
+        return MemoryLRUBackend()
+    if backend=='file':
+        return FileLRUBackend()
+    if backend in ('none', '', None):
+        return None
+    raise ValueError(f"Unknown LAYER_CACHE_BACKEND {backend}. The options are file, memory and none")
+
+#The cache of the process
+layer_cache=LayerCache(get_layer_cache_backend())
@@ -0,0 +1,202 @@
+import contextvars
+import hashlib
+
+from django.apps import apps
+from django.contrib.gis.db.models import GeometryField
+from django.db import connection, transaction
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+from .asyncDb import fetchone
+
+LAYER_VERSION_TABLE = 'core_layerversion'
+LAYER_VERSION_FUNCTION = 'core_bump_layer_version'
+LAYER_VERSION_TRIGGER = 'core_layer_version'
+LAYER_VERSION_COMMIT_TRIGGER = 'core_layer_version_commit'
+#Transaction local setting of the tables whose version has been incremented in the transaction
+LAYER_VERSION_SETTING = 'core_layer_version.'
+
+#(table name, version) read by the conditional_layer_response being built
+_current_version=contextvars.ContextVar('layer_version', default=None)
+
+#The version is incremented once per transaction, when it commits, by a deferred constraint
+#trigger on the rows (INSERT, UPDATE, DELETE). It is fired by all the write paths: ORM, raw SQL
+#and COPY + INSERT ... SELECT. The row of core_layerversion is locked only while the transaction
+#commits: the writers of a layer do not wait for each other (core.myLib.spatialLocks).
+#TRUNCATE, that locks the whole table anyway, has a statement trigger.
+#The version is committed with the data: a reader never sees the new version without the new rows
+LAYER_VERSION_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION {LAYER_VERSION_FUNCTION}() RETURNS trigger AS $$
+BEGIN
+    IF TG_LEVEL = 'ROW' THEN
+        IF current_setting('{LAYER_VERSION_SETTING}' || TG_TABLE_NAME, true) = 'bumped' THEN
+            RETURN NULL;
+        END IF;
+        PERFORM set_config('{LAYER_VERSION_SETTING}' || TG_TABLE_NAME, 'bumped', true);
+    END IF;
+    INSERT INTO {LAYER_VERSION_TABLE} (table_name, version, modified)
+    VALUES (TG_TABLE_NAME, 1, clock_timestamp())
+    ON CONFLICT (table_name) DO UPDATE
+        SET version = {LAYER_VERSION_TABLE}.version + 1, modified = clock_timestamp();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+def get_geometry_models()->list:
+    """The managed models with a geometry field"""
+    models=[]
+    for model in apps.get_models():
+        if not model._meta.managed or model._meta.proxy:
+            continue
+        if any(isinstance(f, GeometryField) for f in model._meta.concrete_fields):
+            models.append(model)
+    return models
+
+def get_geometry_tables()->list:
+    """The tables of the managed models with a geometry field"""
+    return [model._meta.db_table for model in get_geometry_models()]
+
+def install_layer_version_triggers(tables: list=None)->list:
+    """
+    Creates the trigger function, and the triggers of the tables (all the geometry tables
+    by default). The tables that do not exist are skipped. It can be run several times.
+    Returns the tables with the trigger
+    """
+    qn=connection.ops.quote_name
+    installed=[]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [LAYER_VERSION_TABLE])
+        if not cursor.fetchone()[0]:
+            return installed
+        cursor.execute(LAYER_VERSION_FUNCTION_SQL)
+        for table_name in (get_geometry_tables() if tables is None else tables):
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [table_name])
+            if not cursor.fetchone()[0]:
+                continue
+            cursor.execute(f"""CREATE OR REPLACE TRIGGER {LAYER_VERSION_TRIGGER}
+                               AFTER TRUNCATE ON {qn(table_name)}
+                               FOR EACH STATEMENT EXECUTE FUNCTION {LAYER_VERSION_FUNCTION}()""")
+            #the constraint triggers can not be replaced
+            cursor.execute(f"DROP TRIGGER IF EXISTS {LAYER_VERSION_COMMIT_TRIGGER} ON {qn(table_name)}")
+            cursor.execute(f"""CREATE CONSTRAINT TRIGGER {LAYER_VERSION_COMMIT_TRIGGER}
+                               AFTER INSERT OR UPDATE OR DELETE ON {qn(table_name)}
+                               DEFERRABLE INITIALLY DEFERRED
+                               FOR EACH ROW EXECUTE FUNCTION {LAYER_VERSION_FUNCTION}()""")
+            #the row must exist to have a Last-Modified before the first write
+            cursor.execute(f"""INSERT INTO {LAYER_VERSION_TABLE} (table_name, version, modified)
+                               VALUES (%s, 0, clock_timestamp()) ON CONFLICT (table_name) DO NOTHING""", [table_name])
+            installed.append(table_name)
+    return installed
+
+def install_layer_version_triggers_on_migrate(sender, **kwargs):
+    """post_migrate receiver. Installs the triggers in the database of the migration"""
+    install_layer_version_triggers()
+
+def get_layer_version(model):
+    """
+    Returns a tuple (version, modified) of the table of the model, with one indexed lookup.
+    (None, None) if the table has not a trigger
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT version, modified FROM {LAYER_VERSION_TABLE} WHERE table_name = %s",
+                       [model._meta.db_table])
+        row=cursor.fetchone()
+    return row if row else (None, None)
+
+def get_layer_etag(model, version: int, representation: str='')->str:
+    """
+    The strong ETag of the version of the layer. representation is what makes different
+    the responses of the same URL, as the Accept header
+    """
+    digest=hashlib.sha1(representation.encode()).hexdigest()[:8]
+    return f'"{model._meta.db_table}-{version}-{digest}"'
+
+def get_not_modified_response(request, model, version: int, modified):
+    """
+    Returns a tuple (etag, last_modified, response). The response is a 304 Not Modified
+    if the request already has the version, or None
+    """
+    etag=get_layer_etag(model, version, request.META.get('HTTP_ACCEPT', ''))
+    last_modified=int(modified.timestamp())
+    return etag, last_modified, get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+def get_current_layer_version(model)->int:
+    """
+    The version of the layer of the model read by the conditional_layer_response that is
+    building the response, or None. The layer cache adds it to its keys, so a content
+    computed before a write is never served with the ETag of a version after it
+    """
+    current=_current_version.get()
+    if current is None or current[0] != model._meta.db_table:
+        return None
+    return current[1]
+
+def get_versioned_response(model, version: int, get_response):
+    """get_response(), with the version as the current one of the layer"""
+    token=_current_version.set((model._meta.db_table, version))
+    try:
+        return get_response()
+    finally:
+        _current_version.reset(token)
+
+def set_layer_version_headers(response, etag: str, last_modified: int):
+    response['ETag']=etag
+    response['Last-Modified']=http_date(last_modified)
+    patch_vary_headers(response, ('Accept',))
+    return response
+
+def conditional_layer_response(request, model, get_response):
+    """
+    Returns 304 Not Modified if the If-None-Match or If-Modified-Since of the request
+    match the version of the layer of the model. If not, returns get_response() with
+    the headers ETag and Last-Modified. Only the GET and HEAD with a 200 response get them.
+    The version is read before building the response, so a response never has an ETag
+    newer than its content. While get_response() runs, the version is the one of
+    get_current_layer_version(model).
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return get_response()
+    version, modified=get_layer_version(model)
+    if version is None:
+        return get_response()
+    etag, last_modified, response=get_not_modified_response(request, model, version, modified)
+    if response is None:
+        response=get_versioned_response(model, version, get_response)
+        if response.status_code != 200:
+            return response
+    return set_layer_version_headers(response, etag, last_modified)
+
+async def aconditional_layer_response(request, model, get_response):
+    """As conditional_layer_response, for the async views. get_response is a coroutine function"""
+    if request.method not in ('GET', 'HEAD'):
+        return await get_response()
+    row=await fetchone(f"SELECT version, modified FROM {LAYER_VERSION_TABLE} WHERE table_name = %s",
+                       [model._meta.db_table])
+    if row is None:
+        return await get_response()
+    etag, last_modified, response=get_not_modified_response(request, model, *row)
+    if response is None:
+        token=_current_version.set((model._meta.db_table, row[0]))
+        try:
+            response=await get_response()
+        finally:
+            _current_version.reset(token)
+        if response.status_code != 200:
+            return response
+    return set_layer_version_headers(response, etag, last_modified)
+
+class LayerVersionViewSetMixin:
+    """
+    Mixin for the ModelViewSets of geometry models. The list and the retrieve have
+    the ETag and the Last-Modified of the version of the layer, and answer 304 Not Modified,
+    without querying the geometries, if the layer has not changed.
+    It must be the first class, so the conditional check is done before anything else.
+    """
+    def list(self, request, *args, **kwargs):
+        return conditional_layer_response(request, self.queryset.model,
+                                          lambda: super(LayerVersionViewSetMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return conditional_layer_response(request, self.queryset.model,
+                                          lambda: super(LayerVersionViewSetMixin, self).retrieve(request, *args, **kwargs))
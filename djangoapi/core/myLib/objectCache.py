@@ -0,0 +1,379 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.http import Http404
+from rest_framework.response import Response
+
+from djangoapi.settings import (OBJECT_CACHE_BACKEND, OBJECT_CACHE_DIR, OBJECT_CACHE_TTL,
+                                OBJECT_CACHE_MAX_BYTES, OBJECT_CACHE_MAX_ENTRIES)
+from .geometryEncoders import get_output_precision
+from .layerCache import get_layer
+
+class MemoryTTLBackend:
+    """
+    Keeps the entries in the memory of the process, until they expire. When there are
+    more than max_entries, or they use more than max_bytes, the least recently used are removed.
+    Each process (gunicorn worker) has its own cache, and the invalidations only
+    affect the process that does the write: the other ones serve the old object until
+    the TTL. Use the FileTTLBackend with several workers.
+    """
+    def __init__(self, max_bytes: int=OBJECT_CACHE_MAX_BYTES, max_entries: int=OBJECT_CACHE_MAX_ENTRIES):
+        self.max_bytes=max_bytes
+        self.max_entries=max_entries
+        self.entries=OrderedDict() #key: (layer, id, variant). value: (content, expires)
+        self.variants={} #key: (layer, id). value: set of variants
+        self.size=0
+        self.lock=threading.Lock()
+
+    def get(self, layer: str, id, variant: str):
+        """Returns the content, or None if it is not cached or it has expired"""
+        key=(layer, str(id), variant)
+        with self.lock:
+            entry=self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                self.pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def pop(self, key: tuple):
+        content, _=self.entries.pop(key)
+        self.size -= len(content)
+        variants=self.variants.get(key[:2])
+        if variants is not None:
+            variants.discard(key[2])
+            if not variants:
+                del self.variants[key[:2]]
+
+    def set(self, layer: str, id, variant: str, content: bytes, ttl: float)->int:
+        """Stores the entry and returns the number of evicted entries"""
+        if len(content) > self.max_bytes:
+            return 0
+        key=(layer, str(id), variant)
+        with self.lock:
+            if key in self.entries:
+                self.pop(key)
+            self.entries[key]=(content, time.time() + ttl)
+            self.variants.setdefault(key[:2], set()).add(variant)
+            self.size += len(content)
+            evicted=0
+            while self.size > self.max_bytes or len(self.entries) > self.max_entries:
+                self.pop(next(iter(self.entries)))
+                evicted += 1
+            return evicted
+
+    def delete(self, layer: str, ids: list)->int:
+        """Removes all the variants of the objects. Returns the number of removed entries"""
+        removed=0
+        with self.lock:
+            for id in ids:
+                for variant in list(self.variants.get((layer, str(id)), ())):
+                    self.pop((layer, str(id), variant))
+                    removed += 1
+        return removed
+
+    def delete_layer(self, layer: str)->int:
+        with self.lock:
+            keys=[k for k in self.entries if k[0]==layer]
+            for k in keys:
+                self.pop(k)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.variants.clear()
+            self.size=0
+
+    def get_stats(self)->dict:
+        return {'entries': len(self.entries), 'bytes': self.size,
+                'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
+
+class FileTTLBackend:
+    """
+    Keeps the entries in files, in a directory shared by all the processes (gunicorn workers),
+    so the invalidations of one worker are seen by all of them.
+    Each entry is the file <dir>/<layer>/<id>/<hash of the variant>.bin. Its first line
+    is the expiration time, and the rest the content. The modification time is the last use,
+    and the least recently used entries are removed when there are more than max_entries,
+    or they use more than max_bytes.
+    """
+    def __init__(self, directory: str=OBJECT_CACHE_DIR, max_bytes: int=OBJECT_CACHE_MAX_BYTES,
+                 max_entries: int=OBJECT_CACHE_MAX_ENTRIES):
+        self.directory=str(directory)
+        self.max_bytes=max_bytes
+        self.max_entries=max_entries
+
+    def get_object_dir(self, layer: str, id)->str:
+        return os.path.join(self.directory, layer, str(id))
+
+    def get_path(self, layer: str, id, variant: str)->str:
+        return os.path.join(self.get_object_dir(layer, id), hashlib.sha1(variant.encode()).hexdigest() + '.bin')
+
+    def get(self, layer: str, id, variant: str):
+        path=self.get_path(layer, id, variant)
+        try:
+            with open(path, 'rb') as f:
+                expires=float(f.readline())
+                if expires <= time.time():
+                    content=None
+                else:
+                    content=f.read()
+            if content is None:
+                os.remove(path)
+            else:
+                os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return content
+
+    def set(self, layer: str, id, variant: str, content: bytes, ttl: float)->int:
+        if len(content) > self.max_bytes:
+            return 0
+        path=self.get_path(layer, id, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #written to a temporary file and renamed, so other processes never read half files
+        tmp_path=f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(f'{time.time() + ttl}\n'.encode())
+            f.write(content)
+        os.replace(tmp_path, path)
+        return self.evict()
+
+    def iter_entries(self):
+        """Yields (path, stat) of all the entries"""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.bin'):
+                    path=os.path.join(root, name)
+                    try:
+                        yield path, os.stat(path)
+                    except OSError:
+                        continue
+
+    def evict(self)->int:
+        entries=sorted(self.iter_entries(), key=lambda e: e[1].st_mtime)
+        size=sum(e[1].st_size for e in entries)
+        evicted=0
+        while entries and (size > self.max_bytes or len(entries) > self.max_entries):
+            path, stat=entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= stat.st_size
+            evicted += 1
+        return evicted
+
+    def remove_dir(self, path: str)->int:
+        if not os.path.isdir(path):
+            return 0
+        removed=sum(1 for name in os.listdir(path) if name.endswith('.bin'))
+        shutil.rmtree(path, ignore_errors=True)
+        return removed
+
+    def delete(self, layer: str, ids: list)->int:
+        return sum(self.remove_dir(self.get_object_dir(layer, id)) for id in ids)
+
+    def delete_layer(self, layer: str)->int:
+        layer_dir=os.path.join(self.directory, layer)
+        if not os.path.isdir(layer_dir):
+            return 0
+        return sum(self.remove_dir(os.path.join(layer_dir, name)) for name in os.listdir(layer_dir))
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def get_stats(self)->dict:
+        entries=list(self.iter_entries())
+        return {'entries': len(entries), 'bytes': sum(e[1].st_size for e in entries),
+                'max_entries': self.max_entries, 'max_bytes': self.max_bytes, 'directory': self.directory}
+
+class ObjectCache:
+    """
+    Read-through cache of the serialized features, by layer (table) and id.
+    Each object can have several variants: the same feature serialized for different
+    views or output precisions. The invalidation of an object removes all its variants.
+    The entries expire after ttl seconds, so the writes that are not seen (other
+    processes with the MemoryTTLBackend, SQL outside Django) are served at most ttl seconds.
+
+    The objects are invalidated by the post_save and post_delete signals of the
+    registered models (register_object_cache_signals), and by the raw SQL writes,
+    that must call invalidate_on_commit or invalidate_layer_on_commit.
+
+    A payload computed while the object was being invalidated is not stored:
+    the generation of the layer is read before computing it.
+
+    Usage:
+        data=object_cache.get_or_set(Buildings, id, f'selectone|{precision}', lambda: build_payload(id))
+    """
+    def __init__(self, backend=None, ttl: float=OBJECT_CACHE_TTL):
+        self.backend=backend
+        self.ttl=ttl
+        self.lock=threading.Lock()
+        self.generations={}
+        self.metrics={'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0, 'invalidations': 0, 'invalidated_entries': 0}
+
+    @property
+    def enabled(self)->bool:
+        return self.backend is not None
+
+    def count(self, metric: str, n: int=1):
+        with self.lock:
+            self.metrics[metric] += n
+
+    def get_generation(self, layer: str)->int:
+        with self.lock:
+            return self.generations.get(layer, 0)
+
+    def bump_generation(self, layer: str):
+        with self.lock:
+            self.generations[layer]=self.generations.get(layer, 0) + 1
+
+    def get_or_set(self, model, id, variant: str, build):
+        """
+        Returns the cached payload of the object, or build(), which is stored.
+        build() returns a JSON serializable payload, or None if the object
+        does not exist (the None are not stored)
+        """
+        if not self.enabled:
+            return build()
+        layer=get_layer(model)
+        content=self.backend.get(layer, id, variant)
+        if content is not None:
+            self.count('hits')
+            return json.loads(content)
+        self.count('misses')
+        generation=self.get_generation(layer)
+        payload=build()
+        if payload is not None and generation==self.get_generation(layer):
+            evicted=self.backend.set(layer, id, variant, json.dumps(payload, cls=DjangoJSONEncoder).encode(), self.ttl)
+            self.count('sets')
+            self.count('evictions', evicted)
+        return payload
+
+    async def aget_or_set(self, model, id, variant: str, build):
+        """As get_or_set, for the async views. build is a coroutine function"""
+        if not self.enabled:
+            return await build()
+        layer=get_layer(model)
+        content=self.backend.get(layer, id, variant)
+        if content is not None:
+            self.count('hits')
+            return json.loads(content)
+        self.count('misses')
+        generation=self.get_generation(layer)
+        payload=await build()
+        if payload is not None and generation==self.get_generation(layer):
+            evicted=self.backend.set(layer, id, variant, json.dumps(payload, cls=DjangoJSONEncoder).encode(), self.ttl)
+            self.count('sets')
+            self.count('evictions', evicted)
+        return payload
+
+    def invalidate(self, model, *ids):
+        """Removes all the variants of the objects"""
+        if not self.enabled or not ids:
+            return
+        layer=get_layer(model)
+        self.bump_generation(layer)
+        removed=self.backend.delete(layer, ids)
+        self.count('invalidations')
+        self.count('invalidated_entries', removed)
+
+    def invalidate_on_commit(self, model, *ids):
+        """
+        Invalidates now, and again when the transaction commits, as other request can
+        cache the old object before the commit. Outside a transaction it invalidates once
+        """
+        self.invalidate(model, *ids)
+        if not transaction.get_autocommit():
+            transaction.on_commit(lambda: self.invalidate(model, *ids))
+
+    def invalidate_layer(self, model):
+        """Removes all the objects of the model. For the writes of many rows"""
+        if not self.enabled:
+            return
+        layer=get_layer(model)
+        self.bump_generation(layer)
+        removed=self.backend.delete_layer(layer)
+        self.count('invalidations')
+        self.count('invalidated_entries', removed)
+
+    def invalidate_layer_on_commit(self, model):
+        self.invalidate_layer(model)
+        if not transaction.get_autocommit():
+            transaction.on_commit(lambda: self.invalidate_layer(model))
+
+    def clear(self):
+        if self.enabled:
+            self.backend.clear()
+
+    def get_metrics(self)->dict:
+        with self.lock:
+            metrics=dict(self.metrics)
+        requests=metrics['hits'] + metrics['misses']
+        metrics['hit_ratio']=round(metrics['hits']/requests, 4) if requests else None
+        metrics['backend']=type(self.backend).__name__ if self.enabled else None
+        metrics['ttl']=self.ttl
+        if self.enabled:
+            metrics.update(self.backend.get_stats())
+        metrics['timestamp']=time.time()
+        return metrics
+
+class ObjectCacheViewSetMixin:
+    """
+    Mixin for the ModelViewSets of geometry models. The retrieve payloads (serializer.data)
+    are kept in the object cache, by id, serializer and output precision.
+    Put it after GeoBinaryViewSetMixin, so the binary formats are not cached.
+    """
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            precision=get_output_precision(request.query_params)
+        except ValueError:
+            #get_queryset returns the error
+            return super().retrieve(request, *args, **kwargs)
+        id=kwargs[self.lookup_url_kwarg or self.lookup_field]
+        variant=f'retrieve|{self.get_serializer_class().__name__}|{precision}'
+        def build():
+            try:
+                return super(ObjectCacheViewSetMixin, self).retrieve(request, *args, **kwargs).data
+            except Http404:
+                return None
+        data=object_cache.get_or_set(self.queryset.model, id, variant, build)
+        if data is None:
+            raise Http404
+        return Response(data)
+
+def get_object_cache_backend(backend: str=OBJECT_CACHE_BACKEND):
+    if backend=='memory':
+        return MemoryTTLBackend()
+    if backend=='file':
+        return FileTTLBackend()
+    if backend in ('none', '', None):
+        return None
+    raise ValueError(f"Unknown OBJECT_CACHE_BACKEND {backend}. The options are memory, file and none")
+
+#The cache of the process
+object_cache=ObjectCache(get_object_cache_backend())
+
+def invalidate_object_on_write(sender, instance, **kwargs):
+    """post_save and post_delete receiver"""
+    object_cache.invalidate_on_commit(sender, instance.pk)
+
+def register_object_cache_signals(models: list):
+    """Connects the invalidation of the object cache to the writes of the models"""
+    for model in models:
+        post_save.connect(invalidate_object_on_write, sender=model, dispatch_uid=f'object_cache_save_{get_layer(model)}')
+        post_delete.connect(invalidate_object_on_write, sender=model, dispatch_uid=f'object_cache_delete_{get_layer(model)}')
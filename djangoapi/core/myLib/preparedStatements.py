@@ -0,0 +1,116 @@
+"""
+Server side prepared statements for the hot, fixed shape geometry queries of
+WkbConversor, GeometryChecks and GeometryValidation.
+
+The Django cursors send the queries with the parameters already in the SQL text, so
+PostgreSQL parses and plans them on every call. With a pooled or persistent connection
+(DB_POOL, CONN_MAX_AGE), a query run PREPARED_STATEMENTS_THRESHOLD times in the same
+connection is prepared once:
+    PREPARE geom_<hash>(text, integer, float8) AS SELECT ST_SnapToGrid(ST_SetSRID(ST_GeomFromText($1), $2), $3)
+and the next calls only send:
+    EXECUTE geom_<hash>('POLYGON(...)', 25830, 0.0001)
+The PREPARE is sent with the first EXECUTE, in the same round trip. The prepared statements
+live in the connection, until it is closed. The first calls are run as usual, so the
+connections used only once per request do not pay the PREPARE.
+
+Usage:
+    with connection.cursor() as cursor:
+        execute_prepared(cursor, "SELECT ST_IsValid(%s)", [wkb], ['geometry'])
+        row=cursor.fetchone()
+"""
+
+import hashlib
+import re
+import threading
+import weakref
+
+from djangoapi.settings import PREPARED_STATEMENTS_THRESHOLD
+
+PREPARED = -1
+DISABLED = -2
+#state of each database connection: {statement name: executions, PREPARED or DISABLED}
+_states=weakref.WeakKeyDictionary()
+_lock=threading.Lock()
+_metrics={'executions': 0, 'prepares': 0, 'prepared_executions': 0}
+#SQL of each statement name, for the slow query captures (core.myLib.slowQueries)
+_sqls={}
+EXECUTE_PATTERN = re.compile(r'^\s*EXECUTE\s+(geom_[0-9a-f]{16})\b')
+
+def to_positional(sql: str)->str:
+    """Replaces the placeholders %s of the Django cursors by the $1, $2, ... of PREPARE"""
+    parts=sql.split('%s')
+    return parts[0] + ''.join(f'${i}{part}' for i, part in enumerate(parts[1:], start=1))
+
+def get_statement_name(sql: str, types: list)->str:
+    """The same query with the same types always has the same name"""
+    return 'geom_' + hashlib.sha1(f"{sql}|{','.join(types)}".encode()).hexdigest()[:16]
+
+def count(metric: str):
+    with _lock:
+        _metrics[metric] += 1
+
+def get_state(raw_connection)->dict:
+    """The statements of the connection. None if the driver connection does not accept weak references"""
+    with _lock:
+        try:
+            return _states.setdefault(raw_connection, {})
+        except TypeError:
+            return None
+
+def execute_prepared(cursor, sql: str, params: list, types: list,
+                     threshold: int=PREPARED_STATEMENTS_THRESHOLD):
+    """
+    Executes sql, with the placeholders %s and without literal %, in the cursor of a
+    Django connection. types are the PostgreSQL types of the params, in order. After
+    threshold executions in the connection, the query is prepared and executed with EXECUTE.
+    The PREPARE goes with the first EXECUTE, so each call is one round trip.
+    The results are read as usual: cursor.fetchone(), cursor.fetchall()
+    """
+    if len(params) != len(types):
+        raise ValueError(f"The query has {len(params)} parameters and {len(types)} types")
+    count('executions')
+    state=get_state(cursor.db.connection) if threshold > 0 else None
+    if state is None:
+        return cursor.execute(sql, params)
+    name=get_statement_name(sql, types)
+    executions=state.get(name, 0)
+    if executions == DISABLED or (executions != PREPARED and executions + 1 < threshold):
+        if executions != DISABLED:
+            state[name]=executions + 1
+        return cursor.execute(sql, params)
+    execute=f"EXECUTE {name}({', '.join(['%s']*len(params))})" if params else f"EXECUTE {name}"
+    if executions == PREPARED:
+        count('prepared_executions')
+        return cursor.execute(execute, params)
+    signature=f"({', '.join(types)})" if types else ''
+    try:
+        cursor.execute(f"PREPARE {name}{signature} AS {to_positional(sql).replace('%', '%%')}; {execute}", params)
+    except Exception:
+        #it is not known if the statement was prepared: the connection does not use it
+        state[name]=DISABLED
+        raise
+    state[name]=PREPARED
+    _sqls[name]=sql
+    count('prepares')
+    count('prepared_executions')
+    if cursor.description is None:
+        #psycopg 3 is on the result of the PREPARE. psycopg 2 is already on the last one
+        cursor.nextset()
+
+def get_prepared_sql(sql: str)->str:
+    """If sql is the EXECUTE of a statement prepared here, the SQL of the statement. Otherwise None"""
+    match=EXECUTE_PATTERN.match(sql)
+    return _sqls.get(match.group(1)) if match else None
+
+def forget_connection(raw_connection):
+    """To call if the statements of the connection have been deallocated (DEALLOCATE ALL, DISCARD ALL)"""
+    with _lock:
+        _states.pop(raw_connection, None)
+
+def get_prepared_statements_metrics()->dict:
+    with _lock:
+        metrics=dict(_metrics)
+        metrics['connections']=len(_states)
+        metrics['statements']=sum(1 for state in _states.values() for v in state.values() if v == PREPARED)
+    metrics['threshold']=PREPARED_STATEMENTS_THRESHOLD
+    return metrics
@@ -0,0 +1,224 @@
+"""
+Per request instrumentation, for core.middleware.RequestMetricsMiddleware.
+
+In each request are measured:
+    - the SQL queries of the Django connections, with connection.execute_wrapper:
+      the number, the total time and the slowest one
+    - the phases marked in the code with timed_phase: 'geos' and 'serialize'
+    - the python time: the rest of the total
+They are sent in the Server-Timing header of the response, so they are shown in the
+network tab of the browser:
+    Server-Timing: db;dur=12.4;desc="9 queries", db-slowest;dur=4.1, geos;dur=0.8, serialize;dur=1.2, python;dur=3.5, total;dur=18.0
+and added, by URL name, action of the BaseDjangoView and status class, to the Prometheus
+metrics of /metrics/ (request_metrics.to_prometheus()).
+
+The time of the queries run inside a phase is counted in db, not in the phase.
+The body of the streaming responses is sent after the middleware has finished: only
+the time until the first byte is measured. The queries of the async views, in the
+psycopg pool of core.myLib.asyncDb, are not seen by the Django execute wrappers:
+in the ASGI server they are measured with asyncDb.observe_queries. The queries that
+the async views run at the same time are all added to db.
+
+The metrics are the ones of this process: with several gunicorn workers, each one
+has its own ones, as the layer and object cache metrics.
+
+Usage, to measure a phase:
+    with timed_phase('serialize'):
+        response=JsonResponse({'ok':True, 'message': 'Building updated', 'data':[d]})
+Out of a measured request, timed_phase does nothing.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+from djangoapi.settings import REQUEST_METRICS_MAX_SERIES
+
+PHASES = ('geos', 'serialize')
+#Upper bounds, in seconds, of the buckets of the histogram of the request duration
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+#Label of the requests without URL name or action, and of the series beyond REQUEST_METRICS_MAX_SERIES
+NO_LABEL = ''
+OTHER_LABEL = 'other'
+MAX_ACTION_LENGTH = 40
+
+_current=contextvars.ContextVar('request_timings', default=None)
+
+class RequestTimings:
+    """
+    Times of one request. The instance is the execute wrapper of the Django connections:
+        with connection.execute_wrapper(timings):
+    """
+    def __init__(self):
+        self.start=time.perf_counter()
+        self.queries=0
+        self.db_time=0.0
+        self.slowest_time=0.0
+        self.slowest_sql=None
+        self.phases=dict.fromkeys(PHASES, 0.0)
+
+    def __call__(self, execute, sql, params, many, context):
+        start=time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add_query(sql, time.perf_counter() - start)
+
+    def observe(self, sql: str, params, duration: float):
+        """The observer of the queries of the async pool (core.myLib.asyncDb.observe_queries)"""
+        self.add_query(sql, duration)
+
+    def add_query(self, sql: str, duration: float):
+        self.queries += 1
+        self.db_time += duration
+        if duration > self.slowest_time:
+            self.slowest_time=duration
+            self.slowest_sql=sql
+
+    def add_phase(self, name: str, duration: float):
+        self.phases[name]=self.phases.get(name, 0.0) + duration
+
+    def get_python_time(self, total: float)->float:
+        return max(0.0, total - self.db_time - sum(self.phases.values()))
+
+    def get_server_timing(self, total: float)->str:
+        """The value of the Server-Timing header, with the times in milliseconds"""
+        metrics=[f'db;dur={self.db_time*1000:.1f};desc="{self.queries} queries"',
+                 f'db-slowest;dur={self.slowest_time*1000:.1f}']
+        metrics += [f'{name};dur={duration*1000:.1f}' for name, duration in self.phases.items()]
+        metrics += [f'python;dur={self.get_python_time(total)*1000:.1f}', f'total;dur={total*1000:.1f}']
+        return ', '.join(metrics)
+
+def get_current_timings()->RequestTimings:
+    """The timings of the request being measured, or None"""
+    return _current.get()
+
+@contextlib.contextmanager
+def measure_request(connections):
+    """
+    Yields the RequestTimings of the code run inside, with the queries of the connections
+    (django.db.connections.all()). The phases must not be nested
+    """
+    timings=RequestTimings()
+    token=_current.set(timings)
+    try:
+        with contextlib.ExitStack() as stack:
+            for connection in connections:
+                stack.enter_context(connection.execute_wrapper(timings))
+            yield timings
+    finally:
+        _current.reset(token)
+
+@contextlib.contextmanager
+def timed_phase(name: str):
+    """Adds the time of the code inside, without its queries, to the phase name of the current request"""
+    timings=_current.get()
+    if timings is None:
+        yield
+        return
+    start=time.perf_counter()
+    db_time=timings.db_time
+    try:
+        yield
+    finally:
+        timings.add_phase(name, time.perf_counter() - start - (timings.db_time - db_time))
+
+def get_labels(request, status_code: int)->tuple:
+    """
+    (url name, action, status class) of the request. The action is the one of the URLs
+    of the BaseDjangoView: buildings_view/<str:action>/
+    """
+    match=getattr(request, 'resolver_match', None)
+    url_name=(match.url_name or NO_LABEL) if match is not None else NO_LABEL
+    action=str(match.kwargs.get('action', NO_LABEL)) if match is not None else NO_LABEL
+    if len(action) > MAX_ACTION_LENGTH or not action.replace('_', '').isalnum():
+        action=OTHER_LABEL if action else NO_LABEL
+    return url_name, action, f'{status_code // 100}xx'
+
+def escape_label(value: str)->str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class RequestMetrics:
+    """
+    Aggregation of the RequestTimings by (url name, action, status class). As the actions
+    come from the URL, the number of series is limited to max_series: the requests of
+    the new ones are added to the series (other, other, status class)
+    """
+    def __init__(self, max_series: int=REQUEST_METRICS_MAX_SERIES):
+        self.max_series=max_series
+        self.lock=threading.Lock()
+        self.series={}
+
+    def new_series(self)->dict:
+        return {'requests': 0, 'duration_sum': 0.0, 'buckets': [0]*(len(DURATION_BUCKETS) + 1),
+                'queries': 0, 'db_sum': 0.0, 'slowest_query_max': 0.0, 'python_sum': 0.0,
+                'phases': dict.fromkeys(PHASES, 0.0)}
+
+    def add(self, labels: tuple, timings: RequestTimings, total: float):
+        with self.lock:
+            series=self.series.get(labels)
+            if series is None:
+                if len(self.series) >= self.max_series:
+                    labels=(OTHER_LABEL, OTHER_LABEL, labels[2])
+                series=self.series.setdefault(labels, self.new_series())
+            series['requests'] += 1
+            series['duration_sum'] += total
+            series['buckets'][bisect.bisect_left(DURATION_BUCKETS, total)] += 1
+            series['queries'] += timings.queries
+            series['db_sum'] += timings.db_time
+            series['slowest_query_max']=max(series['slowest_query_max'], timings.slowest_time)
+            series['python_sum'] += timings.get_python_time(total)
+            for name, duration in timings.phases.items():
+                series['phases'][name]=series['phases'].get(name, 0.0) + duration
+
+    def reset(self):
+        with self.lock:
+            self.series={}
+
+    def get_series(self)->dict:
+        with self.lock:
+            return {labels: dict(series, buckets=list(series['buckets']), phases=dict(series['phases']))
+                    for labels, series in self.series.items()}
+
+    def to_prometheus(self)->str:
+        """The metrics in the Prometheus text exposition format"""
+        series=sorted(self.get_series().items())
+        lines=[]
+        def add_metric(name: str, kind: str, help_text: str, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                text=','.join(f'{k}="{escape_label(v)}"' for k, v in labels)
+                lines.append(f'{name}{suffix}{{{text}}} {value}')
+
+        def labels_of(key: tuple)->list:
+            return list(zip(('url_name', 'action', 'status'), key))
+
+        add_metric('djangoapi_requests_total', 'counter', 'Requests',
+                   [('', labels_of(k), s['requests']) for k, s in series])
+        samples=[]
+        for k, s in series:
+            cumulative=0
+            for bound, n in zip(DURATION_BUCKETS + ('+Inf',), s['buckets']):
+                cumulative += n
+                samples.append(('_bucket', labels_of(k) + [('le', str(bound))], cumulative))
+            samples.append(('_sum', labels_of(k), repr(s['duration_sum'])))
+            samples.append(('_count', labels_of(k), s['requests']))
+        add_metric('djangoapi_request_duration_seconds', 'histogram', 'Time until the response is returned', samples)
+        add_metric('djangoapi_request_queries_total', 'counter', 'SQL queries of the requests',
+                   [('', labels_of(k), s['queries']) for k, s in series])
+        add_metric('djangoapi_request_db_seconds_total', 'counter', 'Time of the SQL queries of the requests',
+                   [('', labels_of(k), repr(s['db_sum'])) for k, s in series])
+        add_metric('djangoapi_request_slowest_query_seconds', 'gauge', 'Slowest SQL query of a request',
+                   [('', labels_of(k), repr(s['slowest_query_max'])) for k, s in series])
+        samples=[]
+        for k, s in series:
+            for name, duration in list(s['phases'].items()) + [('python', s['python_sum'])]:
+                samples.append(('', labels_of(k) + [('phase', name)], repr(duration)))
+        add_metric('djangoapi_request_phase_seconds_total', 'counter',
+                   'Time of the requests out of the SQL queries, by phase', samples)
+        return '\n'.join(lines) + '\n'
+
+request_metrics=RequestMetrics()
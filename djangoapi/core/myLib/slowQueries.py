@@ -0,0 +1,231 @@
+"""
+Capture of the slow queries, with their plans, for core.middleware.SlowQueryMiddleware.
+
+The queries of the requests that take more than SLOW_QUERY_THRESHOLD_MS, and all the
+queries of a fraction SLOW_QUERY_SAMPLE_RATE of the requests, are kept with:
+    - the SQL, with the placeholders %s, and the parameters. The geometries (GEOSGeometry,
+      WKB, hex EWKB, WKT, GeoJSON) are replaced by their type, size and bbox. The queries of
+      the tables of the credentials (REDACTED_TABLES: users, sessions, knox tokens) have all
+      their strings and binary values replaced by their length, and are not explained.
+      For the EXECUTE of the prepared statements (core.myLib.preparedStatements), the SQL
+      of the statement
+    - the duration, the URL and the request id of the log messages (core.myLib.structuredLogging)
+    - the plan of EXPLAIN, only for the SELECT queries, in a savepoint (or a transaction)
+      that is rolled back, with the statement_timeout SLOW_QUERY_EXPLAIN_TIMEOUT_MS. At most
+      one EXPLAIN each SLOW_QUERY_EXPLAIN_INTERVAL seconds, so a slow database does not get
+      slower. With SLOW_QUERY_EXPLAIN_ANALYZE it is EXPLAIN (ANALYZE, BUFFERS), that runs
+      the query again, in the request: only to investigate, not by default.
+      The geometry literals of the plan are redacted too
+
+The captures are kept in a ring buffer of the last SLOW_QUERY_BUFFER_SIZE ones, of this
+process: with several gunicorn workers, each one has its own buffer. The staff can browse
+them in /core/slow_queries/ and download them in /core/slow_queries/download/.
+"""
+
+import collections
+import itertools
+import random
+import re
+import threading
+import time
+
+from django.contrib.gis.geos import GEOSGeometry, GEOSException
+
+from djangoapi.settings import (SLOW_QUERY_THRESHOLD_MS, SLOW_QUERY_SAMPLE_RATE, SLOW_QUERY_EXPLAIN,
+                                SLOW_QUERY_EXPLAIN_ANALYZE, SLOW_QUERY_EXPLAIN_INTERVAL,
+                                SLOW_QUERY_EXPLAIN_TIMEOUT_MS, SLOW_QUERY_BUFFER_SIZE)
+from .preparedStatements import get_prepared_sql
+from .structuredLogging import get_current_request_id
+
+#The strings longer than this are cut
+MAX_PARAM_LENGTH = 200
+GEOMETRY_TYPES = ('POINT', 'LINESTRING', 'POLYGON', 'MULTIPOINT', 'MULTILINESTRING', 'MULTIPOLYGON',
+                  'GEOMETRYCOLLECTION')
+WKT_PATTERN = re.compile(r'^\s*(SRID=\d+;)?\s*(' + '|'.join(GEOMETRY_TYPES) + r')\b', re.IGNORECASE)
+HEX_WKB_PATTERN = re.compile(r'^(00|01)[0-9A-Fa-f]{16,}$')
+#Geometry literals of the plans: long hex strings, and the WKT
+PLAN_HEX_PATTERN = re.compile(r"'[0-9A-Fa-f]{32,}'")
+PLAN_WKT_PATTERN = re.compile(r"'(SRID=\d+;)?(" + '|'.join(GEOMETRY_TYPES) + r")[^']*'", re.IGNORECASE)
+EXPLAIN_SAVEPOINT = 'slow_query_explain'
+#Tables with credentials: the strings of their queries are never kept (passwords, session keys, token digests)
+REDACTED_TABLES = ('auth_', 'django_session', 'knox_')
+REDACTED_TABLES_PATTERN = re.compile(r'\b(' + '|'.join(REDACTED_TABLES) + r')', re.IGNORECASE)
+
+def redact_geometry(geom, size: int)->dict:
+    if geom.empty:
+        return {'geometry': geom.geom_type, 'size': size, 'srid': geom.srid, 'bbox': None}
+    return {'geometry': geom.geom_type, 'size': size, 'srid': geom.srid, 'points': geom.num_coords,
+            'bbox': [round(v, 6) for v in geom.extent]}
+
+def redact_param(value):
+    """The value, or, if it is a geometry, its type, size in bytes and bbox"""
+    try:
+        if isinstance(value, GEOSGeometry):
+            return redact_geometry(value, len(value.wkb))
+        ewkb=getattr(value, 'ewkb', None)#the PostGISAdapter of the lookups
+        if ewkb is not None:
+            return redact_geometry(GEOSGeometry(memoryview(ewkb)), len(ewkb))
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return redact_geometry(GEOSGeometry(memoryview(value)), len(value))
+        if isinstance(value, str) and (HEX_WKB_PATTERN.match(value) or WKT_PATTERN.match(value)
+                                       or '"coordinates"' in value):
+            return redact_geometry(GEOSGeometry(value), len(value))
+    except (GEOSException, ValueError, TypeError):
+        return {'geometry': 'unknown', 'size': len(value) if hasattr(value, '__len__') else None}
+    if isinstance(value, str) and len(value) > MAX_PARAM_LENGTH:
+        return value[:MAX_PARAM_LENGTH] + f'... ({len(value)} characters)'
+    if isinstance(value, (list, tuple)):
+        return [redact_param(v) for v in value]
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return str(value)[:MAX_PARAM_LENGTH]
+
+def redact_secret(value):
+    """The numbers, booleans and nulls, and only the length of the rest"""
+    if isinstance(value, (list, tuple)):
+        return [redact_secret(v) for v in value]
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return f'<redacted {len(value) if hasattr(value, "__len__") else len(str(value))} characters>'
+
+def is_secret_query(sql: str)->bool:
+    """True if the query uses a table of REDACTED_TABLES"""
+    return REDACTED_TABLES_PATTERN.search(get_prepared_sql(sql) or sql) is not None
+
+def redact_params(params, many: bool=False, secret: bool=False):
+    """The params with the geometries redacted, or, if secret, all but the numbers"""
+    if params is None:
+        return None
+    redact=redact_secret if secret else redact_param
+    if many:
+        params=list(params)
+        return {'rows': len(params), 'first': redact_params(params[0], secret=secret) if params else None}
+    if isinstance(params, dict):
+        return {k: redact(v) for k, v in params.items()}
+    return [redact(v) for v in params]
+
+def redact_plan(plan: str)->str:
+    plan=PLAN_HEX_PATTERN.sub(lambda m: f"'<geometry {(len(m.group()) - 2)//2} bytes>'", plan)
+    return PLAN_WKT_PATTERN.sub(lambda m: f"'<{m.group(2).upper()} {len(m.group()) - 2} characters>'", plan)
+
+def is_explainable(sql: str)->bool:
+    """
+    Only the SELECT queries are run again by the EXPLAIN ANALYZE, and the EXECUTE of the
+    statements of core.myLib.preparedStatements, that are all SELECT
+    """
+    sql=sql.lstrip().lstrip('(').lstrip()
+    return sql[:6].upper() == 'SELECT' or get_prepared_sql(sql) is not None
+
+def explain(db_connection, sql: str, params, analyze: bool=SLOW_QUERY_EXPLAIN_ANALYZE,
+            timeout_ms: int=SLOW_QUERY_EXPLAIN_TIMEOUT_MS)->str:
+    """
+    Returns the plan of the query, with the cursor of the driver, so the execute
+    wrappers do not see the EXPLAIN. All it does is rolled back
+    """
+    options='ANALYZE, BUFFERS' if analyze else 'COSTS'
+    in_transaction=not db_connection.get_autocommit()
+    with db_connection.connection.cursor() as cursor:
+        cursor.execute(f'SAVEPOINT {EXPLAIN_SAVEPOINT}' if in_transaction else 'BEGIN')
+        try:
+            cursor.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+            cursor.execute(f"EXPLAIN ({options}) {sql}", params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+        finally:
+            if in_transaction:
+                cursor.execute(f'ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT}')
+                cursor.execute(f'RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT}')
+            else:
+                cursor.execute('ROLLBACK')
+
+class SlowQueryRecorder:
+    """
+    Ring buffer of the captured queries. The instance creates the execute wrappers of
+    the requests:
+        with connection.execute_wrapper(slow_query_recorder.get_wrapper(path, sampled)):
+    """
+    def __init__(self, threshold_ms: float=SLOW_QUERY_THRESHOLD_MS, sample_rate: float=SLOW_QUERY_SAMPLE_RATE,
+                 size: int=SLOW_QUERY_BUFFER_SIZE, with_explain: bool=SLOW_QUERY_EXPLAIN,
+                 explain_interval: float=SLOW_QUERY_EXPLAIN_INTERVAL):
+        self.threshold_ms=threshold_ms
+        self.sample_rate=sample_rate
+        self.with_explain=with_explain
+        self.explain_interval=explain_interval
+        self.lock=threading.Lock()
+        self.captures=collections.deque(maxlen=size)
+        self.ids=itertools.count(1)
+        self.last_explain=None
+
+    @property
+    def enabled(self)->bool:
+        return self.captures.maxlen > 0 and (self.threshold_ms > 0 or self.sample_rate > 0)
+
+    def is_sampled(self)->bool:
+        """If all the queries of a new request are captured"""
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def get_wrapper(self, path: str, sampled: bool=False):
+        def wrapper(execute, sql, params, many, context):
+            start=time.perf_counter()
+            result=execute(sql, params, many, context)
+            self.observe(context['connection'], sql, params, many, (time.perf_counter() - start)*1000, path, sampled)
+            return result
+        return wrapper
+
+    def get_observer(self, path: str, sampled: bool=False):
+        """
+        As get_wrapper, for the queries of the async pool (core.myLib.asyncDb.observe_queries).
+        They are captured without plan: the EXPLAIN needs a sync connection
+        """
+        def observer(sql, params, duration):
+            self.observe(None, sql, params, False, duration*1000, path, sampled)
+        return observer
+
+    def observe(self, db_connection, sql: str, params, many: bool, duration_ms: float, path: str, sampled: bool):
+        over_threshold=self.threshold_ms > 0 and duration_ms >= self.threshold_ms
+        if over_threshold or sampled:
+            self.capture(db_connection, sql, params, many, duration_ms, path,
+                         'threshold' if over_threshold else 'sampled')
+
+    def reserve_explain(self)->bool:
+        """True if an EXPLAIN can be run now"""
+        now=time.monotonic()
+        with self.lock:
+            if self.last_explain is not None and now - self.last_explain < self.explain_interval:
+                return False
+            self.last_explain=now
+            return True
+
+    def capture(self, db_connection, sql: str, params, many: bool, duration_ms: float, path: str, reason: str):
+        #the plans have the values of the filters too
+        secret=is_secret_query(sql)
+        record={'time': time.time(), 'request_id': get_current_request_id(), 'path': path,
+                'reason': reason, 'duration_ms': round(duration_ms, 3), 'sql': sql,
+                'prepared_sql': get_prepared_sql(sql), 'params': redact_params(params, many, secret),
+                'plan': None, 'explain_error': None}
+        if (self.with_explain and db_connection is not None and not many and not secret
+                and is_explainable(sql) and self.reserve_explain()):
+            try:
+                record['plan']=redact_plan(explain(db_connection, sql, params))
+            except Exception as e:
+                record['explain_error']=str(e)[:MAX_PARAM_LENGTH]
+        with self.lock:
+            record['id']=next(self.ids)
+            self.captures.append(record)
+
+    def get_captures(self, since_id: int=0, with_plans: bool=True)->list:
+        """The captures with id greater than since_id, the newest first"""
+        with self.lock:
+            captures=[c for c in self.captures if c['id'] > since_id]
+        if not with_plans:
+            captures=[{k: v for k, v in c.items() if k != 'plan'} for c in captures]
+        return captures[::-1]
+
+    def get_capture(self, id: int)->dict:
+        with self.lock:
+            return next((c for c in self.captures if c['id'] == id), None)
+
+    def clear(self):
+        with self.lock:
+            self.captures.clear()
+
+slow_query_recorder=SlowQueryRecorder()
@@ -0,0 +1,138 @@
+import math
+from functools import lru_cache
+
+from django.contrib.gis.db.models.functions import AsGeoJSON, GeomOutputGeoFunc
+from django.contrib.gis.gdal import GDALException, SpatialReference, SRSException
+from django.contrib.gis.geos import GEOSException, Polygon
+
+from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION
+from .geometryEncoders import AsText, OUTPUT_DECIMAL_DIGITS, geom_to_geojson, geom_to_wkt
+
+#Meters per pixel at the zoom 0 of the web mercator tiles of 256 pixels, at the equator
+WEB_MERCATOR_RESOLUTION_Z0 = 156543.03392804097
+MAX_ZOOM = 30
+#Annotations with the encodings of the geometry, computed in the SELECT: annotate_geom_encodings
+ENCODING_ANNOTATIONS = {'geojson': 'geom_as_geojson', 'wkt': 'geom_as_wkt'}
+
+class SimplifyPreserveTopology(GeomOutputGeoFunc):
+    """ST_SimplifyPreserveTopology(geom, tolerance): simplifies without making invalid geometries"""
+    function = 'ST_SimplifyPreserveTopology'
+
+@lru_cache(maxsize=32)
+def is_geographic(srid: int)->bool:
+    """True if the units of the srid are degrees"""
+    return SpatialReference(srid).geographic
+
+def parse_bbox(value: str, srid: int=EPSG_FOR_GEOMETRIES, bbox_srid: int=None)->Polygon:
+    """
+    Returns a Polygon, in srid, from a bbox 'minx,miny,maxx,maxy'.
+    If bbox_srid is given and it is different of srid, the bbox is transformed.
+    Raises ValueError if the bbox or the bbox_srid are not valid
+    """
+    try:
+        minx, miny, maxx, maxy=[float(v) for v in value.split(',')]
+    except (ValueError, AttributeError):
+        raise ValueError(f"Invalid bbox {value}. It must be minx,miny,maxx,maxy")
+    if minx > maxx or miny > maxy:
+        raise ValueError(f"Invalid bbox {value}. The min values must be lower than the max ones")
+    bbox=Polygon.from_bbox((minx, miny, maxx, maxy))
+    try:
+        bbox.srid=int(bbox_srid) if bbox_srid else int(srid)
+    except ValueError:
+        raise ValueError(f"Invalid bbox_srid {bbox_srid}. It must be an EPSG code")
+    if bbox.srid != int(srid):
+        try:
+            bbox.transform(int(srid))
+        except (GDALException, GEOSException, SRSException, ValueError):
+            raise ValueError(f"Invalid bbox_srid {bbox_srid}. The bbox can not be transformed to the EPSG {srid}")
+    return bbox
+
+def tolerance_from_zoom(zoom: float, srid: int=EPSG_FOR_GEOMETRIES)->float:
+    """
+    Returns the size of a pixel of the web mercator zoom, in the units of the srid.
+    Simplifying with this tolerance does not change what is seen at that zoom
+    """
+    if zoom < 0 or zoom > MAX_ZOOM:
+        raise ValueError(f"Invalid zoom {zoom}. It must be between 0 and {MAX_ZOOM}")
+    if is_geographic(int(srid)):
+        return 360/(256*2**zoom)
+    return WEB_MERCATOR_RESOLUTION_Z0/2**zoom
+
+def get_simplify_tolerance(params, srid: int=EPSG_FOR_GEOMETRIES)->float:
+    """
+    Returns the tolerance of the parameters tolerance, or zoom, or None if there are not.
+    Returns None if the tolerance is not greater than the ST_SNAP_PRECISION, as
+    the simplification would not remove anything.
+    """
+    try:
+        if params.get('tolerance') not in (None, ''):
+            tolerance=float(params.get('tolerance'))
+        elif params.get('zoom') not in (None, ''):
+            tolerance=tolerance_from_zoom(float(params.get('zoom')), srid)
+        else:
+            return None
+    except ValueError as e:
+        raise ValueError(f"Invalid tolerance or zoom. {e}")
+    if math.isnan(tolerance) or tolerance <= ST_SNAP_PRECISION:
+        return None
+    return tolerance
+
+def apply_spatial_filters(queryset, params, geom_field: str='geom'):
+    """
+    Applies the parameters of the request to the queryset:
+        - bbox=minx,miny,maxx,maxy (and optionally bbox_srid): only the geometries
+            whose bounding box overlaps the bbox. The operator && uses the spatial index.
+        - zoom=<web mercator zoom> or tolerance=<units of the layer>: the geometries
+            are simplified in the database, preserving the topology, and returned in the
+            annotation geom_out. The points are not simplified.
+    Use output_geom(obj) and output_geom_field(queryset) to get the geometry to return.
+    Raises ValueError if the parameters are not valid
+    """
+    field=queryset.model._meta.get_field(geom_field)
+    if params.get('bbox'):
+        bbox=parse_bbox(params.get('bbox'), field.srid, params.get('bbox_srid'))
+        queryset=queryset.filter(**{f'{geom_field}__bboverlaps': bbox})
+    tolerance=get_simplify_tolerance(params, field.srid)
+    if tolerance is not None and field.geom_type.upper() not in ('POINT', 'MULTIPOINT'):
+        queryset=queryset.annotate(geom_out=SimplifyPreserveTopology(geom_field, tolerance))
+    return queryset
+
+def output_geom_field(queryset, geom_field: str='geom')->str:
+    """Returns the name of the simplified geometry annotation if the queryset has it, or geom_field"""
+    return 'geom_out' if 'geom_out' in queryset.query.annotations else geom_field
+
+def output_geom(obj):
+    """Returns the simplified geometry of the object, if the queryset simplified it, or the geom"""
+    if 'geom_out' in obj.__dict__:
+        return obj.__dict__['geom_out']
+    return obj.geom
+
+def annotate_geom_encodings(queryset, geom_field: str='geom', defer_geom: bool=True,
+                            precision: int=OUTPUT_DECIMAL_DIGITS):
+    """
+    Annotates the GeoJSON and the WKT of the geometry (the simplified one, if
+    apply_spatial_filters simplified it), computed by PostGIS in the same SELECT,
+    with at most precision decimal digits.
+    Get them with geom_encoding(obj, 'geojson' | 'wkt').
+    If defer_geom, the geometry itself is not read, so it is not parsed in Python.
+    Accessing obj.geom would then cost one query per object.
+    """
+    field=output_geom_field(queryset, geom_field)
+    queryset=queryset.annotate(**{ENCODING_ANNOTATIONS['geojson']: AsGeoJSON(field, precision=precision),
+                                  ENCODING_ANNOTATIONS['wkt']: AsText(field, precision)})
+    if defer_geom:
+        queryset=queryset.defer(geom_field)
+    return queryset
+
+def geom_encoding(obj, encoding: str, precision: int=OUTPUT_DECIMAL_DIGITS):
+    """
+    Returns the geometry of the object as 'geojson' or 'wkt'. It uses the annotation of
+    annotate_geom_encodings if the object has it. If not (plain instances, just created or updated),
+    it is encoded with GEOS, with at most precision decimal digits
+    """
+    annotation=ENCODING_ANNOTATIONS[encoding]
+    if annotation in obj.__dict__:
+        return obj.__dict__[annotation]
+    if encoding=='wkt':
+        return geom_to_wkt(output_geom(obj), precision)
+    return geom_to_geojson(output_geom(obj), precision)
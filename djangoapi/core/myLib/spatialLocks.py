@@ -0,0 +1,149 @@
+"""
+PostgreSQL advisory locks over the cells of a grid, to serialize the topology-checked
+writes (check the relation with the other geometries, then write) only when they
+can conflict.
+
+Two geometries whose interiors intersect have intersecting bboxes, so they cover
+at least one common cell: the writes that take the locks of the cells of their bboxes
+are serialized if they can conflict, and run in parallel if they are far away.
+
+The locks:
+    - layer lock, a bigint key per table. The cell writers take it shared, and the
+      writes of the whole layer (the bulk import) take it exclusive.
+    - cell locks, two int keys (table, cell), exclusive. Taken in ascending order,
+      so two writers never wait for each other (deadlock). Take all the cells of a
+      write in one call to lock_geometry_cells.
+All of them are transaction locks (pg_advisory_xact_lock): they are released on commit
+or rollback, so they must be taken inside transaction.atomic(), before the check.
+
+Usage:
+    with transaction.atomic():
+        lock_geometry_cells('buildings_buildings', new_geom, old_geom)
+        ... check the relation with the other geometries, and write
+"""
+
+import math
+import zlib
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.db import connection, transaction
+from django.db.transaction import TransactionManagementError
+
+from djangoapi.settings import ST_SNAP_PRECISION, SPATIAL_LOCK_CELL_SIZE, SPATIAL_LOCK_MAX_CELLS
+from .asyncDb import execute
+
+LOCK_LAYER_SQL = "SELECT pg_advisory_xact_lock(%s::bigint)"
+LOCK_LAYER_SHARED_SQL = "SELECT pg_advisory_xact_lock_shared(%s::bigint)"
+#the function scan of unnest returns the keys in the order of the array
+LOCK_CELLS_SQL = "SELECT count(pg_advisory_xact_lock(%s, k)) FROM unnest(%s::integer[]) AS k"
+
+def to_int32(value: int)->int:
+    """The unsigned 32 bits value as the signed int of PostgreSQL"""
+    return value - 2**32 if value >= 2**31 else value
+
+def get_table_key(table_name: str)->int:
+    return to_int32(zlib.crc32(table_name.encode()))
+
+def get_cell_key(i: int, j: int)->int:
+    """
+    The key of the cell (i, j). Two cells can have the same key: then they are
+    serialized as if they were one, which is safe
+    """
+    return to_int32(zlib.crc32(f'{i}:{j}'.encode()))
+
+def get_extent(geom)->tuple:
+    """The extent of a GEOSGeometry, or of a geometry as WKT, GeoJSON or (hex)WKB"""
+    if isinstance(geom, memoryview):
+        geom=bytes(geom)
+    if not isinstance(geom, GEOSGeometry):
+        geom=GEOSGeometry(geom)
+    if geom.empty:
+        return None
+    return geom.extent
+
+def get_cells(extent: tuple, cell_size: float=SPATIAL_LOCK_CELL_SIZE, margin: float=ST_SNAP_PRECISION)->list:
+    """
+    The cells (i, j) that cover the extent, expanded margin units: the snap can move
+    the geometry up to the snap precision. Returns None if they are more than SPATIAL_LOCK_MAX_CELLS
+    """
+    minx, miny, maxx, maxy=extent
+    i0, i1=math.floor((minx - margin)/cell_size), math.floor((maxx + margin)/cell_size)
+    j0, j1=math.floor((miny - margin)/cell_size), math.floor((maxy + margin)/cell_size)
+    if (i1 - i0 + 1)*(j1 - j0 + 1) > SPATIAL_LOCK_MAX_CELLS:
+        return None
+    return [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+def check_in_transaction():
+    if connection.get_autocommit():
+        raise TransactionManagementError('The spatial locks must be taken inside transaction.atomic()')
+
+def lock_layer(table_name: str):
+    """Exclusive lock of the whole layer. Waits for all the cell writers of the table"""
+    check_in_transaction()
+    with connection.cursor() as cursor:
+        cursor.execute(LOCK_LAYER_SQL, [get_table_key(table_name)])
+
+def get_lock_keys(*geoms, cell_size: float=SPATIAL_LOCK_CELL_SIZE)->list:
+    """
+    The sorted keys of the cells covered by the bboxes of the geometries. The None and empty
+    geometries are ignored. Returns None if they cover more than SPATIAL_LOCK_MAX_CELLS cells
+    """
+    keys=set()
+    for geom in geoms:
+        if geom is None:
+            continue
+        extent=get_extent(geom)
+        if extent is None:
+            continue
+        cells=get_cells(extent, cell_size)
+        if cells is None:
+            return None
+        keys.update(get_cell_key(i, j) for i, j in cells)
+    return sorted(keys)
+
+def lock_geometry_cells(table_name: str, *geoms, cell_size: float=SPATIAL_LOCK_CELL_SIZE)->list:
+    """
+    Takes the locks of the cells covered by the bboxes of the geometries, until the end
+    of the transaction. The None and empty geometries are ignored. If the geometries cover
+    more than SPATIAL_LOCK_MAX_CELLS cells, the whole layer is locked.
+    Returns the sorted list of the locked cell keys, or None if the layer was locked
+    """
+    check_in_transaction()
+    keys=get_lock_keys(*geoms, cell_size=cell_size)
+    if keys is None:
+        lock_layer(table_name)
+        return None
+    table_key=get_table_key(table_name)
+    with connection.cursor() as cursor:
+        cursor.execute(LOCK_LAYER_SHARED_SQL, [table_key])
+        cursor.execute(LOCK_CELLS_SQL, [table_key, keys])
+    return keys
+
+async def alock_geometry_cells(conn, table_name: str, *geoms, cell_size: float=SPATIAL_LOCK_CELL_SIZE)->list:
+    """
+    As lock_geometry_cells, in the transaction of the psycopg AsyncConnection conn
+    (core.myLib.asyncDb). Use it inside: async with conn.transaction()
+    """
+    table_key=get_table_key(table_name)
+    keys=get_lock_keys(*geoms, cell_size=cell_size)
+    if keys is None:
+        await execute(conn, LOCK_LAYER_SQL, [table_key])
+        return None
+    await execute(conn, LOCK_LAYER_SHARED_SQL, [table_key])
+    await execute(conn, LOCK_CELLS_SQL, [table_key, keys])
+    return keys
+
+class AtomicWriteViewSetMixin:
+    """
+    Mixin for the ModelViewSets whose serializer checks the geometry against the other
+    ones of the layer (GeoModelSerializer). The create and update run in one transaction,
+    so the spatial locks taken by the validation of the serializer are kept until the write commits.
+    """
+    def create(self, request, *args, **kwargs):
+        with transaction.atomic():
+            return super().create(request, *args, **kwargs)
+
+    def update(self, request, *args, **kwargs):
+        #partial_update calls update
+        with transaction.atomic():
+            return super().update(request, *args, **kwargs)
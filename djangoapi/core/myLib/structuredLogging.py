@@ -0,0 +1,170 @@
+"""
+Logging of the project: leveled, lazily formatted, with the request id and sampling
+of the debug messages. It is configured with the LOGGING setting.
+
+The modules get their logger by name, and pass the values as arguments, so nothing is
+formatted if the message is not written:
+    logger=logging.getLogger(__name__)
+    logger.debug('Snapped geometry %s', b.geom)
+The values that are expensive to get (a query, a relate message) are only computed if
+the debug messages of the request are written:
+    if debug_enabled(logger):
+        logger.debug('Relation: %s', v.get_relate_message())
+
+The levels are set by module in LOG_LEVELS. The debug messages are written for a fraction
+LOG_DEBUG_SAMPLE_RATE of the requests, chosen by core.middleware.RequestIdMiddleware: all
+the ones of a sampled request, or none. Out of the requests (commands, shell) all are written.
+
+Each message has the id of its request: the header X-Request-ID of the request, if it has
+a valid one, or a new one. It is sent back in the header X-Request-ID of the response.
+With LOG_FORMAT json each message is a JSON line, with the extra values of the message:
+    logger.info('Bulk import', extra={'features': n})
+    {"time": "...", "level": "INFO", "logger": "buildings.views", "message": "Bulk import", "request_id": "...", "features": 120}
+
+The messages are written to stdout by a thread (BackgroundStreamHandler), so the requests
+do not wait for the writes.
+"""
+
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import threading
+import uuid
+
+NO_REQUEST_ID = '-'
+#The request ids of the clients are accepted if they are short and safe to write in the logs
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+#Attributes of all the LogRecords. The others are the extra values of the message
+RECORD_ATTRIBUTES = frozenset(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message', 'asctime', 'request_id'}
+
+_request_id=contextvars.ContextVar('request_id', default=NO_REQUEST_ID)
+_debug_sampled=contextvars.ContextVar('debug_sampled', default=True)
+
+def get_request_id(header_value: str=None)->str:
+    """The request id of the header, if it is valid, or a new one"""
+    if header_value and REQUEST_ID_PATTERN.match(header_value):
+        return header_value
+    return uuid.uuid4().hex
+
+def get_current_request_id()->str:
+    return _request_id.get()
+
+@contextlib.contextmanager
+def request_logging_context(request_id: str, debug_sample_rate: float=1.0):
+    """The messages written inside have the request_id. The debug ones only if the request is sampled"""
+    id_token=_request_id.set(request_id)
+    sampled_token=_debug_sampled.set(debug_sample_rate >= 1 or random.random() < debug_sample_rate)
+    try:
+        yield
+    finally:
+        _request_id.reset(id_token)
+        _debug_sampled.reset(sampled_token)
+
+def debug_enabled(logger: logging.Logger)->bool:
+    """True if the debug messages of the logger are written in the current request"""
+    return logger.isEnabledFor(logging.DEBUG) and _debug_sampled.get()
+
+class RequestIdFilter(logging.Filter):
+    """Adds the request_id to the records"""
+    def filter(self, record):
+        record.request_id=_request_id.get()
+        return True
+
+class DebugSamplingFilter(logging.Filter):
+    """Drops the debug records of the requests that are not sampled. It runs before the formatting"""
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or _debug_sampled.get()
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the extra values of the record"""
+    def format(self, record):
+        data={'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+              'message': record.getMessage(), 'request_id': getattr(record, 'request_id', NO_REQUEST_ID)}
+        data.update((k, v) for k, v in record.__dict__.items() if k not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            data['exception']=self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+class BackgroundStreamHandler(logging.Handler):
+    """
+    Formats the records in the thread of the request, and writes them to the stream
+    in a background thread. The queue is unbounded: the requests never wait for the writes.
+    The thread is started in the process where the logging is configured:
+    with gunicorn, in each worker, unless --preload
+    """
+    def __init__(self, stream=None):
+        super().__init__()
+        self.stream=stream if stream is not None else sys.stdout
+        self.lines=queue.SimpleQueue()
+        self.thread=threading.Thread(target=self.write_lines, name='logging', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def emit(self, record):
+        try:
+            self.lines.put(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+    def write_lines(self):
+        while True:
+            line=self.lines.get()
+            if line is None:
+                return
+            try:
+                self.stream.write(line)
+                self.stream.flush()
+            except Exception:
+                pass
+
+    def close(self):
+        """Writes the lines in the queue before returning"""
+        if self.thread.is_alive():
+            self.lines.put(None)
+            self.thread.join()
+        super().close()
+
+def parse_levels(text: str)->dict:
+    """
+    Parses the levels by module of LOG_LEVELS: 'core.myLib.geometryTools=DEBUG,buildings=WARNING'.
+    Raises ValueError if a level is not valid
+    """
+    levels={}
+    for item in filter(None, (i.strip() for i in text.split(','))):
+        name, _, level=item.partition('=')
+        level=level.strip().upper()
+        if not name.strip() or not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Invalid level {item} in LOG_LEVELS. The format is module=LEVEL,module=LEVEL")
+        levels[name.strip()]=level
+    return levels
+
+def get_logging_config(level: str='INFO', levels: dict=None, log_format: str='text', background: bool=True)->dict:
+    """The LOGGING setting: the root level, the levels by module, the format ('text' or 'json') and the handler"""
+    handler={'class': 'core.myLib.structuredLogging.BackgroundStreamHandler'} if background else \
+            {'class': 'logging.StreamHandler', 'stream': 'ext://sys.stdout'}
+    handler.update({'formatter': log_format, 'filters': ['debug_sampling', 'request_id']})
+    #the messages of django go to the root handler, and not also to the console handler of its default logging
+    loggers={'django': {'handlers': [], 'level': 'INFO'}}
+    for name, module_level in (levels or {}).items():
+        loggers.setdefault(name, {})['level']=module_level
+    return {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'filters': {
+            'request_id': {'()': 'core.myLib.structuredLogging.RequestIdFilter'},
+            'debug_sampling': {'()': 'core.myLib.structuredLogging.DebugSamplingFilter'},
+        },
+        'formatters': {
+            'text': {'format': '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'},
+            'json': {'()': 'core.myLib.structuredLogging.JsonFormatter'},
+        },
+        'handlers': {'console': handler},
+        'root': {'handlers': ['console'], 'level': level},
+        'loggers': loggers,
+    }
@@ -0,0 +1,187 @@
+"""
+Vectorized generation of synthetic layers with NumPy, for the load tests
+(manage.py generate_synthetic_dataset).
+
+The features are placed on a jittered grid of square cells: each polygon is a star
+polygon around the center of its cell, moved a bit, and it never leaves its cell,
+so the polygons do not overlap. The vertices are snapped to the ST_SNAP_PRECISION grid,
+as the API does on write. The cells can be clustered: they are chosen with the weights
+of a mixture of gaussians over the grid, instead of uniformly.
+
+The geometries are written as hex EWKB, built for all the features of a batch at once
+with NumPy structured arrays, so the cost per feature is only the slicing of the hex string.
+All is reproducible from the seed of the numpy.random.Generator.
+"""
+
+import math
+
+try:
+    import numpy as np
+except ImportError: #only needed to generate the synthetic datasets: pip install numpy
+    np = None
+
+from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION
+
+WKB_SRID_FLAG = 0x20000000
+WKB_POINT = 1
+WKB_POLYGON = 3
+#Shape of the star polygons, in fractions of the cell size. The center moves at most
+#MAX_JITTER and the vertices are at most MAX_RADIUS from it, so the polygon is inside
+#the cell with a margin bigger than the snap
+MAX_RADIUS = 0.4
+MIN_RADIUS_RATIO = 0.5
+MAX_JITTER = 0.04
+#The angles of the vertices move at most this fraction of half the angle between two of them,
+#so they are still in order and the polygon is simple
+ANGLE_NOISE = 0.3
+
+def check_numpy():
+    if np is None:
+        raise ImportError("The synthetic datasets need numpy: pip install numpy")
+
+def snap(values, size: float=ST_SNAP_PRECISION):
+    """Rounds to the grid as ST_SnapToGrid: rint(v/size)*size. rint rounds half to even, as numpy.round"""
+    return np.round(values/size)*size
+
+def min_vertex_distance(cell_size: float, max_vertices: int)->float:
+    """The minimum distance between two consecutive vertices of the star polygons"""
+    min_angle=2*math.pi/max_vertices*(1 - ANGLE_NOISE)
+    return 2*MIN_RADIUS_RATIO*MAX_RADIUS*cell_size*math.sin(min_angle/2)
+
+def check_polygon_shape(cell_size: float, max_vertices: int, snap_size: float=ST_SNAP_PRECISION):
+    """
+    Raises ValueError if the vertices can be so close that the snap could make the
+    polygons invalid
+    """
+    if min_vertex_distance(cell_size, max_vertices) < 4*snap_size:
+        raise ValueError(f"The cells of {cell_size} units are too small for polygons of {max_vertices} vertices "
+                         f"with the snap {snap_size}. Use bigger cells or less vertices")
+
+class JitteredGrid:
+    """
+    Grid of columns x rows square cells of cell_size, with the lower left corner in origin.
+    The cells are numbered by rows: cell = row*columns + column
+    """
+    def __init__(self, n_cells: int, cell_size: float, origin: tuple=(0, 0)):
+        self.columns=max(1, math.ceil(math.sqrt(n_cells)))
+        self.rows=max(1, math.ceil(n_cells/self.columns))
+        self.cell_size=cell_size
+        self.origin=origin
+
+    @property
+    def n_cells(self)->int:
+        return self.columns*self.rows
+
+    def get_weights(self, rng, clusters: int=0, clustering: float=0, spread: float=50):
+        """
+        Returns the weight of each cell: (1 - clustering) + clustering*mixture, where
+        mixture is the sum of clusters gaussians of sigma spread cells, with random centers,
+        normalized to 1 at its maximum. Returns None if the weights are uniform
+        """
+        if clusters <= 0 or clustering <= 0:
+            return None
+        cells=np.arange(self.n_cells)
+        i=(cells % self.columns).astype(np.float64)
+        j=(cells // self.columns).astype(np.float64)
+        centers_i=rng.uniform(0, self.columns, clusters)
+        centers_j=rng.uniform(0, self.rows, clusters)
+        mixture=np.zeros(self.n_cells)
+        for ci, cj in zip(centers_i, centers_j):
+            mixture += np.exp(-((i - ci)**2 + (j - cj)**2)/(2*spread**2))
+        return (1 - clustering) + clustering*mixture/mixture.max()
+
+    def choose_cells(self, rng, n: int, weights=None):
+        """
+        Returns n different cells, sorted, chosen uniformly or with the weights
+        (Efraimidis-Spirakis: the n smallest exponential(1)/weight)
+        """
+        if n > self.n_cells:
+            raise ValueError(f"There are {self.n_cells} cells for {n} features")
+        if n == 0:
+            return np.arange(0)
+        if weights is None:
+            cells=rng.choice(self.n_cells, n, replace=False)
+        else:
+            with np.errstate(divide='ignore'):
+                keys=rng.exponential(size=self.n_cells)/weights
+            cells=np.argpartition(keys, n - 1)[:n] if n < self.n_cells else np.arange(self.n_cells)
+        #sorted, the rows are written close to their neighbours
+        return np.sort(cells)
+
+    def get_centers(self, cells)->tuple:
+        """The x and y of the centers of the cells"""
+        x=self.origin[0] + (cells % self.columns + 0.5)*self.cell_size
+        y=self.origin[1] + (cells // self.columns + 0.5)*self.cell_size
+        return x, y
+
+def star_polygons(rng, x, y, cell_size: float, min_vertices: int, max_vertices: int,
+                  snap_size: float=ST_SNAP_PRECISION):
+    """
+    Yields tuples (indexes, xs, ys) with the polygons centered near x, y that have the same
+    number of vertices: indexes are their positions in x and y, and xs and ys
+    are arrays (polygons, vertices + 1), with the rings closed and snapped
+    """
+    n=len(x)
+    vertices=rng.integers(min_vertices, max_vertices + 1, n)
+    x=x + rng.uniform(-MAX_JITTER, MAX_JITTER, n)*cell_size
+    y=y + rng.uniform(-MAX_JITTER, MAX_JITTER, n)*cell_size
+    for v in np.unique(vertices):
+        indexes=np.nonzero(vertices == v)[0]
+        m=len(indexes)
+        step=2*math.pi/v
+        angles=np.arange(v)*step + rng.uniform(-ANGLE_NOISE, ANGLE_NOISE, (m, v))*step/2
+        angles += rng.uniform(0, 2*math.pi, (m, 1))
+        radii=MAX_RADIUS*cell_size*rng.uniform(MIN_RADIUS_RATIO, 1, (m, v))
+        #counterclockwise shell, closed with the first vertex
+        xs=snap(x[indexes, None] + radii*np.cos(angles), snap_size)
+        ys=snap(y[indexes, None] + radii*np.sin(angles), snap_size)
+        yield indexes, np.hstack([xs, xs[:, :1]]), np.hstack([ys, ys[:, :1]])
+
+def to_hex_list(records)->list:
+    """Splits the structured array in the hex of each record"""
+    size=records.dtype.itemsize*2
+    text=records.tobytes().hex()
+    return [text[k:k + size] for k in range(0, len(text), size)]
+
+def polygons_ewkb_hex(xs, ys, srid: int=EPSG_FOR_GEOMETRIES)->list:
+    """The hex EWKB of the polygons of one ring with the coordinates xs, ys: arrays (polygons, points)"""
+    m, points=xs.shape
+    records=np.zeros(m, dtype=np.dtype([('order', 'u1'), ('type', '<u4'), ('srid', '<u4'), ('rings', '<u4'),
+                                         ('points', '<u4'), ('coords', '<f8', (points, 2))]))
+    records['order']=1 #little endian
+    records['type']=WKB_POLYGON | WKB_SRID_FLAG
+    records['srid']=srid
+    records['rings']=1
+    records['points']=points
+    records['coords'][:, :, 0]=xs
+    records['coords'][:, :, 1]=ys
+    return to_hex_list(records)
+
+def points_ewkb_hex(x, y, srid: int=EPSG_FOR_GEOMETRIES)->list:
+    records=np.zeros(len(x), dtype=np.dtype([('order', 'u1'), ('type', '<u4'), ('srid', '<u4'),
+                                              ('x', '<f8'), ('y', '<f8')]))
+    records['order']=1
+    records['type']=WKB_POINT | WKB_SRID_FLAG
+    records['srid']=srid
+    records['x']=x
+    records['y']=y
+    return to_hex_list(records)
+
+def building_polygons(rng, grid: JitteredGrid, cells, min_vertices: int, max_vertices: int,
+                      srid: int=EPSG_FOR_GEOMETRIES, snap_size: float=ST_SNAP_PRECISION)->list:
+    """The hex EWKB of the star polygons of the cells, in the order of cells"""
+    x, y=grid.get_centers(cells)
+    result=[None]*len(cells)
+    for indexes, xs, ys in star_polygons(rng, x, y, grid.cell_size, min_vertices, max_vertices, snap_size):
+        for k, wkb in zip(indexes, polygons_ewkb_hex(xs, ys, srid)):
+            result[k]=wkb
+    return result
+
+def random_points(rng, grid: JitteredGrid, n: int, weights=None, srid: int=EPSG_FOR_GEOMETRIES,
+                  snap_size: float=ST_SNAP_PRECISION)->list:
+    """The hex EWKB of n snapped points, in random positions of cells chosen with the weights"""
+    p=None if weights is None else weights/weights.sum()
+    cells=np.sort(rng.choice(grid.n_cells, n, p=p))
+    x=grid.origin[0] + (cells % grid.columns + rng.uniform(0, 1, n))*grid.cell_size
+    y=grid.origin[1] + (cells // grid.columns + rng.uniform(0, 1, n))*grid.cell_size
+    return points_ewkb_hex(snap(x, snap_size), snap(y, snap_size), srid)
@@ -0,0 +1,93 @@
+from django.db import connection
+from django.http import HttpResponse, JsonResponse
+from django.views import View
+
+from .layerCache import (ENVELOPE_SEGMENTS, WEB_MERCATOR_HALF_WIDTH, layer_cache, get_layer, get_versioned_key,
+                         tile_extent)
+from .layerVersion import conditional_layer_response
+
+MAX_TILE_ZOOM = 24
+MVT_CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+
+class VectorTileView(View):
+    """
+    DJANGO CLASS BASED VIEW
+
+    Serves the geometries of a model as Mapbox Vector Tiles, built in the database
+    with ST_AsMVT and ST_AsMVTGeom. The tiles are selected with the operator &&,
+    so the spatial index is used: the envelope of the tile, with the buffer, is densified
+    before it is transformed to the srid of the layer, as tile_extent does for the invalidations
+    of the layer cache.
+    The view has no access control: the children add the one of the views of their layer
+    (LoginRequiredMixin).
+    The tiles are kept in the layer cache (core.myLib.layerCache), until a write
+    touches their extent. The tiles have the ETag of the version of the layer
+    (core.myLib.layerVersion): the clients revalidate them with If-None-Match and get a 304.
+
+    To use this view:
+        1. Inherit from this class, and set the model and the attributes of the features:
+            class BuildingsTileView(LoginRequiredMixin, VectorTileView):
+                model = Buildings
+                tile_attributes = ['description', 'area']
+        2. Register the view in the urls.py file:
+            path('tiles/<int:z>/<int:x>/<int:y>.mvt', views.BuildingsTileView.as_view(), name='buildings_tiles'),
+        3. The URL must be like:
+            GET /buildings/tiles/<z>/<x>/<y>.mvt
+    """
+    model = None
+    layer_name = None #name of the layer in the tile. The table name by default
+    tile_attributes = [] #fields of the model added as attributes of the features. The id is always added
+    geom_field = 'geom'
+    extent = 4096 #size of the tile in tile coordinates
+    buffer = 64 #buffer around the tile in tile coordinates, to avoid clipping artifacts
+
+    def get(self, request, z, x, y):
+        if z < 0 or z > MAX_TILE_ZOOM or not (0 <= x < 2**z) or not (0 <= y < 2**z):
+            return JsonResponse({"ok":False, "message": f"Invalid tile {z}/{x}/{y}", "data":[]}, status=400)
+        return conditional_layer_response(request, self.model, lambda: self.get_tile_response(z, x, y))
+
+    def get_tile_response(self, z: int, x: int, y: int):
+        layer=get_layer(self.model)
+        key=get_versioned_key(self.model, f"{z}/{x}/{y}")
+        cached=layer_cache.get(layer, key)
+        if cached is not None:
+            return HttpResponse(cached[0], content_type=cached[1])
+        generation=layer_cache.get_generation(layer)
+        tile=self.get_tile(z, x, y)
+        srid=self.model._meta.get_field(self.geom_field).srid
+        layer_cache.set(layer, key, tile, MVT_CONTENT_TYPE,
+                        tile_extent(z, x, y, srid, self.buffer/self.extent), generation)
+        return HttpResponse(tile, content_type=MVT_CONTENT_TYPE)
+
+    def get_layer_name(self)->str:
+        return self.layer_name or self.model._meta.db_table
+
+    def get_tile_query(self)->str:
+        qn=connection.ops.quote_name
+        meta=self.model._meta
+        geom_column=qn(meta.get_field(self.geom_field).column)
+        attributes=''.join(f", t.{qn(meta.get_field(name).column)} AS {qn(name)}" for name in self.tile_attributes)
+        return f"""WITH bounds AS (
+                        SELECT ST_TileEnvelope(%s, %s, %s) AS geom
+                    ),
+                    mvtgeom AS (
+                        SELECT ST_AsMVTGeom(ST_Transform(t.{geom_column}, 3857), bounds.geom, %s, %s, true) AS geom,
+                               t.{qn(meta.pk.column)} AS id{attributes}
+                        FROM {qn(meta.db_table)} t, bounds
+                        WHERE t.{geom_column} && ST_Transform(ST_Segmentize(ST_Expand(bounds.geom, %s), %s), %s)
+                    )
+                    SELECT ST_AsMVT(mvtgeom.*, %s, %s, 'geom', 'id') FROM mvtgeom
+                """
+
+    def get_tile(self, z: int, x: int, y: int)->bytes:
+        """Returns the tile z/x/y in MVT"""
+        srid=self.model._meta.get_field(self.geom_field).srid
+        #the buffer, in meters
+        tile_width=2*WEB_MERCATOR_HALF_WIDTH/2**z
+        margin=tile_width*self.buffer/self.extent
+        with connection.cursor() as cursor:
+            cursor.execute(self.get_tile_query(), [z, x, y, self.extent, self.buffer, margin,
+                                                   (tile_width + 2*margin)/ENVELOPE_SEGMENTS, srid,
+                                                   self.get_layer_name(), self.extent])
+            row=cursor.fetchone()
+        return bytes(row[0]) if row and row[0] is not None else b''
@@ -1,3 +1,982 @@
-from django.test import TestCase
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+import zlib
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.contrib.gis.geos import GEOSGeometry
+
+from core.middleware import CompressionMiddleware, RequestIdMiddleware, RequestMetricsMiddleware, SlowQueryMiddleware
+from core.myLib.asyncDb import execute
+from core.myLib.benchmarkTools import compare_to_baseline
+from core.myLib.copyTools import IterStream, copy_text_row
+from core.myLib.geojsonStream import GeojsonStreamReader
+from core.myLib.geoStreaming import geojson_streaming_response, iter_feature_collection, iter_ndjson
+from core.myLib.keysetPagination import encode_cursor, get_spatial_sort_sql, keyset_page
+from core.myLib.geometryEncoders import AsText, geom_to_geojson, geom_to_wkt, get_output_precision
+from core.management.commands import ensure_spatial_indexes
+from core.myLib.geometryTools import (WkbConversor, GeometryValidation, GeometryChecks, matrix_implies_intersection,
+                                      snap_decimal_digits)
+from core.myLib.layerCache import LayerCache, MemoryLRUBackend, FileLRUBackend, ANY_EXTENT, tile_extent
+from core.myLib.objectCache import ObjectCache, MemoryTTLBackend, FileTTLBackend
+from core.myLib.syntheticData import np, JitteredGrid, building_polygons
+from core.myLib.preparedStatements import execute_prepared, get_prepared_sql, get_statement_name, to_positional
+from core.myLib.requestMetrics import RequestMetrics, RequestTimings, measure_request, timed_phase, request_metrics
+from core.myLib.slowQueries import SlowQueryRecorder, explain, redact_param, redact_plan
+from core.myLib.spatialFilters import (apply_spatial_filters, get_simplify_tolerance, output_geom, output_geom_field,
+                                     parse_bbox, tolerance_from_zoom)
+from core.myLib.structuredLogging import (DebugSamplingFilter, JsonFormatter, RequestIdFilter, debug_enabled,
+                                          get_current_request_id, parse_levels, request_logging_context)
+from core.views import PrometheusMetrics, is_allowed_address
+from buildings.models import Buildings, Owners
+from djangoapi.settings import ST_SNAP_PRECISION
+from flowers.models import Flower
+
+#Geometries used to compare the engines of the WkbConversor. They include
+#coordinates out of the grid, negative ones, repeated points after the snap,
+#holes that collapse and collections
+PARITY_GEOMETRIES = [
+    'POINT(751834.41234 4303759.86987)',
+    'POINT(-0.00004 -12.34565)',
+    'LINESTRING(0 0, 10.00004 0.00001, 10.00001 0.00004, 20.123456 5.654321)',
+    'POLYGON((0 0, 10 0, 10 10, 0 11, 0 0))',
+    'POLYGON((0.000049 0.000051, 10.123449 0.000049, 10.123451 10.987651, 0.000051 11.000049, 0.000049 0.000051))',
+    'POLYGON((0 0, 100 0, 100 100, 0 100, 0 0),(10 10, 10.00001 10, 10.00001 10.00001, 10 10))',
+    'POLYGON((0 0, 100 0, 100 100, 0 100, 0 0),(10 10, 20 10, 20 20, 10 20, 10 10))',
+    'MULTIPOLYGON(((0 0, 1 0, 1 1, 0 0)),((5.55555 5.55555, 6.66666 5.55555, 6.66666 6.66666, 5.55555 5.55555)))',
+    'MULTIPOINT((1.11111 2.22222),(3.33333 4.44444))',
+    'GEOMETRYCOLLECTION(POINT(1.23456 6.54321),LINESTRING(0 0, 1.00001 1.00001))',
+    '{"type": "Polygon", "coordinates": [[[0, 0], [10.00006, 0], [10.00006, 10.00006], [0, 10.00006], [0, 0]]]}',
+    '{"type": "Point", "coordinates": [751834.412345, 4303759.869876]}',
+]
+
+class WkbConversorEngineParityTest(TestCase):
+    """
+    The 'geos' engine of the WkbConversor must give the same WKB
+    that the 'postgis' engine, byte by byte
+    """
+
+    def test_wkb_is_identical(self):
+        for geom_text in PARITY_GEOMETRIES:
+            with self.subTest(geom_text=geom_text):
+                postgis_wkb=WkbConversor(engine='postgis').set_wkt_from_text(geom_text)
+                geos_wkb=WkbConversor(engine='geos').set_wkt_from_text(geom_text)
+                self.assertEqual(postgis_wkb.upper(), geos_wkb)
+
+    def test_wkb_is_identical_with_other_precision(self):
+        for geom_text in PARITY_GEOMETRIES:
+            with self.subTest(geom_text=geom_text):
+                postgis_wkb=WkbConversor(st_snap_precision=0.5, engine='postgis').set_wkt_from_text(geom_text)
+                geos_wkb=WkbConversor(st_snap_precision=0.5, engine='geos').set_wkt_from_text(geom_text)
+                self.assertEqual(postgis_wkb.upper(), geos_wkb)
+
+    def test_encodings_are_equivalent(self):
+        for geom_text in PARITY_GEOMETRIES:
+            with self.subTest(geom_text=geom_text):
+                postgis=WkbConversor(engine='postgis')
+                postgis.set_wkt_from_text(geom_text)
+                geos=WkbConversor(engine='geos')
+                geos.set_wkt_from_text(geom_text)
+                self.assertTrue(GEOSGeometry(postgis.get_as_wkt()).equals_exact(GEOSGeometry(geos.get_as_wkt()), 1e-9))
+                self.assertTrue(GEOSGeometry(postgis.get_as_geojson()).equals_exact(GEOSGeometry(geos.get_as_geojson()), 1e-9))
+
+    def test_geos_engine_does_not_query_the_database(self):
+        with self.assertNumQueries(0):
+            c=WkbConversor(engine='geos')
+            c.set_wkt_from_text(PARITY_GEOMETRIES[4])
+            c.get_as_wkt()
+            c.get_as_geojson()
+
+    def test_engine_per_call(self):
+        c=WkbConversor(engine='postgis')
+        with self.assertNumQueries(0):
+            c.set_wkt_from_text(PARITY_GEOMETRIES[0], engine='geos')
+        with self.assertNumQueries(1):
+            c.get_as_wkt()
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            WkbConversor(engine='shapely')
+
+
+class GeometryValidationTest(TestCase):
+    """
+    GeometryValidation must do all the work in only one query
+    """
+    def setUp(self):
+        self.building=Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=Buildings.geom.field.srid))
+
+    def test_one_query_per_validation(self):
+        with self.assertNumQueries(1):
+            v=GeometryValidation().validate('POLYGON((5 5, 15 5, 15 15, 5 15, 5 5))', 'buildings_buildings', 'T********',
+                                            with_wkt=True, with_geojson=True)
+        self.assertTrue(v.is_valid)
+        self.assertEqual(v.related_ids, [(self.building.id,)])
+        self.assertIsNotNone(v.wkt)
+        self.assertIsNotNone(v.geojson)
+
+    def test_same_wkb_than_wkb_conversor(self):
+        geom_text='POLYGON((20.00004 20, 30.00006 20, 30 30, 20 30, 20.00004 20))'
+        v=GeometryValidation().validate(geom_text)
+        self.assertEqual(v.wkb, WkbConversor(engine='postgis').set_wkt_from_text(geom_text))
+        self.assertIsNone(v.related_ids)
+        self.assertIsNone(v.wkt)
+
+    def test_id_to_avoid(self):
+        v=GeometryValidation().validate('POLYGON((5 5, 15 5, 15 15, 5 15, 5 5))', 'buildings_buildings', 'T********',
+                                        id_to_avoid=self.building.id)
+        self.assertFalse(v.are_there_related_ids())
+
+    def test_invalid_geometry(self):
+        with self.assertNumQueries(1):
+            v=GeometryValidation().validate('POLYGON((0 0, 10 10, 10 0, 0 10, 0 0))', 'buildings_buildings', 'T********')
+        self.assertFalse(v.is_valid)
+        self.assertIn('Self-intersection', v.valid_reason)
+        self.assertEqual(v.related_ids, [])
+
+
+class GeometryChecksBatchTest(TestCase):
+    def setUp(self):
+        self.building=Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=Buildings.geom.field.srid))
+
+    def get_wkb(self, wkt):
+        return WkbConversor(engine='geos').set_wkt_from_text(wkt)
+
+    def test_batch_is_one_query(self):
+        wkbs=[
+            self.get_wkb('POLYGON((5 5, 15 5, 15 15, 5 15, 5 5))'),      #intersects the building and the next one
+            self.get_wkb('POLYGON((12 12, 20 12, 20 20, 12 20, 12 12))'),#intersects the previous one
+            self.get_wkb('POLYGON((0 0, 10 10, 10 0, 0 10, 0 0))'),      #invalid
+            self.get_wkb('POLYGON((50 50, 60 50, 60 60, 50 60, 50 50))'),#ok
+        ]
+        with self.assertNumQueries(1):
+            result=GeometryChecks.check_batch(wkbs, 'buildings_buildings')
+        self.assertEqual([r['index'] for r in result], [0, 1, 2, 3])
+        self.assertEqual(result[0]['related_ids'], [self.building.id])
+        self.assertEqual(result[0]['conflicting_candidates'], [1])
+        self.assertEqual(result[1]['related_ids'], [])
+        self.assertEqual(result[1]['conflicting_candidates'], [0])
+        self.assertFalse(result[2]['is_valid'])
+        self.assertIsNotNone(result[2]['valid_reason'])
+        self.assertTrue(result[3]['is_valid'])
+        self.assertEqual(result[3]['related_ids'], [])
+        self.assertEqual(result[3]['conflicting_candidates'], [])
+
+    def test_batch_ids_to_avoid(self):
+        wkbs=[self.get_wkb('POLYGON((0 0, 11 0, 11 11, 0 11, 0 0))')]
+        result=GeometryChecks.check_batch(wkbs, 'buildings_buildings', ids_to_avoid=[self.building.id])
+        self.assertEqual(result[0]['related_ids'], [])
+
+    def test_batch_empty(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(GeometryChecks.check_batch([], 'buildings_buildings'), [])
+
+
+class BboxPrefilterTest(TestCase):
+    def setUp(self):
+        srid=Buildings.geom.field.srid
+        self.building=Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=srid))
+        self.far=Buildings.objects.create(geom=GEOSGeometry('POLYGON((50 50, 60 50, 60 60, 50 60, 50 50))', srid=srid))
+
+    def test_matrix_implies_intersection(self):
+        for matrix in ('T********', 't********', '*T*******', '***T*****', '****0****', '212101212'):
+            self.assertTrue(matrix_implies_intersection(matrix), matrix)
+        #disjoint, only the exteriors, and not a matrix
+        for matrix in ('FF*FF****', '**T******', '*****T***', '********T', 'T*****', ''):
+            self.assertFalse(matrix_implies_intersection(matrix), matrix)
+
+    def get_relate_sql(self, matrix: str, use_bbox_prefilter: bool=True)->tuple:
+        """The ids related to a square over the building, and the SQL that has been run"""
+        gc=GeometryChecks(WkbConversor(engine='geos').set_wkt_from_text('POLYGON((5 5, 15 5, 15 15, 5 15, 5 5))'))
+        with CaptureQueriesContext(connection) as queries:
+            ids=gc.check_st_relate('buildings_buildings', matrix, use_bbox_prefilter=use_bbox_prefilter)
+        sql=queries.captured_queries[-1]['sql']
+        return [row[0] for row in ids], get_prepared_sql(sql) or sql
+
+    def test_intersects_uses_the_prefilter(self):
+        ids, sql=self.get_relate_sql('T********')
+        self.assertEqual(ids, [self.building.id])
+        self.assertIn('&&', sql)
+        ids, sql=self.get_relate_sql('T********', use_bbox_prefilter=False)
+        self.assertEqual(ids, [self.building.id])
+        self.assertNotIn('&&', sql)
+
+    def test_disjoint_does_not_use_the_prefilter(self):
+        #with the && the disjoint geometries would never be found
+        ids, sql=self.get_relate_sql('FF*FF****')
+        self.assertEqual(ids, [self.far.id])
+        self.assertNotIn('&&', sql)
+
+
+class SpatialIndexCommandsTest(TransactionTestCase):
+    def setUp(self):
+        srid=Buildings.geom.field.srid
+        for i in range(5):
+            Buildings.objects.create(geom=GEOSGeometry(f'POLYGON(({i*20} 0, {i*20+10} 0, {i*20+10} 10, {i*20} 10, {i*20} 0))', srid=srid))
+
+    def get_index_names(self, table_name: str)->list:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s", [table_name])
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_ensure_spatial_indexes(self):
+        out=io.StringIO()
+        call_command('ensure_spatial_indexes', check=True, stdout=out)
+        self.assertIn('buildings_buildings.geom: GiST index', out.getvalue())
+        try:
+            call_command('ensure_spatial_indexes', spatial_sort=True, stdout=io.StringIO())
+            self.assertIn('buildings_buildings_geom_sortkey', self.get_index_names('buildings_buildings'))
+            #the keyset pagination walks the same rows with the index
+            rows, cursor=keyset_page(Buildings.objects.all(), None, 3, 'spatial')
+            rows += keyset_page(Buildings.objects.all(), cursor, 3)[0]
+            self.assertEqual(sorted(r.id for r in rows), sorted(Buildings.objects.values_list('id', flat=True)))
+        finally:
+            with connection.cursor() as cursor:
+                for table_name, column in ensure_spatial_indexes.Command().get_geometry_columns():
+                    cursor.execute(f'DROP INDEX IF EXISTS "{table_name}_{column}_sortkey"')
+
+    def test_benchmark_st_relate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output=os.path.join(directory, 'relate.json')
+            for matrix in ('T********', 'FF*FF****'):
+                call_command('benchmark_st_relate', matrix=matrix, samples=3, repeat=1, offset=5, output=output)
+                with open(output) as f:
+                    results=json.load(f)
+                self.assertEqual(results['candidates'], 3)
+                self.assertEqual(results['rows'], 5)
+                for key in ('without_prefilter', 'with_prefilter'):
+                    self.assertEqual(results[key]['n'], 3)
+                self.assertNotIn('&&', results['without_prefilter']['plan'])
+                self.assertEqual('&&' in results['with_prefilter']['plan'], matrix == 'T********')
+
+
+class LayerCacheTest(TestCase):
+    def get_caches(self):
+        return [LayerCache(MemoryLRUBackend(max_bytes=100, max_entries=3)),
+                LayerCache(FileLRUBackend(tempfile.mkdtemp(), max_bytes=100, max_entries=3))]
+
+    def test_lru_eviction(self):
+        for cache in self.get_caches():
+            for i in range(3):
+                cache.set('layer', f'k{i}', b'x'*10, 'text/plain', (i, i, i+1, i+1))
+            cache.get('layer', 'k0')#k1 is now the least recently used
+            cache.set('layer', 'k3', b'x'*10, 'text/plain', (3, 3, 4, 4))
+            self.assertIsNone(cache.get('layer', 'k1'))
+            self.assertEqual(cache.get('layer', 'k0'), (b'x'*10, 'text/plain'))
+            self.assertEqual(cache.get_metrics()['evictions'], 1)
+
+    def test_max_bytes(self):
+        for cache in self.get_caches():
+            cache.set('layer', 'big', b'x'*60, 'text/plain', (0, 0, 1, 1))
+            cache.set('layer', 'big2', b'x'*60, 'text/plain', (0, 0, 1, 1))
+            self.assertIsNone(cache.get('layer', 'big'))
+            self.assertIsNotNone(cache.get('layer', 'big2'))
+
+    def test_invalidation_only_removes_the_touched_entries(self):
+        for cache in self.get_caches():
+            cache.set('layer', 'a', b'a', 'text/plain', (0, 0, 10, 10))
+            cache.set('layer', 'b', b'b', 'text/plain', (20, 20, 30, 30))
+            cache.set('other', 'a', b'a', 'text/plain', (0, 0, 10, 10))
+            cache.set('layer', 'any', b'c', 'text/plain', ANY_EXTENT)
+            cache.invalidate_geometries('layer', GEOSGeometry('POLYGON((5 5, 6 5, 6 6, 5 6, 5 5))'))
+            self.assertIsNone(cache.get('layer', 'a'))
+            self.assertIsNone(cache.get('layer', 'any'))
+            self.assertIsNotNone(cache.get('layer', 'b'))
+            self.assertIsNotNone(cache.get('other', 'a'))
+
+    def test_stale_generation_is_not_stored(self):
+        for cache in self.get_caches():
+            generation=cache.get_generation('layer')
+            cache.invalidate('layer', [(0, 0, 1, 1)])
+            cache.set('layer', 'a', b'a', 'text/plain', (0, 0, 1, 1), generation)
+            self.assertIsNone(cache.get('layer', 'a'))
+
+    def test_entries_expire(self):
+        for backend in (MemoryLRUBackend(ttl=60), FileLRUBackend(tempfile.mkdtemp(), ttl=60)):
+            cache=LayerCache(backend)
+            cache.set('layer', 'a', b'a', 'text/plain', (0, 0, 1, 1))
+            self.assertIsNotNone(cache.get('layer', 'a'))
+            with mock.patch('core.myLib.layerCache.time.time', return_value=time.time() + 61):
+                self.assertIsNone(cache.get('layer', 'a'))
+            self.assertIsNone(cache.get('layer', 'a'))
+
+    def test_file_backend_does_not_list_the_directory_on_every_store(self):
+        backend=FileLRUBackend(tempfile.mkdtemp(), max_bytes=100, max_entries=3)
+        with mock.patch.object(backend, 'iter_entries', wraps=backend.iter_entries) as iter_entries:
+            for i in range(10):
+                backend.set('layer', f'k{i}', b'x'*10, 'text/plain', (0, 0, 1, 1))
+        self.assertEqual(iter_entries.call_count, 1)
+        self.assertEqual(backend.get_stats()['entries'], 3)
+        self.assertEqual(len(backend.index), 3)
+        #the entries of other processes are added on the next scan
+        other=FileLRUBackend(backend.directory, max_bytes=100, max_entries=3, rescan_interval=0)
+        other.set('layer', 'other', b'x'*10, 'text/plain', (0, 0, 1, 1))
+        self.assertEqual(other.get_stats()['entries'], 3)
+        self.assertIsNotNone(other.get('layer', 'other'))
+
+    def test_file_backend_invalidation_only_reads_the_unknown_entries(self):
+        backend=FileLRUBackend(tempfile.mkdtemp())
+        for i in range(10):
+            backend.set('layer', f'k{i}', b'x', 'text/plain', (i*10, 0, i*10 + 1, 1))
+        #an entry stored by other process
+        other=FileLRUBackend(backend.directory)
+        other.set('layer', 'other', b'x', 'text/plain', (0, 0, 1, 1))
+        with mock.patch('core.myLib.layerCache.json.load', wraps=json.load) as load:
+            self.assertEqual(backend.invalidate('layer', [(0, 0, 0.5, 0.5)]), 2)
+        self.assertEqual(load.call_count, 1)
+        self.assertIsNone(backend.get('layer', 'k0'))
+        self.assertIsNone(backend.get('layer', 'other'))
+        self.assertIsNotNone(backend.get('layer', 'k1'))
+        with mock.patch('core.myLib.layerCache.json.load', wraps=json.load) as load:
+            self.assertEqual(backend.invalidate('layer', [(15, 0, 35, 1)]), 2)
+        self.assertEqual(load.call_count, 0)
+
+    def test_metrics_only_for_the_staff(self):
+        self.client.force_login(User.objects.create_user('metrics', password='metrics'))
+        for url in ('/core/layer_cache_metrics/', '/core/object_cache_metrics/', '/core/database_metrics/'):
+            self.assertEqual(self.client.get(url).status_code, 403)
+        User.objects.filter(username='metrics').update(is_staff=True)
+        for url in ('/core/layer_cache_metrics/', '/core/object_cache_metrics/', '/core/database_metrics/'):
+            response=self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.json()['ok'])
+
+    def test_tile_extent(self):
+        self.assertEqual(tile_extent(1, 0, 0, 3857), (-20037508.342789244, 0, 0, 20037508.342789244))
+        minx, miny, maxx, maxy=tile_extent(10, 511, 387, 4326)
+        self.assertTrue(-0.36 < minx < maxx < 0.01 and 39.8 < miny < maxy < 40.3)
+
+
+class ObjectCacheTest(TestCase):
+    def get_caches(self, ttl: float=60):
+        return [ObjectCache(MemoryTTLBackend(max_bytes=1000, max_entries=3), ttl),
+                ObjectCache(FileTTLBackend(tempfile.mkdtemp(), max_bytes=1000, max_entries=3), ttl)]
+
+    def test_read_through(self):
+        for cache in self.get_caches():
+            calls=[]
+            build=lambda: calls.append(1) or {'id': 1, 'geom': 'POINT (1 2)'}
+            self.assertEqual(cache.get_or_set(Buildings, 1, 'v', build), {'id': 1, 'geom': 'POINT (1 2)'})
+            self.assertEqual(cache.get_or_set(Buildings, 1, 'v', build), {'id': 1, 'geom': 'POINT (1 2)'})
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(cache.get_metrics()['hit_ratio'], 0.5)
+            #the missing objects are not cached
+            cache.get_or_set(Buildings, 2, 'v', lambda: None)
+            self.assertEqual(cache.get_metrics()['sets'], 1)
+
+    def test_ttl(self):
+        for cache in self.get_caches(ttl=0):
+            cache.get_or_set(Buildings, 1, 'v', lambda: {'id': 1})
+            self.assertEqual(cache.get_or_set(Buildings, 1, 'v', lambda: {'id': 'new'}), {'id': 'new'})
+
+    def test_lru_eviction(self):
+        for cache in self.get_caches():
+            for i in range(3):
+                cache.get_or_set(Buildings, i, 'v', lambda: {'id': i})
+                time.sleep(0.01)#the file backend orders by modification time
+            cache.get_or_set(Buildings, 0, 'v', lambda: None)#0 is now more recent than 1
+            cache.get_or_set(Buildings, 3, 'v', lambda: {'id': 3})
+            self.assertIsNone(cache.get_or_set(Buildings, 1, 'v', lambda: None))
+            self.assertEqual(cache.get_or_set(Buildings, 0, 'v', lambda: None), {'id': 0})
+            self.assertEqual(cache.get_metrics()['evictions'], 1)
+
+    def test_invalidation_removes_all_the_variants(self):
+        for cache in self.get_caches():
+            cache.get_or_set(Buildings, 1, 'a', lambda: {'v': 'a'})
+            cache.get_or_set(Buildings, 1, 'b', lambda: {'v': 'b'})
+            cache.get_or_set(Buildings, 2, 'a', lambda: {'v': 'a'})
+            cache.invalidate(Buildings, 1)
+            self.assertIsNone(cache.get_or_set(Buildings, 1, 'a', lambda: None))
+            self.assertIsNone(cache.get_or_set(Buildings, 1, 'b', lambda: None))
+            self.assertIsNotNone(cache.get_or_set(Buildings, 2, 'a', lambda: None))
+            cache.invalidate_layer(Buildings)
+            self.assertIsNone(cache.get_or_set(Buildings, 2, 'a', lambda: None))
+
+
+class GeometryEncodersTest(TestCase):
+    def test_snap_decimal_digits(self):
+        self.assertEqual(snap_decimal_digits(0.0001), 4)
+        self.assertEqual(snap_decimal_digits(0.25), 2)
+        self.assertEqual(snap_decimal_digits(10), 0)
+
+    def test_get_output_precision(self):
+        self.assertEqual(get_output_precision({}, default=4), 4)
+        self.assertEqual(get_output_precision({'precision': '2'}), 2)
+        for value in ('-1', '16', 'a'):
+            with self.assertRaises(ValueError):
+                get_output_precision({'precision': value})
+
+    def test_python_encoders_match_postgis(self):
+        building=Buildings.objects.create(geom=GEOSGeometry(
+            'POLYGON((751834.1234 4303759.8765, 751844 4303759.8765, 751844 4303769.5, 751834.1234 4303759.8765))',
+            srid=Buildings.geom.field.srid))
+        for precision in (0, 2, 4):
+            row=Buildings.objects.filter(id=building.id).annotate(wkt=AsText('geom', precision)).values_list('wkt', flat=True)
+            self.assertEqual(GEOSGeometry(geom_to_wkt(building.geom, precision)), GEOSGeometry(row[0]))
+        self.assertEqual(geom_to_wkt(building.geom, 4).count('751834.1234'), 2)
+        self.assertNotIn('751834.12340', geom_to_wkt(building.geom, 4))
+        self.assertIn('[751844, 4303759.8765]', geom_to_geojson(building.geom, 4))
+
+
+class CompressionMiddlewareTest(TestCase):
+    def get_response(self, response, accept_encoding='gzip'):
+        request=RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        return CompressionMiddleware(lambda r: response, min_size=100)(request)
+
+    def test_small_responses_are_not_compressed(self):
+        response=self.get_response(HttpResponse(b'x'*50))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        response=self.get_response(StreamingHttpResponse([b'x'*20, b'x'*20]))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(response.streaming_content), b'x'*40)
+
+    def test_response_is_compressed(self):
+        content=b'{"type": "Feature", "geometry": null}'*100
+        response=self.get_response(HttpResponse(content, content_type='application/json'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(zlib.decompress(response.content, 31), content)
+
+    def test_streaming_response_is_compressed_incrementally(self):
+        consumed=[]
+        def chunks():
+            for i in range(1000):
+                consumed.append(i)
+                yield b'{"type": "Feature", "id": %d}\n' % i * 20
+        response=self.get_response(StreamingHttpResponse(chunks()))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        #only the chunks up to the min_size have been read before sending
+        self.assertEqual(len(consumed), 1)
+        content=zlib.decompress(b''.join(response.streaming_content), 31)
+        self.assertEqual(content, b''.join(b'{"type": "Feature", "id": %d}\n' % i * 20 for i in range(1000)))
+
+    def test_not_accepted(self):
+        response=self.get_response(HttpResponse(b'x'*500), accept_encoding='identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+
+class AsyncMiddlewareTest(TestCase):
+    """The async path of the middlewares, used by the ASGI server"""
+    class Connection:
+        """Stands for a psycopg AsyncConnection of the pool"""
+        async def execute(self, sql, params=None):
+            return sql
+
+    async def test_middlewares_are_async_with_an_async_view(self):
+        async def view(request):
+            await execute(self.Connection(), "SELECT 1")
+            return HttpResponse(get_current_request_id())
+        recorder=SlowQueryRecorder(threshold_ms=0, sample_rate=1, size=5, with_explain=True)
+        middleware=RequestIdMiddleware(SlowQueryMiddleware(RequestMetricsMiddleware(view), recorder=recorder),
+                                       debug_sample_rate=1)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response=await middleware(RequestFactory().get('/', HTTP_X_REQUEST_ID='async-1'))
+        self.assertEqual(response['X-Request-ID'], 'async-1')
+        self.assertEqual(response.content, b'async-1')
+        #the queries of the pool are measured and captured, without plan
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+        captures=recorder.get_captures()
+        self.assertEqual([(c['sql'], c['request_id'], c['plan']) for c in captures], [('SELECT 1', 'async-1', None)])
+
+    def test_middlewares_are_sync_with_a_sync_view(self):
+        for middleware_class in (CompressionMiddleware, RequestIdMiddleware, RequestMetricsMiddleware, SlowQueryMiddleware):
+            self.assertFalse(iscoroutinefunction(middleware_class(lambda request: HttpResponse())))
+
+    async def test_async_streaming_response_is_compressed(self):
+        consumed=[]
+        async def chunks():
+            for i in range(1000):
+                consumed.append(i)
+                yield b'{"type": "Feature", "id": %d}\n' % i * 20
+        async def view(request):
+            return StreamingHttpResponse(chunks())
+        response=await CompressionMiddleware(view, min_size=100)(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response.is_async)
+        self.assertEqual(len(consumed), 1)
+        content=zlib.decompress(b''.join([chunk async for chunk in response.streaming_content]), 31)
+        self.assertEqual(content, b''.join(b'{"type": "Feature", "id": %d}\n' % i * 20 for i in range(1000)))
+
+    async def test_small_async_streaming_response_is_not_compressed(self):
+        async def chunks():
+            yield b'x'*20
+            yield b'x'*20
+        async def view(request):
+            return StreamingHttpResponse(chunks())
+        response=await CompressionMiddleware(view, min_size=100)(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), b'x'*40)
+
+
+class RequestMetricsTest(TestCase):
+    def test_queries_and_phases_are_measured(self):
+        with measure_request(connections.all()) as timings:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_sleep(0.01)")
+                with timed_phase('serialize'):
+                    cursor.execute("SELECT 1")
+                    time.sleep(0.005)
+        self.assertEqual(timings.queries, 2)
+        self.assertGreaterEqual(timings.slowest_time, 0.01)
+        self.assertIn('pg_sleep', timings.slowest_sql)
+        #the query inside the phase is not counted in it
+        self.assertGreaterEqual(timings.phases['serialize'], 0.005)
+        self.assertLess(timings.phases['serialize'], timings.db_time + 0.005)
+
+    def test_phase_out_of_a_request(self):
+        with timed_phase('geos'):
+            pass
+
+    def test_server_timing_header(self):
+        request_metrics.reset()
+        def view(request):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return HttpResponse(b'ok')
+        response=RequestMetricsMiddleware(view)(RequestFactory().get('/'))
+        header=response['Server-Timing']
+        for name in ('db', 'db-slowest', 'geos', 'serialize', 'python', 'total'):
+            self.assertIn(f'{name};dur=', header)
+        self.assertIn('desc="1 queries"', header)
+        self.assertIn('djangoapi_requests_total{url_name="",action="",status="2xx"} 1', request_metrics.to_prometheus())
+
+    def test_prometheus_endpoint_only_for_the_staff_and_the_allowed_ips(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        self.client.force_login(User.objects.create_user('prometheus', password='prometheus'))
+        self.assertEqual(self.client.get('/metrics/').status_code, 403)
+        User.objects.filter(username='prometheus').update(is_staff=True)
+        response=self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE djangoapi_requests_total counter', response.content.decode())
+        #the Prometheus server, without login. The test client connects from 127.0.0.1
+        self.client.logout()
+        with mock.patch.object(PrometheusMetrics, 'allowed_ips', ['10.0.0.0/8', '127.0.0.1']):
+            self.assertEqual(self.client.get('/metrics/').status_code, 200)
+            self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='192.168.1.10').status_code, 403)
+        self.assertFalse(is_allowed_address('not an address', ['127.0.0.1']))
+        self.assertFalse(is_allowed_address('127.0.0.1', ['not a network']))
+
+    def test_prometheus_format_and_series_limit(self):
+        metrics=RequestMetrics(max_series=1)
+        timings=RequestTimings()
+        timings.add_query('SELECT 1', 0.002)
+        metrics.add(('buildings_views', 'update', '2xx'), timings, 0.03)
+        metrics.add(('buildings_views', 'insert', '2xx'), timings, 2)
+        text=metrics.to_prometheus()
+        self.assertIn('djangoapi_requests_total{url_name="buildings_views",action="update",status="2xx"} 1', text)
+        self.assertIn('djangoapi_requests_total{url_name="other",action="other",status="2xx"} 1', text)
+        self.assertIn('djangoapi_request_duration_seconds_bucket{url_name="buildings_views",action="update",status="2xx",le="0.05"} 1', text)
+        self.assertIn('djangoapi_request_duration_seconds_bucket{url_name="buildings_views",action="update",status="2xx",le="0.025"} 0', text)
+        self.assertIn('djangoapi_request_queries_total{url_name="buildings_views",action="update",status="2xx"} 1', text)
+
+
+class StructuredLoggingTest(TestCase):
+    def setUp(self):
+        self.stream=io.StringIO()
+        handler=logging.StreamHandler(self.stream)
+        handler.addFilter(DebugSamplingFilter())
+        handler.addFilter(RequestIdFilter())
+        handler.setFormatter(JsonFormatter())
+        self.logger=logging.getLogger('core.tests.structured_logging')
+        self.logger.propagate=False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+
+    def get_lines(self)->list:
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_messages_have_the_request_id_and_extra_values(self):
+        with request_logging_context('abc-123'):
+            self.logger.info('Bulk import %s', 'buildings', extra={'features': 12})
+        line=self.get_lines()[0]
+        self.assertEqual(line['message'], 'Bulk import buildings')
+        self.assertEqual(line['request_id'], 'abc-123')
+        self.assertEqual(line['features'], 12)
+
+    def test_debug_messages_of_requests_not_sampled_are_not_formatted(self):
+        class Expensive:
+            formatted=False
+            def __str__(self):
+                Expensive.formatted=True
+                return 'expensive'
+        with request_logging_context('not-sampled', debug_sample_rate=0):
+            self.assertFalse(debug_enabled(self.logger))
+            self.logger.debug('Value %s', Expensive())
+            self.logger.warning('Written')
+        self.assertFalse(Expensive.formatted)
+        self.assertEqual([line['message'] for line in self.get_lines()], ['Written'])
+
+    def test_request_id_middleware(self):
+        def view(request):
+            return HttpResponse(get_current_request_id())
+        response=RequestIdMiddleware(view, debug_sample_rate=1)(RequestFactory().get('/', HTTP_X_REQUEST_ID='client-id-1'))
+        self.assertEqual(response['X-Request-ID'], 'client-id-1')
+        self.assertEqual(response.content, b'client-id-1')
+        #the unsafe ids are replaced
+        response=RequestIdMiddleware(view, debug_sample_rate=1)(RequestFactory().get('/', HTTP_X_REQUEST_ID='a b\n'))
+        self.assertNotEqual(response['X-Request-ID'], 'a b\n')
+
+    def test_parse_levels(self):
+        self.assertEqual(parse_levels('core.myLib.geometryTools=debug, buildings=WARNING'),
+                         {'core.myLib.geometryTools': 'DEBUG', 'buildings': 'WARNING'})
+        with self.assertRaises(ValueError):
+            parse_levels('buildings=LOUD')
+
+
+class SlowQueriesTest(TestCase):
+    def test_geometries_are_redacted(self):
+        square=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=4326)
+        for value in (square, square.hexewkb.decode(), square.wkt, square.json, memoryview(square.ewkb)):
+            redacted=redact_param(value)
+            self.assertEqual(redacted['geometry'], 'Polygon')
+            self.assertEqual(redacted['bbox'], [0, 0, 10, 10])
+        self.assertEqual(redact_param('T********'), 'T********')
+        self.assertEqual(redact_param(12), 12)
+        plan="Filter: st_relate(geom, '0103000020E61000000100000005000000000000000000'::geometry, 'T********'::text)"
+        self.assertEqual(redact_plan(plan), "Filter: st_relate(geom, '<geometry 23 bytes>'::geometry, 'T********'::text)")
+
+    def test_slow_select_is_captured_with_its_plan(self):
+        recorder=SlowQueryRecorder(threshold_ms=10, sample_rate=0, size=2, with_explain=True, explain_interval=0)
+        with connection.execute_wrapper(recorder.get_wrapper('/test/')), connection.cursor() as cursor:
+            cursor.execute("SELECT pg_sleep(0.02), %s", ['POINT(1 2)'])
+            cursor.execute("SELECT 1")
+        captures=recorder.get_captures()
+        self.assertEqual(len(captures), 1)
+        self.assertEqual(captures[0]['reason'], 'threshold')
+        self.assertEqual(captures[0]['params'][0]['geometry'], 'Point')
+        #without SLOW_QUERY_EXPLAIN_ANALYZE the query is not run again
+        self.assertIn('cost=', captures[0]['plan'])
+        self.assertNotIn('actual time', captures[0]['plan'])
+        #the EXPLAIN is rolled back to its savepoint: the transaction of the test can go on
+        self.assertEqual(Buildings.objects.count(), 0)
+
+    def test_explain_analyze(self):
+        with connection.cursor():
+            plan=explain(connection, "SELECT %s::int + 1", [1], analyze=True)
+        self.assertIn('actual time', plan)
+
+    def test_credentials_are_redacted(self):
+        recorder=SlowQueryRecorder(threshold_ms=0, sample_rate=1, size=10, with_explain=True, explain_interval=0)
+        with connection.execute_wrapper(recorder.get_wrapper('/test/', True)), connection.cursor() as cursor:
+            cursor.execute('SELECT session_data FROM "django_session" WHERE session_key = %s AND expire_date > %s',
+                           ['abcdef0123456789', '2020-01-01'])
+            cursor.execute("SELECT count(*) FROM knox_authtoken WHERE token_key = %s", ['12345678'])
+            cursor.execute("SELECT %s, %s", ['visible', 3])
+        session, token, other=recorder.get_captures()[::-1]
+        self.assertEqual(session['params'], ['<redacted 16 characters>', '<redacted 10 characters>'])
+        self.assertEqual(token['params'], ['<redacted 8 characters>'])
+        self.assertIsNone(session['plan'])
+        self.assertEqual(other['params'], ['visible', 3])
+
+    def test_ring_buffer_and_sampling(self):
+        recorder=SlowQueryRecorder(threshold_ms=0, sample_rate=1, size=2, with_explain=False)
+        with connection.execute_wrapper(recorder.get_wrapper('/test/', recorder.is_sampled())), connection.cursor() as cursor:
+            for i in range(3):
+                cursor.execute("SELECT %s", [i])
+        captures=recorder.get_captures()
+        self.assertEqual([c['params'] for c in captures], [[2], [1]])
+        self.assertEqual({c['reason'] for c in captures}, {'sampled'})
+        self.assertEqual(recorder.get_captures(since_id=captures[0]['id']), [])
+
+    def test_only_the_staff_can_see_them(self):
+        self.client.force_login(User.objects.create_user('slow_queries', password='slow_queries'))
+        self.assertEqual(self.client.get('/core/slow_queries/').status_code, 403)
+        User.objects.filter(username='slow_queries').update(is_staff=True)
+        response=self.client.get('/core/slow_queries/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['ok'])
+        response=self.client.get('/core/slow_queries/download/')
+        self.assertIn('attachment', response['Content-Disposition'])
+
+
+class PreparedStatementsTest(TestCase):
+    sql = "SELECT ST_AsText(ST_SnapToGrid(ST_SetSRID(ST_GeomFromText(%s), %s), %s))"
+    types = ['text', 'integer', 'float8']
+
+    def is_prepared(self, name: str)->bool:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_prepared_statements WHERE name = %s", [name])
+            return cursor.fetchone()[0] == 1
+
+    def test_to_positional(self):
+        self.assertEqual(to_positional("SELECT %s, f(%s)"), "SELECT $1, f($2)")
+
+    def test_prepared_after_the_threshold(self):
+        name=get_statement_name(self.sql, self.types)
+        rows=[]
+        for i in range(3):
+            with self.assertNumQueries(1), connection.cursor() as cursor:
+                execute_prepared(cursor, self.sql, [f'POINT({i}.00004 0)', 4326, 0.0001], self.types, threshold=2)
+                rows.append(cursor.fetchone()[0])
+            self.assertEqual(self.is_prepared(name), i >= 1)
+        self.assertEqual(rows, ['POINT(0 0)', 'POINT(1 0)', 'POINT(2 0)'])
+
+    def test_validation_results_are_the_same(self):
+        Buildings.objects.create(geom=GEOSGeometry('POLYGON((0 0, 10 0, 10 10, 0 10, 0 0))', srid=Buildings.geom.field.srid))
+        results=[]
+        for _ in range(3):
+            v=GeometryValidation().validate('POLYGON((5 5, 15 5, 15 15, 5 15, 5 5))', 'buildings_buildings', 'T********',
+                                            with_wkt=True)
+            results.append((v.wkb, v.is_valid, len(v.related_ids), v.wkt))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
+
+class BenchmarkGeometryCrudTest(TestCase):
+    def test_compare_to_baseline(self):
+        baseline={'10': {'operations': {'a': {'p95_ms': 10}, 'b': {'p95_ms': 10}}}}
+        results={'10': {'operations': {'a': {'p95_ms': 11}, 'b': {'p95_ms': 13}, 'c': {'p95_ms': 1}}}}
+        regressions=compare_to_baseline(results, baseline, 'p95_ms', 20)
+        self.assertEqual([r['path'] for r in regressions], ['/10/operations/b'])
+
+    def test_small_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output=os.path.join(directory, 'crud.json')
+            call_command('benchmark_geometry_crud', sizes='30,60', samples=2, memory_samples=1, output=output, stderr=io.StringIO())
+            with open(output) as f:
+                results=json.load(f)
+        self.assertEqual(list(results['sizes']), ['30', '60'])
+        for operation, summary in results['sizes']['60']['operations'].items():
+            self.assertEqual(summary['n'], 2, operation)
+            self.assertEqual(summary['errors'], 0, operation)
+            self.assertGreater(summary['queries_mean'], 0, operation)
+        #the benchmark rows are removed
+        self.assertEqual(Buildings.objects.count(), 0)
+
+
+@skipIf(np is None, 'numpy is not installed')
+class SyntheticDatasetTest(TestCase):
+    def generate(self, seed: int)->list:
+        rng=np.random.default_rng(seed)
+        grid=JitteredGrid(100, 25)
+        cells=grid.choose_cells(rng, 80, grid.get_weights(rng, clusters=2, clustering=0.9, spread=3))
+        return building_polygons(rng, grid, cells, 3, 16)
+
+    def test_polygons_are_valid_snapped_and_disjoint(self):
+        wkbs=self.generate(7)
+        self.assertEqual(wkbs, self.generate(7))
+        geoms=[GEOSGeometry(wkb) for wkb in wkbs]
+        for g in geoms:
+            self.assertTrue(g.valid, g.wkt)
+            self.assertEqual(g.srid, Buildings.geom.field.srid)
+            for x, y in g.coords[0]:
+                self.assertEqual((x, y), (round(x/ST_SNAP_PRECISION)*ST_SNAP_PRECISION, round(y/ST_SNAP_PRECISION)*ST_SNAP_PRECISION))
+        union=geoms[0]
+        for g in geoms[1:]:
+            union=union.union(g)
+        self.assertAlmostEqual(union.area, sum(g.area for g in geoms), places=4)
+
+    def test_command_loads_the_layers(self):
+        call_command('generate_synthetic_dataset', buildings=200, flowers=50, owners=20, seed=3, batch_size=64,
+                     stdout=io.StringIO())
+        self.assertEqual(Buildings.objects.count(), 200)
+        self.assertEqual(Flower.objects.count(), 50)
+        self.assertEqual(Owners.objects.count(), 20)
+        with connection.cursor() as cursor:
+            cursor.execute("""SELECT count(*) FROM buildings_buildings a JOIN buildings_buildings b
+                              ON a.id < b.id AND a.geom && b.geom AND ST_Relate(a.geom, b.geom, 'T********')""")
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute("SELECT bool_and(ST_IsValid(geom)), bool_and(area > 0) FROM buildings_buildings")
+            self.assertEqual(cursor.fetchone(), (True, True))
+        #--replace loads the same dataset again
+        call_command('generate_synthetic_dataset', buildings=200, seed=3, replace=True, stdout=io.StringIO())
+        self.assertEqual(Buildings.objects.count(), 200)
+
+
+class GeojsonStreamReaderTest(TestCase):
+    def read(self, text: str, chunk_size: int=7)->list:
+        return list(GeojsonStreamReader(io.BytesIO(text.encode()), chunk_size=chunk_size))
+
+    def test_feature_collection_read_in_small_chunks(self):
+        features=[{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [i + 0.123456789, -12345.6]},
+                   'properties': {'description': 'casa \u00e1rbol \u20ac'}} for i in range(20)]
+        text=json.dumps({'type': 'FeatureCollection', 'crs': None, 'features': features}, ensure_ascii=False)
+        #the chunks split the numbers and the characters of several bytes
+        for chunk_size in (1, 3, 7, 64*1024):
+            self.assertEqual(self.read(text, chunk_size), features)
+        self.assertEqual(self.read('{"type": "FeatureCollection", "features": []}'), [])
+
+    def test_ndjson_sequences_and_geometries(self):
+        point={'type': 'Point', 'coordinates': [1, 2]}
+        feature={'type': 'Feature', 'geometry': point, 'properties': {}}
+        text=json.dumps(feature) + '\n' + '\x1e' + json.dumps(feature) + '\r\n' + json.dumps(point) + '\n'
+        self.assertEqual(self.read(text), [feature, feature, feature])
+
+    def test_malformed_and_truncated(self):
+        for text in ('[1, 2]', '{"type": "Feature"} x',
+                     '{"type": "FeatureCollection", "features": [{"type": "Feature"} {"type": "Feature"}]}',
+                     '{"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [1,',
+                     '{"type": "FeatureCollection", "features": [{"type": "Feature"}',
+                     '{"type": "Feature", "geometry": null'):
+            with self.assertRaises(ValueError, msg=text):
+                self.read(text)
+
+    def test_features_are_read_one_by_one(self):
+        class Stream(io.BytesIO):
+            reads=0
+            def read(self, size=-1):
+                Stream.reads += 1
+                return super().read(size)
+        text=json.dumps({'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'properties': {'i': i}} for i in range(100)]})
+        reader=iter(GeojsonStreamReader(Stream(text.encode()), chunk_size=64))
+        self.assertEqual(next(reader)['properties'], {'i': 0})
+        self.assertLess(Stream.reads, 5)
+
+
+class CopyToolsTest(TestCase):
+    def test_copy_text_row(self):
+        self.assertEqual(copy_text_row([1, None, 'a\tb\nc\\d\r']), '1\t\\N\ta\\tb\\nc\\\\d\\r\n')
+
+    def test_iter_stream(self):
+        stream=IterStream(iter(['ab', 'cde', '', 'f']))
+        self.assertEqual(stream.read(4), 'abcd')
+        self.assertEqual(stream.read(4), 'ef')
+        self.assertEqual(stream.read(4), '')
+        self.assertEqual(IterStream(['ab', 'c']).read(), 'abc')
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        srid=Buildings.geom.field.srid
+        self.ids=[Buildings.objects.create(description=f'b{i}', geom=GEOSGeometry(
+                      f'POLYGON(({x} {y}, {x+1} {y}, {x+1} {y+1}, {x} {y+1}, {x} {y}))', srid=srid)).id
+                  for i, (x, y) in enumerate([(30, 30), (0, 0), (20, 10), (0, 1), (10, 30)])]
+        #without geometry, and with an empty one: their sort key is ''
+        self.ids.append(Buildings.objects.create(description='null').id)
+        self.ids.append(Buildings.objects.create(description='empty', geom=GEOSGeometry('POLYGON EMPTY', srid=srid)).id)
+
+    def walk(self, order: str, page_size: int=2)->list:
+        ids=[]
+        rows, cursor=keyset_page(Buildings.objects.all(), None, page_size, order)
+        ids += [r.id for r in rows]
+        while cursor is not None:
+            rows, cursor=keyset_page(Buildings.objects.all(), cursor, page_size, order)
+            self.assertLessEqual(len(rows), page_size)
+            ids += [r.id for r in rows]
+        return ids
+
+    def test_walk_by_id(self):
+        self.assertEqual(self.walk('id'), sorted(self.ids))
+
+    def test_walk_spatial_with_null_geometries(self):
+        ids=self.walk('spatial')
+        self.assertEqual(sorted(ids), sorted(self.ids))
+        #the rows without geometry go first, ordered by id, and none is skipped after them
+        self.assertEqual(ids[:2], self.ids[-2:])
+        sort_sql=get_spatial_sort_sql(Buildings.objects.all())
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT id FROM buildings_buildings ORDER BY {sort_sql}, id")
+            self.assertEqual(ids, [row[0] for row in cursor.fetchall()])
+
+    def test_tampered_cursor(self):
+        for cursor in ('not a cursor', encode_cursor({'o': 'spatial', 'id': 1}),
+                       encode_cursor({'o': 'spatial', 'id': 1, 'k': 5}), encode_cursor({'o': 'id', 'id': '1'}),
+                       encode_cursor({'o': 'other', 'id': 1}), encode_cursor([1, 2])):
+            with self.assertRaises(ValueError):
+                keyset_page(Buildings.objects.all(), cursor)
+            response=self.client.get('/buildings/buildings/', {'cursor': cursor})
+            self.assertEqual(response.status_code, 400)
+
+
+class SpatialFiltersTest(TestCase):
+    def test_parse_bbox(self):
+        bbox=parse_bbox('0,1,10,11', 4326)
+        self.assertEqual(bbox.srid, 4326)
+        self.assertEqual(bbox.extent, (0, 1, 10, 11))
+        bbox=parse_bbox('0,0,1113194.9,1118890.0', 4326, '3857')
+        self.assertEqual(bbox.srid, 4326)
+        self.assertAlmostEqual(bbox.extent[2], 10, places=3)
+
+    def test_invalid_bbox(self):
+        for value, bbox_srid in (('0,0,10', None), ('a,0,10,10', None), ('10,0,0,10', None), (None, None),
+                                 ('0,0,10,10', 'abc'), ('0,0,10,10', '4326.5'), ('0,0,10,10', '999999'),
+                                 ('0,0,10,10', '-1')):
+            with self.assertRaises(ValueError):
+                parse_bbox(value, 4326, bbox_srid)
+
+    def test_invalid_bbox_srid_is_a_bad_request(self):
+        for bbox_srid in ('abc', '999999'):
+            response=self.client.get('/buildings/buildings/', {'bbox': '0,0,10,10', 'bbox_srid': bbox_srid})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('bbox_srid', response.json()['detail'])
+
+    def test_tolerance(self):
+        self.assertAlmostEqual(tolerance_from_zoom(0, 3857), 156543.03392804097)
+        self.assertAlmostEqual(tolerance_from_zoom(1, 4326), 360/512)
+        with self.assertRaises(ValueError):
+            tolerance_from_zoom(31, 4326)
+        self.assertIsNone(get_simplify_tolerance({}, 4326))
+        self.assertIsNone(get_simplify_tolerance({'tolerance': ST_SNAP_PRECISION/2}, 4326))
+        self.assertEqual(get_simplify_tolerance({'tolerance': '5', 'zoom': '1'}, 3857), 5)
+        with self.assertRaises(ValueError):
+            get_simplify_tolerance({'zoom': 'a'}, 4326)
+
+    def test_apply_spatial_filters(self):
+        srid=Buildings.geom.field.srid
+        polygon='POLYGON(({x} 0, {x1} 0.01, {x2} 0, {x2} 2, {x} 2, {x} 0))'
+        inside=Buildings.objects.create(geom=GEOSGeometry(polygon.format(x=0, x1=1, x2=2), srid=srid))
+        Buildings.objects.create(geom=GEOSGeometry(polygon.format(x=10, x1=11, x2=12), srid=srid))
+        queryset=apply_spatial_filters(Buildings.objects.all(), {'bbox': '-1,-1,3,3', 'tolerance': '0.5'})
+        self.assertEqual([b.id for b in queryset], [inside.id])
+        self.assertEqual(output_geom_field(queryset), 'geom_out')
+        #the vertex 0.01 out of the line is removed
+        self.assertEqual(output_geom(queryset[0]).num_coords, inside.geom.num_coords - 1)
+        self.assertEqual(output_geom_field(apply_spatial_filters(Buildings.objects.all(), {})), 'geom')
+
+
+class GeoStreamingTest(TestCase):
+    def test_feature_collection_framing(self):
+        features=[json.dumps({'type': 'Feature', 'id': i}) for i in range(5)]
+        for batch in (1, 2, 5, 200):
+            document=json.loads(''.join(iter_feature_collection(iter(features), batch)))
+            self.assertEqual([f['id'] for f in document['features']], list(range(5)))
+        self.assertEqual(json.loads(''.join(iter_feature_collection(iter([])))),
+                         {'type': 'FeatureCollection', 'features': []})
+
+    def test_ndjson_lines(self):
+        features=[json.dumps({'type': 'Feature', 'id': i}) for i in range(5)]
+        text=''.join(iter_ndjson(iter(features), batch=2))
+        self.assertTrue(text.endswith('\n'))
+        self.assertEqual([json.loads(line)['id'] for line in text.splitlines()], list(range(5)))
+        self.assertEqual(''.join(iter_ndjson(iter([]))), '')
+
+    def test_streaming_response(self):
+        srid=Buildings.geom.field.srid
+        square=Buildings.objects.create(description='a "quoted" name', geom=GEOSGeometry('POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))', srid=srid))
+        empty=Buildings.objects.create()
+        queryset=Buildings.objects.order_by('id')
+        response=geojson_streaming_response(queryset, ['description'], 'geojson', chunk_size=1)
+        self.assertEqual(response['Content-Type'], 'application/geo+json')
+        document=json.loads(b''.join(response.streaming_content))
+        self.assertEqual([f['id'] for f in document['features']], [square.id, empty.id])
+        self.assertEqual(document['features'][0]['properties'], {'description': 'a "quoted" name'})
+        self.assertEqual(document['features'][0]['geometry']['type'], 'Polygon')
+        self.assertIsNone(document['features'][1]['geometry'])
+
+        response=geojson_streaming_response(queryset, ['description'], 'ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines=b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [square.id, empty.id])
+
+        response=geojson_streaming_response(Buildings.objects.none(), ['description'], 'geojson')
+        self.assertEqual(json.loads(b''.join(response.streaming_content))['features'], [])
+
+    def test_stream_parameter_of_the_views(self):
+        Flower.objects.create(description='f1', geom=GEOSGeometry('POINT(1 1)', srid=Flower.geom.field.srid))
+        response=self.client.get('/flowers/flowers/selectall/', {'stream': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 1)
+        response=self.client.get('/flowers/flowers/selectall/', {'stream': 'geojson'})
+        self.assertEqual(response['Content-Type'], 'application/geo+json')
+        self.assertEqual(len(json.loads(b''.join(response.streaming_content))['features']), 1)
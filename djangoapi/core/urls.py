@@ -15,6 +15,12 @@ urlpatterns = [
     path('login/', views.LoginView.as_view(),name="login"),
     path('logout/', views.LogoutView.as_view(),name="login"),
     path('isloggedin/', views.IsLoggedIn.as_view(),name="isloggedin"),
+    path('layer_cache_metrics/', views.LayerCacheMetrics.as_view(),name="layer_cache_metrics"),
+    path('object_cache_metrics/', views.ObjectCacheMetrics.as_view(),name="object_cache_metrics"),
+    path('database_metrics/', views.DatabaseMetrics.as_view(),name="database_metrics"),
+    path('slow_queries/', views.SlowQueries.as_view(),name="slow_queries"),
+    path('slow_queries/<int:id>/', views.SlowQueries.as_view(),name="slow_queries"),
+    path('slow_queries/download/', views.SlowQueries.as_view(download=True),name="slow_queries_download"),
 
     # Vistas Knox para API (para Angular)
     path('knox/login/', views.KnoxLoginAPIView.as_view(), name='knox_login'),
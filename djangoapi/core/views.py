@@ -1,10 +1,10 @@
 #Django imports
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.views import View
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.shortcuts import redirect
-import random, time
+import ipaddress, logging, random, time
 
 # Añadir estos imports al inicio del archivo
 from knox.views import LoginView as KnoxLoginView
@@ -17,6 +17,16 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth import login as django_login
 
+from core.myLib.layerCache import layer_cache
+from core.myLib.objectCache import object_cache
+from core.myLib.dbPool import get_pool_metrics
+from core.myLib.preparedStatements import get_prepared_statements_metrics
+from core.myLib.requestMetrics import request_metrics
+from core.myLib.slowQueries import slow_query_recorder
+from djangoapi.settings import METRICS_ALLOWED_IPS
+
+logger=logging.getLogger(__name__)
+
 # Añadir estas nuevas clases/funciones
 class KnoxLoginAPIView(KnoxLoginView):
     permission_classes = []
@@ -78,6 +88,90 @@ def custom_logout_view(request):
 def notLoggedIn(request):
     return JsonResponse({"ok":False,"message": "You are not logged in", "data":[]})
 
+def is_allowed_address(address: str, allowed: list)->bool:
+    """True if the address is one of the allowed addresses or networks: ['10.0.0.5', '172.18.0.0/16']"""
+    try:
+        address=ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    for network in allowed:
+        try:
+            if address in ipaddress.ip_network(network, strict=False):
+                return True
+        except ValueError:
+            continue
+    return False
+
+class StaffRequiredMixin:
+    """
+    The requests of the users that are not staff get a 403, as the metrics show the internals of the server.
+    The addresses of allowed_ips, as the one of the Prometheus server, do not need to log in
+    """
+    allowed_ips = []
+
+    def dispatch(self, request, *args, **kwargs):
+        if not request.user.is_staff and not is_allowed_address(request.META.get('REMOTE_ADDR', ''), self.allowed_ips):
+            return JsonResponse({"ok":False,"message": "Only the staff can see the metrics", "data":[]}, status=403)
+        return super().dispatch(request, *args, **kwargs)
+
+class LayerCacheMetrics(StaffRequiredMixin, View):
+    """Hits, misses, evictions and size of the layer cache of this process. Only for the staff"""
+    def get(self, request):
+        return JsonResponse({"ok":True,"message": "Layer cache metrics", "data":[layer_cache.get_metrics()]})
+
+class ObjectCacheMetrics(StaffRequiredMixin, View):
+    """Hits, misses, evictions and size of the object cache of this process. Only for the staff"""
+    def get(self, request):
+        return JsonResponse({"ok":True,"message": "Object cache metrics", "data":[object_cache.get_metrics()]})
+
+class DatabaseMetrics(StaffRequiredMixin, View):
+    """Size and waits of the connection pool, and the prepared statements, of this process. Only for the staff"""
+    def get(self, request):
+        return JsonResponse({"ok":True,"message": "Database metrics",
+                             "data":[{'pool': get_pool_metrics(), 'prepared_statements': get_prepared_statements_metrics()}]})
+
+class PrometheusMetrics(StaffRequiredMixin, View):
+    """
+    Number of requests, duration, SQL queries, database time, slowest query and
+    time by phase of the requests of this process, by URL name and action, in the
+    Prometheus text format (core.middleware.RequestMetricsMiddleware).
+    Only for the staff and the addresses of METRICS_ALLOWED_IPS
+    """
+    allowed_ips = METRICS_ALLOWED_IPS
+
+    def get(self, request):
+        return HttpResponse(request_metrics.to_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class SlowQueries(View):
+    """
+    The slow queries captured by this process (core.myLib.slowQueries), the newest first.
+    Only for the staff. Without the plans, unless plans=true. With since_id, only the
+    ones captured after that one:
+        GET /core/slow_queries/?since_id=120
+        GET /core/slow_queries/<id>/ --> one capture, with its plan
+        GET /core/slow_queries/download/ --> all, with the plans, as a JSON file
+    """
+    download = False #as_view(download=True): all the captures as a file
+
+    def get(self, request, id=None):
+        if not request.user.is_staff:
+            return JsonResponse({"ok":False,"message": "Only the staff can see the slow queries", "data":[]}, status=403)
+        if id is not None:
+            capture=slow_query_recorder.get_capture(id)
+            if capture is None:
+                return JsonResponse({"ok":False,"message": f"The slow query {id} is not in the buffer", "data":[]}, status=404)
+            return JsonResponse({"ok":True,"message": "Slow query", "data":[capture]})
+        if self.download:
+            response=JsonResponse(slow_query_recorder.get_captures(), safe=False)
+            response['Content-Disposition']='attachment; filename="slow_queries.json"'
+            return response
+        try:
+            since_id=int(request.GET.get('since_id', 0))
+        except ValueError:
+            return JsonResponse({"ok":False,"message": "since_id must be an integer", "data":[]}, status=400)
+        with_plans=request.GET.get('plans', 'false').lower() in ('true', '1')
+        return JsonResponse({"ok":True,"message": "Slow queries", "data": slow_query_recorder.get_captures(since_id, with_plans)})
+
 class HelloWord(View):
     def get(self, request):
         return JsonResponse({"ok":True,"message": "Core. Hello world", "data":[]})
@@ -115,8 +209,7 @@ class LogoutView(LoginRequiredMixin, View):
 
 class IsLoggedIn(View):
     def post(self, request, *args, **kwargs):
-        print(request.user.username)
-        print(request.user.is_authenticated)
+        logger.debug('IsLoggedIn %s: %s', request.user.username, request.user.is_authenticated)
         if request.user.is_authenticated:
             return JsonResponse({"ok":True,"message": "You are authenticated", "data":[{'username':request.user.username}]})
         else:
@@ -11,12 +11,101 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 from pathlib import Path
+import importlib.util
 import os
+
+from core.myLib.structuredLogging import get_logging_config, parse_levels
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 EPSG_FOR_GEOMETRIES=int(os.getenv('EPSG_FOR_GEOMETRIES',4326))
 ST_SNAP_PRECISION=float(os.getenv('ST_SNAP_PRECISION',0.0001))
 MAX_NUMBER_OF_RETRIEVED_ROWS=int(os.getenv('MAX_NUMBER_OF_RETRIEVED_ROWS',1000))
+#Engine used by WkbConversor to parse, snap and encode geometries:
+#   'postgis' -> one query to the database for each operation
+#   'geos' -> done in process with GEOS, without touching the database
+WKB_CONVERSOR_ENGINE=os.getenv('WKB_CONVERSOR_ENGINE','postgis')
+#Cache of the tiles and bbox responses of the geometry layers (core/myLib/layerCache.py):
+#   'file' -> in LAYER_CACHE_DIR, shared by all the workers, so the writes invalidate
+#   the entries of all of them. 'memory' -> in the memory of each process: the writes
+#   only invalidate the cache of the worker that does them, and the other ones serve
+#   the old responses up to LAYER_CACHE_TTL seconds. Only for one worker. 'none' -> disabled.
+#The entries expire after LAYER_CACHE_TTL seconds (0: never)
+LAYER_CACHE_BACKEND=os.getenv('LAYER_CACHE_BACKEND','file')
+LAYER_CACHE_DIR=os.getenv('LAYER_CACHE_DIR',str(BASE_DIR / 'layer_cache'))
+LAYER_CACHE_TTL=float(os.getenv('LAYER_CACHE_TTL',300))
+LAYER_CACHE_MAX_BYTES=int(os.getenv('LAYER_CACHE_MAX_BYTES',64*1024*1024))
+LAYER_CACHE_MAX_ENTRIES=int(os.getenv('LAYER_CACHE_MAX_ENTRIES',10000))
+#Read-through cache of the serialized features of selectone and retrieve (core/myLib/objectCache.py):
+#   'memory', 'file' (in OBJECT_CACHE_DIR, shared by all the workers) or 'none'.
+#   The entries expire after OBJECT_CACHE_TTL seconds
+OBJECT_CACHE_BACKEND=os.getenv('OBJECT_CACHE_BACKEND','memory')
+OBJECT_CACHE_DIR=os.getenv('OBJECT_CACHE_DIR',str(BASE_DIR / 'object_cache'))
+OBJECT_CACHE_TTL=float(os.getenv('OBJECT_CACHE_TTL',300))
+OBJECT_CACHE_MAX_BYTES=int(os.getenv('OBJECT_CACHE_MAX_BYTES',16*1024*1024))
+OBJECT_CACHE_MAX_ENTRIES=int(os.getenv('OBJECT_CACHE_MAX_ENTRIES',5000))
+#Advisory locks of the topology-checked writes (core/myLib/spatialLocks.py). The writes
+#lock the cells of SPATIAL_LOCK_CELL_SIZE units that cover their bbox. If they cover
+#more than SPATIAL_LOCK_MAX_CELLS cells, the whole layer is locked
+SPATIAL_LOCK_CELL_SIZE=float(os.getenv('SPATIAL_LOCK_CELL_SIZE',500))
+SPATIAL_LOCK_MAX_CELLS=int(os.getenv('SPATIAL_LOCK_MAX_CELLS',256))
+#Connections of the async views (core.myLib.asyncDb), served by uvicorn. Each worker
+#process has its own pool, with at most ASYNC_DB_POOL_MAX_SIZE connections: keep
+#workers*ASYNC_DB_POOL_MAX_SIZE under the max_connections of PostgreSQL
+ASYNC_DB_POOL_MIN_SIZE=int(os.getenv('ASYNC_DB_POOL_MIN_SIZE',1))
+ASYNC_DB_POOL_MAX_SIZE=int(os.getenv('ASYNC_DB_POOL_MAX_SIZE',10))
+#Connections of the sync views. With DB_POOL (it needs psycopg 3 and psycopg-pool, so it is enabled
+#by default if they are installed), each worker process keeps a pool of DB_POOL_MIN_SIZE to
+#DB_POOL_MAX_SIZE connections, and the requests wait at most DB_POOL_TIMEOUT seconds for one.
+#Without the pool, the connections are kept CONN_MAX_AGE seconds (0: one per request).
+#CONN_HEALTH_CHECKS checks the reused connections before giving them to a request
+DB_POOL=os.getenv('DB_POOL', str(importlib.util.find_spec('psycopg_pool') is not None)).lower() in ('true', '1', 't')
+DB_POOL_MIN_SIZE=int(os.getenv('DB_POOL_MIN_SIZE',2))
+DB_POOL_MAX_SIZE=int(os.getenv('DB_POOL_MAX_SIZE',10))
+DB_POOL_TIMEOUT=float(os.getenv('DB_POOL_TIMEOUT',10))
+CONN_MAX_AGE=int(os.getenv('CONN_MAX_AGE',60))
+CONN_HEALTH_CHECKS=os.getenv('CONN_HEALTH_CHECKS','True').lower() in ('true', '1', 't')
+#The fixed geometry queries are prepared in the server (core.myLib.preparedStatements) when they have
+#been run PREPARED_STATEMENTS_THRESHOLD times in the same connection. 0 disables them
+PREPARED_STATEMENTS_THRESHOLD=int(os.getenv('PREPARED_STATEMENTS_THRESHOLD',2))
+#Instrumentation of the requests (core.middleware.RequestMetricsMiddleware): number and time of the
+#SQL queries, GEOS, serialization and python time. They are sent in the Server-Timing header if
+#REQUEST_METRICS_SERVER_TIMING, and aggregated in /metrics/ (Prometheus), by URL name and action.
+#REQUEST_METRICS_MAX_SERIES limits the number of (url name, action, status) series.
+#/metrics/ is only for the staff, and for the addresses or networks of METRICS_ALLOWED_IPS, as the
+#Prometheus server: '10.0.0.5,172.18.0.0/16'. The address is the one of the connection: behind the
+#proxy, it is the address of the proxy, so do not add it
+REQUEST_METRICS_SERVER_TIMING=os.getenv('REQUEST_METRICS_SERVER_TIMING','True').lower() in ('true', '1', 't')
+REQUEST_METRICS_MAX_SERIES=int(os.getenv('REQUEST_METRICS_MAX_SERIES',500))
+METRICS_ALLOWED_IPS=[v.strip() for v in os.getenv('METRICS_ALLOWED_IPS','').split(',') if v.strip()]
+#Logging (core.myLib.structuredLogging). LOG_LEVEL is the level of all the modules, and LOG_LEVELS the
+#ones of some modules: 'core.myLib.geometryTools=DEBUG,buildings=WARNING'. The debug messages are
+#written for a fraction LOG_DEBUG_SAMPLE_RATE (0-1) of the requests. LOG_FORMAT: text or json.
+#With LOG_BACKGROUND the messages are written to stdout by a thread, and the requests do not wait
+LOG_LEVEL=os.getenv('LOG_LEVEL','INFO').upper()
+LOG_LEVELS=parse_levels(os.getenv('LOG_LEVELS',''))
+LOG_DEBUG_SAMPLE_RATE=float(os.getenv('LOG_DEBUG_SAMPLE_RATE',1))
+LOG_FORMAT=os.getenv('LOG_FORMAT','text')
+LOG_BACKGROUND=os.getenv('LOG_BACKGROUND','True').lower() in ('true', '1', 't')
+LOGGING=get_logging_config(LOG_LEVEL, LOG_LEVELS, LOG_FORMAT, LOG_BACKGROUND)
+#Slow query capture (core.myLib.slowQueries): the queries slower than SLOW_QUERY_THRESHOLD_MS (0: none),
+#and all the ones of a fraction SLOW_QUERY_SAMPLE_RATE of the requests, are kept in a ring buffer of
+#SLOW_QUERY_BUFFER_SIZE captures, with the geometries redacted, and all the strings of the queries of the
+#auth, session and knox tables. With SLOW_QUERY_EXPLAIN the SELECTs get the plan of EXPLAIN, at most one
+#each SLOW_QUERY_EXPLAIN_INTERVAL seconds, and stopped after SLOW_QUERY_EXPLAIN_TIMEOUT_MS.
+#SLOW_QUERY_EXPLAIN_ANALYZE runs EXPLAIN (ANALYZE, BUFFERS): the query is run again inside the request
+SLOW_QUERY_THRESHOLD_MS=float(os.getenv('SLOW_QUERY_THRESHOLD_MS',500))
+SLOW_QUERY_SAMPLE_RATE=float(os.getenv('SLOW_QUERY_SAMPLE_RATE',0))
+SLOW_QUERY_BUFFER_SIZE=int(os.getenv('SLOW_QUERY_BUFFER_SIZE',200))
+SLOW_QUERY_EXPLAIN=os.getenv('SLOW_QUERY_EXPLAIN','True').lower() in ('true', '1', 't')
+SLOW_QUERY_EXPLAIN_ANALYZE=os.getenv('SLOW_QUERY_EXPLAIN_ANALYZE','False').lower() in ('true', '1', 't')
+SLOW_QUERY_EXPLAIN_INTERVAL=float(os.getenv('SLOW_QUERY_EXPLAIN_INTERVAL',10))
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS=int(os.getenv('SLOW_QUERY_EXPLAIN_TIMEOUT_MS',5000))
+#Compression of the responses (core.middleware.CompressionMiddleware). The responses smaller than
+#COMPRESSION_MIN_SIZE bytes are not compressed. Gzip levels: 1 (fast) to 9 (small).
+#Brotli qualities: 0 (fast) to 11 (small). Brotli is used only if the package brotli is installed
+COMPRESSION_MIN_SIZE=int(os.getenv('COMPRESSION_MIN_SIZE',1024))
+COMPRESSION_GZIP_LEVEL=int(os.getenv('COMPRESSION_GZIP_LEVEL',6))
+COMPRESSION_BROTLI_QUALITY=int(os.getenv('COMPRESSION_BROTLI_QUALITY',4))
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.0/howto/deployment/checklist/
@@ -59,8 +148,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.RequestIdMiddleware',
+    'core.middleware.SlowQueryMiddleware',
+    'core.middleware.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'core.middleware.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
 #    'django.middleware.csrf.CsrfViewMiddleware',
@@ -113,9 +206,16 @@ DATABASES = {
         'PORT': os.getenv('POSTGRES_PORT'),
         'OPTIONS': {
             'options': '-c search_path=public',
-        }
+        },
+        'CONN_HEALTH_CHECKS': CONN_HEALTH_CHECKS,
     }
 }
+if DB_POOL:
+    #the pool replaces the persistent connections: CONN_MAX_AGE must be 0
+    DATABASES['default']['OPTIONS']['pool']={'min_size': DB_POOL_MIN_SIZE, 'max_size': DB_POOL_MAX_SIZE,
+                                             'timeout': DB_POOL_TIMEOUT}
+else:
+    DATABASES['default']['CONN_MAX_AGE']=CONN_MAX_AGE
 
 
 # Password validation
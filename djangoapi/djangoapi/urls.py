@@ -23,7 +23,7 @@ from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
-from core.views import custom_logout_view
+from core.views import custom_logout_view, PrometheusMetrics
 
 schema_view = get_schema_view(
    openapi.Info(
@@ -44,6 +44,7 @@ urlpatterns = [
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
 
     path('admin/', admin.site.urls),
+    path('metrics/', PrometheusMetrics.as_view(), name='metrics'),
     path("accounts/logout/", custom_logout_view, name="logout"),
     path("accounts/", include("django.contrib.auth.urls")),
 
@@ -1,3 +1,31 @@
+from django.contrib.gis.geos import GEOSGeometry
 from django.test import TestCase
 
-# Create your tests here.
+from core.myLib.geometryEncoders import geom_to_wkt
+from core.myLib.geometryTools import snap_geos_to_grid
+from djangoapi.settings import ST_SNAP_PRECISION
+from .models import Flower
+
+class FlowerSnapTest(TestCase):
+    """The flowers are snapped on write, as the buildings, so the output precision does not change them"""
+    point = 'POINT(1.00004 2.00006)'
+
+    def setUp(self):
+        self.expected=snap_geos_to_grid(GEOSGeometry(self.point), ST_SNAP_PRECISION)
+
+    def assertSnapped(self, id):
+        geom=Flower.objects.get(id=id).geom
+        self.assertEqual(geom.coords, self.expected.coords)
+
+    def test_insert_and_update_are_snapped(self):
+        response=self.client.post('/flowers/flowers/insert/', {'geom': self.point, 'description': 'f'})
+        id=response.json()['data'][0]['id']
+        self.assertSnapped(id)
+        Flower.objects.filter(id=id).update(geom=GEOSGeometry('POINT(5 5)', srid=Flower.geom.field.srid))
+        response=self.client.post(f'/flowers/flowers/update/{id}/', {'geom': self.point, 'description': 'f'})
+        self.assertEqual(response.json()['data'][0]['geom'], geom_to_wkt(self.expected))
+        self.assertSnapped(id)
+
+    def test_flower2_insert_is_snapped(self):
+        response=self.client.post('/flowers/insert_flower/', {'geom': self.point, 'description': 'f'})
+        self.assertSnapped(response.json()['data'][0]['id'])
@@ -13,4 +13,7 @@ urlpatterns = [
     #get: selectone/id/
     #post: delete/id/, update/id/
     path('flowers/<str:action>/<int:id>/', views.Flower.as_view(), name='buildings_views'),  # POST requests
+
+    #get: tiles/z/x/y.mvt
+    path('tiles/<int:z>/<int:x>/<int:y>.mvt', views.FlowerTileView.as_view(), name='flowers_tiles'),
 ]
\ No newline at end of file
@@ -1,10 +1,29 @@
+import logging
+
 from django.views import View
 from django.http import JsonResponse
 from flowers.models import Flower as FlowerModel
 from django.forms.models import model_to_dict
 from django.contrib.gis.geos import GEOSGeometry
-from djangoapi.settings import EPSG_FOR_GEOMETRIES
+from djangoapi.settings import EPSG_FOR_GEOMETRIES, ST_SNAP_PRECISION
 from core.myLib.baseDjangoView import BaseDjangoView
+from core.myLib.geoBinaryFormats import binary_response
+from core.myLib.geometryEncoders import geom_to_wkt
+from core.myLib.geometryTools import snap_geos_to_grid
+from core.myLib.geoStreaming import geojson_streaming_response
+from core.myLib.layerCache import layer_cache, get_layer
+from core.myLib.objectCache import object_cache
+from core.myLib.vectorTileView import VectorTileView
+
+logger=logging.getLogger(__name__)
+
+def get_snapped_geom(request)->GEOSGeometry:
+    """
+    The geometry of the request snapped to ST_SNAP_PRECISION, as the buildings are stored,
+    so the output with the digits of the grid (core.myLib.geometryEncoders) does not change it
+    """
+    geom=GEOSGeometry(request.POST.get('geom',''), srid=EPSG_FOR_GEOMETRIES)
+    return snap_geos_to_grid(geom, ST_SNAP_PRECISION)
 
 class HelloWord(View):
     def get(self, request):
@@ -20,7 +39,7 @@ class HelloWord(View):
 class Flower2(View):
     def get(self, request):
         id=request.GET.get('id')
-        print(f'id {id}')
+        logger.debug('id %s', id)
 #        f=FlowerModel.objects.get(id=id)
         f=list(FlowerModel.objects.filter(id=id))
 
@@ -28,13 +47,13 @@ class Flower2(View):
             return JsonResponse({"ok":False,"message": f"The flowe {id} does not exist", "data":[]})
         f=f[0]
         d=model_to_dict(f)
-        d['geom']=f.geom.wkt        
+        d['geom']=geom_to_wkt(f.geom)        
         return JsonResponse({"ok":True,"message": "Buildings. Helloworld. By get", "data":[d]})
     
     def post(self, request):
         description=request.POST.get('description')
         health=request.POST.get('health')
-        geom=GEOSGeometry(request.POST.get('geom',''), srid=EPSG_FOR_GEOMETRIES)
+        geom=get_snapped_geom(request)
         age_days=request.POST.get('age_days')
         f=FlowerModel()
         f.age_days=age_days
@@ -42,14 +61,17 @@ class Flower2(View):
         f.heath=health
         f.geom=geom
         f.save()
+        layer_cache.invalidate_on_commit(get_layer(FlowerModel), f.geom)
 
         return JsonResponse({"ok":True,"message": f"Building inserted. if: {f.id}", "data":[{'id':f.id}]})
 
 class Flower(BaseDjangoView):
+    layer_model = FlowerModel #the selectall with bbox is cached, and the selects have ETag
+
     def insert(self, request):
         description=request.POST.get('description')
         health=request.POST.get('health')
-        geom=GEOSGeometry(request.POST.get('geom',''), srid=EPSG_FOR_GEOMETRIES)
+        geom=get_snapped_geom(request)
         age_days=request.POST.get('age_days')
         f=FlowerModel()
         f.age_days=age_days
@@ -57,30 +79,55 @@ class Flower(BaseDjangoView):
         f.heath=health
         f.geom=geom
         f.save()
+        layer_cache.invalidate_on_commit(get_layer(FlowerModel), f.geom)
         return JsonResponse({"ok":True,"message": f"Building inserted. if: {f.id}", "data":[{'id':f.id}]})
 
     def selectone(self, id):
-        print(f'id {id}')
+        logger.debug('id %s', id)
+        #the serialized flower is kept in the object cache
+        d=object_cache.get_or_set(FlowerModel, id, f'selectone|{self.output_precision}', lambda: self.get_flower_dict(id))
+        if d is None:
+            return JsonResponse({"ok":False,"message": f"The flowe {id} does not exist", "data":[]})
+        return JsonResponse({"ok":True,"message": "Buildings. Helloworld. By get", "data":[d]})
+
+    def get_flower_dict(self, id):
 #        f=FlowerModel.objects.get(id=id)
         f=list(FlowerModel.objects.filter(id=id))
 
         if len(f)<1:
-            return JsonResponse({"ok":False,"message": f"The flowe {id} does not exist", "data":[]})
+            return None
         f=f[0]
         d=model_to_dict(f)
-        d['geom']=f.geom.wkt        
-        return JsonResponse({"ok":True,"message": "Buildings. Helloworld. By get", "data":[d]})
+        d['geom']=geom_to_wkt(f.geom, self.output_precision)        
+        return d
             
     def selectall(self):
-        lf=list(FlowerModel.objects.all())
+        try:
+            queryset=self.get_spatial_queryset(FlowerModel.objects.all())
+            binary_format=self.get_binary_format()
+            if binary_format:
+                return binary_response(queryset, ['description', 'heath', 'age_days'], binary_format,
+                                       precision=self.output_precision)
+            stream_format=self.get_stream_format()
+            if stream_format:
+                return geojson_streaming_response(queryset.order_by('id'), ['description', 'heath', 'age_days'], stream_format,
+                                                  precision=self.output_precision)
+            page=self.get_keyset_page(queryset)
+        except ValueError as e:
+            return JsonResponse({"ok":False,"message": str(e), "data":[]}, status=400)
+        if page is None:
+            lf=list(queryset)
+            next_cursor=None
+        else:
+            lf, next_cursor=page
         if len(lf)<1:
             return JsonResponse({"ok":False,"message": f"No flowers still", "data":[]})
         l=[]
         for f in lf:
             d=model_to_dict(f)
-            d['geom']=f.geom.wkt
+            d['geom']=geom_to_wkt(f.geom, self.output_precision)
             l.append(d)     
-        return JsonResponse({"ok":True,"message": f"Flowers retriewed {len(lf)}", "data":l})
+        return JsonResponse({"ok":True,"message": f"Flowers retriewed {len(lf)}", "data":l, "next_cursor": next_cursor})
    
 
 
@@ -91,15 +138,17 @@ class Flower(BaseDjangoView):
         f=f[0]
         description=request.POST.get('description')
         health=request.POST.get('health')
-        geom=GEOSGeometry(request.POST.get('geom',''), srid=EPSG_FOR_GEOMETRIES)
+        geom=get_snapped_geom(request)
         age_days=request.POST.get('age_days')
+        old_geom=f.geom
         f.heath=health
         f.geom=geom
         f.age_days=age_days
         f.description=description
         f.save()
+        layer_cache.invalidate_on_commit(get_layer(FlowerModel), old_geom, f.geom)
         d=model_to_dict(f)
-        d['geom']=f.geom.wkt   
+        d['geom']=geom_to_wkt(f.geom)   
         return JsonResponse({"ok":True,"message": f"The flower {id} updated", "data":[d]})
 
     def delete(self, id):
@@ -108,6 +157,16 @@ class Flower(BaseDjangoView):
             return JsonResponse({"ok":False,"message": f"The flower {id} does not exist", "data":[]})
         f=f[0]
         f.delete()
+        layer_cache.invalidate_on_commit(get_layer(FlowerModel), f.geom)
         return JsonResponse({"ok":True,"message": f"The flower {id} has been deleted", "data":[]})
 
+class FlowerTileView(VectorTileView):
+    """
+    Flowers as Mapbox Vector Tiles:
+        GET /flowers/tiles/<z>/<x>/<y>.mvt
+    """
+    model = FlowerModel
+    layer_name = 'flowers'
+    tile_attributes = ['description', 'heath', 'age_days'] #the id is always added
+
 # Create your views here.